@@ -0,0 +1,239 @@
+"""
+Admission control for /generate: per-route concurrency limits with bounded wait queues,
+and the retry policy used for throttled Bedrock calls
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, Dict, Optional
+
+from shared_state import get_store
+
+if TYPE_CHECKING:
+    from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Defaults per route: the agent routes run several model calls (and tool calls) per request
+DEFAULT_LIMITS = {
+    "general": {"max_concurrency": 16, "max_queue": 32},
+    "asana": {"max_concurrency": 4, "max_queue": 8},
+    "knowledge_base": {"max_concurrency": 8, "max_queue": 16},
+}
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted
+
+    status_code is 429 when the route's wait queue is full (rejected immediately)
+    and 503 when the request waited longer than the queue deadline.
+    """
+
+    def __init__(self, route: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"{route} route overloaded: {reason}")
+        self.route = route
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Ticket:
+    """An admitted request's slot; release() is idempotent"""
+
+    def __init__(self, limiter: "RouteLimiter"):
+        self._limiter = limiter
+        self._start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._limiter._release(time.monotonic() - self._start)
+
+
+class RouteLimiter:
+    """
+    Concurrency limit with a bounded FIFO wait queue and a queue-time deadline
+
+    Freed slots are handed directly to the oldest waiter, so a burst cannot
+    overtake requests that are already queued.
+
+    With a shared store, max_concurrency is the limit for all workers of the
+    host together: slots are taken in the store, and queued requests poll it
+    (waiters of one worker are still served in order; across workers there is
+    no strict FIFO). active is this worker's share.
+    """
+
+    # Seconds between attempts to take a shared slot while queued
+    SHARED_POLL_INTERVAL = 0.01
+
+    def __init__(self, route: str, max_concurrency: int, max_queue: int, queue_timeout: float, shared=None):
+        self.route = route
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.shared = shared
+        self.slot_name = f"admission:{route}"
+        self.active = 0
+        self._waiters: deque = deque()
+        # Moving average of how long a slot is held, used for Retry-After
+        self._service_time = 1.0
+        self.counters = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_deadline": 0}
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to be free for a new request"""
+        backlog = len(self._waiters) + 1
+        return max(1, math.ceil(self._service_time * backlog / self.max_concurrency))
+
+    async def acquire(self) -> Ticket:
+        """
+        Wait for a slot
+
+        Raises:
+            Overloaded: If the queue is full or the queue deadline passes
+        """
+        if self.shared is not None:
+            return await self._acquire_shared()
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.counters["admitted"] += 1
+            return Ticket(self)
+
+        if len(self._waiters) >= self.max_queue:
+            self.counters["rejected_queue_full"] += 1
+            raise Overloaded(self.route, 429, self.retry_after(), "queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.counters["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self._release(None)
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.counters["rejected_deadline"] += 1
+            raise Overloaded(self.route, 503, self.retry_after(), f"queued longer than {self.queue_timeout:g}s")
+        self.counters["admitted"] += 1
+        return Ticket(self)
+
+    async def _acquire_shared(self) -> Ticket:
+        if not self._waiters and self.shared.try_acquire(self.slot_name, self.max_concurrency):
+            self.active += 1
+            self.counters["admitted"] += 1
+            return Ticket(self)
+
+        if len(self._waiters) >= self.max_queue:
+            self.counters["rejected_queue_full"] += 1
+            raise Overloaded(self.route, 429, self.retry_after(), "queue full")
+
+        # Waiters are tokens that keep this worker's order; the oldest one polls the store
+        waiter = object()
+        self._waiters.append(waiter)
+        self.counters["queued"] += 1
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while True:
+                if self._waiters[0] is waiter and self.shared.try_acquire(self.slot_name, self.max_concurrency):
+                    break
+                if time.monotonic() >= deadline:
+                    self.counters["rejected_deadline"] += 1
+                    raise Overloaded(self.route, 503, self.retry_after(),
+                                     f"queued longer than {self.queue_timeout:g}s")
+                await asyncio.sleep(self.SHARED_POLL_INTERVAL)
+        finally:
+            self._waiters.remove(waiter)
+        self.active += 1
+        self.counters["admitted"] += 1
+        return Ticket(self)
+
+    def _release(self, held: Optional[float]):
+        if held is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * held
+        if self.shared is not None:
+            self.shared.release(self.slot_name)
+            self.active -= 1
+            return
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # Hand the slot over without decrementing active
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        shared = {}
+        if self.shared is not None:
+            shared["host_active"] = self.shared.active(self.slot_name)
+        return {
+            "active": self.active,
+            **shared,
+            "queued": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            **self.counters,
+        }
+
+
+class AdmissionController:
+    """Per-route limiters configured from the environment (host-wide when shared state is configured)"""
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, int]]] = None, queue_timeout: Optional[float] = None,
+                 shared=None):
+        queue_timeout = queue_timeout if queue_timeout is not None else float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+        shared = shared if shared is not None else get_store()
+        self.limiters: Dict[str, RouteLimiter] = {}
+        for route, defaults in {**DEFAULT_LIMITS, **(limits or {})}.items():
+            prefix = f"ADMISSION_{route.upper()}"
+            self.limiters[route] = RouteLimiter(
+                route,
+                max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", defaults["max_concurrency"])),
+                max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", defaults["max_queue"])),
+                queue_timeout=queue_timeout,
+                shared=shared,
+            )
+
+    async def admit(self, route: str) -> Optional[Ticket]:
+        """Acquire a slot for a route (routes without a limiter are always admitted)"""
+        limiter = self.limiters.get(route)
+        return await limiter.acquire() if limiter else None
+
+    def stats(self) -> dict:
+        return {route: limiter.stats() for route, limiter in self.limiters.items()}
+
+
+def bedrock_client_config(max_pool_connections: int) -> "Config":
+    """
+    botocore config for Bedrock clients
+
+    Adaptive retry mode retries ThrottlingException with jittered exponential
+    backoff and rate-limits the client while Bedrock keeps throttling.
+    """
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=max_pool_connections,
+        retries={
+            "mode": os.getenv("BEDROCK_RETRY_MODE", "adaptive"),
+            "max_attempts": int(os.getenv("BEDROCK_MAX_ATTEMPTS", "6")),
+        },
+    )
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """True for Bedrock throttling errors that survived the client's retries"""
+    response = getattr(error, "response", None)
+    if not isinstance(response, dict):
+        return False
+    code = response.get("Error", {}).get("Code", "")
+    return code in ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException")
@@ -1,44 +1,157 @@
 """
 Helper module for creating and configuring LangChain agents with Asana MCP tools
 """
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
 from langgraph.prebuilt import create_react_agent
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from typing import List, Any
+from langchain_core.runnables import RunnableLambda
+from typing import Callable, Dict, List, Any, Optional
+import os
+import asyncio
 import logging
 
+import metrics
+from budget import RequestBudget, default_budget, run_agent
+from compaction import CompactingToolNode, ToolOutputCompactor, compaction_enabled, record_request_savings
+from memory import history_trimmer
+
 logger = logging.getLogger(__name__)
 
+def _parse_tool_timeouts(value: str) -> Dict[str, float]:
+    """Parse "tool_name=seconds,..." into a dict"""
+    timeouts = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, seconds = item.partition("=")
+        timeouts[name.strip()] = float(seconds)
+    return timeouts
+
 
-def create_asana_agent(chat_model, tools: List[Any]):
+class ParallelToolNode(CompactingToolNode):
     """
-    Create a ReAct agent specifically configured for Asana operations
-    
-    Args:
-        chat_model: The LLM model to use
-        tools: List of Asana MCP tools
-        
-    Returns:
-        Configured agent for Asana operations
+    ToolNode that bounds the fan-out of one model turn and times out each tool call
+
+    ToolNode already gathers the tool calls of a turn; this limits how many of them
+    run at once so a single turn cannot occupy the whole MCP pool, and turns a slow
+    call into an error ToolMessage instead of stalling the other results. Results
+    keep the order of the model's tool_calls however the calls finish, and are
+    compacted (see compaction) when a compactor is given.
     """
-    
-    # System message for the agent
-    system_message = SystemMessage(content="""あなたはAsanaタスク管理のアシスタントです。
+
+    def __init__(
+        self,
+        tools: List[Any],
+        max_concurrency: Optional[int] = None,
+        timeout: Optional[float] = None,
+        tool_timeouts: Optional[Dict[str, float]] = None,
+        **kwargs
+    ):
+        super().__init__(tools, **kwargs)
+        self.max_concurrency = max_concurrency or int(os.getenv("ASANA_TOOL_MAX_CONCURRENCY", "4"))
+        self.timeout = timeout or float(os.getenv("ASANA_TOOL_TIMEOUT", "30"))
+        self.tool_timeouts = tool_timeouts if tool_timeouts is not None else _parse_tool_timeouts(
+            os.getenv("ASANA_TOOL_TIMEOUTS", "")
+        )
+
+    async def _afunc(self, input, config, *, store):
+        tool_calls, input_type = self._parse_input(input, store)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # gather keeps the order of tool_calls; MCP tools return plain content, never a Command
+        outputs = await asyncio.gather(
+            *(self._arun_limited(call, input_type, config, semaphore) for call in tool_calls)
+        )
+        return self._compact_outputs(input, outputs if input_type == "list" else {self.messages_key: outputs})
+
+    async def _arun_limited(self, call, input_type, config, semaphore: asyncio.Semaphore) -> ToolMessage:
+        timeout = self.tool_timeouts.get(call["name"], self.timeout)
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(self._arun_one(call, input_type, config), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Asana tool {call['name']} timed out after {timeout}s")
+                return ToolMessage(
+                    content=f"ツール {call['name']} の実行が {timeout:g} 秒でタイムアウトしました。",
+                    name=call["name"],
+                    tool_call_id=call["id"],
+                    status="error"
+                )
+
+
+ASANA_SYSTEM_PROMPT = """あなたはAsanaタスク管理のアシスタントです。
 ユーザーの質問に対して、利用可能なAsanaツールを使用して情報を取得し、日本語で応答してください。
 
 重要なルール：
 1. 常に日本語で応答する
-2. プロジェクト一覧を取得する場合、まずワークスペース一覧を取得してから、各ワークスペースのプロジェクトを検索する
+2. プロジェクト一覧を取得する場合、まずasana_list_workspacesでワークスペース一覧を取得してから、各ワークスペースのプロジェクトをasana_search_projectsで検索する（取得済みのワークスペースとプロジェクト一覧が提供されている場合はそれを使用する）
 3. エラーが発生した場合は、わかりやすく日本語で説明する
 4. 思考過程（<thinking>タグ）は最終出力に含めない
-5. ツールの実行結果を元に、簡潔でわかりやすい応答を生成する
+5. ツールの実行結果を元に、簡潔でユーザーにわかりやすく整形した応答を生成する
+6. 互いに依存しないツール呼び出し（複数ワークスペースのプロジェクト検索、複数タスクの取得など）は、1回の応答でまとめて呼び出す
+7. 会話の履歴に取得済みのツール結果（ワークスペースやプロジェクトのIDなど）がある場合は、同じツールを再度呼び出さずにその結果を利用する
 
 利用可能なツール:
 - asana_list_workspaces: ワークスペース一覧を取得
 - asana_search_projects: 特定のワークスペース内のプロジェクトを検索
 - asana_search_tasks: タスクを検索
-- その他多数のAsana操作ツール
-""")
+- その他、質問に応じたAsana操作ツール
+"""
+
+
+def prompt_cache_enabled() -> bool:
+    return os.getenv("BEDROCK_PROMPT_CACHE_ENABLED", "true").lower() == "true"
+
+
+def system_prompt_content(text: str):
+    """
+    System message content ending in a Bedrock cache point
+
+    Everything before the cache point (tool schemas and the system prompt) is
+    the stable prefix Bedrock prompt caching reuses across model steps and
+    requests. Without BEDROCK_PROMPT_CACHE_ENABLED the plain text is returned.
+    """
+    if not prompt_cache_enabled():
+        return text
+    return [{"type": "text", "text": text}, {"cachePoint": {"type": "default"}}]
+
+
+def directory_injector(directory: Callable[[], Optional[str]]) -> RunnableLambda:
+    """
+    Runnable adding the prefetched workspace / project directory after the system prompt
+
+    The directory is read on every model call, so a shared agent always sees
+    the latest snapshot. It is a separate system message after the cache point,
+    with a cache point of its own, so the cached system prompt prefix stays the same.
+    """
+    def inject(prompt_value) -> List[Any]:
+        messages = prompt_value.to_messages()
+        text = directory()
+        if text:
+            messages.insert(1, SystemMessage(content=system_prompt_content(text)))
+        return messages
+
+    return RunnableLambda(inject)
+
+
+def create_asana_agent(chat_model, tools: List[Any], max_concurrency: Optional[int] = None,
+                       tool_timeouts: Optional[Dict[str, float]] = None, checkpointer=None,
+                       directory: Optional[Callable[[], Optional[str]]] = None):
+    """
+    Create a ReAct agent specifically configured for Asana operations
+    
+    Args:
+        chat_model: The LLM model to use
+        tools: List of Asana MCP tools
+        max_concurrency: Maximum number of tool calls of one model turn running at once
+        tool_timeouts: Optional per-tool timeouts in seconds
+        checkpointer: Optional LangGraph checkpointer for session memory
+        directory: Optional callable returning the prefetched workspace / project
+                   directory text (see prefetch), or None when there is no fresh snapshot
+        
+    Returns:
+        Configured agent for Asana operations
+    """
+    
+    # Tool schemas and this system prompt are identical on every step, so Bedrock can cache them
+    system_message = SystemMessage(content=system_prompt_content(ASANA_SYSTEM_PROMPT))
     
     # Create prompt template with system message
     prompt = ChatPromptTemplate.from_messages([
@@ -46,60 +159,93 @@ def create_asana_agent(chat_model, tools: List[Any]):
         MessagesPlaceholder(variable_name="messages"),
     ])
     
+    # Session agents keep earlier turns; trim them to a token budget before each model call
+    if checkpointer is not None:
+        prompt = history_trimmer() | prompt
+    
+    # Prefetched workspaces and projects spare the discovery tool calls
+    if directory is not None:
+        prompt = prompt | directory_injector(directory)
+    
     # Create agent with prompt template
+    # Independent tool calls of one turn run concurrently; their JSON is projected
+    # to the fields answers use before it re-enters the messages
+    compactor = ToolOutputCompactor("asana") if compaction_enabled() else None
+    tool_node = ParallelToolNode(tools, max_concurrency=max_concurrency, tool_timeouts=tool_timeouts,
+                                 compactor=compactor)
     agent = create_react_agent(
         chat_model,
-        tools,
-        messages_modifier=prompt
+        tool_node,
+        messages_modifier=prompt,
+        checkpointer=checkpointer
     )
     
     return agent
 
 
-async def execute_asana_query(agent, query: str) -> str:
+def log_prompt_savings(agent, messages: List[Any]):
+    """
+    Log the input tokens one request saved: tool schemas left out by tool
+    selection on every model step, prompt tokens read from the Bedrock cache
+    and tool output left out by compaction
+    """
+    human_index = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+    steps = [m for m in messages[human_index + 1:] if isinstance(m, AIMessage)]
+    cache_read = sum(
+        ((m.usage_metadata or {}).get("input_token_details") or {}).get("cache_read", 0) or 0 for m in steps
+    )
+    saved = ((getattr(agent, "config", None) or {}).get("metadata") or {}).get(metrics.TOOL_TOKENS_SAVED_KEY, 0)
+    compacted_tokens, compacted_bytes = record_request_savings("asana", messages)
+    logger.info(f"Asana request: {len(steps)} model steps, ~{saved * len(steps)} tool-schema tokens saved, "
+                f"{cache_read} prompt tokens read from cache, ~{compacted_tokens} tool-output tokens "
+                f"({compacted_bytes} bytes) compacted away")
+
+
+async def execute_asana_query(agent, query: str, config: Optional[Dict[str, Any]] = None,
+                              budget: Optional[RequestBudget] = None, chat_model=None) -> str:
     """
     Execute an Asana-related query using the configured agent
     
     Args:
         agent: The configured agent
         query: User's query in Japanese
+        config: Optional runnable config (selects the session thread for session agents)
+        budget: Request deadline and step / tool-call limits (a default budget when omitted)
+        chat_model: Model that writes a partial answer when the budget runs out
         
     Returns:
         Response string in Japanese
     """
     try:
-        # Add instruction to the query
-        enhanced_query = f"""{query}
-
-注意: 
-- プロジェクト一覧を取得する場合は、まずasana_list_workspacesでワークスペースを取得してください
-- その後、各ワークスペースに対してasana_search_projectsを使用してプロジェクトを検索してください
-- 最終的な応答は日本語で、ユーザーにわかりやすく整形してください"""
-        
-        # Execute the query
-        result = await agent.ainvoke({
-            "messages": [HumanMessage(content=enhanced_query)]
-        })
+        # The instructions live in the cached system prompt, so the query is sent as is
+        result = await run_agent(agent, {
+            "messages": [HumanMessage(content=query)]
+        }, "asana", config, budget or default_budget(), chat_model)
         
         # Extract and process the response
         if result.get("messages"):
-            # Find the last AI message
-            for message in reversed(result["messages"]):
-                if hasattr(message, 'content') and message.content:
-                    # Skip tool call messages
-                    if hasattr(message, 'tool_calls') and message.tool_calls:
-                        continue
-                    
-                    content = message.content
-                    # Remove thinking tags if present
-                    import re
-                    content = re.sub(r'<thinking>.*?</thinking>', '', content, flags=re.DOTALL).strip()
-                    
-                    # If content is empty after removing thinking tags, continue to next message
-                    if not content:
-                        continue
+            log_prompt_savings(agent, result["messages"])
+            with metrics.stage("postprocess", route="asana"):
+                # Find the last AI message
+                for message in reversed(result["messages"]):
+                    # Earlier turns of a session are not part of this answer
+                    if isinstance(message, HumanMessage):
+                        break
+                    if hasattr(message, 'content') and message.content:
+                        # Skip tool call messages
+                        if hasattr(message, 'tool_calls') and message.tool_calls:
+                            continue
+                        
+                        content = message.content
+                        # Remove thinking tags if present
+                        import re
+                        content = re.sub(r'<thinking>.*?</thinking>', '', content, flags=re.DOTALL).strip()
                         
-                    return content
+                        # If content is empty after removing thinking tags, continue to next message
+                        if not content:
+                            continue
+                            
+                        return content
             
             # If no suitable message found, return error
             return "申し訳ございません。Asanaからの情報を取得できませんでした。"
@@ -108,4 +254,5 @@ async def execute_asana_query(agent, query: str) -> str:
         
     except Exception as e:
         logger.error(f"Error executing Asana query: {e}")
+        metrics.record_error("asana")
         return f"エラーが発生しました: {str(e)}"
\ No newline at end of file
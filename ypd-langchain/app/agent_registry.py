@@ -0,0 +1,219 @@
+"""
+Registry that builds the Bedrock chat model and the ReAct agents once and reuses them across requests
+"""
+import os
+import asyncio
+import logging
+from typing import Any, Callable, List, Optional, Tuple
+
+import metrics
+from admission import bedrock_client_config
+from agent_helper import create_asana_agent
+from knowledge_base import create_knowledge_base_agent
+from model_tiers import TieredChatModel, TierPolicy, tier_model_ids, tiering_enabled
+from tool_selection import schema_tokens, select_tools, tool_selection_enabled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_ID = "us.amazon.nova-pro-v1:0"
+
+
+def _tools_signature(tools: List[Any]) -> Tuple:
+    """
+    Build a signature that changes whenever the tool list changes
+
+    Tool identity is part of the signature because the MCP tools are bound to
+    the client that produced them, so a re-initialized client must trigger a rebuild
+    even when the tool names are unchanged.
+    """
+    return tuple((tool.name, id(tool)) for tool in tools)
+
+
+class AgentRegistry:
+    """Holds the shared chat model and the compiled agents for the lifetime of the app"""
+
+    def __init__(self, model_id: Optional[str] = None, region: Optional[str] = None):
+        self.model_id = model_id or os.getenv("BEDROCK_MODEL_ID", DEFAULT_MODEL_ID)
+        self.region = region or os.getenv("AWS_REGION", "us-west-2")
+        self.max_pool_connections = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+
+        self.chat_model = None
+        self.checkpointer = None
+        self.asana_agent = None
+        self.kb_agent = None
+        # Variants compiled with the checkpointer, for requests that carry a session ID
+        self.asana_session_agent = None
+        self.kb_session_agent = None
+        # Asana agents bound to a subset of the tools, by matched tool groups
+        self.asana_subset_agents = {}
+        self._asana_tools_signature = None
+        self._kb_retriever = None
+        self._kb_table_version = 0
+        self._lock = asyncio.Lock()
+        # Prefetched Asana workspace / project directory for the Asana agents (see prefetch)
+        self.asana_directory: Optional[Callable[[], Optional[str]]] = None
+        self.builds = {"asana": 0, "asana_subset": 0, "knowledge_base": 0, "asana_session": 0, "knowledge_base_session": 0}
+
+    def initialize(self, chat_model=None, checkpointer=None):
+        """
+        Create the shared chat model
+
+        Args:
+            chat_model: Optional pre-built model (used by benchmarks and tests)
+            checkpointer: Optional LangGraph checkpointer for the session agents
+        """
+        self.chat_model = chat_model or self._create_chat_model()
+        self.checkpointer = checkpointer
+        # Model calls are measured on every route, including general queries that bypass the agents
+        handlers = metrics.callbacks()
+        if handlers:
+            self.chat_model.callbacks = [*(self.chat_model.callbacks or []), *handlers]
+        logger.info(f"Agent registry initialized with model: {self.model_id}")
+
+    def _create_chat_model(self):
+        """
+        Create the chat model: a single ChatBedrock model, or with MODEL_TIERING_ENABLED
+        a TieredChatModel over Nova Micro / Lite / Pro
+        """
+        if not tiering_enabled():
+            return self._create_bedrock_model(self.model_id, self.max_pool_connections)
+        tiers = {}
+        for tier, model_id in tier_model_ids(self.model_id).items():
+            pool = int(os.getenv(f"MODEL_TIER_{tier.upper()}_POOL_CONNECTIONS", str(self.max_pool_connections)))
+            tiers[tier] = self._create_bedrock_model(model_id, pool)
+        logger.info(f"Model tiering enabled: {tier_model_ids(self.model_id)}")
+        return TieredChatModel(tiers=tiers, policy=TierPolicy())
+
+    def _create_bedrock_model(self, model_id: str, max_pool_connections: int):
+        """Create a ChatBedrock model backed by its own pooled bedrock-runtime client with adaptive retries"""
+        import boto3
+        from langchain_aws import ChatBedrock
+        client = boto3.client(
+            "bedrock-runtime",
+            region_name=self.region,
+            config=bedrock_client_config(max_pool_connections),
+        )
+        return ChatBedrock(
+            model=model_id,
+            region_name=self.region,
+            client=client,
+            beta_use_converse_api=True
+        )
+
+    def get_chat_model(self, route: Optional[str] = None):
+        """
+        Get the shared chat model, creating it on first use
+
+        Args:
+            route: Route the call answers for; a tiered model picks its tier by route
+        """
+        if self.chat_model is None:
+            self.initialize()
+        if route and isinstance(self.chat_model, TieredChatModel):
+            return self.chat_model.with_config({"metadata": {"route": route}})
+        return self.chat_model
+
+    async def get_asana_agent(self, asana_client, session: bool = False, query: Optional[str] = None):
+        """
+        Get the compiled Asana agent, rebuilding it when the tool list changes
+
+        Args:
+            asana_client: Initialized AsanaMCPClient
+            session: Return the variant compiled with the checkpointer
+            query: User's question; when given, a stateless request gets an agent
+                bound to the tools its question needs (see tool_selection)
+
+        Returns:
+            Compiled Asana agent
+        """
+        tools = await asana_client.get_tools()
+        signature = _tools_signature(tools)
+        if self.asana_agent is None or signature != self._asana_tools_signature:
+            async with self._lock:
+                if self.asana_agent is None or signature != self._asana_tools_signature:
+                    agent = create_asana_agent(self.get_chat_model(), tools, directory=self.asana_directory)
+                    self.asana_agent = agent.with_config({"callbacks": metrics.callbacks()})
+                    self.asana_session_agent = None
+                    self.asana_subset_agents = {}
+                    self._asana_tools_signature = signature
+                    self.builds["asana"] += 1
+                    logger.info(f"Built Asana agent with {len(tools)} tools")
+        if not session:
+            if query is None or not tool_selection_enabled():
+                return self.asana_agent
+            return self._get_asana_subset_agent(tools, query)
+
+        if self.asana_session_agent is None:
+            agent = create_asana_agent(self.get_chat_model(), tools, checkpointer=self.checkpointer,
+                                       directory=self.asana_directory)
+            self.asana_session_agent = agent.with_config({"callbacks": metrics.callbacks()})
+            self.builds["asana_session"] += 1
+            logger.info("Built session Asana agent")
+        return self.asana_session_agent
+
+    def _get_asana_subset_agent(self, tools: List[Any], query: str):
+        """
+        Asana agent bound to the tool groups a question needs
+
+        Session agents keep every tool: a follow-up such as "それを完了にして"
+        needs tools its own wording does not mention.
+        """
+        selection = select_tools(tools, query)
+        if selection.groups is None:
+            return self.asana_agent
+        agent = self.asana_subset_agents.get(selection.groups)
+        if agent is None:
+            saved = schema_tokens(tools) - schema_tokens(selection.tools)
+            agent = create_asana_agent(self.get_chat_model(), selection.tools, directory=self.asana_directory).with_config({
+                "callbacks": metrics.callbacks(),
+                "metadata": {metrics.TOOL_TOKENS_SAVED_KEY: saved},
+            })
+            self.asana_subset_agents[selection.groups] = agent
+            self.builds["asana_subset"] += 1
+            logger.info(f"Built Asana agent for {'+'.join(selection.groups)} with "
+                        f"{len(selection.tools)} of {len(tools)} tools (~{saved} schema tokens fewer per step)")
+        return agent
+
+    async def get_knowledge_base_agent(self, kb_client, session: bool = False):
+        """
+        Get the compiled knowledge base agent, rebuilding it when the retriever or the loaded tables change
+
+        Args:
+            kb_client: Initialized KnowledgeBaseClient
+            session: Return the variant compiled with the checkpointer
+
+        Returns:
+            Compiled knowledge base agent
+        """
+        retriever = kb_client.get_retriever()
+        # The query_table tool description lists the tables, so a reload needs a new agent.
+        # Checking the files (and re-reading changed spreadsheets) stays off the event loop.
+        if kb_client.tables is not None and kb_client.tables.due():
+            await asyncio.to_thread(kb_client.tables.refresh)
+        table_version = kb_client.tables.version if kb_client.tables is not None else 0
+        if self.kb_agent is None or retriever is not self._kb_retriever or table_version != self._kb_table_version:
+            agent = create_knowledge_base_agent(self.get_chat_model(), kb_client)
+            self.kb_agent = agent.with_config({"callbacks": metrics.callbacks()})
+            self.kb_session_agent = None
+            self._kb_retriever = retriever
+            self._kb_table_version = table_version
+            self.builds["knowledge_base"] += 1
+            logger.info("Built knowledge base agent")
+        if not session:
+            return self.kb_agent
+
+        if self.kb_session_agent is None:
+            agent = create_knowledge_base_agent(self.get_chat_model(), kb_client, checkpointer=self.checkpointer)
+            self.kb_session_agent = agent.with_config({"callbacks": metrics.callbacks()})
+            self.builds["knowledge_base_session"] += 1
+            logger.info("Built session knowledge base agent")
+        return self.kb_session_agent
+
+    def stats(self) -> dict:
+        """Return build counters for health reporting"""
+        return {
+            "model_id": self.model_id,
+            "asana_agent_ready": self.asana_agent is not None,
+            "knowledge_base_agent_ready": self.kb_agent is not None,
+            "builds": dict(self.builds),
+        }
@@ -2,42 +2,89 @@
 Asana MCP Client configuration and initialization
 """
 import os
-from typing import List, Optional
-from langchain_mcp_adapters.client import MultiServerMCPClient
+import shlex
+import shutil
+from typing import List, Optional, Tuple
 from langchain_core.tools import BaseTool
 import logging
 
+from mcp_pool import MCPServerPool
+from tool_cache import ToolResultCache
+from router import intent_router
+
 logger = logging.getLogger(__name__)
 
+ASANA_MCP_PACKAGE = "@roychri/mcp-server-asana"
+# Executable installed by `npm install -g @roychri/mcp-server-asana`
+ASANA_MCP_BINARY = "mcp-server-asana"
+
+
+def resolve_server_command() -> Tuple[str, List[str]]:
+    """
+    Command that starts the Asana MCP server
+
+    ASANA_MCP_COMMAND (e.g. "node /opt/mcp/dist/index.js") wins; otherwise a
+    pre-installed mcp-server-asana on PATH is started directly, and only
+    without it the package is resolved with `npx -y` on every start, which
+    needs the npm registry and adds seconds to the cold start.
+    """
+    command = os.getenv("ASANA_MCP_COMMAND")
+    if command:
+        parts = shlex.split(command)
+        return parts[0], parts[1:]
+    binary = shutil.which(ASANA_MCP_BINARY)
+    if binary:
+        return binary, []
+    logger.warning(f"{ASANA_MCP_BINARY} not found on PATH; starting the MCP server with npx -y")
+    return "npx", ["-y", ASANA_MCP_PACKAGE]
+
 
 class AsanaMCPClient:
     """Asana MCP Client wrapper for managing Asana operations"""
     
-    def __init__(self, access_token: Optional[str] = None):
+    def __init__(
+        self,
+        access_token: Optional[str] = None,
+        command: Optional[str] = None,
+        args: Optional[List[str]] = None,
+        pool_size: Optional[int] = None
+    ):
         self.access_token = access_token or os.getenv("ASANA_ACCESS_TOKEN")
         if not self.access_token:
             raise ValueError("ASANA_ACCESS_TOKEN is required")
         
-        self.client = None
+        # Server command; overridable so tests can run fake_mcp_server.py instead
+        if command is None:
+            command, default_args = resolve_server_command()
+            args = args if args is not None else default_args
+        self.connection = {
+            "command": command,
+            "args": args if args is not None else [],
+            "transport": "stdio",
+            "env": {
+                "ASANA_ACCESS_TOKEN": self.access_token
+            }
+        }
+        self.pool_size = pool_size
+        self.pool = None
         self.tools = None
+        
+        # Read-only tool results are cached and identical concurrent calls coalesced
+        self.tool_cache = None
+        if os.getenv("ASANA_TOOL_CACHE_ENABLED", "true").lower() == "true":
+            self.tool_cache = ToolResultCache()
     
     async def initialize(self):
-        """Initialize the MCP client and get available tools"""
+        """Start the MCP server pool and get available tools"""
         try:
-            # Configure MCP client with Asana server
-            self.client = MultiServerMCPClient({
-                "asana": {
-                    "command": "npx",
-                    "args": ["-y", "@roychri/mcp-server-asana"],
-                    "transport": "stdio",
-                    "env": {
-                        "ASANA_ACCESS_TOKEN": self.access_token
-                    }
-                }
-            })
+            # Pre-warm long-lived server processes instead of one process per tool call
+            self.pool = MCPServerPool(self.connection, size=self.pool_size, name="asana")
+            await self.pool.start()
             
             # Get available tools from the MCP server
-            self.tools = await self.client.get_tools()
+            self.tools = await self.pool.get_tools()
+            if self.tool_cache:
+                self.tools = self.tool_cache.wrap(self.tools)
             logger.info(f"Initialized Asana MCP client with {len(self.tools)} tools")
             # Log tool names for debugging
             tool_names = [tool.name for tool in self.tools]
@@ -54,10 +101,19 @@ class AsanaMCPClient:
             await self.initialize()
         return self.tools
     
+    def status(self) -> dict:
+        """Report the real connection state of the MCP server pool"""
+        if not self.pool:
+            return {"connected": False}
+        return {
+            **self.pool.status(),
+            "tool_cache": self.tool_cache.stats() if self.tool_cache else None
+        }
+    
     async def close(self):
-        """Close the MCP client connection"""
-        if self.client:
-            await self.client.__aexit__(None, None, None)
+        """Drain in-flight tool calls and stop the MCP server processes"""
+        if self.pool:
+            await self.pool.close()
 
 
 def is_asana_related_query(query: str) -> bool:
@@ -70,18 +126,4 @@ def is_asana_related_query(query: str) -> bool:
     Returns:
         bool: True if query is related to Asana tasks
     """
-    asana_keywords = [
-        "タスク", "task", "tasks",
-        "プロジェクト", "project", 
-        "アサナ", "asana", "Asana",
-        "期限", "deadline", "due",
-        "担当", "assignee", "assigned",
-        "進捗", "progress", "status",
-        "コメント", "comment",
-        "完了", "complete", "done",
-        "作成", "create", "new",
-        "更新", "update", "modify"
-    ]
-    
-    query_lower = query.lower()
-    return any(keyword.lower() in query_lower for keyword in asana_keywords)
\ No newline at end of file
+    return intent_router.route(query) == "asana"
@@ -0,0 +1,157 @@
+"""
+Batch processing of many prompts with shared routing and deduplication
+"""
+import os
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from langchain_core.messages import HumanMessage
+
+import metrics
+from admission import Overloaded, Ticket, is_throttling_error
+from router import intent_router
+
+logger = logging.getLogger(__name__)
+
+
+def _item(index: int, route: str, result: Any, duplicate_of: Optional[int]) -> dict:
+    """Build one NDJSON result line; exceptions become per-item errors"""
+    item = {"index": index, "route": route}
+    if duplicate_of is not None:
+        item["duplicate_of"] = duplicate_of
+    if isinstance(result, BaseException):
+        item["error"] = (
+            "現在混み合っています。しばらくしてから再度お試しください。"
+            if is_throttling_error(result) or isinstance(result, Overloaded)
+            else "応答の生成中にエラーが発生しました。"
+        )
+        item["error_type"] = type(result).__name__
+    else:
+        item["response"] = getattr(result, "content", result)
+    return item
+
+
+async def admit_item(admit: Callable[[str], Awaitable[Optional[Ticket]]], route: str,
+                     attempts: Optional[int] = None) -> Optional[Ticket]:
+    """
+    Take the route's admission slot for one batch item
+
+    Batch items share the per-route limits with interactive requests; while a
+    route is overloaded the item waits for the Retry-After time and tries again.
+
+    Raises:
+        Overloaded: If the route is still overloaded after attempts tries
+    """
+    attempts = attempts or int(os.getenv("BATCH_ADMISSION_ATTEMPTS", "3"))
+    for attempt in range(attempts):
+        try:
+            return await admit(route)
+        except Overloaded as e:
+            if attempt + 1 == attempts:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+
+async def run_batch(
+    prompts: List[str],
+    chat_model,
+    agent_handlers: Dict[str, Callable[[str], Awaitable[str]]],
+    ordered: bool = True,
+    general_concurrency: Optional[int] = None,
+    agent_concurrency: Optional[int] = None,
+    router: Optional[Callable[[str], str]] = None,
+    admit: Optional[Callable[[str], Awaitable[Optional[Ticket]]]] = None
+) -> AsyncIterator[dict]:
+    """
+    Route, deduplicate and answer a list of prompts
+
+    Identical prompts are answered once. General prompts and agent-route
+    prompts run in bounded worker pools; with admit, every item also takes a
+    slot of its route's admission limit (see admit_item), so concurrent
+    batches stay within the limits interactive traffic uses. One result is
+    yielded per input prompt, either in input order or as soon as it completes.
+
+    Args:
+        prompts: Prompts in request order
+        chat_model: Shared chat model for general prompts
+        agent_handlers: Handler per agent route ("asana", "knowledge_base", "hybrid")
+        ordered: Yield results in input order instead of completion order
+        general_concurrency: Maximum concurrent general model calls
+        agent_concurrency: Maximum concurrent agent runs
+        router: Routing function (defaults to intent_router.route)
+        admit: Admission function returning a ticket for a route (AdmissionController.admit)
+
+    Yields:
+        {"index", "route", "response"} or {"index", "route", "error", "error_type"};
+        duplicates also carry "duplicate_of" (the first index of the same prompt)
+    """
+    general_concurrency = general_concurrency or int(os.getenv("BATCH_GENERAL_CONCURRENCY", "8"))
+    agent_concurrency = agent_concurrency or int(os.getenv("BATCH_AGENT_CONCURRENCY", "4"))
+    router = router or intent_router.route
+
+    # Deduplicate, then route every distinct prompt once
+    indices: Dict[str, List[int]] = {}
+    for index, prompt in enumerate(prompts):
+        indices.setdefault(prompt, []).append(index)
+    with metrics.stage("route", route="batch"):
+        routes = {prompt: router(prompt) for prompt in indices}
+    general = [prompt for prompt, route in routes.items() if route not in agent_handlers]
+    agent = [prompt for prompt, route in routes.items() if route in agent_handlers]
+    logger.info(f"Batch of {len(prompts)} prompts: {len(indices)} distinct, "
+                f"{len(general)} general, {len(agent)} agent")
+    for route in routes.values():
+        metrics.REQUESTS.inc(endpoint="batch", route=route)
+
+    completed: asyncio.Queue = asyncio.Queue()
+
+    general_semaphore = asyncio.Semaphore(general_concurrency)
+    agent_semaphore = asyncio.Semaphore(agent_concurrency)
+
+    async def run_item(prompt: str, semaphore: asyncio.Semaphore, answer: Callable[[], Awaitable[Any]]):
+        route = routes[prompt]
+        async with semaphore:
+            ticket = None
+            try:
+                ticket = await admit_item(admit, route) if admit else None
+                with metrics.stage("handler", route=route):
+                    result = await answer()
+            except Exception as e:
+                # Fail the item rather than the whole batch
+                result = e
+            finally:
+                if ticket:
+                    ticket.release()
+        completed.put_nowait((prompt, result))
+
+    def general_answer(prompt: str):
+        return lambda: chat_model.ainvoke([HumanMessage(content=prompt)])
+
+    def agent_answer(prompt: str):
+        return lambda: agent_handlers[routes[prompt]](prompt)
+
+    tasks = [asyncio.create_task(run_item(prompt, general_semaphore, general_answer(prompt))) for prompt in general] + \
+        [asyncio.create_task(run_item(prompt, agent_semaphore, agent_answer(prompt))) for prompt in agent]
+    ready: Dict[int, dict] = {}
+    next_index = 0
+    try:
+        for _ in range(len(indices)):
+            prompt, result = await completed.get()
+            if isinstance(result, BaseException):
+                logger.error(f"Batch item failed ({routes[prompt]}): {result}")
+                metrics.record_error(routes[prompt])
+            first = indices[prompt][0]
+            items = [_item(index, routes[prompt], result, None if index == first else first) for index in indices[prompt]]
+            if not ordered:
+                for item in items:
+                    yield item
+                continue
+            for item in items:
+                ready[item["index"]] = item
+            while next_index in ready:
+                yield ready.pop(next_index)
+                next_index += 1
+    finally:
+        # Stop outstanding work when the client goes away
+        for task in tasks:
+            task.cancel()
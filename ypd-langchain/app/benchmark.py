@@ -0,0 +1,2382 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the LangChain API (fake backends, no AWS / Asana access required)
+
+Usage:
+    python benchmark.py registry [--iterations N]
+    python benchmark.py kb-load [--concurrency N] [--retrieval-latency SEC]
+    python benchmark.py response-cache [--model-latency SEC]
+    python benchmark.py stream [--model-latency SEC]
+    python benchmark.py router [--iterations N]
+    python benchmark.py tool-fanout [--tool-latency SEC] [--max-concurrency N]
+    python benchmark.py metrics [--requests N]
+    python benchmark.py overload [--capacity N] [--model-latency SEC] [--duration SEC] [--slo SEC]
+    python benchmark.py batch [--prompts N] [--model-latency SEC]
+    python benchmark.py memory [--turns N] [--max-history-tokens N]
+    python benchmark.py kb-rag [--questions N] [--model-latency SEC] [--retrieval-latency SEC]
+    python benchmark.py kb-local [--source-dir DIR] [--retrieval-latency SEC] [--min-score X]
+    python benchmark.py kb-table [--source-dir DIR] [--model-latency SEC] [--retrieval-latency SEC]
+    python benchmark.py tiers [--micro-latency SEC] [--lite-latency SEC] [--pro-latency SEC]
+    python benchmark.py asana-prompt
+    python benchmark.py hybrid [--model-latency SEC] [--slow-tool-latency SEC] [--straggler-timeout SEC]
+    python benchmark.py compaction [--document-chars N] [--request-budget N]
+    python benchmark.py prefetch [--tool-latency SEC] [--interval SEC] [--max-staleness SEC]
+    python benchmark.py budget [--max-steps N] [--max-tool-calls N] [--deadline SEC]
+    python benchmark.py startup [--runs N] [--npx-delay SEC]
+    python benchmark.py scaling [--workers 1,2,4] [--requests N] [--concurrency N]
+    python benchmark.py load [--requests N] [--concurrency N] [--mcp] [--memory] [--output FILE] [--baseline FILE]
+    python benchmark.py replay --trace FILE [--speed X] [--concurrency N] [--url URL] [--output FILE] [--baseline FILE]
+
+load and replay share the backend options (--model-latency, --retrieval-latency,
+--tool-latency, --mcp to run the Asana route against fake_mcp_server.py
+processes, --url to target a running server instead of fake backends). Traces
+are recorded by the app when TRACE_RECORD_PATH is set.
+"""
+import argparse
+import asyncio
+import gc
+import inspect
+import json
+import os
+import re
+import socket
+import sqlite3
+import resource
+import statistics
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+import httpx
+import uvicorn
+from langchain_aws import ChatBedrock
+
+import main as app_main
+import metrics
+from agent_helper import create_asana_agent
+from admission import AdmissionController, Overloaded
+from agent_registry import AgentRegistry
+from asana_mcp import AsanaMCPClient
+from langchain_core.documents import Document
+from langchain_core.messages import HumanMessage, ToolMessage
+
+from prefetch import Prefetcher
+from compaction import BUDGET_NOTE, DOCUMENTS_SEEN_NOTE, DUPLICATE_NOTE, ToolOutputCompactor
+from fakes import FakeChatModel, FakeEmbeddings, FakeRetriever, fake_asana_payload, make_fake_asana_tools
+from data_sources import read_xlsx, source_files
+from knowledge_base import KnowledgeBaseClient, compact_documents, create_knowledge_base_agent, estimate_tokens
+from local_index import load_or_build_index
+from tables import TableQuery, TableStore
+from memory import SessionMemory, split_turns
+from model_tiers import TIER_ORDER, TieredChatModel, TierPolicy
+from response_cache import SemanticResponseCache
+from retrieval_cache import RetrievalCache, SQLiteCacheBackend
+from shared_state import SharedStore
+from startup import PRELOAD_MODULES
+from streaming import ThinkingStripper
+from router import intent_router
+from tool_selection import select_tools
+from tool_cache import ToolResultCache
+from traces import TraceRecorder, load_trace
+
+
+def summarize(label: str, samples_ms):
+    """Print p50/mean/max for a list of millisecond samples"""
+    print(f"{label:<28} p50={statistics.median(samples_ms):8.3f}ms "
+          f"mean={statistics.mean(samples_ms):8.3f}ms max={max(samples_ms):8.3f}ms")
+
+
+class _FakeAsanaClient:
+    """Minimal AsanaMCPClient stand-in that returns a fixed tool list"""
+
+    def __init__(self, tools):
+        self.tools = tools
+
+    async def get_tools(self):
+        return self.tools
+
+
+def make_kb_client(retriever) -> KnowledgeBaseClient:
+    """Create a KnowledgeBaseClient backed by a fake retriever"""
+    kb_client = KnowledgeBaseClient(knowledge_base_id="FAKEKB")
+    kb_client.initialize(retriever=retriever)
+    return kb_client
+
+
+def install_fake_backends(chat_model, kb_client=None, asana_client=None, memory=None):
+    """Point the FastAPI app globals at fake backends (lifespan is not run)"""
+    registry = AgentRegistry()
+    registry.initialize(chat_model=chat_model, checkpointer=memory.checkpointer if memory else None)
+    app_main.agent_registry = registry
+    app_main.kb_client = kb_client
+    app_main.asana_client = asana_client
+    app_main.memory = memory
+    return registry
+
+
+def app_client() -> httpx.AsyncClient:
+    """HTTP client that calls the FastAPI app in-process"""
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app), base_url="http://bench", timeout=60)
+
+
+async def serve_app():
+    """Run the app on a local port (needed for real streaming and client disconnects)"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app_main.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task, f"http://127.0.0.1:{port}"
+
+
+async def max_loop_stall(awaitable, interval: float = 0.005) -> float:
+    """Await and return the longest gap the event loop went without running a ticker meanwhile"""
+    gaps = [0.0]
+
+    async def tick():
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            gaps.append(now - last - interval)
+            last = now
+
+    ticker = asyncio.create_task(tick())
+    try:
+        await awaitable
+    finally:
+        ticker.cancel()
+    return max(gaps)
+
+
+def open_async_generators() -> Counter:
+    """Suspended async generators by name (a graph run that did not unwind leaves its channels open)"""
+    return Counter(obj.__qualname__ for obj in gc.get_objects() if inspect.isasyncgen(obj) and obj.ag_frame is not None)
+
+
+async def read_sse(response: httpx.Response):
+    """Yield (event, data) pairs from a streaming SSE response"""
+    event = None
+    async for line in response.aiter_lines():
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            yield event, json.loads(line[len("data: "):])
+
+
+async def timed_post(client: httpx.AsyncClient, path: str, payload: dict):
+    """POST and return (elapsed seconds, response)"""
+    start = time.perf_counter()
+    response = await client.post(path, json=payload)
+    return time.perf_counter() - start, response
+
+
+async def bench_registry(args):
+    """Compare per-request model/agent construction with the shared registry"""
+    print("=== Agent setup cost per /generate request ===")
+    tools = make_fake_asana_tools()
+    kb_client = make_kb_client(FakeRetriever())
+    region = os.getenv("AWS_REGION", "us-west-2")
+
+    per_request = []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        chat = ChatBedrock(model="us.amazon.nova-pro-v1:0", region_name=region, beta_use_converse_api=True)
+        create_asana_agent(chat, tools)
+        create_knowledge_base_agent(chat, kb_client)
+        per_request.append((time.perf_counter() - start) * 1000)
+
+    registry = AgentRegistry()
+    registry.initialize()
+    asana_client = _FakeAsanaClient(tools)
+    reused = []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        registry.get_chat_model()
+        await registry.get_asana_agent(asana_client)
+        await registry.get_knowledge_base_agent(kb_client)
+        reused.append((time.perf_counter() - start) * 1000)
+
+    summarize("build per request", per_request)
+    summarize("registry (reused)", reused)
+    saving = statistics.median(per_request) - statistics.median(reused)
+    print(f"Per-request saving (p50): {saving:.3f}ms, agent builds: {registry.builds}")
+
+    # A changed tool list must trigger exactly one rebuild
+    asana_client.tools = make_fake_asana_tools()
+    await registry.get_asana_agent(asana_client)
+    status = "✅" if registry.builds["asana"] == 2 else "❌"
+    print(f"{status} Asana agent rebuilt after tool list change (builds: {registry.builds['asana']})")
+
+
+async def bench_kb_load(args):
+    """Concurrent knowledge base /generate requests against a blocking stubbed retriever"""
+    print("=== Concurrent knowledge base /generate load test ===")
+    retriever = FakeRetriever(latency=args.retrieval_latency)
+    kb_client = make_kb_client(retriever)
+    install_fake_backends(FakeChatModel(tool_script=["search_knowledge_base"]), kb_client=kb_client)
+
+    async with app_client() as client:
+        start = time.perf_counter()
+        kb_requests = [
+            timed_post(client, "/generate", {"prompt": f"社内マニュアル{i}について教えて"})
+            for i in range(args.concurrency)
+        ]
+        # A general query issued during the load must not wait behind the retrievals
+        general_request = timed_post(client, "/generate", {"prompt": "こんにちは"})
+        results = await asyncio.gather(general_request, *kb_requests)
+        wall = time.perf_counter() - start
+    kb_client.close()
+
+    general_latency, _ = results[0]
+    kb_latencies = [elapsed * 1000 for elapsed, _ in results[1:]]
+    ok = sum(1 for _, response in results[1:] if response.status_code == 200)
+    serialized = args.concurrency * args.retrieval_latency
+    summarize("kb /generate", kb_latencies)
+    print(f"{ok}/{args.concurrency} succeeded, wall={wall:.2f}s, serialized would be >= {serialized:.2f}s, "
+          f"retriever calls={retriever.calls}")
+    status = "✅" if wall < serialized / 2 else "❌"
+    print(f"{status} Concurrent requests overlap (wall {wall:.2f}s < {serialized / 2:.2f}s)")
+    status = "✅" if general_latency < args.retrieval_latency else "❌"
+    print(f"{status} General query answered in {general_latency * 1000:.1f}ms while retrievals were in flight")
+
+
+async def bench_response_cache(args):
+    """Latency of /generate for cache misses, exact hits and semantic hits"""
+    print("=== Semantic response cache ===")
+    now = [0.0]
+    kb_client = make_kb_client(FakeRetriever())
+    chat_model = FakeChatModel(tool_script=["search_knowledge_base"], latency=args.model_latency)
+    install_fake_backends(chat_model, kb_client=kb_client, asana_client=_FakeAsanaClient(make_fake_asana_tools()))
+    # The bigram fake embedder scores paraphrases lower than Titan, hence the lower threshold
+    app_main.response_cache = SemanticResponseCache(
+        embedder=FakeEmbeddings(), similarity_threshold=0.85, clock=lambda: now[0]
+    )
+
+    cases = [
+        ("miss", "社内のセキュリティポリシーについて教えて"),
+        ("exact hit", "社内のセキュリティポリシーについて教えて"),
+        ("normalized hit", "  社内のセキュリティポリシーについて教えて "),
+        ("semantic hit", "社内のセキュリティポリシーについて教えてください"),
+        ("different question", "会社の就業規則について教えて"),
+    ]
+    async with app_client() as client:
+        latencies = {}
+        for label, prompt in cases:
+            elapsed, _ = await timed_post(client, "/generate", {"prompt": prompt})
+            latencies[label] = elapsed * 1000
+            print(f"{label:<20} {elapsed * 1000:9.2f}ms  {prompt}")
+
+        # Asana answers expire after their short route TTL; mutations are never cached
+        await timed_post(client, "/generate", {"prompt": "今日締切のタスクの進捗は？"})
+        fresh, _ = await timed_post(client, "/generate", {"prompt": "今日締切のタスクの進捗は？"})
+        now[0] += app_main.response_cache.route_ttls["asana"] + 1
+        stale, _ = await timed_post(client, "/generate", {"prompt": "今日締切のタスクの進捗は？"})
+        await timed_post(client, "/generate", {"prompt": "新しいタスクを作成して：会議資料の準備"})
+        mutation, _ = await timed_post(client, "/generate", {"prompt": "新しいタスクを作成して：会議資料の準備"})
+
+        # A write request close to a cached read-only answer still reaches the agent, streamed or not
+        await timed_post(client, "/generate", {"prompt": "今日締切のタスクの一覧を教えて"})
+        write = "今日締切のタスクの一覧を教えて。削除して"
+        similar_write, _ = await timed_post(client, "/generate", {"prompt": write})
+        async with client.stream("POST", "/generate/stream", json={"prompt": write}) as response:
+            streamed_write = {event: data async for event, data in read_sse(response)}
+
+        # English write verbs only count as whole words, so this read-only question is cached
+        await timed_post(client, "/generate", {"prompt": "What is the office address?"})
+        english_read, _ = await timed_post(client, "/generate", {"prompt": "What is the office address?"})
+        await timed_post(client, "/generate", {"prompt": "Add a comment to today's task"})
+        english_write, _ = await timed_post(client, "/generate", {"prompt": "Add a comment to today's task"})
+    kb_client.close()
+
+    fast = args.model_latency * 1000 / 2
+    checks = [
+        ("exact hit answered without the agent", latencies["exact hit"] < fast),
+        ("semantic hit answered without the agent", latencies["semantic hit"] < fast),
+        ("different question is a miss", latencies["different question"] > fast),
+        ("Asana answer served within its TTL", fresh * 1000 < fast),
+        ("Asana answer re-fetched after its TTL", stale * 1000 > fast),
+        ("Asana mutation never served from cache", mutation * 1000 > fast),
+        ("Write request similar to a cached answer not served from cache", similar_write * 1000 > fast),
+        ("... nor by /generate/stream", streamed_write["route"]["cached"] is False and "done" in streamed_write),
+        ("English read-only question containing a write verb (address) served from cache", english_read * 1000 < fast),
+        ("Repeated English write request (Add a comment) not served from cache", english_write * 1000 > fast),
+    ]
+    for name, passed in checks:
+        print(f"{'✅' if passed else '❌'} {name}")
+    print(f"Stats: {app_main.response_cache.stats()}")
+
+
+async def bench_stream(args):
+    """Time to first byte of /generate/stream vs /generate, thinking stripping and cancellation"""
+    print("=== Streaming /generate ===")
+    stripper = ThinkingStripper()
+    pieces = ["<thin", "king>考え中</th", "inking>  回答", "です<", "b>"]
+    streamed = "".join(stripper.feed(piece) for piece in pieces) + stripper.flush()
+    print(f"{'✅' if streamed == '回答です<b>' else '❌'} Thinking tags split across chunks are stripped ({streamed!r})")
+
+    calls = []
+    tools = make_fake_asana_tools(latency=args.model_latency, calls=calls)
+    chat_model = FakeChatModel(
+        tool_script=["asana_list_workspaces", "asana_search_projects", "asana_search_tasks"],
+        latency=args.model_latency
+    )
+    install_fake_backends(chat_model, asana_client=_FakeAsanaClient(tools))
+    server, task, base_url = await serve_app()
+    prompt = {"prompt": "今日締切のタスクを教えて"}
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        start = time.perf_counter()
+        await client.post("/generate", json=prompt)
+        blocking = time.perf_counter() - start
+
+        start = time.perf_counter()
+        first_event, first_token, tokens, final = None, None, [], None
+        async with client.stream("POST", "/generate/stream", json=prompt) as response:
+            async for event, data in read_sse(response):
+                if event == "tool_start":
+                    first_event = first_event or time.perf_counter() - start
+                elif event == "token":
+                    first_token = first_token or time.perf_counter() - start
+                    tokens.append(data["text"])
+                elif event == "done":
+                    final = data["response"]
+        streaming_total = time.perf_counter() - start
+
+        print(f"/generate total:            {blocking * 1000:9.1f}ms")
+        print(f"/generate/stream 1st tool:  {first_event * 1000:9.1f}ms")
+        print(f"/generate/stream 1st token: {first_token * 1000:9.1f}ms (total {streaming_total * 1000:.1f}ms)")
+        print(f"{'✅' if first_event < blocking / 2 else '❌'} First tool progress event arrives before the ReAct loop finishes")
+        streamed_answer = "".join(tokens)
+        print(f"{'✅' if streamed_answer == final and '<thinking' not in streamed_answer else '❌'} Streamed tokens match the final answer without thinking blocks")
+
+        # Disconnect after the first tool call starts; the remaining calls must not run, and the
+        # agent run must unwind itself rather than leave async generators for asyncio to close
+        calls.clear()
+        loop = asyncio.get_running_loop()
+        asyncgen_errors = []
+
+        def on_error(loop, context):
+            if "asynchronous generator" in context.get("message", ""):
+                asyncgen_errors.append(context)
+            loop.default_exception_handler(context)
+
+        loop.set_exception_handler(on_error)
+        before = open_async_generators()
+        try:
+            async with client.stream("POST", "/generate/stream", json=prompt) as response:
+                async for event, data in read_sse(response):
+                    if event == "tool_start":
+                        break
+            await asyncio.sleep(len(chat_model.tool_script) * args.model_latency * 2 + 0.5)
+            # Generators of an abandoned run are closed by asyncio when collected
+            gc.collect()
+            await asyncio.sleep(0.1)
+            left_open = open_async_generators() - before
+        finally:
+            loop.set_exception_handler(None)
+        print(f"{'✅' if len(calls) < len(chat_model.tool_script) and not asyncgen_errors and not left_open else '❌'} "
+              f"Client disconnect cancels the agent ({len(calls)}/{len(chat_model.tool_script)} tool calls completed, "
+              f"{len(asyncgen_errors)} async generator errors, left open: {dict(left_open) or 'none'})")
+
+    server.should_exit = True
+    await task
+
+
+# Keyword lists of the previous routing implementation, kept for comparison
+LEGACY_ASANA_KEYWORDS = [
+    "タスク", "task", "tasks", "プロジェクト", "project", "アサナ", "asana", "Asana",
+    "期限", "deadline", "due", "担当", "assignee", "assigned", "進捗", "progress", "status",
+    "コメント", "comment", "完了", "complete", "done", "作成", "create", "new",
+    "更新", "update", "modify"
+]
+LEGACY_KB_KEYWORDS = [
+    "文書", "ドキュメント", "資料", "書類", "文献", "マニュアル", "ガイド", "手順書", "説明書",
+    "規程", "規則", "ポリシー", "方針", "仕様書", "設計書", "報告書", "レポート", "レコード", "リスト",
+    "社内", "会社", "組織", "部署", "チーム", "プロジェクト", "製品", "サービス",
+    "システム", "ツール", "アプリケーション", "について教えて", "について説明", "とは何",
+    "どのような", "どうやって", "やり方", "使い方", "方法", "手順",
+    "最新の", "現在の", "今の", "確認したい", "調べたい", "知りたい", "探している", "検索", "参照"
+]
+LEGACY_KB_PATTERNS = [
+    r".*の(手順|方法|やり方|使い方)", r".*について(教えて|説明|知りたい)",
+    r".*マニュアル|.*ガイド|.*ドキュメント", r".*規程|.*ポリシー|.*ルール"
+]
+
+
+def legacy_route(query: str) -> str:
+    """Routing as done by the previous is_asana_related_query / is_knowledge_base_query"""
+    query_lower = query.lower()
+    if any(keyword.lower() in query_lower for keyword in LEGACY_ASANA_KEYWORDS):
+        return "asana"
+    if any(keyword in query_lower for keyword in LEGACY_KB_KEYWORDS):
+        return "knowledge_base"
+    if any(re.search(pattern, query_lower) for pattern in LEGACY_KB_PATTERNS):
+        return "knowledge_base"
+    return "general"
+
+
+def load_routing_corpus(path: str = "routing_corpus.jsonl"):
+    """Load the labelled routing corpus as (prompt, route) pairs"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), path), encoding="utf-8") as f:
+        return [(item["prompt"], item["route"]) for item in map(json.loads, f) if item]
+
+
+async def bench_router(args):
+    """Throughput and misrouting rate of the intent router vs the legacy keyword loops"""
+    print("=== Intent routing ===")
+    corpus = load_routing_corpus()
+    # Long prompts without keywords are where the leading-.* patterns backtrack
+    long_prompts = {
+        "long+kw": [prompt * 40 for prompt, route in corpus if route != "general"][:10],
+        "long-kw": [prompt * 40 for prompt, route in corpus if route == "general"][:10],
+    }
+
+    for label, route in (("legacy keyword loops", legacy_route), ("compiled router", intent_router.route)):
+        misrouted = [(prompt, expected, route(prompt)) for prompt, expected in corpus if route(prompt) != expected]
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            for prompt, _ in corpus:
+                route(prompt)
+        elapsed = time.perf_counter() - start
+        long_us = {}
+        for kind, prompts in long_prompts.items():
+            repeats = max(1, args.iterations // 20)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for prompt in prompts:
+                    route(prompt)
+            long_us[kind] = (time.perf_counter() - start) / (repeats * len(prompts)) * 1e6
+        throughput = args.iterations * len(corpus) / elapsed
+        print(f"{label:<22} {throughput:8.0f} prompts/s, "
+              + ", ".join(f"{kind} {us:7.1f}us" for kind, us in long_us.items())
+              + f", misrouted {len(misrouted)}/{len(corpus)} ({len(misrouted) / len(corpus):.1%})")
+        for prompt, expected, got in misrouted:
+            print(f"    expected {expected:<15} got {got:<15} {prompt}")
+
+    print(f"Ranked intents for a mixed prompt: {intent_router.rank('このプロジェクトの手順書と進捗を教えて')}")
+
+
+async def bench_tool_fanout(args):
+    """Wall-clock time of a model turn with several independent Asana tool calls, sequential vs concurrent"""
+    print("=== Asana tool fan-out within one model turn ===")
+    base = args.tool_latency
+    latencies = {
+        "asana_list_workspaces": base,
+        "asana_search_projects": base * 3,
+        "asana_search_tasks": base * 4,
+        "asana_get_task": base * 2,
+    }
+    fan_out = [
+        ("asana_search_projects", {"workspace": "1001"}),
+        ("asana_search_projects", {"workspace": "1002"}),
+        ("asana_search_tasks", {"workspace": "1001", "text": "資料"}),
+        ("asana_get_task", {"workspace": "1001", "text": "3001"}),
+    ]
+    script = ["asana_list_workspaces", fan_out]
+    turn_sum = sum(latencies[name] for name, _ in fan_out)
+    turn_max = max(latencies[name] for name, _ in fan_out)
+    print(f"Fan-out turn: {len(fan_out)} calls, sum of call times {turn_sum:.2f}s, slowest call {turn_max:.2f}s")
+
+    async def run(max_concurrency, tool_timeouts=None):
+        tools = make_fake_asana_tools(latencies=latencies)
+        agent = create_asana_agent(
+            FakeChatModel(tool_script=script), tools, max_concurrency=max_concurrency, tool_timeouts=tool_timeouts
+        )
+        start = time.perf_counter()
+        result = await agent.ainvoke({"messages": [HumanMessage(content="全ワークスペースのプロジェクトと資料タスクを教えて")]})
+        return time.perf_counter() - start, [m for m in result["messages"] if isinstance(m, ToolMessage)]
+
+    sequential, _ = await run(1)
+    concurrent, messages = await run(args.max_concurrency)
+    print(f"sequential (max_concurrency=1)   {sequential:6.2f}s")
+    print(f"concurrent (max_concurrency={args.max_concurrency})   {concurrent:6.2f}s  "
+          f"(speed-up x{sequential / concurrent:.1f})")
+    order = [message.tool_call_id for message in messages[1:]]
+    expected = [f"call_1_{i}" for i in range(len(fan_out))]
+    print(f"{'✅' if order == expected else '❌'} Results merged in tool call order: {order}")
+    print(f"{'✅' if concurrent < base + turn_max + base * 2 else '❌'} Fan-out turn takes about the slowest call")
+
+    timeout = base * 2.5
+    elapsed, messages = await run(args.max_concurrency, tool_timeouts={"asana_search_tasks": timeout})
+    timed_out = [message.name for message in messages if message.status == "error"]
+    print(f"{'✅' if timed_out == ['asana_search_tasks'] else '❌'} Per-tool timeout ({timeout:.2f}s) only fails "
+          f"the slow call: {timed_out}, turn finished in {elapsed:.2f}s")
+
+
+class _BrokenAsanaClient:
+    """AsanaMCPClient stand-in whose tool listing fails"""
+
+    async def get_tools(self):
+        raise ConnectionError("MCP server unavailable")
+
+
+async def bench_metrics(args):
+    """Per-request overhead of the instrumentation and a sample of /metrics"""
+    print("=== Instrumentation overhead ===")
+    script = ["asana_list_workspaces", "asana_search_projects"]
+    prompt = {"prompt": "今日締切のタスクを教えて"}
+    asana_client = _FakeAsanaClient(make_fake_asana_tools())
+    # Callbacks are attached when an agent is built, so each mode keeps its own registry
+    registries = {}
+    for enabled in (False, True):
+        metrics.ENABLED = enabled
+        registries[enabled] = install_fake_backends(FakeChatModel(tool_script=script), asana_client=asana_client)
+
+    async def request(client, enabled: bool) -> float:
+        metrics.ENABLED = enabled
+        app_main.agent_registry = registries[enabled]
+        elapsed, _ = await timed_post(client, "/generate", prompt)
+        return elapsed * 1000
+
+    timings = {False: [], True: []}
+    differences = []
+    async with app_client() as client:
+        # Warm up both modes (agent builds, imports, caches) before measuring
+        for _ in range(args.warmup):
+            for enabled in (False, True):
+                await request(client, enabled)
+        # Alternate the modes request by request (ABBA order, so drift cancels out) and
+        # compare each pair: the overhead is tiny next to the request-to-request noise
+        for i in range(args.requests):
+            pair = {}
+            for enabled in ((False, True) if i % 2 == 0 else (True, False)):
+                pair[enabled] = await request(client, enabled)
+                timings[enabled].append(pair[enabled])
+            differences.append(pair[True] - pair[False])
+        metrics.ENABLED = True
+        summarize("instrumentation off", timings[False])
+        summarize("instrumentation on", timings[True])
+        overhead = statistics.median(differences)
+        # Distribution-free 95% confidence interval of the median paired difference
+        ordered = sorted(differences)
+        spread = int(1.96 * len(ordered) ** 0.5 / 2)
+        low, high = ordered[max(len(ordered) // 2 - spread - 1, 0)], ordered[min(len(ordered) // 2 + spread, len(ordered) - 1)]
+        print(f"Overhead per request (median of {len(differences)} paired requests): {overhead:.3f}ms "
+              f"(95% CI {low:.3f} to {high:.3f}ms; {len(script)} tool calls and {len(script) + 1} model calls "
+              f"per request)")
+        # The fake model answers instantly; in production the Bedrock calls dominate a request
+        production = (len(script) + 1) * args.model_latency * 1000
+        print(f"{'✅' if 0 <= low and high < 0.01 * production else '❌'} Instrumentation adds {high / production * 100:.2f}% "
+              f"at most to a request whose {len(script) + 1} model calls take {args.model_latency:g}s each")
+
+        # A failing route shows up in the per-route error counter
+        install_fake_backends(FakeChatModel(), asana_client=_BrokenAsanaClient())
+        await client.post("/generate", json=prompt)
+
+        response = await client.get("/metrics")
+    text = response.text
+    wanted = ('ypd_stage_duration_seconds_count', 'ypd_tool_call_duration_seconds_count',
+              'ypd_model_call_duration_seconds_count', 'ypd_model_tokens_total', 'ypd_request_errors_total{')
+    for line in text.splitlines():
+        if line.startswith(wanted):
+            print(f"    {line}")
+    checks = {
+        "per-stage histograms": 'stage="handler",route="asana"' in text and 'stage="postprocess"' in text,
+        "tool call histograms": 'tool="asana_search_projects"' in text,
+        "token counts from usage metadata": 'ypd_model_tokens_total{model=' in text,
+        "per-route error counter": metrics.REQUEST_ERRORS.value(route="asana") >= 1,
+    }
+    for name, passed in checks.items():
+        print(f"{'✅' if passed else '❌'} /metrics exposes {name}")
+
+    iterations = 100_000
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with metrics.stage("bench", route="bench"):
+            pass
+    print(f"stage() cost: {(time.perf_counter() - start) / iterations * 1e6:.2f}us per timed stage")
+
+
+async def bench_overload(args):
+    """Open-loop load test of the general route with and without admission control"""
+    print("=== Goodput under overload ===")
+    capacity_rps = args.capacity / args.model_latency
+    print(f"Backend: {args.capacity} concurrent model calls x {args.model_latency}s "
+          f"= {capacity_rps:.0f} req/s, SLO {args.slo}s, {args.duration}s per load level")
+    prompt = {"prompt": "こんにちは、自己紹介をしてください"}
+
+    async def run_level(client, rate):
+        results = []
+
+        async def one():
+            elapsed, response = await timed_post(client, "/generate", prompt)
+            results.append((response.status_code, elapsed, response.headers.get("retry-after")))
+
+        tasks = []
+        start = time.perf_counter()
+        for i in range(int(rate * args.duration)):
+            # Open loop: requests arrive on schedule whether or not earlier ones finished
+            await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+            tasks.append(asyncio.create_task(one()))
+        await asyncio.gather(*tasks)
+        good = [elapsed for status, elapsed, _ in results if status == 200 and elapsed <= args.slo]
+        rejected = [elapsed for status, elapsed, retry in results if status in (429, 503) and retry]
+        ok = sorted(elapsed for status, elapsed, _ in results if status == 200)
+        p95 = ok[int(len(ok) * 0.95) - 1] if ok else 0.0
+        return len(good) / args.duration, len(rejected), max(rejected, default=0.0), p95, len(results)
+
+    async with app_client() as client:
+        for label, enabled in (("no admission control", False), ("admission control", True)):
+            print(f"--- {label} ---")
+            install_fake_backends(FakeChatModel(latency=args.model_latency, capacity=args.capacity))
+            app_main.admission = AdmissionController(
+                limits={"general": {"max_concurrency": args.capacity, "max_queue": args.capacity}},
+                queue_timeout=args.slo / 2
+            ) if enabled else None
+            for multiple in (0.5, 1, 2, 4, 8):
+                goodput, rejected, slowest_reject, p95, total = await run_level(client, capacity_rps * multiple)
+                print(f"offered {multiple:>3}x ({capacity_rps * multiple:5.0f} req/s): "
+                      f"goodput {goodput:5.1f} req/s, p95 {p95:5.2f}s, "
+                      f"rejected {rejected:4d}/{total} (slowest rejection {slowest_reject * 1000:.0f}ms)")
+    app_main.admission = None
+
+
+async def bench_batch(args):
+    """One /generate/batch call vs one /generate call per prompt"""
+    print("=== Batch /generate ===")
+    corpus = [prompt for prompt, _ in load_routing_corpus()]
+    # Nightly jobs repeat prompts; everything past the corpus size is a repeat
+    prompts = [corpus[i % len(corpus)] for i in range(args.prompts)]
+    failing = next(prompt for prompt in prompts if intent_router.route(prompt) == "general")
+
+    def install():
+        chat_model = FakeChatModel(latency=args.model_latency, fail_on=[failing])
+        install_fake_backends(chat_model, kb_client=make_kb_client(FakeRetriever()),
+                              asana_client=_FakeAsanaClient(make_fake_asana_tools()))
+        return chat_model
+
+    server, task, base_url = await serve_app()
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        chat_model = install()
+        start = time.perf_counter()
+        statuses = []
+        for prompt in prompts:
+            response = await client.post("/generate", json={"prompt": prompt})
+            statuses.append(response.status_code)
+        print(f"{'sequential /generate':<22} {time.perf_counter() - start:6.2f}s, "
+              f"model calls {len(chat_model.call_log)} ({statuses.count(500)} HTTP 500)")
+
+        for ordered in (True, False):
+            chat_model = install()
+            start = time.perf_counter()
+            first_line = None
+            items = []
+            async with client.stream("POST", "/generate/batch", json={"prompts": prompts, "ordered": ordered}) as response:
+                async for line in response.aiter_lines():
+                    if line:
+                        first_line = first_line or time.perf_counter() - start
+                        items.append(json.loads(line))
+            label = "batch (ordered)" if ordered else "batch (as completed)"
+            print(f"{label:<22} {time.perf_counter() - start:6.2f}s, first line after {first_line * 1000:5.0f}ms, "
+                  f"model calls {len(chat_model.call_log)}")
+            if ordered:
+                errors = [item for item in items if "error" in item]
+                duplicates = len(prompts) - len(set(prompts))
+                print(f"{'✅' if [item['index'] for item in items] == list(range(len(prompts))) else '❌'} "
+                      f"One line per prompt in input order")
+                print(f"{'✅' if errors and all(prompts[item['index']] == failing for item in errors) else '❌'} "
+                      f"Failing prompt reported per item ({len(errors)} lines), the rest answered")
+                print(f"{'✅' if sum('duplicate_of' in item for item in items) == duplicates else '❌'} "
+                      f"{duplicates} duplicate prompts answered once")
+
+        # Batch items share the route limits with interactive requests
+        install()
+        app_main.admission = AdmissionController(limits={"general": {"max_concurrency": 2, "max_queue": 64}})
+        limiter = app_main.admission.limiters["general"]
+        peak = 0
+
+        async def sample():
+            nonlocal peak
+            while True:
+                peak = max(peak, limiter.active)
+                await asyncio.sleep(0.005)
+
+        sampler = asyncio.create_task(sample())
+        async with client.stream("POST", "/generate/batch", json={"prompts": prompts}) as response:
+            items = [json.loads(line) async for line in response.aiter_lines() if line]
+        sampler.cancel()
+        app_main.admission = None
+        errors = [item for item in items if "error" in item]
+        print(f"{'✅' if 0 < peak <= 2 and limiter.active == 0 else '❌'} General batch items admitted through the "
+              f"route limit (peak {peak} active of 2, {limiter.counters['admitted']} admitted)")
+        print(f"{'✅' if all(prompts[item['index']] == failing for item in errors) else '❌'} "
+              f"Items waiting for admission are answered, not rejected ({len(errors)} error lines)")
+    server.should_exit = True
+    await task
+
+
+async def bench_memory(args):
+    """Follow-up questions with and without a session: tool calls, prompt size and session eviction"""
+    print("=== Conversation memory ===")
+    script = [("asana_list_workspaces", {}), ("asana_search_projects", {"workspace": "1001"})]
+    questions = [f"プロジェクトの進捗を教えて（{i + 1}回目）" for i in range(args.turns)]
+
+    async def converse(memory, session_ids, max_history_tokens):
+        os.environ["MEMORY_MAX_HISTORY_TOKENS"] = str(max_history_tokens)
+        calls = []
+        chat_model = FakeChatModel(tool_script=script, reuse_tool_results=True)
+        install_fake_backends(chat_model, asana_client=_FakeAsanaClient(make_fake_asana_tools(calls=calls)), memory=memory)
+        responses = []
+        async with app_client() as client:
+            for session_id in session_ids:
+                for question in questions:
+                    payload = {"prompt": question, "session_id": session_id} if session_id else {"prompt": question}
+                    response = await client.post("/generate", json=payload)
+                    responses.append(response.json()["response"])
+        return calls, chat_model.prompt_tokens, responses
+
+    runs = [
+        ("no session", None, [None], 4000),
+        ("session, untrimmed", SessionMemory(max_turns=10 ** 6), ["s1"], 10 ** 9),
+        ("session, trimmed", SessionMemory(), ["s1"], args.max_history_tokens),
+    ]
+    results = {}
+    for label, memory, session_ids, max_history_tokens in runs:
+        if memory:
+            await memory.initialize()
+        calls, prompt_tokens, responses = await converse(memory, session_ids, max_history_tokens)
+        results[label] = (calls, prompt_tokens, responses)
+        print(f"{label:<20} tool calls {len(calls):3d}, prompt tokens first/last model call "
+              f"{prompt_tokens[0]:5d}/{prompt_tokens[-1]:5d}, total {sum(prompt_tokens):7d}")
+
+    calls, _, responses = results["session, trimmed"]
+    print(f"{'✅' if len(calls) == len(script) else '❌'} Follow-ups reuse the earlier tool results "
+          f"({len(calls)} tool calls in {args.turns} turns vs {len(results['no session'][0])} without a session)")
+    print(f"{'✅' if all(question in response for question, response in zip(questions, responses)) else '❌'} "
+          f"Every turn answers its own question")
+    untrimmed, trimmed = results["session, untrimmed"][1][-1], results["session, trimmed"][1][-1]
+    print(f"{'✅' if trimmed < untrimmed else '❌'} Trimming bounds the prompt: last prompt {trimmed} tokens "
+          f"vs {untrimmed} untrimmed")
+
+    # Eviction: more sessions than max_sessions, then every session idle past the TTL
+    now = [0.0]
+    memory = SessionMemory(max_sessions=4, idle_ttl=60, max_turns=3, clock=lambda: now[0])
+    await memory.initialize()
+    await converse(memory, [f"user-{i}" for i in range(6)], args.max_history_tokens)
+    saver = memory.checkpointer
+    stats = memory.stats()
+    print(f"{'✅' if stats['sessions'] == 4 and stats['evicted_lru'] == 2 and len(saver.storage) == 4 else '❌'} "
+          f"LRU eviction keeps {stats['sessions']} of 6 sessions ({len(saver.storage)} threads stored)")
+    agent = app_main.agent_registry.asana_session_agent
+    state = await agent.aget_state({"configurable": {"thread_id": "asana:user-5"}})
+    stored_turns = len(split_turns(state.values["messages"]))
+    checkpoints = max(len(namespaces[""]) for namespaces in saver.storage.values())
+    print(f"{'✅' if stored_turns <= 3 and checkpoints == 1 else '❌'} Stored history capped at "
+          f"{stored_turns} turns, {checkpoints} checkpoint per session, "
+          f"{sum(len(blob[1]) for blob in saver.blobs.values()) // len(saver.storage)} bytes per session")
+    now[0] += 61
+    async with app_client() as client:
+        await client.post("/generate", json={"prompt": questions[0], "session_id": "late"})
+    stats = memory.stats()
+    print(f"{'✅' if stats['sessions'] == 1 and stats['evicted_idle'] == 4 else '❌'} Idle sessions evicted after "
+          f"the TTL: {stats}")
+
+    # The SQLite backend keeps one checkpoint per session too
+    state_dir = tempfile.mkdtemp(prefix="memory-")
+    os.environ["MEMORY_SQLITE_PATH"] = os.path.join(state_dir, "sessions.sqlite")
+    try:
+        memory = SessionMemory(backend="sqlite", max_turns=3)
+        await memory.initialize()
+        calls, _, responses = await converse(memory, ["sqlite"], args.max_history_tokens)
+        cursor = await memory.checkpointer.conn.execute("SELECT COUNT(*) FROM checkpoints")
+        (checkpoints,) = await cursor.fetchone()
+        await memory.close()
+        print(f"{'✅' if memory.backend == 'sqlite' and checkpoints == 1 and len(calls) == len(script) else '❌'} "
+              f"SQLite backend: {checkpoints} checkpoint stored after {len(responses)} turns, "
+              f"{len(calls)} tool calls")
+    finally:
+        os.environ.pop("MEMORY_SQLITE_PATH", None)
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+async def bench_kb_rag(args):
+    """Knowledge base answers through the ReAct agent vs one-shot retrieve-then-generate"""
+    print("=== Knowledge base: agent vs direct RAG ===")
+    questions = [prompt for prompt, route in load_routing_corpus() if route == "knowledge_base"][:args.questions]
+
+    async def run(mode, top_score=1.0):
+        chat_model = FakeChatModel(tool_script=["search_knowledge_base"], latency=args.model_latency)
+        retriever = FakeRetriever(latency=args.retrieval_latency, top_score=top_score, document_chars=800)
+        kb_client = make_kb_client(retriever)
+        kb_client.answer_mode = mode
+        install_fake_backends(chat_model, kb_client=kb_client)
+        before = {mode: metrics.KB_ANSWERS.value(mode=mode) for mode in ("direct", "agent_fallback", "agent")}
+        latencies = []
+        async with app_client() as client:
+            for question in questions:
+                elapsed, response = await timed_post(client, "/generate", {"prompt": question})
+                assert response.status_code == 200, response.text
+                latencies.append(elapsed * 1000)
+        answers = {mode: metrics.KB_ANSWERS.value(mode=mode) - count for mode, count in before.items()}
+        return latencies, chat_model, retriever, answers
+
+    results = {}
+    for mode in ("agent", "direct"):
+        latencies, chat_model, retriever, answers = await run(mode)
+        results[mode] = (statistics.median(latencies), len(chat_model.call_log), sum(chat_model.prompt_tokens))
+        print(f"{mode:<8} p50 {statistics.median(latencies):7.1f}ms, model calls {len(chat_model.call_log):3d}, "
+              f"input tokens {sum(chat_model.prompt_tokens):6d}, retrievals {retriever.calls} ({len(questions)} questions)")
+    agent, direct = results["agent"], results["direct"]
+    print(f"{'✅' if direct[1] * 2 <= agent[1] else '❌'} One model call per question instead of "
+          f"{agent[1] / len(questions):.0f} ({agent[0] / direct[0]:.1f}x faster, "
+          f"{1 - direct[2] / agent[2]:.0%} fewer input tokens)")
+
+    _, _, _, answers = await run("direct", top_score=0.2)
+    print(f"{'✅' if answers['agent_fallback'] == len(questions) else '❌'} Low retrieval scores fall back to the "
+          f"agent: {answers}")
+
+    documents = [
+        Document(page_content="経費精算は 月末 までに申請します。", metadata={"location": {"s3Location": {"uri": "s3://kb/経費規程.pdf"}}, "score": 0.9}),
+        Document(page_content="経費精算は月末までに申請します。", metadata={"location": {"s3Location": {"uri": "s3://kb/経費規程.pdf"}}, "score": 0.8}),
+        Document(page_content="出張旅費の上限。" * 400, metadata={"location": {"s3Location": {"uri": "s3://kb/旅費規程.pdf"}}, "score": 0.7}),
+        Document(page_content="", metadata={"score": 0.6}),
+    ]
+    context, sources = compact_documents(documents, max_tokens=600, max_document_tokens=500)
+    print(f"{'✅' if context.count('経費精算') == 1 else '❌'} Duplicate chunks removed")
+    print(f"{'✅' if estimate_tokens(context) <= 650 else '❌'} Context truncated to the budget "
+          f"({estimate_tokens(context)} tokens from {sum(estimate_tokens(d.page_content) for d in documents)})")
+    print(f"{'✅' if sources == ['経費規程.pdf', '旅費規程.pdf'] and '[2] 旅費規程.pdf' in context else '❌'} "
+          f"Chunks labelled with their sources: {sources}")
+
+
+DATA_SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "doc", "knowledge-base-data-source")
+
+
+def data_source_questions(source_dir: str):
+    """
+    Questions about single spreadsheet rows, with the row that answers each one
+
+    The second column (artist) is asked about from the third (album / title),
+    and the third from the second and fourth (e.g. the 概要 column).
+    """
+    questions = []
+    for path in source_files(source_dir):
+        if not path.lower().endswith(".xlsx"):
+            continue
+        source = os.path.relpath(path, source_dir).replace(os.sep, "/")
+        for sheet, rows in read_xlsx(path).items():
+            for number, row in enumerate(rows[1:], start=2):
+                target = (source, sheet, number)
+                if len(row) > 2 and row[2]:
+                    questions.append((f"{row[2]} のアーティストは誰ですか？", target))
+                if len(row) > 2 and row[1] and row[2]:
+                    questions.append((f"{row[1]} の {row[2]} について教えて", target))
+                if len(row) > 3 and row[3]:
+                    questions.append((f"「{row[3]}」という内容の曲は？", target))
+    return questions
+
+
+def recall_at(results, target, k: int) -> bool:
+    return any((doc.metadata.get("source"), doc.metadata.get("sheet"), doc.metadata.get("row")) == target
+               for doc in results[:k])
+
+
+async def bench_kb_local(args):
+    """Local BM25 / hybrid index vs Bedrock retrieval: recall, latency, fallback and startup"""
+    print("=== Knowledge base: local index vs remote retrieval ===")
+    index_dir = tempfile.mkdtemp(prefix="kb-local-")
+    try:
+        started = time.perf_counter()
+        index = load_or_build_index(args.source_dir, index_dir)
+        build_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        index = load_or_build_index(args.source_dir, index_dir)
+        load_ms = (time.perf_counter() - started) * 1000
+        print(f"{'✅' if load_ms < build_ms else '❌'} Startup: build {build_ms:.1f}ms, memory-mapped load "
+              f"{load_ms:.1f}ms ({len(index)} documents, {len(index.vocabulary)} terms)")
+
+        questions = data_source_questions(args.source_dir)
+        embedder = FakeEmbeddings()
+        hybrid = load_or_build_index(args.source_dir, os.path.join(index_dir, "hybrid"), embedder=embedder,
+                                     embedding_model="fake-bigram")
+        for label, search in (
+            ("bm25", lambda q: index.search(q, 5)),
+            ("hybrid", lambda q: hybrid.search(q, 5, query_vector=embedder.embed_query(q))),
+        ):
+            samples, top1, top5 = [], 0, 0
+            for question, target in questions:
+                started = time.perf_counter()
+                results = search(question)
+                samples.append((time.perf_counter() - started) * 1000)
+                top1 += recall_at(results, target, 1)
+                top5 += recall_at(results, target, 5)
+            print(f"{label:<8} recall@1 {top1 / len(questions):6.1%}  recall@5 {top5 / len(questions):6.1%}  "
+                  f"p50 {percentile(samples, 50):6.3f}ms  p99 {percentile(samples, 99):6.3f}ms ({len(questions)} questions)")
+
+        # End to end through KnowledgeBaseClient.aretrieve: Bedrock only, then local first
+        off_topic = [prompt for prompt, route in load_routing_corpus() if route == "knowledge_base"]
+        results = {}
+        for mode in ("remote", "fallback", "merge"):
+            retriever = FakeRetriever(latency=args.retrieval_latency, top_score=0.7)
+            kb_client = KnowledgeBaseClient(knowledge_base_id="FAKEKB")
+            kb_client.cache = None
+            kb_client.local_mode = mode
+            kb_client.local_min_score = args.min_score
+            kb_client.initialize(retriever=retriever, local_index=None if mode == "remote" else index)
+            samples, top5 = [], 0
+            for question, target in questions:
+                started = time.perf_counter()
+                documents = await kb_client.aretrieve(question)
+                samples.append((time.perf_counter() - started) * 1000)
+                top5 += recall_at(documents, target, 5)
+            remote_calls = retriever.calls
+            wrongly_local = 0
+            for question in off_topic:
+                documents = await kb_client.aretrieve(question)
+                wrongly_local += all(doc.metadata.get("retrieval") == "local" for doc in documents)
+            kb_client.close()
+            results[mode] = (percentile(samples, 50), top5 / len(questions))
+            print(f"{mode:<8} recall@5 {top5 / len(questions):6.1%}  p50 {percentile(samples, 50):7.2f}ms  "
+                  f"p95 {percentile(samples, 95):7.2f}ms  Bedrock calls {remote_calls:3d}/{len(questions)}  "
+                  f"off-topic answered locally {wrongly_local}/{len(off_topic)}")
+            if mode == "fallback":
+                print(f"{'✅' if wrongly_local == 0 else '❌'} Questions outside the local data reach Bedrock "
+                      f"(KB_LOCAL_MIN_SCORE={args.min_score:g})")
+        print(f"{'✅' if results['fallback'][0] < results['remote'][0] else '❌'} Local-first p50 "
+              f"{results['fallback'][0]:.2f}ms vs Bedrock {results['remote'][0]:.2f}ms "
+              f"(the fake Bedrock returns no relevant rows, so its recall is a floor)")
+
+        # A changed source file rebuilds the index and re-embeds only changed rows
+        copy_dir = os.path.join(index_dir, "sources")
+        shutil.copytree(args.source_dir, copy_dir)
+        counting = _CountingEmbeddings()
+        load_or_build_index(copy_dir, os.path.join(index_dir, "copy"), embedder=counting, embedding_model="fake-bigram")
+        first = counting.embedded
+        with open(os.path.join(copy_dir, "追加.md"), "w", encoding="utf-8") as f:
+            f.write("# 追加資料\n\nローカル索引の差分再構築を確認するための文書です。")
+        load_or_build_index(copy_dir, os.path.join(index_dir, "copy"), embedder=counting, embedding_model="fake-bigram")
+        print(f"{'✅' if counting.embedded - first == 1 else '❌'} Rebuild after a source change embedded "
+              f"{counting.embedded - first} new document(s) (first build: {first})")
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+async def bench_kb_table(args):
+    """List / count questions: top-k retrieval vs the query_table tool over the spreadsheet tables"""
+    print("=== Knowledge base: tables vs top-k retrieval for list questions ===")
+    # Ground truth straight from the sheets: rows per artist
+    expected = {}
+    for path in source_files(args.source_dir):
+        if path.lower().endswith(".xlsx"):
+            for sheet, rows in read_xlsx(path).items():
+                for row in rows[1:]:
+                    expected.setdefault((sheet, row[1]), []).append(row[2])
+    store = TableStore(args.source_dir)
+    started = time.perf_counter()
+    store.refresh(force=True)
+    print(f"Loaded {len(store.tables)} tables in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    index_dir = tempfile.mkdtemp(prefix="kb-table-")
+    try:
+        index = load_or_build_index(args.source_dir, index_dir)
+        questions = [(f"{artist} のレコードのリスト", sheet, [{"column": "artist", "value": artist}], titles)
+                     for (sheet, artist), titles in expected.items()]
+        for sheet in store.tables:
+            titles = [title for (s, _), group in expected.items() if s == sheet for title in group]
+            questions.append((f"{sheet} のレコードをすべて教えて", sheet, [], titles))
+        complete = {"retrieval": 0, "table": 0}
+        samples = {"retrieval": [], "table": []}
+        for question, sheet, filters, titles in questions:
+            started = time.perf_counter()
+            documents = index.search(question, 5)
+            samples["retrieval"].append((time.perf_counter() - started) * 1000)
+            complete["retrieval"] += all(any(f": {title}" in doc.page_content for doc in documents) for title in titles)
+            started = time.perf_counter()
+            result = store.query(TableQuery(table=sheet, filters=filters, limit=100))
+            samples["table"].append((time.perf_counter() - started) * 1000)
+            complete["table"] += sorted(row[store.get(sheet).columns[2]] for row in result["rows"]) == sorted(titles)
+        for label in ("retrieval", "table"):
+            print(f"{label:<10} complete answers {complete[label]:3d}/{len(questions)}  "
+                  f"p50 {percentile(samples[label], 50):6.3f}ms  p99 {percentile(samples[label], 99):6.3f}ms")
+        # Lists longer than numberOfResults can never be complete with top-k retrieval
+        print(f"{'✅' if complete['table'] == len(questions) else '❌'} Every list question answered exactly from the table")
+        counts = {sheet: store.query(TableQuery(table=sheet, aggregate="count"))["matched"] for sheet in store.tables}
+        truth = {}
+        for sheet, _ in expected:
+            truth[sheet] = sum(len(titles) for (s, _), titles in expected.items() if s == sheet)
+        print(f"{'✅' if counts == truth else '❌'} Counts per sheet: {counts}")
+
+        # End to end: a list question goes to the agent's query_table tool without a Bedrock retrieval
+        chat_model = FakeChatModel(tool_script=[("query_table", {
+            "table": "jazz", "filters": [{"column": "artist", "value": "Miles Davis"}]})], latency=args.model_latency)
+        retriever = FakeRetriever(latency=args.retrieval_latency)
+        kb_client = KnowledgeBaseClient(knowledge_base_id="FAKEKB")
+        kb_client.initialize(retriever=retriever, local_index=None, tables=store)
+        install_fake_backends(chat_model, kb_client=kb_client)
+        before = metrics.KB_ANSWERS.value(mode="table")
+        async with app_client() as client:
+            elapsed, response = await timed_post(client, "/generate", {"prompt": "社内文書にある Miles Davis のレコードのリストを教えて"})
+        kb_client.close()
+        print(f"{'✅' if retriever.calls == 0 and metrics.KB_ANSWERS.value(mode='table') == before + 1 else '❌'} "
+              f"List question answered through query_table in {elapsed * 1000:.0f}ms "
+              f"(Bedrock retrievals: {retriever.calls}, model calls: {len(chat_model.call_log)})")
+
+        # Incremental reload: only the changed file is read again
+        copy_dir = os.path.join(index_dir, "sources")
+        shutil.copytree(args.source_dir, copy_dir)
+        copy = TableStore(copy_dir, reload_interval=0)
+        copy.refresh(force=True)
+        loaded = copy.counters["reloaded_files"]
+        csv_path = os.path.join(copy_dir, "追加.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write("No,artist,album\n1,Chet Baker,Chet Baker Sings\n")
+        copy.refresh()
+        with open(csv_path, "a", encoding="utf-8") as f:
+            f.write("2,Chet Baker,It Could Happen to You\n")
+        copy.refresh()
+        rows = copy.query(TableQuery(table="追加", aggregate="count"))["matched"]
+        print(f"{'✅' if copy.counters['reloaded_files'] - loaded == 2 and rows == 2 else '❌'} Added and changed CSV "
+              f"reloaded {copy.counters['reloaded_files'] - loaded} time(s) without re-reading the workbook ({rows} rows)")
+
+        # Reloads on the request path and in the invalidate endpoint run on a worker thread
+        load = copy._load
+
+        def slow_load(path, tables):
+            time.sleep(args.slow_reload)
+            return load(path, tables)
+
+        copy._load = slow_load
+        kb_client = KnowledgeBaseClient(knowledge_base_id="FAKEKB")
+        kb_client.initialize(retriever=FakeRetriever(), local_index=None, tables=copy)
+        registry = install_fake_backends(FakeChatModel(), kb_client=kb_client)
+        await registry.get_knowledge_base_agent(kb_client)
+        loaded = copy.counters["reloaded_files"]
+        stalls = []
+        async with app_client() as client:
+            for reload in (lambda: registry.get_knowledge_base_agent(kb_client),
+                           lambda: client.post("/knowledge-base/cache/invalidate")):
+                with open(csv_path, "a", encoding="utf-8") as f:
+                    f.write("3,Chet Baker,Chet Baker & Strings\n")
+                stalls.append(await max_loop_stall(reload()))
+        kb_client.close()
+        reloads = copy.counters["reloaded_files"] - loaded
+        print(f"{'✅' if max(stalls) < args.slow_reload / 2 and reloads == 2 and registry.builds['knowledge_base'] == 2 else '❌'} "
+              f"{reloads} table reloads of {args.slow_reload * 1000:.0f}ms each stall the event loop at most "
+              f"{max(stalls) * 1000:.0f}ms (agent rebuilt {registry.builds['knowledge_base'] - 1} time(s))")
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+COMPLEX_PROMPTS = [
+    "新しい勤怠管理システムの設計方針を、既存システムとの違いとメリット・デメリットを比較しながら分析して提案してください",
+    "社内 Wiki の移行計画について、手順と理由をまとめ、リスクの評価と代替案の考察も加えてください",
+    "Python と Go の違いを比較し、社内ツールの実装にどちらを使うべきか理由とともに説明してください",
+]
+
+
+def tier_totals() -> dict:
+    """Calls and estimated cost per tier so far, from the model tier metrics"""
+    return {
+        tier: (sum(metrics.MODEL_TIER_CALLS.value(tier=tier, purpose=p) for p in ("answer", "tool", "synthesis")),
+               metrics.MODEL_COST.value(tier=tier))
+        for tier in TIER_ORDER
+    }
+
+
+async def bench_tiers(args):
+    """Mixed workload with every call on Nova Pro vs model tiering (Micro / Lite / Pro)"""
+    print("=== Model tiering ===")
+    corpus = load_routing_corpus()
+    workload = [(prompt, "general") for prompt, route in corpus if route == "general"]
+    workload += [(prompt, "complex") for prompt in COMPLEX_PROMPTS]
+    workload += [(prompt, route) for prompt, route in corpus if route != "general"]
+    # The small tool-step model picks a wrong tool for every fifth Asana question
+    invalid = [prompt for prompt, route in corpus if route == "asana"][::5]
+    latencies = {"micro": args.micro_latency, "lite": args.lite_latency, "pro": args.pro_latency}
+
+    async def run(policy):
+        tiers = {
+            tier: FakeChatModel(tool_script=LOAD_TOOL_SCRIPT, latency=latency, invalid_on=invalid if tier == "lite" else [])
+            for tier, latency in latencies.items()
+        }
+        install_fake_backends(TieredChatModel(tiers=tiers, policy=policy), kb_client=make_kb_client(FakeRetriever()),
+                              asana_client=_FakeAsanaClient(make_fake_asana_tools()))
+        escalations = sum(metrics.MODEL_ESCALATIONS.value(tier=tier, reason="unknown_tool") for tier in TIER_ORDER)
+        requests = []
+        async with app_client() as client:
+            for prompt, kind in workload:
+                before = tier_totals()
+                elapsed, response = await timed_post(client, "/generate", {"prompt": prompt})
+                after = tier_totals()
+                used = [tier for tier in TIER_ORDER if after[tier][0] > before[tier][0]]
+                requests.append({
+                    "kind": kind, "ms": elapsed * 1000, "ok": response.status_code == 200 and bool(response.json().get("response")),
+                    "top_tier": used[-1] if used else "none", "tiers": used,
+                    "cost": sum(after[tier][1] - before[tier][1] for tier in TIER_ORDER),
+                })
+        escalations = sum(metrics.MODEL_ESCALATIONS.value(tier=tier, reason="unknown_tool") for tier in TIER_ORDER) - escalations
+        return requests, escalations
+
+    results = {
+        "pro only": await run(TierPolicy(low=0, high=0, tool_tier="pro", synthesis_tier="pro")),
+        "tiered": await run(TierPolicy()),
+    }
+    for label, (requests, _) in results.items():
+        print(f"--- {label}: {len(requests)} requests, total cost ${sum(r['cost'] for r in requests):.6f} ---")
+        for key, name in (("kind", "workload"), ("top_tier", "highest tier")):
+            for value in dict.fromkeys(r[key] for r in requests):
+                group = [r for r in requests if r[key] == value]
+                ms = [r["ms"] for r in group]
+                costs = [r["cost"] * 1e6 for r in group]
+                print(f"  {name:<12} {value:<15} n={len(group):3d}  p50 {percentile(ms, 50):6.0f}ms  "
+                      f"p95 {percentile(ms, 95):6.0f}ms  cost/request p50 {percentile(costs, 50):7.1f}µ$  "
+                      f"p95 {percentile(costs, 95):7.1f}µ$")
+
+    pro, tiered = results["pro only"][0], results["tiered"][0]
+    pro_cost, tiered_cost = sum(r["cost"] for r in pro), sum(r["cost"] for r in tiered)
+    print(f"{'✅' if tiered_cost < pro_cost else '❌'} Tiered cost ${tiered_cost:.6f} vs ${pro_cost:.6f} "
+          f"all-Pro ({1 - tiered_cost / pro_cost:.0%} less)")
+
+    def p50(requests, kind):
+        return percentile([r["ms"] for r in requests if r["kind"] == kind], 50)
+
+    print(f"{'✅' if p50(tiered, 'general') < p50(pro, 'general') else '❌'} Simple prompts answered by Micro: "
+          f"p50 {p50(tiered, 'general'):.0f}ms vs {p50(pro, 'general'):.0f}ms")
+    complex_tiers = {r["top_tier"] for r in tiered if r["kind"] == "complex"}
+    kb_tiers = {r["top_tier"] for r in tiered if r["kind"] == "knowledge_base"}
+    print(f"{'✅' if complex_tiers <= {'lite', 'pro'} and kb_tiers == {'pro'} else '❌'} Complex prompts on "
+          f"{sorted(complex_tiers)}, knowledge base answers on {sorted(kb_tiers)}")
+    asana = [r for r in tiered if r["kind"] == "asana"]
+    print(f"{'✅' if all(r['tiers'][:1] == ['lite'] and 'pro' in r['tiers'] for r in asana) else '❌'} "
+          f"Asana tool steps on Lite, final answers on Pro")
+    escalations = results["tiered"][1]
+    print(f"{'✅' if escalations >= len(invalid) and all(r['ok'] for r in tiered) else '❌'} "
+          f"{escalations:.0f} wrong tool calls escalated to Pro, every request answered "
+          f"({sum(r['ok'] for r in tiered)}/{len(tiered)})")
+
+
+async def bench_asana_prompt(args):
+    """Asana input tokens per request: every tool schema vs per-query tool selection and the cached prefix"""
+    print("=== Asana prompt: tool selection and prompt caching ===")
+    questions = [prompt for prompt, route in load_routing_corpus() if route == "asana"]
+    tools = make_fake_asana_tools()
+    subsets = [select_tools(tools, question) for question in questions]
+    print(f"Tools bound per question: {sorted(len(s.tools) for s in subsets)} of {len(tools)} "
+          f"({sum(s.groups is None for s in subsets)} questions keep every tool)")
+
+    def tokens(kind):
+        return metrics.MODEL_TOKENS.value(model="FakeChatModel", type=kind)
+
+    async def run(selection, cache):
+        os.environ["ASANA_TOOL_SELECTION_ENABLED"] = str(selection).lower()
+        os.environ["BEDROCK_PROMPT_CACHE_ENABLED"] = str(cache).lower()
+        chat_model = FakeChatModel(tool_script=LOAD_TOOL_SCRIPT)
+        install_fake_backends(chat_model, asana_client=_FakeAsanaClient(tools))
+        saved_before = metrics.PROMPT_TOKENS_SAVED.value()
+        requests, answers = [], []
+        async with app_client() as client:
+            for question in questions:
+                before = (tokens("input"), tokens("cache_read"))
+                response = await client.post("/generate", json={"prompt": question})
+                answers.append(response.json()["response"])
+                requests.append((tokens("input") - before[0], tokens("cache_read") - before[1]))
+        return requests, answers, metrics.PROMPT_TOKENS_SAVED.value() - saved_before
+
+    results = {}
+    for label, selection, cache in (("every tool", False, False), ("tool selection", True, False),
+                                    ("selection + cache", True, True)):
+        requests, answers, saved = await run(selection, cache)
+        results[label] = (requests, answers)
+        uncached = [r[0] for r in requests]
+        print(f"{label:<18} input tokens/request p50 {percentile(uncached, 50):6.0f} p95 {percentile(uncached, 95):6.0f}, "
+              f"cache read/request p50 {percentile([r[1] for r in requests], 50):6.0f}, "
+              f"ypd_prompt_tokens_saved_total +{saved:.0f}")
+    for key in ("ASANA_TOOL_SELECTION_ENABLED", "BEDROCK_PROMPT_CACHE_ENABLED"):
+        os.environ.pop(key)
+
+    full, selected, cached = (results[label][0] for label in ("every tool", "tool selection", "selection + cache"))
+    full_total, selected_total = sum(r[0] for r in full), sum(r[0] for r in selected)
+    print(f"{'✅' if selected_total < full_total else '❌'} Tool selection sends {1 - selected_total / full_total:.0%} "
+          f"fewer input tokens ({selected_total:.0f} vs {full_total:.0f})")
+    cached_total = sum(r[0] for r in cached)
+    print(f"{'✅' if cached_total < selected_total and all(r[1] for r in cached[1:]) else '❌'} Stable prefix read "
+          f"from the cache after the first request: {cached_total:.0f} uncached input tokens, "
+          f"{sum(r[1] for r in cached):.0f} from the cache")
+    print(f"{'✅' if results['every tool'][1] == results['selection + cache'][1] else '❌'} Same answers with and "
+          f"without tool selection")
+
+
+# Questions about both Asana and the documents, with the halves a user re-asks separately
+HYBRID_QUESTIONS = [
+    ("このプロジェクトの手順書と進捗を教えて", "このプロジェクトの進捗を教えて", "このプロジェクトの手順書を教えて"),
+    ("経費精算の手順書とAsanaの担当タスクを教えて", "Asanaの担当タスクを教えて", "経費精算の手順書を教えて"),
+    ("就業規則と今週締切のタスクを確認したい", "今週締切のタスクを確認したい", "就業規則を確認したい"),
+]
+
+
+async def bench_hybrid(args):
+    """Questions about both Asana and the documents: one hybrid request vs a sequential re-ask"""
+    tool_calls = []
+    chat_model = FakeChatModel(tool_script=LOAD_TOOL_SCRIPT, latency=args.model_latency, call_log=[])
+    install_fake_backends(
+        chat_model,
+        kb_client=make_kb_client(FakeRetriever(latency=args.retrieval_latency)),
+        asana_client=_FakeAsanaClient(make_fake_asana_tools(latency=args.tool_latency, calls=tool_calls)),
+    )
+    routed = [app_main.route_query(question) for question, _, _ in HYBRID_QUESTIONS]
+    halves = [(app_main.route_query(asana), app_main.route_query(kb)) for _, asana, kb in HYBRID_QUESTIONS]
+    print(f"{'✅' if set(routed) == {'hybrid'} and set(halves) == {('asana', 'knowledge_base')} else '❌'} "
+          f"Mixed questions route to hybrid ({routed}); their halves to one route each")
+
+    async with app_client() as client:
+        async def ask(prompt: str):
+            elapsed, response = await timed_post(client, "/generate", {"prompt": prompt})
+            return elapsed, response.json().get("response", "")
+
+        print("=== One request vs asking again for the missing half ===")
+        rows = {"sequential re-ask": [], "hybrid": []}
+        for question, asana_half, kb_half in HYBRID_QUESTIONS:
+            os.environ["HYBRID_ROUTING_ENABLED"] = "false"
+            calls_before = len(chat_model.call_log)
+            first_route = intent_router.route(question)
+            elapsed, _ = await ask(question)
+            again, _ = await ask(kb_half if first_route == "asana" else asana_half)
+            rows["sequential re-ask"].append((elapsed + again, 2, len(chat_model.call_log) - calls_before))
+
+            os.environ["HYBRID_ROUTING_ENABLED"] = "true"
+            calls_before = len(chat_model.call_log)
+            elapsed, answer = await ask(question)
+            synthesis = chat_model.call_log[-1]
+            merged = "## Asanaの調査結果" in synthesis and "## 社内文書の調査結果" in synthesis
+            rows["hybrid"].append((elapsed, 1, len(chat_model.call_log) - calls_before, merged))
+        os.environ.pop("HYBRID_ROUTING_ENABLED", None)
+
+        for label, samples in rows.items():
+            print(f"{label:<18} {statistics.mean(r[0] for r in samples) * 1000:7.0f}ms per question  "
+                  f"{statistics.mean(r[1] for r in samples):.0f} requests  "
+                  f"{statistics.mean(r[2] for r in samples):.1f} model calls")
+        sequential = statistics.mean(r[0] for r in rows["sequential re-ask"])
+        hybrid = statistics.mean(r[0] for r in rows["hybrid"])
+        print(f"{'✅' if all(r[3] for r in rows['hybrid']) else '❌'} One synthesis call merges the Asana and "
+              f"document answers")
+        print(f"{'✅' if hybrid < sequential else '❌'} Answered {1 - hybrid / sequential:.0%} faster than asking "
+              f"twice (branches overlap; re-ask think time not counted)")
+
+        print(f"=== Early cancellation: asana_search_projects takes {args.slow_tool_latency:g}s ===")
+        tool_calls.clear()
+        slow_tools = make_fake_asana_tools(latency=args.tool_latency, calls=tool_calls,
+                                           latencies={"asana_search_projects": args.slow_tool_latency})
+        app_main.asana_client = _FakeAsanaClient(slow_tools)
+        os.environ["HYBRID_STRAGGLER_TIMEOUT"] = str(args.straggler_timeout)
+        try:
+            elapsed, answer = await ask(HYBRID_QUESTIONS[0][0])
+        finally:
+            os.environ.pop("HYBRID_STRAGGLER_TIMEOUT", None)
+        # Give a cancelled tool call the time it would have needed to finish
+        await asyncio.sleep(0.1)
+        cancelled = "asana_search_projects" not in tool_calls
+        print(f"{'✅' if elapsed < args.slow_tool_latency and cancelled else '❌'} Answered in {elapsed:.2f}s: the "
+              f"Asana branch was cancelled {args.straggler_timeout:g}s after the documents answered "
+              f"({'tool call cancelled' if cancelled else 'tool call completed'})")
+        print(f"{'✅' if 'Asanaからは情報を取得できませんでした' in answer else '❌'} The answer says which part is missing")
+
+
+# Asana calls of a typical task question; the second search repeats the first
+COMPACTION_TOOL_SCRIPT = [
+    ("asana_list_workspaces", {}),
+    [("asana_search_projects", {"workspace": "1001"}), ("asana_search_projects", {"workspace": "1002"})],
+    ("asana_search_tasks", {"workspace": "1001", "text": "会議"}),
+    ("asana_search_tasks", {"workspace": "1001", "text": "会議"}),
+    ("asana_get_task", {"task_id": "3001"}),
+]
+COMPACTION_QUESTIONS = [
+    "今週締切のタスクを一覧にして",
+    "会議資料のタスクの担当者と期限を教えて",
+    "Webサイトリニューアルの未完了タスクを教えて",
+]
+
+
+async def bench_compaction(args):
+    """Tool output in the agent context: raw MCP / retrieval payloads vs compacted results"""
+    print("=== Tool-output compaction: input tokens per request ===")
+
+    async def run(enabled: bool):
+        os.environ["TOOL_OUTPUT_COMPACTION_ENABLED"] = str(enabled).lower()
+        chat_model = FakeChatModel(tool_script=COMPACTION_TOOL_SCRIPT + [("search_knowledge_base", {"query": "就業規則"})] * 2,
+                                   prompt_tokens=[])
+        kb_client = make_kb_client(FakeRetriever(document_chars=args.document_chars))
+        kb_client.answer_mode = "agent"
+        install_fake_backends(chat_model, kb_client=kb_client,
+                              asana_client=_FakeAsanaClient(make_fake_asana_tools(payloads=True)))
+        rows, answers = [], []
+        async with app_client() as client:
+            for question in COMPACTION_QUESTIONS + ["就業規則の休暇の規定を教えて"]:
+                calls_before = len(chat_model.prompt_tokens)
+                response = await client.post("/generate", json={"prompt": question})
+                answers.append(response.json()["response"])
+                rows.append(sum(chat_model.prompt_tokens[calls_before:]))
+        return rows, answers
+
+    saved_before = {route: metrics.TOOL_OUTPUT_REQUEST_TOKENS_SAVED.count(route=route) for route in ("asana", "knowledge_base")}
+    full, full_answers = await run(False)
+    compacted, compacted_answers = await run(True)
+    os.environ.pop("TOOL_OUTPUT_COMPACTION_ENABLED", None)
+    for label, rows in (("raw payloads", full), ("compacted", compacted)):
+        print(f"{label:<13} Asana input tokens/request {statistics.mean(rows[:-1]):7.0f}, "
+              f"knowledge base agent {rows[-1]:6.0f}")
+    asana_full, asana_compacted = sum(full[:-1]), sum(compacted[:-1])
+    print(f"{'✅' if asana_compacted < asana_full * 0.6 else '❌'} Asana requests send {1 - asana_compacted / asana_full:.0%} "
+          f"fewer input tokens")
+    print(f"{'✅' if compacted[-1] < full[-1] else '❌'} Knowledge base agent sends {1 - compacted[-1] / full[-1]:.0%} "
+          f"fewer input tokens")
+    print(f"{'✅' if full_answers == compacted_answers else '❌'} Same answers with and without compaction")
+    observed = {route: metrics.TOOL_OUTPUT_REQUEST_TOKENS_SAVED.count(route=route) - count for route, count in saved_before.items()}
+    print(f"{'✅' if observed == {'asana': 3, 'knowledge_base': 1} else '❌'} Savings observed once per compacted "
+          f"request: {observed}; totals {metrics.TOOL_OUTPUT_TOKENS_SAVED.value(route='asana'):.0f} tokens / "
+          f"{metrics.TOOL_OUTPUT_BYTES_SAVED.value(route='asana'):.0f} bytes (asana), "
+          f"{metrics.TOOL_OUTPUT_TOKENS_SAVED.value(route='knowledge_base'):.0f} tokens (knowledge base)")
+
+    print("=== Tool messages of one request ===")
+    agent = create_asana_agent(FakeChatModel(tool_script=COMPACTION_TOOL_SCRIPT), make_fake_asana_tools(payloads=True))
+    result = await agent.ainvoke({"messages": [HumanMessage(content=COMPACTION_QUESTIONS[1])]})
+    tool_messages = [m for m in result["messages"] if isinstance(m, ToolMessage)]
+    for message in tool_messages:
+        print(f"{message.name:<24} {estimate_tokens(message.artifact):6d} -> {estimate_tokens(message.content):5d} tokens")
+    searches = [m for m in tool_messages if m.name == "asana_search_tasks"]
+    print(f"{'✅' if all(json.loads(m.artifact) == json.loads(fake_asana_payload(m.name, {})) for m in tool_messages if m.name != 'asana_search_projects') else '❌'} "
+          f"Full payloads kept as tool message artifacts")
+    print(f"{'✅' if searches[1].content == DUPLICATE_NOTE else '❌'} Repeated call replaced by a reference to the first result")
+    projected = json.loads(searches[0].content.split("\n")[0])["data"][0]
+    print(f"{'✅' if 'html_notes' not in projected and projected['assignee'] == {'gid': '4001', 'name': '山田 太郎'} else '❌'} "
+          f"Asana JSON projected: {sorted(projected)}")
+
+    kb_client = make_kb_client(FakeRetriever(document_chars=args.document_chars))
+    agent = create_knowledge_base_agent(FakeChatModel(tool_script=[("search_knowledge_base", {"query": "就業規則"})] * 2), kb_client)
+    result = await agent.ainvoke({"messages": [HumanMessage(content="就業規則の休暇の規定を教えて")]})
+    first, second = [m for m in result["messages"] if isinstance(m, ToolMessage)]
+    print(f"{'✅' if second.content == DOCUMENTS_SEEN_NOTE and len(second.artifact) == len(first.artifact) == 5 else '❌'} "
+          f"Documents already shown are left out of the second search ({estimate_tokens(str(first.artifact))} -> "
+          f"{estimate_tokens(first.content)} tokens for the first)")
+
+    os.environ["TOOL_OUTPUT_MAX_REQUEST_TOKENS"] = str(args.request_budget)
+    try:
+        agent = create_asana_agent(FakeChatModel(tool_script=COMPACTION_TOOL_SCRIPT), make_fake_asana_tools(payloads=True))
+        result = await agent.ainvoke({"messages": [HumanMessage(content=COMPACTION_QUESTIONS[1])]})
+    finally:
+        os.environ.pop("TOOL_OUTPUT_MAX_REQUEST_TOKENS")
+    contents = [m.content for m in result["messages"] if isinstance(m, ToolMessage)]
+    total = sum(estimate_tokens(content) for content in contents)
+    print(f"{'✅' if total <= args.request_budget + estimate_tokens(BUDGET_NOTE) else '❌'} Request budget of "
+          f"{args.request_budget} tokens: {total} tokens of tool output ({[estimate_tokens(c) for c in contents]})")
+
+    payload = fake_asana_payload("asana_search_tasks", {})
+    compactor = ToolOutputCompactor("asana")
+    message = ToolMessage(content=payload, name="asana_search_tasks", tool_call_id="call_0")
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        compactor.compact([], [message])
+    per_call = (time.perf_counter() - start) / args.iterations
+    print(f"{'✅' if per_call < 0.05 else '❌'} Compacting a {len(payload.encode('utf-8')) // 1024} KB search result takes "
+          f"{per_call * 1000:.2f}ms")
+
+
+# Asana calls of a task question: discovery first, then the search
+PREFETCH_TOOL_SCRIPT = [
+    ("asana_list_workspaces", {}),
+    [("asana_search_projects", {"workspace": "1001"}), ("asana_search_projects", {"workspace": "1002"})],
+    ("asana_search_tasks", {"workspace": "1001", "text": "会議"}),
+]
+PREFETCH_QUESTIONS = ["会議資料のタスクの期限を教えて", "Webサイトリニューアルの未完了タスクは？", "今週締切のタスクを一覧にして"]
+
+
+async def bench_prefetch(args):
+    """Asana questions with and without the prefetched workspace / project directory, and KB warm-up"""
+    print(f"=== Asana directory prefetch (fake_mcp_server.py, {args.tool_latency:g}s per tool call) ===")
+    asana_client = AsanaMCPClient(access_token="fake-token", command=sys.executable,
+                                  args=[FAKE_MCP_SERVER, "--latency", str(args.tool_latency)], pool_size=1)
+    await asana_client.initialize()
+    try:
+        async def run(prefetcher):
+            chat_model = FakeChatModel(tool_script=PREFETCH_TOOL_SCRIPT, latency=args.model_latency, call_log=[])
+            registry = install_fake_backends(chat_model, asana_client=asana_client)
+            registry.asana_directory = prefetcher.directory_prompt if prefetcher else None
+            asana_client.tool_cache.clear()
+            latencies, answers = [], []
+            async with app_client() as client:
+                for question in PREFETCH_QUESTIONS:
+                    elapsed, response = await timed_post(client, "/generate", {"prompt": question})
+                    latencies.append(elapsed)
+                    answers.append(response.json()["response"])
+            return statistics.mean(latencies), len(chat_model.call_log) / len(PREFETCH_QUESTIONS), answers
+
+        cold = await run(None)
+        prefetcher = Prefetcher(asana_client=asana_client, asana_interval=args.interval, max_staleness=args.max_staleness)
+        prefetcher.start()
+        for _ in range(100):
+            if prefetcher.directory is not None:
+                break
+            await asyncio.sleep(0.05)
+        directory = prefetcher.directory
+        print(f"{'✅' if directory and [w['gid'] for w in directory.workspaces] == ['1001', '1002'] and directory.project_count() == 3 else '❌'} "
+              f"Snapshot from the MCP server: {directory.workspaces if directory else None}, "
+              f"{directory.project_count() if directory else 0} projects")
+        warm = await run(prefetcher)
+        for label, (latency, calls, _) in (("discovery calls", cold), ("prefetched", warm)):
+            print(f"{label:<16} {latency * 1000:7.0f}ms per question, {calls:.1f} model calls")
+        print(f"{'✅' if warm[1] < cold[1] and warm[0] < cold[0] else '❌'} Prefetched directory skips "
+              f"{cold[1] - warm[1]:.0f} model steps per question ({1 - warm[0] / cold[0]:.0%} faster)")
+        print(f"{'✅' if warm[2] == cold[2] else '❌'} Same answers with and without the prefetched directory")
+
+        await asyncio.sleep(args.interval * 2.5)
+        refreshes = prefetcher.counters["asana_refreshes"]
+        print(f"{'✅' if refreshes >= 3 else '❌'} Refreshed every {args.interval:g}s in the background ({refreshes} refreshes)")
+        app_main.prefetcher = prefetcher
+        async with app_client() as client:
+            stats = (await client.get("/health")).json()["services"]["prefetch"]
+        app_main.prefetcher = None
+        print(f"{'✅' if stats['asana']['fresh'] and stats['asana']['projects'] == 3 else '❌'} /health reports the "
+              f"snapshot: {stats['asana']}")
+
+        asana_client_before = prefetcher.asana_client
+        prefetcher.asana_client = _FakeAsanaClient([])
+        await asyncio.sleep(args.interval * 1.5)
+        kept = prefetcher.directory is directory or prefetcher.directory.project_count() == 3
+        print(f"{'✅' if prefetcher.counters['asana_errors'] and kept else '❌'} A failed refresh keeps the last snapshot "
+              f"({prefetcher.counters['asana_errors']} errors)")
+        prefetcher.asana_client = asana_client_before
+        await prefetcher.close()
+
+        stale = Prefetcher(asana_client=asana_client, asana_interval=3600, max_staleness=args.max_staleness)
+        await stale.refresh_asana()
+        await asyncio.sleep(args.max_staleness * 1.5)
+        expired = await run(stale)
+        print(f"{'✅' if stale.directory_prompt() is None and expired[1] == cold[1] else '❌'} A snapshot older than "
+              f"{args.max_staleness:g}s is not used ({expired[1]:.1f} model calls per question)")
+    finally:
+        await asana_client.close()
+
+    print(f"=== Knowledge base warm-up ({args.retrieval_latency:g}s per retrieval) ===")
+    questions = [prompt for prompt, route in load_routing_corpus() if route == "knowledge_base"][:4]
+    retriever = FakeRetriever(latency=args.retrieval_latency)
+    kb_client = make_kb_client(retriever)
+    install_fake_backends(FakeChatModel(latency=args.model_latency), kb_client=kb_client)
+    prefetcher = Prefetcher(kb_client=kb_client, kb_queries=questions[:2])
+    warmed = await prefetcher.warm_knowledge_base()
+    calls = retriever.calls
+    async with app_client() as client:
+        latencies = [(await timed_post(client, "/generate", {"prompt": question}))[0] for question in questions]
+    print(f"warmed questions {statistics.mean(latencies[:2]) * 1000:7.0f}ms, cold questions "
+          f"{statistics.mean(latencies[2:]) * 1000:7.0f}ms")
+    print(f"{'✅' if warmed == 2 and retriever.calls - calls == 2 else '❌'} Warmed questions answered from the "
+          f"retrieval cache ({retriever.calls - calls} retrievals for {len(questions)} questions)")
+    await prefetcher.warm_knowledge_base()
+    print(f"{'✅' if retriever.calls == calls + 4 and kb_client.cache.stats()['entries'] == 4 else '❌'} Warm-up "
+          f"retrieves again to refresh the cached entries ({kb_client.cache.stats()['entries']} entries)")
+    kb_client.close()
+
+
+# A confused model: one more task search after every result, never an answer
+LOOPING_TOOL_SCRIPT = [("asana_search_tasks", {"workspace": "1001", "text": f"会議 {i}"}) for i in range(40)]
+# The same, calling four searches per turn
+FANOUT_TOOL_SCRIPT = [
+    [("asana_search_tasks", {"workspace": "1001", "text": f"会議 {i}-{j}"}) for j in range(4)] for i in range(10)
+]
+
+
+async def bench_budget(args):
+    """Request deadlines and agent step / tool-call budgets: looping agents stop with a partial answer"""
+    question = "今週締切のタスクを一覧にして"
+    os.environ["AGENT_MAX_STEPS"] = str(args.max_steps)
+    os.environ["AGENT_MAX_TOOL_CALLS"] = str(args.max_tool_calls)
+    os.environ["AGENT_PARTIAL_ANSWER_RESERVE"] = "0.5"
+
+    async def ask(script, tool_latency=0.0, prompt=question, budget=True, session_id=None, memory=None,
+                  model_latency=args.model_latency):
+        tool_calls = []
+        chat_model = FakeChatModel(tool_script=script, latency=model_latency, call_log=[])
+        install_fake_backends(chat_model, asana_client=_FakeAsanaClient(
+            make_fake_asana_tools(latency=tool_latency, calls=tool_calls)), memory=memory)
+        os.environ["REQUEST_BUDGET_ENABLED"] = str(budget).lower()
+        payload = {"prompt": prompt, **({"session_id": session_id} if session_id else {})}
+        async with app_client() as client:
+            elapsed, response = await timed_post(client, "/generate", payload)
+        return elapsed, response, chat_model.call_log, tool_calls
+
+    async def ask_stream(script, tool_latency=0.0, prompt=question, model_latency=args.model_latency):
+        tool_calls = []
+        chat_model = FakeChatModel(tool_script=script, latency=model_latency, call_log=[])
+        install_fake_backends(chat_model, asana_client=_FakeAsanaClient(
+            make_fake_asana_tools(latency=tool_latency, calls=tool_calls)))
+        os.environ["REQUEST_BUDGET_ENABLED"] = "true"
+        start = time.perf_counter()
+        async with app_client() as client:
+            async with client.stream("POST", "/generate/stream", json={"prompt": prompt}) as response:
+                events = {event: data async for event, data in read_sse(response)}
+        return time.perf_counter() - start, events, chat_model.call_log, tool_calls
+
+    try:
+        print(f"=== Looping Asana agent (budget: {args.max_steps} steps, {args.max_tool_calls} tool calls) ===")
+        rows = {}
+        for label, budget in (("no budget", False), ("budget", True)):
+            rows[label] = await ask(LOOPING_TOOL_SCRIPT, budget=budget)
+            elapsed, response, calls, tools = rows[label]
+            print(f"{label:<10} {elapsed * 1000:7.0f}ms  {len(calls):3d} model calls  {len(tools):3d} tool calls")
+        elapsed, response, calls, tools = rows["budget"]
+        answer = response.json().get("response", "")
+        print(f"{'✅' if len(calls) == args.max_steps + 1 and len(tools) == args.max_steps - 1 else '❌'} Stopped after "
+              f"{args.max_steps} model steps; the last step's tool call was not run, one call wrote the answer")
+        print(f"{'✅' if response.status_code == 200 and '調査を途中で打ち切りました' in answer else '❌'} Partial answer "
+              f"with a note: ...{answer[-60:]!r}")
+        prompt = calls[-1]
+        print(f"{'✅' if f'会議 {args.max_steps - 2}' in prompt and question in prompt else '❌'} The partial answer "
+              f"is written from the tool results gathered so far ({prompt.count('の結果')} results)")
+
+        elapsed, response, calls, tools = await ask(FANOUT_TOOL_SCRIPT)
+        print(f"{'✅' if len(tools) <= args.max_tool_calls and len(tools) % 4 == 0 else '❌'} Tool-call budget: "
+              f"stopped before the turn that would exceed {args.max_tool_calls} calls ({len(tools)} run)")
+
+        tool_calls = []
+        chat_model = FakeChatModel(tool_script=LOOPING_TOOL_SCRIPT, latency=args.model_latency, call_log=[])
+        install_fake_backends(chat_model, asana_client=_FakeAsanaClient(make_fake_asana_tools(calls=tool_calls)))
+        os.environ["REQUEST_BUDGET_ENABLED"] = "true"
+        prompts = [question, "来週締切のタスクを一覧にして"]
+        async with app_client() as client:
+            response = await client.post("/generate/batch", json={"prompts": prompts})
+        items = [json.loads(line) for line in response.text.splitlines() if line]
+        stopped = all('調査を途中で打ち切りました' in item.get('response', '') for item in items)
+        print(f"{'✅' if stopped and len(tool_calls) == len(prompts) * (args.max_steps - 1) else '❌'} Batch: each "
+              f"agent item stops at its own budget ({len(tool_calls)} tool calls for {len(items)} items)")
+
+        elapsed, events, calls, tools = await ask_stream(LOOPING_TOOL_SCRIPT)
+        answer = events.get("done", {}).get("response", "")
+        print(f"{'✅' if '調査を途中で打ち切りました' in answer and len(tools) == args.max_steps - 1 else '❌'} Stream: "
+              f"stopped after {len(tools)} tool calls, the done event carries the partial answer")
+
+        ok = [await ask(PREFETCH_TOOL_SCRIPT, budget=budget) for budget in (False, True)]
+        print(f"{'✅' if ok[0][1].json() == ok[1][1].json() and '打ち切り' not in ok[1][1].json()['response'] else '❌'} "
+              f"Questions within the budget get the same answer as without it")
+
+        print(f"=== Deadline ({args.deadline:g}s, {args.slow_tool_latency:g}s per tool call) ===")
+        os.environ["REQUEST_DEADLINE"] = str(args.deadline)
+        elapsed, response, calls, tools = await ask(LOOPING_TOOL_SCRIPT, tool_latency=args.slow_tool_latency)
+        finished = len(tools)
+        await asyncio.sleep(args.slow_tool_latency * 2)
+        answer = response.json().get("response", "")
+        print(f"{'✅' if elapsed <= args.deadline + 0.2 and '制限時間' in answer else '❌'} Answered in "
+              f"{elapsed:.2f}s from {finished} tool results: ...{answer[-50:]!r}")
+        print(f"{'✅' if len(tools) == finished else '❌'} The in-flight tool call was cancelled at the deadline "
+              f"({len(tools) - finished} finished afterwards)")
+
+        trace_path = os.path.join(tempfile.mkdtemp(prefix="budget-trace-"), "trace.jsonl")
+        app_main.trace_recorder = TraceRecorder(trace_path)
+        try:
+            elapsed, events, calls, tools = await ask_stream(LOOPING_TOOL_SCRIPT, tool_latency=args.slow_tool_latency)
+            answer = events.get("done", {}).get("response", "")
+            print(f"{'✅' if elapsed <= args.deadline + 0.2 and '制限時間' in answer else '❌'} Stream answered in "
+                  f"{elapsed:.2f}s with the partial answer as the done event")
+            general = next(p for p, route in load_routing_corpus() if route == "general")
+            elapsed, events, calls, tools = await ask_stream([], prompt=general, model_latency=args.deadline * 2)
+            print(f"{'✅' if 'error' in events and 'done' not in events and elapsed < args.deadline * 2 else '❌'} "
+                  f"A streamed general question past the deadline ends with an error event after {elapsed:.2f}s")
+        finally:
+            app_main.trace_recorder = None
+        statuses = [entry["status"] for entry in load_trace(trace_path)]
+        shutil.rmtree(os.path.dirname(trace_path), ignore_errors=True)
+        print(f"{'✅' if statuses == [200, 504] else '❌'} The trace records the partial-answer stream and the "
+              f"timed-out stream with their outcomes (status {statuses})")
+
+        elapsed, response, calls, tools = await ask([], prompt=general, model_latency=args.deadline * 2)
+        print(f"{'✅' if response.status_code == 504 and elapsed < args.deadline * 2 else '❌'} A general question "
+              f"past the deadline gets 504 after {elapsed:.2f}s (deadline + 1s grace; model call cancelled)")
+
+        tool_calls = []
+        chat_model = FakeChatModel(tool_script=LOAD_TOOL_SCRIPT * 10, latency=args.model_latency, call_log=[])
+        install_fake_backends(
+            chat_model,
+            kb_client=make_kb_client(FakeRetriever(latency=args.model_latency)),
+            asana_client=_FakeAsanaClient(make_fake_asana_tools(latency=args.slow_tool_latency, calls=tool_calls)),
+        )
+        async with app_client() as client:
+            elapsed, response = await timed_post(client, "/generate", {"prompt": HYBRID_QUESTIONS[0][0]})
+        print(f"{'✅' if response.status_code == 200 and elapsed <= args.deadline + 0.2 else '❌'} Hybrid branches "
+              f"share the deadline: answered in {elapsed:.2f}s")
+        os.environ.pop("REQUEST_DEADLINE", None)
+
+        print("=== Sessions ===")
+        memory = SessionMemory()
+        await memory.initialize()
+        await ask(LOOPING_TOOL_SCRIPT, session_id="budget", memory=memory)
+        agent = await app_main.agent_registry.get_asana_agent(app_main.asana_client, session=True)
+        state = await agent.aget_state({"configurable": {"thread_id": "asana:budget"}})
+        messages = state.values["messages"]
+        answered = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+        dangling = [call for m in messages for call in getattr(m, "tool_calls", []) if call["id"] not in answered]
+        print(f"{'✅' if not dangling and '打ち切り' in messages[-1].content and not state.next else '❌'} The stopped "
+              f"turn is stored with every tool call answered and the partial answer last")
+        elapsed, response, calls, tools = await ask(PREFETCH_TOOL_SCRIPT, session_id="budget", memory=memory)
+        print(f"{'✅' if response.status_code == 200 and response.json()['response'].endswith('への回答です。') else '❌'} "
+              f"The session continues with the next question")
+        await memory.close()
+
+        print("=== Metrics ===")
+        runs = {outcome: metrics.AGENT_RUNS.value(route="asana", outcome=outcome)
+                for outcome in ("completed", "steps", "tool_calls", "deadline")}
+        print(f"{'✅' if all(runs.values()) else '❌'} ypd_agent_runs_total by outcome: {runs}")
+        print(f"{'✅' if metrics.REQUEST_DEADLINES.value(route='general') else '❌'} "
+              f"ypd_request_deadline_exceeded_total counts the 504")
+    finally:
+        for name in ("AGENT_MAX_STEPS", "AGENT_MAX_TOOL_CALLS", "AGENT_PARTIAL_ANSWER_RESERVE",
+                     "REQUEST_BUDGET_ENABLED", "REQUEST_DEADLINE"):
+            os.environ.pop(name, None)
+
+
+class _CountingEmbeddings(FakeEmbeddings):
+    """FakeEmbeddings that counts embedded documents"""
+
+    def __init__(self):
+        super().__init__()
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+FAKE_MCP_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_mcp_server.py")
+
+# One script drives both agents: the model only calls the tools bound to the agent it runs in
+LOAD_TOOL_SCRIPT = [
+    ("search_knowledge_base", {"query": "就業規則"}),
+    ("asana_list_workspaces", {}),
+    ("asana_search_projects", {"workspace": "1001"}),
+]
+
+
+def percentile(samples, q: float) -> float:
+    """Nearest-rank percentile (q in 0-100)"""
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def git_commit() -> str:
+    """Current commit, recorded with the results so that runs can be compared between commits"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def synthetic_trace(requests: int):
+    """Closed-loop trace cycling through the routing corpus (its route mix)"""
+    corpus = load_routing_corpus()
+    return [
+        {"offset": 0.0, "endpoint": "generate", "route": route, "prompt": prompt}
+        for prompt, route in (corpus[i % len(corpus)] for i in range(requests))
+    ]
+
+
+def fill_trace_prompts(trace):
+    """Give entries recorded without prompts a corpus prompt of the same route"""
+    by_route = {}
+    for prompt, route in load_routing_corpus():
+        by_route.setdefault(route, []).append(prompt)
+    used = {}
+    for entry in trace:
+        if "prompt" not in entry:
+            prompts = by_route.get(entry.get("route"), by_route["general"])
+            entry["prompt"] = prompts[used.get(entry.get("route"), 0) % len(prompts)]
+            used[entry.get("route")] = used.get(entry.get("route"), 0) + 1
+    return trace
+
+
+async def install_load_backends(args):
+    """Fake Bedrock model, KB retriever and Asana tools (or fake MCP server processes) for load runs"""
+    chat_model = FakeChatModel(tool_script=LOAD_TOOL_SCRIPT, latency=args.model_latency)
+    kb_client = make_kb_client(FakeRetriever(latency=args.retrieval_latency))
+    if args.mcp:
+        asana_client = AsanaMCPClient(
+            access_token="fake-token", command=sys.executable,
+            args=[FAKE_MCP_SERVER, "--latency", str(args.tool_latency)]
+        )
+        await asana_client.initialize()
+    else:
+        asana_client = _FakeAsanaClient(make_fake_asana_tools(latency=args.tool_latency))
+    install_fake_backends(chat_model, kb_client=kb_client, asana_client=asana_client)
+    return asana_client if args.mcp else None
+
+
+async def run_trace(client: httpx.AsyncClient, trace, concurrency: int, speed: float = 0.0):
+    """
+    Send the requests of a trace
+
+    Args:
+        client: Client for the app (in-process or a running server)
+        trace: Trace entries with prompts
+        concurrency: Maximum requests in flight (closed loop)
+        speed: Replay recorded offsets at this speed-up (open loop); 0 sends as fast as concurrency allows
+
+    Returns:
+        ([(route, seconds, ok)], wall-clock seconds)
+    """
+    results = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(entry):
+        async with semaphore:
+            payload = {"prompt": entry["prompt"]}
+            if entry.get("session_id"):
+                payload["session_id"] = entry["session_id"]
+            start = time.perf_counter()
+            try:
+                if entry.get("endpoint") == "stream":
+                    async with client.stream("POST", "/generate/stream", json=payload) as response:
+                        body = await response.aread()
+                    ok = response.status_code == 200 and b"event: error" not in body
+                else:
+                    response = await client.post("/generate", json=payload)
+                    ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            results.append((entry.get("route", "unknown"), time.perf_counter() - start, ok))
+
+    start = time.perf_counter()
+    tasks = []
+    for entry in trace:
+        if speed:
+            await asyncio.sleep(max(0.0, start + entry.get("offset", 0.0) / speed - time.perf_counter()))
+        tasks.append(asyncio.create_task(one(entry)))
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start
+
+
+def latency_report(results, elapsed: float) -> dict:
+    """p50/p95/p99 latency, throughput and error count per route and overall"""
+    report = {}
+    groups = {"all": results}
+    for route in sorted({route for route, _, _ in results}):
+        groups[route] = [result for result in results if result[0] == route]
+    for name, group in groups.items():
+        latencies = [seconds * 1000 for _, seconds, _ in group]
+        report[name] = {
+            "requests": len(group),
+            "errors": sum(1 for _, _, ok in group if not ok),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "throughput_rps": round(len(group) / elapsed, 2),
+        }
+    return report
+
+
+async def measure_route_memory(client: httpx.AsyncClient, trace, concurrency: int) -> dict:
+    """Peak Python heap allocated while serving each route's requests alone (tracemalloc)"""
+    memory = {}
+    tracemalloc.start()
+    try:
+        for route in sorted({entry.get("route", "unknown") for entry in trace}):
+            entries = [entry for entry in trace if entry.get("route", "unknown") == route]
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            await run_trace(client, entries, concurrency)
+            _, peak = tracemalloc.get_traced_memory()
+            memory[route] = round((peak - baseline) / 1024, 1)
+    finally:
+        tracemalloc.stop()
+    return memory
+
+
+def print_load_report(report: dict, memory: dict):
+    print(f"{'route':<16}{'requests':>9}{'errors':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'req/s':>9}{'peak KiB':>10}")
+    for route, row in report.items():
+        peak = f"{memory[route]:10.1f}" if route in memory else f"{'':>10}"
+        print(f"{route:<16}{row['requests']:>9}{row['errors']:>7}{row['p50_ms']:>8.1f}ms{row['p95_ms']:>8.1f}ms"
+              f"{row['p99_ms']:>8.1f}ms{row['throughput_rps']:>9.1f}{peak}")
+    print(f"Max RSS of the benchmark process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float, compare_throughput: bool = True) -> int:
+    """Print changes against a saved run; returns the number of regressions beyond tolerance"""
+    print(f"--- vs baseline {baseline.get('commit', '?')} (tolerance {tolerance:.0%}) ---")
+    regressions = 0
+    # Open-loop replays send at the recorded rate, so their throughput says nothing about the code
+    metrics_compared = [("p50_ms", True), ("p95_ms", True), ("p99_ms", True)]
+    if compare_throughput:
+        metrics_compared.append(("throughput_rps", False))
+    for route, row in report.items():
+        before = baseline.get("routes", {}).get(route)
+        if not before:
+            continue
+        for key, higher_is_worse in metrics_compared:
+            if not before.get(key):
+                continue
+            change = (row[key] - before[key]) / before[key]
+            regressed = change > tolerance if higher_is_worse else change < -tolerance
+            regressions += regressed
+            print(f"{'❌' if regressed else '✅'} {route:<16}{key:<16}{before[key]:>10.1f} -> {row[key]:>10.1f} ({change:+.1%})")
+    return regressions
+
+
+async def run_load(args, trace, label: str):
+    """Run a trace against fake backends (or --url), print the report and save / compare results"""
+    print(f"=== {label}: {len(trace)} requests, concurrency {args.concurrency} ===")
+    mcp_client = None
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=120)
+    else:
+        mcp_client = await install_load_backends(args)
+        client = app_client()
+    try:
+        async with client:
+            # Warm up connection pools and lazily built agents outside the measurement
+            await run_trace(client, trace[:min(len(trace), args.concurrency)], args.concurrency)
+            results, elapsed = await run_trace(client, trace, args.concurrency, getattr(args, "speed", 0.0))
+            memory = await measure_route_memory(client, trace, args.concurrency) if args.memory else {}
+    finally:
+        if mcp_client:
+            await mcp_client.close()
+
+    report = latency_report(results, elapsed)
+    print_load_report(report, memory)
+    summary = {
+        "commit": git_commit(),
+        "label": label,
+        "config": {key: value for key, value in vars(args).items() if key != "func"},
+        "routes": report,
+        "memory_kib": memory,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        closed_loop = not getattr(args, "speed", 0.0) and not baseline.get("config", {}).get("speed")
+        regressions = compare_with_baseline(report, baseline, args.tolerance, compare_throughput=closed_loop)
+        if regressions:
+            raise SystemExit(f"{regressions} regressions against {args.baseline}")
+
+
+async def bench_load(args):
+    """Closed-loop load over the routing corpus mix"""
+    await run_load(args, synthetic_trace(args.requests), "load")
+
+
+async def bench_replay(args):
+    """Replay a recorded trace"""
+    trace = fill_trace_prompts(load_trace(args.trace))
+    if args.limit:
+        trace = trace[:args.limit]
+    await run_load(args, trace, f"replay {os.path.basename(args.trace)}")
+
+
+def measure_imports(runs: int):
+    """Median seconds to import main in a fresh interpreter, and to import the deferred modules afterwards"""
+    code = (
+        "import importlib, json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import main\n"
+        "imported = time.perf_counter() - start\n"
+        "from startup import PRELOAD_MODULES\n"
+        "loaded = [name for name in PRELOAD_MODULES if name in sys.modules]\n"
+        "start = time.perf_counter()\n"
+        "for name in PRELOAD_MODULES:\n"
+        "    importlib.import_module(name)\n"
+        "print(json.dumps([imported, time.perf_counter() - start, loaded]))\n"
+    )
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return (statistics.median(s[0] for s in samples), statistics.median(s[1] for s in samples),
+            sorted({name for s in samples for name in s[2]}))
+
+
+def measure_startup(env: dict, timeout: float = 60.0) -> dict:
+    """
+    Start the app with uvicorn and poll the probes
+
+    Returns:
+        Seconds from process start to the first /health/live and /health/ready
+        200 responses, whether readiness answered 503 before that, and the
+        startup phases the app reported
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    result = {"live": None, "ready": None, "not_ready_seen": False, "startup": None}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=2) as client:
+            while result["ready"] is None and time.perf_counter() - started < timeout:
+                try:
+                    if result["live"] is None and client.get("/health/live").status_code == 200:
+                        result["live"] = time.perf_counter() - started
+                    response = client.get("/health/ready")
+                    if response.status_code == 200:
+                        result["ready"] = time.perf_counter() - started
+                        result["startup"] = response.json()["startup"]
+                    elif response.status_code == 503:
+                        result["not_ready_seen"] = True
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.02)
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+async def bench_startup(args):
+    """Import time and time-to-ready: npx-resolved MCP server and sequential init vs the cold-start path"""
+    print("=== Cold start ===")
+    imported, deferred, loaded = measure_imports(args.runs)
+    print(f"import main {imported * 1000:6.0f}ms (median of {args.runs}); deferred modules "
+          f"{', '.join(PRELOAD_MODULES)} import in {deferred * 1000:.0f}ms afterwards")
+    print(f"{'✅' if not loaded else '❌'} Heavy modules not imported with the app: "
+          f"{'none loaded' if not loaded else loaded}")
+
+    index_dir = tempfile.mkdtemp(prefix="startup-")
+    try:
+        # The local index is built once, like an image that ships it
+        load_or_build_index(DATA_SOURCE_DIR, index_dir)
+        env = {
+            "ASANA_ACCESS_TOKEN": "benchmark", "BEDROCK_KNOWLEDGE_BASE_ID": "FAKEKB",
+            "KB_LOCAL_SOURCE_DIR": DATA_SOURCE_DIR, "KB_LOCAL_INDEX_DIR": index_dir,
+            "ASANA_MCP_POOL_SIZE": "2",
+        }
+        runs = [
+            ("npx -y, sequential", {"ASANA_MCP_COMMAND": f"{sys.executable} {FAKE_MCP_SERVER} --startup-delay {args.npx_delay}",
+                                    "STARTUP_CONCURRENT_INIT": "false"}),
+            ("local binary, concurrent", {"ASANA_MCP_COMMAND": f"{sys.executable} {FAKE_MCP_SERVER}"}),
+            ("+ background init", {"ASANA_MCP_COMMAND": f"{sys.executable} {FAKE_MCP_SERVER}",
+                                   "STARTUP_BACKGROUND_INIT": "true"}),
+        ]
+        results = {}
+        for label, extra in runs:
+            result = measure_startup({**env, **extra})
+            results[label] = result
+            phases = (result["startup"] or {}).get("phases", {})
+            live = f"{result['live']:5.2f}s" if result["live"] is not None else "  n/a"
+            ready = f"{result['ready']:5.2f}s" if result["ready"] is not None else "  n/a"
+            print(f"{label:<26} live {live}  ready {ready}  phases "
+                  f"{', '.join(f'{name} {seconds:.2f}s' for name, seconds in phases.items())}")
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+    baseline, concurrent, background = (results[label] for label, _ in runs)
+    if None in (baseline["ready"], concurrent["ready"], background["ready"]):
+        print("❌ The app did not become ready")
+        return
+    print(f"{'✅' if concurrent['ready'] < baseline['ready'] - args.npx_delay / 2 else '❌'} Time to ready "
+          f"{concurrent['ready']:.2f}s vs {baseline['ready']:.2f}s with npx -y ({args.npx_delay:g}s simulated resolve) "
+          f"and sequential init")
+    phases = concurrent["startup"]["phases"]
+    overlap = phases["asana_mcp"] + phases["knowledge_base"] + phases["memory"] - concurrent["startup"]["seconds_to_ready"]
+    print(f"{'✅' if overlap > 0 else '❌'} Asana, Knowledge Base and memory initialised concurrently "
+          f"({overlap:.2f}s overlapped)")
+    print(f"{'✅' if background['not_ready_seen'] and background['live'] < background['ready'] else '❌'} "
+          f"Background init: live after {background['live']:.2f}s, ready after {background['ready']:.2f}s "
+          f"(readiness answered 503 meanwhile)")
+
+
+def scaling_app():
+    """
+    App factory for the worker processes started by benchmark.py scaling
+
+    Runs the app's own lifespan (per-worker MCP server pool, admission, shared
+    state) with the fake chat model and retriever; their latencies come from
+    SCALING_MODEL_LATENCY and SCALING_RETRIEVAL_LATENCY.
+    """
+    model_latency = float(os.getenv("SCALING_MODEL_LATENCY", "0.05"))
+    retrieval_latency = float(os.getenv("SCALING_RETRIEVAL_LATENCY", "0.05"))
+
+    class ScalingRegistry(AgentRegistry):
+        def initialize(self, chat_model=None, checkpointer=None):
+            super().initialize(chat_model=FakeChatModel(tool_script=LOAD_TOOL_SCRIPT, latency=model_latency),
+                               checkpointer=checkpointer)
+
+    app_main.AgentRegistry = ScalingRegistry
+    app_main.init_kb_client = lambda: make_kb_client(FakeRetriever(latency=retrieval_latency))
+    return app_main.app
+
+
+async def poll_workers(base_url: str, workers: int, timeout: float = 90.0) -> dict:
+    """
+    Ask /health on new connections until every worker has answered
+
+    Returns:
+        Latest /health body per worker pid (fewer than workers on timeout)
+    """
+    seen = {}
+    started = time.perf_counter()
+    async with httpx.AsyncClient(base_url=base_url, timeout=5, headers={"Connection": "close"}) as client:
+        while len(seen) < workers and time.perf_counter() - started < timeout:
+            try:
+                response = await client.get("/health")
+                body = response.json()
+                if body.get("status") == "healthy":
+                    seen[body["worker"]["pid"]] = body
+            except (httpx.TransportError, ValueError):
+                pass
+            await asyncio.sleep(0.02)
+    return seen
+
+
+def cache_ratios(healths: dict) -> dict:
+    """Retrieval and Asana tool cache hits summed over the workers"""
+    retrieval = {"hits": 0, "misses": 0}
+    tools = {"hits": 0, "misses": 0}
+    for body in healths.values():
+        services = body["services"]
+        cache = services["knowledge_base"].get("retrieval_cache") or {}
+        retrieval["hits"] += cache.get("hits", 0)
+        retrieval["misses"] += cache.get("misses", 0)
+        cache = services["asana_mcp"].get("tool_cache") or {}
+        tools["hits"] += cache.get("hits", 0) + cache.get("shared_hits", 0)
+        tools["misses"] += cache.get("misses", 0)
+    return {
+        name: {**counts, "hit_ratio": counts["hits"] / max(1, counts["hits"] + counts["misses"])}
+        for name, counts in (("retrieval", retrieval), ("tools", tools))
+    }
+
+
+async def run_workers(args, workers: int, shared_path, trace) -> dict:
+    """Start uvicorn with several workers, send the trace and read the caches of every worker"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = {key: value for key, value in os.environ.items() if key not in ("SHARED_STATE_PATH", "WEB_CONCURRENCY")}
+    env.update({
+        "ASANA_ACCESS_TOKEN": "benchmark", "BEDROCK_KNOWLEDGE_BASE_ID": "FAKEKB",
+        "ASANA_MCP_COMMAND": f"{sys.executable} {FAKE_MCP_SERVER} --latency {args.tool_latency}",
+        "ASANA_MCP_POOL_SIZE": "1",
+        "SCALING_MODEL_LATENCY": str(args.model_latency), "SCALING_RETRIEVAL_LATENCY": str(args.retrieval_latency),
+        # Keep the per-route concurrency limits but queue the whole closed loop instead of rejecting it
+        "ADMISSION_QUEUE_TIMEOUT": "60",
+        **{f"ADMISSION_{route.upper()}_MAX_QUEUE": str(args.concurrency) for route in ("general", "asana", "knowledge_base")},
+    })
+    if shared_path:
+        env["SHARED_STATE_PATH"] = shared_path
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmark:scaling_app", "--factory", "--workers", str(workers),
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        if len(await poll_workers(base_url, workers)) < workers:
+            raise RuntimeError(f"{workers} workers did not become ready")
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=0)
+        async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+            results, elapsed = await run_trace(client, trace, args.concurrency)
+        healths = await poll_workers(base_url, workers)
+    finally:
+        process.terminate()
+        process.wait()
+    report = latency_report(results, elapsed)["all"]
+    return {**report, **cache_ratios(healths), "workers_reporting": len(healths)}
+
+
+async def check_shared_state(path: str):
+    """Two stores on one file stand in for two workers: caches and admission limits are shared"""
+    worker_a, worker_b = SharedStore(path, worker=os.getpid()), SharedStore(path, worker=os.getppid())
+    try:
+        documents = [Document(page_content="年次有給休暇は20日です。", metadata={"score": 0.9})]
+        RetrievalCache(backend=SQLiteCacheBackend(worker_a)).set("有給休暇は何日?", documents)
+        shared_documents = RetrievalCache(backend=SQLiteCacheBackend(worker_b)).get("有給休暇は何日？")
+        print(f"{'✅' if shared_documents == documents else '❌'} Retrieval cached by one worker is a hit in another")
+
+        calls = []
+        tools_a = {t.name: t for t in ToolResultCache(shared=worker_a).wrap(make_fake_asana_tools(calls=calls))}
+        tools_b = {t.name: t for t in ToolResultCache(shared=worker_b).wrap(make_fake_asana_tools(calls=calls))}
+        search = {"workspace": "1001", "text": "締切"}
+        await tools_a["asana_search_tasks"].ainvoke(search)
+        await tools_b["asana_search_tasks"].ainvoke(search)
+        shared_read = calls.count("asana_search_tasks") == 1
+        await tools_b["asana_create_task"].ainvoke({"workspace": "1001", "text": "新しいタスク"})
+        await tools_a["asana_search_tasks"].ainvoke(search)
+        print(f"{'✅' if shared_read and calls.count('asana_search_tasks') == 2 else '❌'} Asana tool result shared "
+              f"({calls.count('asana_search_tasks')} search calls for 3 reads); a write in one worker invalidates "
+              f"the other's cached read")
+
+        embedder = FakeEmbeddings()
+        answers_a = SemanticResponseCache(embedder=embedder, shared=worker_a)
+        answers_b = SemanticResponseCache(embedder=embedder, shared=worker_b)
+        await answers_a.store("就業規則の有給休暇は何日ですか", "knowledge_base", "20日です。")
+        hit, _ = await answers_b.lookup("就業規則の有給休暇は何日ですか")
+        answers_b.invalidate("knowledge_base")
+        stale, _ = await answers_a.lookup("就業規則の有給休暇は何日ですか")
+        print(f"{'✅' if hit and stale is None else '❌'} Response cache: {hit['match'] if hit else 'miss'} hit "
+              f"in the other worker; invalidation reaches both")
+
+        limits = {"asana": {"max_concurrency": 2, "max_queue": 4}}
+        admission_a = AdmissionController(limits=limits, queue_timeout=0.2, shared=worker_a)
+        admission_b = AdmissionController(limits=limits, queue_timeout=0.2, shared=worker_b)
+        tickets = [await admission_a.admit("asana"), await admission_a.admit("asana")]
+        try:
+            await admission_b.admit("asana")
+            rejected = False
+        except Overloaded:
+            rejected = True
+        waiting = asyncio.create_task(admission_b.admit("asana"))
+        await asyncio.sleep(0.05)
+        tickets[0].release()
+        tickets.append(await waiting)
+        host_active = admission_b.stats()["asana"]["host_active"]
+        for ticket in tickets[1:]:
+            ticket.release()
+        print(f"{'✅' if rejected and host_active == 2 else '❌'} Admission limit of 2 holds across workers "
+              f"(third request {'rejected' if rejected else 'admitted'}, admitted after a release; "
+              f"{host_active} active on the host)")
+
+        # Another worker holding the write lock must not stall the event loop
+        ticket = await admission_a.admit("asana")
+        worker_a.set("busy", "key", "value", 60)
+        worker_b.set("busy", "read", "value", 60, tag="asana_get_task")
+        worker_b.set("busy-answers", "answer", "value", 60, tag="general")
+        generation = worker_b.generation("busy")
+        before = worker_a.busy
+        locker = sqlite3.connect(path, isolation_level=None)
+        locker.execute("BEGIN IMMEDIATE")
+        start = time.perf_counter()
+        hit = worker_a.get("busy", "key")
+        worker_a.set("busy", "other", "value", 60)
+        acquired = worker_a.try_acquire("admission:asana", 10)
+        ticket.release()
+        worker_a.delete_tags("busy", ["asana_get_task"])
+        worker_a.clear("busy-answers", tag="general")
+        stalled = time.perf_counter() - start
+        locker.execute("COMMIT")
+        locker.close()
+
+        def applied():
+            return (worker_a.active("admission:asana") == 0 and worker_b.get("busy", "read") is None
+                    and worker_b.get("busy-answers", "answer") is None and worker_b.generation("busy") > generation)
+
+        for _ in range(100):
+            if applied():
+                break
+            await asyncio.sleep(0.02)
+        print(f"{'✅' if stalled < 6 * worker_a.busy_timeout + 0.1 and not acquired and hit else '❌'} While another "
+              f"worker holds the write lock, shared state calls return after {stalled * 1000:.0f}ms "
+              f"({worker_a.busy - before} statements skipped; the read still hits)")
+        print(f"{'✅' if applied() else '❌'} A slot release and invalidations that met the lock are applied "
+              f"in the other worker once the lock is free")
+        rows = []
+        for _ in range(3):
+            worker_a.get("busy", "key")
+            rows.append(worker_a._connection().execute(
+                "SELECT last_used FROM entries WHERE namespace = 'busy' AND key = 'key'").fetchone()[0])
+        print(f"{'✅' if len(set(rows)) == 1 else '❌'} Hits within {worker_a.touch_interval:g}s do not rewrite "
+              f"the entry's LRU time")
+    finally:
+        worker_a.close()
+        worker_b.close()
+
+
+async def bench_scaling(args):
+    """Throughput per worker count, with per-process vs shared caches and admission limits"""
+    state_dir = tempfile.mkdtemp(prefix="scaling-")
+    try:
+        print("=== Shared state between workers ===")
+        await check_shared_state(os.path.join(state_dir, "check.sqlite"))
+
+        worker_counts = sorted({int(count) for count in args.workers.split(",")})
+        print(f"=== Workers: {args.requests} requests, concurrency {args.concurrency}, {os.cpu_count()} CPUs ===")
+        trace = synthetic_trace(args.requests)
+        runs = []
+        for workers in worker_counts:
+            for shared in ((False,) if workers == 1 else (False, True)):
+                shared_path = os.path.join(state_dir, f"shared-{workers}.sqlite") if shared else None
+                result = await run_workers(args, workers, shared_path, trace)
+                runs.append((workers, shared, result))
+                print(f"{workers} workers {'shared ' if shared else 'private'}  {result['throughput_rps']:7.1f} req/s  "
+                      f"p50 {result['p50_ms']:7.1f}ms  p95 {result['p95_ms']:7.1f}ms  errors {result['errors']:3d}  "
+                      f"retrieval hits {result['retrieval']['hit_ratio']:5.1%}  "
+                      f"tool hits {result['tools']['hit_ratio']:5.1%}")
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    errors = sum(result["errors"] for _, _, result in runs)
+    print(f"{'✅' if not errors else '❌'} {errors} failed requests over {len(runs)} runs")
+    most = worker_counts[-1]
+    if most > 1:
+        private = next(result for workers, shared, result in runs if workers == most and not shared)
+        shared = next(result for workers, shared, result in runs if workers == most and shared)
+        print(f"{'✅' if shared['retrieval']['misses'] < private['retrieval']['misses'] else '❌'} {most} workers: "
+              f"{shared['retrieval']['misses']} Knowledge Base retrievals with shared caches vs "
+              f"{private['retrieval']['misses']} with per-process caches")
+        single = runs[0][2]
+        if (os.cpu_count() or 1) >= most:
+            print(f"{'✅' if shared['throughput_rps'] > single['throughput_rps'] * 1.3 else '❌'} Throughput "
+                  f"{single['throughput_rps']:.1f} -> {shared['throughput_rps']:.1f} req/s from 1 to {most} workers")
+        else:
+            print(f"⚠️ Only {os.cpu_count()} CPUs: throughput scaling to {most} workers is not measurable here "
+                  f"({single['throughput_rps']:.1f} -> {shared['throughput_rps']:.1f} req/s)")
+
+
+def add_load_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--model-latency", type=float, default=0.05)
+    parser.add_argument("--retrieval-latency", type=float, default=0.05)
+    parser.add_argument("--tool-latency", type=float, default=0.02)
+    parser.add_argument("--mcp", action="store_true", help="Run Asana tools on fake_mcp_server.py processes")
+    parser.add_argument("--memory", action="store_true", help="Also measure peak heap per route (tracemalloc)")
+    parser.add_argument("--url", help="Send the requests to a running server instead of fake backends")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Compare with results written by --output on another commit")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    registry_parser = subparsers.add_parser("registry", help="Agent registry vs per-request construction")
+    registry_parser.add_argument("--iterations", type=int, default=50)
+    registry_parser.set_defaults(func=bench_registry)
+
+    kb_load_parser = subparsers.add_parser("kb-load", help="Concurrent KB requests with a blocking retriever")
+    kb_load_parser.add_argument("--concurrency", type=int, default=8)
+    kb_load_parser.add_argument("--retrieval-latency", type=float, default=0.5)
+    kb_load_parser.set_defaults(func=bench_kb_load)
+
+    response_cache_parser = subparsers.add_parser("response-cache", help="Semantic answer cache hit latency")
+    response_cache_parser.add_argument("--model-latency", type=float, default=0.5)
+    response_cache_parser.set_defaults(func=bench_response_cache)
+
+    stream_parser = subparsers.add_parser("stream", help="SSE time to first byte and cancellation")
+    stream_parser.add_argument("--model-latency", type=float, default=0.3)
+    stream_parser.set_defaults(func=bench_stream)
+
+    router_parser = subparsers.add_parser("router", help="Intent routing throughput and misrouting rate")
+    router_parser.add_argument("--iterations", type=int, default=200)
+    router_parser.set_defaults(func=bench_router)
+
+    tool_fanout_parser = subparsers.add_parser("tool-fanout", help="Concurrent Asana tool calls within one model turn")
+    tool_fanout_parser.add_argument("--tool-latency", type=float, default=0.1)
+    tool_fanout_parser.add_argument("--max-concurrency", type=int, default=4)
+    tool_fanout_parser.set_defaults(func=bench_tool_fanout)
+
+    metrics_parser = subparsers.add_parser("metrics", help="Instrumentation overhead and /metrics output")
+    metrics_parser.add_argument("--requests", type=int, default=1000, help="Request pairs (one per mode)")
+    metrics_parser.add_argument("--warmup", type=int, default=50, help="Unmeasured request pairs first")
+    metrics_parser.add_argument("--model-latency", type=float, default=1.0, help="Bedrock call latency the overhead is compared with")
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    overload_parser = subparsers.add_parser("overload", help="Goodput under overload with and without admission control")
+    overload_parser.add_argument("--capacity", type=int, default=8)
+    overload_parser.add_argument("--model-latency", type=float, default=0.2)
+    overload_parser.add_argument("--duration", type=float, default=3.0)
+    overload_parser.add_argument("--slo", type=float, default=2.0)
+    overload_parser.set_defaults(func=bench_overload)
+
+    batch_parser = subparsers.add_parser("batch", help="Batch endpoint vs one request per prompt")
+    batch_parser.add_argument("--prompts", type=int, default=90)
+    batch_parser.add_argument("--model-latency", type=float, default=0.05)
+    batch_parser.set_defaults(func=bench_batch)
+
+    memory_parser = subparsers.add_parser("memory", help="Session memory: tool reuse, prompt trimming, eviction")
+    memory_parser.add_argument("--turns", type=int, default=30)
+    memory_parser.add_argument("--max-history-tokens", type=int, default=800)
+    memory_parser.set_defaults(func=bench_memory)
+
+    kb_rag_parser = subparsers.add_parser("kb-rag", help="Knowledge base agent vs direct retrieve-then-generate")
+    kb_rag_parser.add_argument("--questions", type=int, default=20)
+    kb_rag_parser.add_argument("--model-latency", type=float, default=0.3)
+    kb_rag_parser.add_argument("--retrieval-latency", type=float, default=0.1)
+    kb_rag_parser.set_defaults(func=bench_kb_rag)
+
+    kb_local_parser = subparsers.add_parser("kb-local", help="Local hybrid index vs remote retrieval: recall and latency")
+    kb_local_parser.add_argument("--source-dir", default=DATA_SOURCE_DIR)
+    kb_local_parser.add_argument("--retrieval-latency", type=float, default=0.15)
+    kb_local_parser.add_argument("--min-score", type=float, default=0.6)
+    kb_local_parser.set_defaults(func=bench_kb_local)
+
+    kb_table_parser = subparsers.add_parser("kb-table", help="List / count questions: tables vs top-k retrieval")
+    kb_table_parser.add_argument("--source-dir", default=DATA_SOURCE_DIR)
+    kb_table_parser.add_argument("--model-latency", type=float, default=0.3)
+    kb_table_parser.add_argument("--retrieval-latency", type=float, default=0.15)
+    kb_table_parser.add_argument("--slow-reload", type=float, default=0.5, help="Seconds to read a changed table file")
+    kb_table_parser.set_defaults(func=bench_kb_table)
+
+    tiers_parser = subparsers.add_parser("tiers", help="Model tiering: cost and latency per tier vs all-Pro")
+    tiers_parser.add_argument("--micro-latency", type=float, default=0.05)
+    tiers_parser.add_argument("--lite-latency", type=float, default=0.1)
+    tiers_parser.add_argument("--pro-latency", type=float, default=0.3)
+    tiers_parser.set_defaults(func=bench_tiers)
+
+    asana_prompt_parser = subparsers.add_parser("asana-prompt", help="Asana input tokens: tool selection and prompt caching")
+    asana_prompt_parser.set_defaults(func=bench_asana_prompt)
+
+    hybrid_parser = subparsers.add_parser("hybrid", help="Mixed Asana + document questions: hybrid route vs re-asking")
+    hybrid_parser.add_argument("--model-latency", type=float, default=0.2)
+    hybrid_parser.add_argument("--retrieval-latency", type=float, default=0.1)
+    hybrid_parser.add_argument("--tool-latency", type=float, default=0.05)
+    hybrid_parser.add_argument("--slow-tool-latency", type=float, default=3.0)
+    hybrid_parser.add_argument("--straggler-timeout", type=float, default=0.3)
+    hybrid_parser.set_defaults(func=bench_hybrid)
+
+    compaction_parser = subparsers.add_parser("compaction", help="Tool output in the agent context: raw vs compacted")
+    compaction_parser.add_argument("--document-chars", type=int, default=2000)
+    compaction_parser.add_argument("--request-budget", type=int, default=1500)
+    compaction_parser.add_argument("--iterations", type=int, default=200)
+    compaction_parser.set_defaults(func=bench_compaction)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="Prefetched Asana directory and knowledge base warm-up")
+    prefetch_parser.add_argument("--model-latency", type=float, default=0.1)
+    prefetch_parser.add_argument("--tool-latency", type=float, default=0.05)
+    prefetch_parser.add_argument("--retrieval-latency", type=float, default=0.2)
+    prefetch_parser.add_argument("--interval", type=float, default=0.5, help="Asana refresh interval")
+    prefetch_parser.add_argument("--max-staleness", type=float, default=0.5)
+    prefetch_parser.set_defaults(func=bench_prefetch)
+
+    budget_parser = subparsers.add_parser("budget", help="Request deadlines and agent step / tool-call budgets")
+    budget_parser.add_argument("--model-latency", type=float, default=0.02)
+    budget_parser.add_argument("--slow-tool-latency", type=float, default=0.4)
+    budget_parser.add_argument("--deadline", type=float, default=2.0)
+    budget_parser.add_argument("--max-steps", type=int, default=6)
+    budget_parser.add_argument("--max-tool-calls", type=int, default=10)
+    budget_parser.set_defaults(func=bench_budget)
+
+    startup_parser = subparsers.add_parser("startup", help="Import time and time-to-ready of the app process")
+    startup_parser.add_argument("--runs", type=int, default=3)
+    startup_parser.add_argument("--npx-delay", type=float, default=3.0, help="Simulated npx -y package resolution")
+    startup_parser.set_defaults(func=bench_startup)
+
+    scaling_parser = subparsers.add_parser("scaling", help="Throughput per uvicorn worker count, shared vs per-process state")
+    scaling_parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    scaling_parser.add_argument("--requests", type=int, default=300)
+    scaling_parser.add_argument("--concurrency", type=int, default=16)
+    scaling_parser.add_argument("--model-latency", type=float, default=0.05)
+    scaling_parser.add_argument("--retrieval-latency", type=float, default=0.05)
+    scaling_parser.add_argument("--tool-latency", type=float, default=0.02)
+    scaling_parser.set_defaults(func=bench_scaling)
+
+    load_parser = subparsers.add_parser("load", help="Latency percentiles, throughput and memory per route")
+    load_parser.add_argument("--requests", type=int, default=300)
+    add_load_arguments(load_parser)
+    load_parser.set_defaults(func=bench_load)
+
+    replay_parser = subparsers.add_parser("replay", help="Replay a recorded traffic trace")
+    replay_parser.add_argument("--trace", required=True, help="JSONL trace recorded with TRACE_RECORD_PATH")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Replay speed-up; 0 ignores recorded timing")
+    replay_parser.add_argument("--limit", type=int, default=0, help="Replay only the first N requests")
+    add_load_arguments(replay_parser)
+    replay_parser.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Request deadlines and step / tool-call budgets for the ReAct agents
+
+Without a bound, a model that keeps calling tools holds the connection, an
+MCP slot and Bedrock quota for as long as it loops. Every /generate request
+gets a deadline, and every agent run within it a maximum number of model
+steps and tool calls:
+
+- The agent runs step by step (LangGraph's recursion limit is set from the
+  step budget as a backstop); the run stops before a step whose tool calls
+  exceed the budget, or whose results no model step would be left to use
+- At the deadline (minus the time reserved for the partial answer) the run is
+  cancelled, which cancels its in-flight model and tool calls
+- A stopped run is answered from the tool results it already has, in one model
+  call without tools; a note tells the user the answer is partial
+
+Hybrid answers share the request's deadline across their branches; streamed
+answers (streaming.stream_events) are bounded the same way and send the partial
+answer as their final event.
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+from contextlib import aclosing
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langgraph.errors import GraphRecursionError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# What create_react_agent answers when the recursion limit leaves no step for the tool results
+STEP_LIMIT_MESSAGE = "Sorry, need more steps to process this request."
+
+# Seconds RequestBudget.guard() waits past the deadline
+DEADLINE_GRACE = 1.0
+
+STOP_REASONS = {
+    "deadline": "制限時間に達した",
+    "steps": "処理ステップ数の上限に達した",
+    "tool_calls": "ツール呼び出し回数の上限に達した",
+}
+
+PARTIAL_ANSWER_PROMPT = """以下は、ユーザーの質問に回答するために途中まで行った調査の結果です。{reason}ため、調査を打ち切りました。
+取得済みの情報だけを使って、質問にできるだけ回答してください。情報が足りない部分は推測せず、確認できなかったことを明記してください。
+
+質問: {question}
+
+{results}"""
+PARTIAL_NOTE = "\n\n（{reason}ため調査を途中で打ち切りました。取得できた情報のみに基づく回答です）"
+NO_RESULTS_ANSWER = "申し訳ございません。{reason}ため、回答を作成できませんでした。質問を絞って再度お試しください。"
+CANCELLED_TOOL_RESULT = "（{reason}ため、このツールは実行されませんでした）"
+
+
+def budget_enabled() -> bool:
+    return os.getenv("REQUEST_BUDGET_ENABLED", "true").lower() == "true"
+
+
+class RequestBudget:
+    """
+    Deadline of one request and the step / tool-call limits of each agent run in it
+
+    The deadline is absolute, so a budget handed to concurrent branches bounds
+    all of them together; the step and tool-call limits apply to each agent run.
+    """
+
+    def __init__(
+        self,
+        deadline: Optional[float] = None,
+        max_steps: Optional[int] = None,
+        max_tool_calls: Optional[int] = None,
+        reserve: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Args:
+            deadline: Seconds the request may take end to end (REQUEST_DEADLINE)
+            max_steps: Model calls per agent run (AGENT_MAX_STEPS)
+            max_tool_calls: Tool calls per agent run (AGENT_MAX_TOOL_CALLS)
+            reserve: Seconds kept for the partial answer after a run is stopped (AGENT_PARTIAL_ANSWER_RESERVE)
+            clock: Time source (tests)
+        """
+        self.deadline = deadline or float(os.getenv("REQUEST_DEADLINE", "60"))
+        self.max_steps = max_steps or int(os.getenv("AGENT_MAX_STEPS", "8"))
+        self.max_tool_calls = max_tool_calls or int(os.getenv("AGENT_MAX_TOOL_CALLS", "16"))
+        reserve = reserve if reserve is not None else float(os.getenv("AGENT_PARTIAL_ANSWER_RESERVE", "5"))
+        # A short deadline still leaves most of its time to the agent
+        self.reserve = min(reserve, self.deadline / 4)
+        self.clock = clock
+        self.ends_at = clock() + self.deadline
+
+    def remaining(self) -> float:
+        """Seconds until the deadline (negative once it passed)"""
+        return self.ends_at - self.clock()
+
+    def shortened(self, seconds: float) -> "RequestBudget":
+        """Copy whose deadline is seconds earlier, e.g. for branches whose answers are merged afterwards"""
+        budget = RequestBudget(self.deadline, self.max_steps, self.max_tool_calls, self.reserve, self.clock)
+        budget.ends_at = self.ends_at - seconds
+        return budget
+
+    def guard(self) -> asyncio.Timeout:
+        """
+        Async context manager cancelling the work shortly after the deadline
+
+        The agents answer by the deadline themselves; the grace second keeps the
+        guard from cutting off a partial answer that is just being returned.
+        """
+        return asyncio.timeout(max(self.remaining(), 0) + DEADLINE_GRACE)
+
+    @property
+    def recursion_limit(self) -> int:
+        # One graph step per model call and one per tool turn
+        return 2 * self.max_steps
+
+    def exceeded(self, messages: List[BaseMessage]) -> Optional[str]:
+        """
+        Why the run must stop before its next step, or None
+
+        Args:
+            messages: Agent state messages; only those after the latest human message count
+        """
+        steps = _request_messages(messages)
+        calls = [m for m in steps if isinstance(m, AIMessage)]
+        last = steps[-1] if steps else None
+        if isinstance(last, AIMessage) and last.content == STEP_LIMIT_MESSAGE:
+            return "steps"
+        if not isinstance(last, AIMessage) or not last.tool_calls:
+            return None
+        if sum(len(m.tool_calls) for m in calls) > self.max_tool_calls:
+            return "tool_calls"
+        if len(calls) >= self.max_steps:
+            return "steps"
+        return None
+
+
+def default_budget() -> Optional[RequestBudget]:
+    """A budget from the environment, or None when REQUEST_BUDGET_ENABLED=false"""
+    return RequestBudget() if budget_enabled() else None
+
+
+def _request_messages(messages: List[BaseMessage]) -> List[BaseMessage]:
+    start = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+    return messages[start + 1:]
+
+
+def _text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+
+
+def _answered(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """Messages without the steps the run did not finish (unanswered tool calls, the step-limit reply)"""
+    answered_ids = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+    return [
+        m for m in messages
+        if not (isinstance(m, AIMessage) and (
+            m.content == STEP_LIMIT_MESSAGE or any(call["id"] not in answered_ids for call in m.tool_calls)))
+    ]
+
+
+def partial_answer_messages(messages: List[BaseMessage], reason: str, max_tokens: int = 6000) -> Optional[List[HumanMessage]]:
+    """
+    Prompt answering the question from the tool results a stopped run collected
+
+    The results are passed as text (not as tool messages), so the call needs no
+    tool definitions.
+
+    Returns:
+        The messages, or None when the run has no tool results to answer from
+    """
+    from knowledge_base import truncate_to_tokens
+
+    question = next((_text(m.content) for m in reversed(messages) if isinstance(m, HumanMessage)), "")
+    results = [m for m in _request_messages(messages) if isinstance(m, ToolMessage) and m.status != "error"]
+    if not results:
+        return None
+    sections = "\n\n".join(f"## {m.name or 'ツール'} の結果\n{_text(m.content)}" for m in results)
+    return [HumanMessage(content=PARTIAL_ANSWER_PROMPT.format(
+        reason=STOP_REASONS[reason], question=question, results=truncate_to_tokens(sections, max_tokens)))]
+
+
+async def partial_answer(chat_model, messages: List[BaseMessage], reason: str, budget: RequestBudget) -> str:
+    """
+    Answer of a stopped run, written within the time left before the deadline
+
+    Falls back to a fixed message when there are no tool results, no chat model
+    or no time left, or the call fails.
+    """
+    fallback = NO_RESULTS_ANSWER.format(reason=STOP_REASONS[reason])
+    prompt = partial_answer_messages(messages, reason)
+    if prompt is None or chat_model is None or budget.remaining() <= 0:
+        return fallback
+    try:
+        async with asyncio.timeout(budget.remaining()):
+            ai_msg = await chat_model.ainvoke(prompt)
+    except Exception as e:
+        logger.warning(f"Partial answer failed: {e!r}")
+        return fallback
+    content = re.sub(r"<thinking>.*?</thinking>", "", _text(ai_msg.content), flags=re.DOTALL).strip()
+    return content + PARTIAL_NOTE.format(reason=STOP_REASONS[reason]) if content else fallback
+
+
+async def _close_session_turn(agent, config: Dict[str, Any], answer: AIMessage, reason: str):
+    """
+    Store the partial answer in a session thread
+
+    The run may have stopped after a model step whose tool calls never ran;
+    Bedrock rejects a history with unanswered tool calls, so they get a result first.
+    """
+    state = await agent.aget_state(config)
+    messages = state.values.get("messages", [])
+    answered_ids = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+    closing = [
+        ToolMessage(content=CANCELLED_TOOL_RESULT.format(reason=STOP_REASONS[reason]), name=call["name"],
+                    tool_call_id=call["id"], status="error")
+        for m in _request_messages(messages) if isinstance(m, AIMessage)
+        for call in m.tool_calls if call["id"] not in answered_ids
+    ]
+    await agent.aupdate_state(config, {"messages": [*closing, answer]}, as_node="agent")
+
+
+async def run_agent(
+    agent,
+    inputs: Dict[str, Any],
+    route: str,
+    config: Optional[Dict[str, Any]] = None,
+    budget: Optional[RequestBudget] = None,
+    chat_model=None
+) -> Dict[str, Any]:
+    """
+    Run a ReAct agent within a budget
+
+    Args:
+        agent: Compiled agent
+        inputs: Agent input ({"messages": [...]})
+        route: Route label of the metrics ("asana", "knowledge_base")
+        config: Optional runnable config (session thread)
+        budget: Request budget; None runs the agent unbounded
+        chat_model: Model (without tools) that writes the partial answer of a stopped run
+
+    Returns:
+        The final agent state; a stopped run ends with the partial answer
+    """
+    if budget is None:
+        return await agent.ainvoke(inputs, config=config)
+
+    state, reason = inputs, None
+    run_config = {**(config or {}), "recursion_limit": budget.recursion_limit}
+    try:
+        async with asyncio.timeout(max(budget.remaining() - budget.reserve, 0)):
+            async with aclosing(agent.astream(inputs, config=run_config, stream_mode="values")) as steps:
+                async for state in steps:
+                    reason = budget.exceeded(state["messages"])
+                    if reason:
+                        break
+    except TimeoutError:
+        reason = "deadline"
+    except GraphRecursionError:
+        reason = "steps"
+
+    messages, answer = await conclude_run(agent, list(state.get("messages", [])), route, reason, config, budget,
+                                          chat_model)
+    if answer is None:
+        return state
+    return {**state, "messages": [*_answered(messages), answer]}
+
+
+async def conclude_run(
+    agent,
+    messages: List[BaseMessage],
+    route: str,
+    reason: Optional[str],
+    config: Optional[Dict[str, Any]],
+    budget: RequestBudget,
+    chat_model=None
+) -> Tuple[List[BaseMessage], Optional[AIMessage]]:
+    """
+    Record the outcome of a budgeted agent run and answer it if it was stopped
+
+    Args:
+        agent: Compiled agent
+        messages: Messages of the run's latest state
+        route: Route label of the metrics
+        reason: Why the run was stopped ("deadline", "steps", "tool_calls"), or None if it completed
+        config: Optional runnable config (session thread)
+        budget: Request budget
+        chat_model: Model (without tools) that writes the partial answer
+
+    Returns:
+        (messages, answer): the run's messages and the partial answer (None when the run completed);
+        the partial answer is also stored in the session thread
+    """
+    if config is not None and reason == "deadline":
+        # Cancelled between checkpoints: the stored thread is the latest complete state
+        messages = (await agent.aget_state(config)).values.get("messages", messages)
+    request = _request_messages(messages)
+    if metrics.ENABLED:
+        metrics.AGENT_RUNS.inc(route=route, outcome=reason or "completed")
+        metrics.AGENT_STEPS.observe(sum(1 for m in request if isinstance(m, AIMessage)), route=route)
+        metrics.AGENT_TOOL_CALLS.observe(sum(1 for m in request if isinstance(m, ToolMessage)), route=route)
+    if reason is None:
+        return messages, None
+
+    logger.warning(f"Stopped {route} agent ({reason}) after {sum(1 for m in request if isinstance(m, AIMessage))} "
+                   f"model steps and {sum(1 for m in request if isinstance(m, ToolMessage))} tool results")
+    answer = AIMessage(content=await partial_answer(chat_model, messages, reason, budget))
+    if config is not None:
+        try:
+            await _close_session_turn(agent, config, answer, reason)
+        except Exception as e:
+            logger.warning(f"Failed to store the partial answer in the session: {e}")
+    return messages, answer
@@ -0,0 +1,294 @@
+"""
+Compaction of tool outputs before they enter the agent's messages
+
+Every model step of a ReAct agent sends the whole message list again, so a raw
+Asana JSON response or the full text of the retrieved documents is paid for on
+every later step of the request. Tool results are compacted as they arrive:
+
+- Asana JSON keeps what answers use: objects nested in a task or project are
+  reduced to their gid and name, empty values, resource types, rich-text copies
+  and likes are dropped, long texts (notes, comments) are truncated, and lists
+  that do not fit keep their first items with a note of how many were left out
+- Retrieved documents already shown earlier in the request are left out
+- A result identical to an earlier one of the request is replaced by a reference to it
+- All tool output of one request stays within a token budget
+
+The full payload stays on the ToolMessage as its artifact, which is never sent
+to the model, so citations can still use the complete documents and records.
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Any, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage
+from langgraph.prebuilt import ToolNode
+
+import metrics
+from knowledge_base import compact_documents, estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# ToolMessage.response_metadata key with the tokens / bytes one result saved
+METADATA_KEY = "compaction"
+
+# Fields of Asana objects the answers never use
+DROPPED_FIELDS = frozenset({
+    "resource_type", "html_notes", "html_text", "likes", "hearts", "liked", "hearted",
+    "num_likes", "num_hearts", "photo",
+})
+# What an object nested in another one (assignee, projects, custom fields...) keeps
+REFERENCE_FIELDS = ("gid", "name", "display_value")
+
+DUPLICATE_NOTE = "（この呼び出しの結果はこのリクエストで取得済みです。上の結果を参照してください）"
+DOCUMENTS_SEEN_NOTE = "（検索結果はすべてこのリクエストで取得済みの文書です。上の検索結果を参照してください）"
+BUDGET_NOTE = ("（このリクエストのツール結果が上限の {limit} トークンに達したため、結果を省略しました。"
+               "取得済みの結果を元に回答してください）")
+OMITTED_NOTE = "（他 {count} 件は省略しました。必要な場合は条件を絞って検索してください）"
+
+
+def compaction_enabled() -> bool:
+    return os.getenv("TOOL_OUTPUT_COMPACTION_ENABLED", "true").lower() == "true"
+
+
+def project_asana(value: Any, max_text_tokens: int, nested: bool = False) -> Any:
+    """
+    Reduce an Asana API value to the fields answers use
+
+    Args:
+        value: Parsed JSON returned by an Asana tool
+        max_text_tokens: Token budget of each string value (notes, comments)
+        nested: Whether value is inside an Asana object (and is a reference if it has a gid)
+
+    Returns:
+        The projected value; empty values are removed
+    """
+    if isinstance(value, dict):
+        if nested and "gid" in value:
+            value = {key: value[key] for key in REFERENCE_FIELDS if key in value}
+        projected = {}
+        for key, item in value.items():
+            if key in DROPPED_FIELDS:
+                continue
+            item = project_asana(item, max_text_tokens, nested or "gid" in value)
+            if item is None or item == "" or item == [] or item == {}:
+                continue
+            projected[key] = item
+        return projected
+    if isinstance(value, list):
+        return [project_asana(item, max_text_tokens, nested) for item in value]
+    if isinstance(value, str):
+        return truncate_to_tokens(value, max_text_tokens)
+    return value
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def fit_json(value: Any, max_tokens: int) -> str:
+    """
+    Serialise a JSON value within max_tokens
+
+    A list (or the "data" list of an Asana response) keeps its first items
+    and notes how many were left out; anything else is truncated.
+    """
+    text = _dumps(value)
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    envelope = isinstance(value, dict) and isinstance(value.get("data"), list)
+    items = value["data"] if envelope else value
+    if not isinstance(items, list):
+        return truncate_to_tokens(text, max_tokens)
+    note = OMITTED_NOTE.format(count=len(items))
+    budget = max_tokens - estimate_tokens(_dumps({**value, "data": []}) if envelope else "[]") - estimate_tokens(note)
+    kept = []
+    for item in items:
+        budget -= estimate_tokens(_dumps(item)) + 1
+        if budget < 0:
+            break
+        kept.append(item)
+    text = _dumps({**value, "data": kept} if envelope else kept)
+    return text + "\n" + OMITTED_NOTE.format(count=len(items) - len(kept))
+
+
+def _text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+
+
+def _is_documents(value: Any) -> bool:
+    return isinstance(value, list) and bool(value) and all(isinstance(item, Document) for item in value)
+
+
+def _document_key(document: Document) -> str:
+    # The same chunk comparison compact_documents uses
+    return "".join(document.page_content.split())
+
+
+def _request_tool_messages(messages: List[BaseMessage]) -> List[ToolMessage]:
+    """Tool results of the current request (after the latest human message)"""
+    start = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+    return [m for m in messages[start + 1:] if isinstance(m, ToolMessage)]
+
+
+class ToolOutputCompactor:
+    """
+    Compacts the tool results of one agent step, given the request's earlier messages
+
+    The compactor keeps no state of its own (what the request already holds is
+    read from the messages), so one instance serves concurrent requests.
+    """
+
+    def __init__(
+        self,
+        route: str,
+        max_request_tokens: Optional[int] = None,
+        max_output_tokens: Optional[int] = None,
+        max_text_tokens: Optional[int] = None,
+        max_document_tokens: int = 1000
+    ):
+        """
+        Args:
+            route: Route label of the agent's metrics ("asana", "knowledge_base")
+            max_request_tokens: Token budget of all tool output of one request
+            max_output_tokens: Token budget of one tool result (table query results are exempt)
+            max_text_tokens: Token budget of each string value in Asana JSON
+            max_document_tokens: Token budget of each retrieved document
+        """
+        self.route = route
+        self.max_request_tokens = max_request_tokens or int(os.getenv("TOOL_OUTPUT_MAX_REQUEST_TOKENS", "8000"))
+        self.max_output_tokens = max_output_tokens or int(os.getenv("TOOL_OUTPUT_MAX_TOKENS", "3000"))
+        self.max_text_tokens = max_text_tokens or int(os.getenv("TOOL_OUTPUT_MAX_TEXT_TOKENS", "300"))
+        self.max_document_tokens = max_document_tokens
+
+    def compact(self, messages: List[BaseMessage], outputs: List[Any]) -> List[Any]:
+        """
+        Compact the results of one step
+
+        Args:
+            messages: Agent state messages before this step's results
+            outputs: This step's ToolMessages (anything else is passed through)
+
+        Returns:
+            The outputs with compacted content and the full payload as artifact
+        """
+        earlier = _request_tool_messages(messages)
+        used = sum(estimate_tokens(_text(m.content)) for m in earlier)
+        seen = {self._digest(m.artifact) for m in earlier if isinstance(m.artifact, str)}
+        seen_documents = [
+            _document_key(document) for m in earlier if _is_documents(m.artifact) for document in m.artifact
+        ]
+        compacted = []
+        for output in outputs:
+            if not isinstance(output, ToolMessage) or output.status == "error":
+                compacted.append(output)
+                continue
+            output = self._compact_one(output, self.max_request_tokens - used, seen, seen_documents)
+            used += estimate_tokens(_text(output.content))
+            compacted.append(output)
+        return compacted
+
+    @staticmethod
+    def _digest(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _compact_one(self, output: ToolMessage, remaining: int, seen: set, seen_documents: List[str]) -> ToolMessage:
+        raw = _text(output.content)
+        payload = output.artifact if output.artifact is not None else raw
+        # Without compaction documents reached the model as their repr
+        original = str(payload) if _is_documents(payload) else raw
+        limit = min(self.max_output_tokens, remaining)
+
+        if remaining <= 0:
+            content = BUDGET_NOTE.format(limit=self.max_request_tokens)
+        elif _is_documents(payload):
+            documents = [d for d in payload if not any(_document_key(d) in key for key in seen_documents)]
+            content = compact_documents(documents, limit, self.max_document_tokens)[0] if documents else DOCUMENTS_SEEN_NOTE
+            seen_documents.extend(_document_key(d) for d in documents)
+        elif isinstance(payload, str) and self._digest(payload) in seen:
+            content = DUPLICATE_NOTE
+        else:
+            if isinstance(payload, str):
+                seen.add(self._digest(payload))
+            content = self._compact_text(output.name or "", raw, limit, remaining)
+
+        tokens_saved = max(estimate_tokens(original) - estimate_tokens(content), 0)
+        bytes_saved = max(len(original.encode("utf-8")) - len(content.encode("utf-8")), 0)
+        if metrics.ENABLED:
+            metrics.TOOL_OUTPUT_TOKENS_SAVED.inc(tokens_saved, route=self.route)
+            metrics.TOOL_OUTPUT_BYTES_SAVED.inc(bytes_saved, route=self.route)
+        return output.model_copy(update={
+            "content": content,
+            "artifact": payload,
+            "response_metadata": {
+                **output.response_metadata,
+                METADATA_KEY: {"tokens_saved": tokens_saved, "bytes_saved": bytes_saved},
+            },
+        })
+
+    def _compact_text(self, name: str, raw: str, limit: int, remaining: int) -> str:
+        if not name.startswith("asana_"):
+            # Table query results must keep every row; only the request budget applies
+            return truncate_to_tokens(raw, remaining)
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            return truncate_to_tokens(raw, limit)
+        if not isinstance(value, (dict, list)):
+            return truncate_to_tokens(raw, limit)
+        return fit_json(project_asana(value, self.max_text_tokens), limit)
+
+
+class CompactingToolNode(ToolNode):
+    """ToolNode whose results are compacted before they are added to the agent state"""
+
+    def __init__(self, tools: List[Any], compactor: Optional[ToolOutputCompactor] = None, **kwargs):
+        super().__init__(tools, **kwargs)
+        self.compactor = compactor
+
+    def _func(self, input, config, *, store):
+        return self._compact_outputs(input, super()._func(input, config, store=store))
+
+    async def _afunc(self, input, config, *, store):
+        return self._compact_outputs(input, await super()._afunc(input, config, store=store))
+
+    def _compact_outputs(self, input, outputs):
+        """Compact the ToolMessages of a node result (Command results are left as they are)"""
+        if self.compactor is None:
+            return outputs
+        if isinstance(input, list):
+            messages = input
+        elif isinstance(input, dict):
+            messages = input.get(self.messages_key, [])
+        else:
+            messages = getattr(input, self.messages_key, [])
+        if isinstance(outputs, dict):
+            return {**outputs, self.messages_key: self.compactor.compact(messages, outputs[self.messages_key])}
+        if isinstance(outputs, list) and all(isinstance(output, ToolMessage) for output in outputs):
+            return self.compactor.compact(messages, outputs)
+        return outputs
+
+
+def request_savings(messages: List[BaseMessage]) -> Tuple[int, int]:
+    """(tokens, bytes) compaction saved on the tool results of the latest request in messages"""
+    savings = [m.response_metadata.get(METADATA_KEY) or {} for m in _request_tool_messages(messages)]
+    return sum(s.get("tokens_saved", 0) for s in savings), sum(s.get("bytes_saved", 0) for s in savings)
+
+
+def record_request_savings(route: str, messages: List[BaseMessage]) -> Tuple[int, int]:
+    """
+    Observe the request's savings in the per-request histograms
+
+    Returns:
+        (tokens, bytes) saved
+    """
+    tokens_saved, bytes_saved = request_savings(messages)
+    compacted = any(METADATA_KEY in m.response_metadata for m in _request_tool_messages(messages))
+    if metrics.ENABLED and compacted:
+        metrics.TOOL_OUTPUT_REQUEST_TOKENS_SAVED.observe(tokens_saved, route=route)
+        metrics.TOOL_OUTPUT_REQUEST_BYTES_SAVED.observe(bytes_saved, route=route)
+    return tokens_saved, bytes_saved
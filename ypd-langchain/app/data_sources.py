@@ -0,0 +1,190 @@
+"""
+Readers for the knowledge base data-source files (doc/knowledge-base-data-source)
+
+Spreadsheets are read with the standard library only (an .xlsx file is a zip of
+XML parts), so the local retrieval tier needs no extra dependencies.
+"""
+import os
+import re
+import csv
+import zipfile
+import logging
+import posixpath
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+SPREADSHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIP_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PACKAGE_RELATIONSHIP_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+TABLE_EXTENSIONS = (".xlsx", ".csv")
+TEXT_EXTENSIONS = (".md", ".txt")
+
+# Text files are split into chunks of about this many characters at paragraph breaks
+TEXT_CHUNK_CHARS = 800
+
+
+def _column_index(cell_ref: str) -> int:
+    """Zero-based column index of a cell reference such as "C12" """
+    index = 0
+    for c in re.match(r"[A-Z]+", cell_ref).group(0):
+        index = index * 26 + ord(c) - ord("A") + 1
+    return index - 1
+
+
+def _cell_text(cell: ET.Element, shared_strings: List[str]) -> str:
+    cell_type = cell.get("t")
+    if cell_type == "inlineStr":
+        return "".join(t.text or "" for t in cell.iter(f"{SPREADSHEET_NS}t"))
+    value = cell.findtext(f"{SPREADSHEET_NS}v")
+    if value is None:
+        return ""
+    if cell_type == "s":
+        return shared_strings[int(value)]
+    if cell_type in ("str", "b", "e"):
+        return value
+    # Numbers are stored as floats; show whole numbers without ".0"
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return str(int(number)) if number.is_integer() else value
+
+
+def read_xlsx(path: str) -> Dict[str, List[List[str]]]:
+    """
+    Read every sheet of an .xlsx workbook as rows of cell text
+
+    Args:
+        path: Workbook path
+
+    Returns:
+        Sheet name -> rows (the first row is usually the header), in workbook order
+    """
+    with zipfile.ZipFile(path) as archive:
+        shared_strings = []
+        if "xl/sharedStrings.xml" in archive.namelist():
+            root = ET.fromstring(archive.read("xl/sharedStrings.xml"))
+            for item in root.iter(f"{SPREADSHEET_NS}si"):
+                # Rich text runs are concatenated; phonetic guides (rPh) are not part of the value
+                shared_strings.append("".join(
+                    (child.text if child.tag == f"{SPREADSHEET_NS}t" else child.findtext(f"{SPREADSHEET_NS}t")) or ""
+                    for child in item if child.tag in (f"{SPREADSHEET_NS}t", f"{SPREADSHEET_NS}r")
+                ))
+
+        relationships = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+        targets = {
+            rel.get("Id"): rel.get("Target")
+            for rel in relationships.iter(f"{PACKAGE_RELATIONSHIP_NS}Relationship")
+        }
+        workbook = ET.fromstring(archive.read("xl/workbook.xml"))
+
+        sheets: Dict[str, List[List[str]]] = {}
+        for sheet in workbook.iter(f"{SPREADSHEET_NS}sheet"):
+            target = targets[sheet.get(f"{RELATIONSHIP_NS}id")]
+            part = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+            root = ET.fromstring(archive.read(part))
+            rows = []
+            for row in root.iter(f"{SPREADSHEET_NS}row"):
+                values: List[str] = []
+                for cell in row.iter(f"{SPREADSHEET_NS}c"):
+                    # Empty cells are omitted from the XML, so place values by their reference
+                    column = _column_index(cell.get("r")) if cell.get("r") else len(values)
+                    values.extend([""] * (column + 1 - len(values)))
+                    values[column] = _cell_text(cell, shared_strings).strip()
+                if any(values):
+                    rows.append(values)
+            sheets[sheet.get("name")] = rows
+        return sheets
+
+
+def read_csv(path: str) -> Dict[str, List[List[str]]]:
+    """Read a CSV file (UTF-8, with or without BOM) as a single sheet named after the file"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = [[value.strip() for value in row] for row in csv.reader(f) if any(value.strip() for value in row)]
+    return {os.path.splitext(os.path.basename(path))[0]: rows}
+
+
+def read_table(path: str) -> Dict[str, List[List[str]]]:
+    """Read an .xlsx or .csv file as sheet name -> rows"""
+    if path.lower().endswith(".xlsx"):
+        return read_xlsx(path)
+    return read_csv(path)
+
+
+def source_files(directory: str) -> List[str]:
+    """Supported data-source files under directory, sorted by relative path"""
+    paths = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.startswith((".", "~$")):
+                continue
+            if name.lower().endswith(TABLE_EXTENSIONS + TEXT_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths, key=lambda path: os.path.relpath(path, directory))
+
+
+def _chunk_text(text: str, max_chars: int = TEXT_CHUNK_CHARS) -> List[str]:
+    chunks: List[str] = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if chunks and len(chunks[-1]) + len(paragraph) + 2 <= max_chars:
+            chunks[-1] += "\n\n" + paragraph
+        else:
+            chunks.extend(paragraph[i:i + max_chars] for i in range(0, len(paragraph), max_chars))
+    return chunks
+
+
+def _source_metadata(path: str, directory: str, **extra) -> dict:
+    return {"source": os.path.relpath(path, directory).replace(os.sep, "/"), **extra}
+
+
+def load_documents(directory: str, paths: Optional[List[str]] = None) -> List[Document]:
+    """
+    Turn the data-source files into retrievable documents
+
+    Every spreadsheet row becomes one document of "header: value" pairs (with the
+    sheet name), so a question about one record matches that record only. Text
+    files are split into paragraph chunks.
+
+    Args:
+        directory: Data-source root directory
+        paths: Files to load (defaults to source_files(directory))
+
+    Returns:
+        Documents with metadata "source" (path relative to directory) and, for
+        spreadsheet rows, "sheet" and "row"
+    """
+    documents: List[Document] = []
+    for path in paths if paths is not None else source_files(directory):
+        try:
+            if path.lower().endswith(TABLE_EXTENSIONS):
+                for sheet, rows in read_table(path).items():
+                    if len(rows) < 2:
+                        continue
+                    header = rows[0]
+                    for number, row in enumerate(rows[1:], start=2):
+                        fields = [
+                            f"{header[i] if i < len(header) and header[i] else f'列{i + 1}'}: {value}"
+                            for i, value in enumerate(row) if value
+                        ]
+                        documents.append(Document(
+                            page_content=f"{sheet} / " + " / ".join(fields),
+                            metadata=_source_metadata(path, directory, sheet=sheet, row=number),
+                        ))
+            else:
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    for number, chunk in enumerate(_chunk_text(f.read())):
+                        documents.append(Document(
+                            page_content=chunk,
+                            metadata=_source_metadata(path, directory, chunk=number),
+                        ))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile, ET.ParseError) as e:
+            logger.warning(f"Skipping unreadable data-source file {path}: {e}")
+    return documents
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Local fake of @roychri/mcp-server-asana for offline tests and benchmarks (stdio transport)
+
+Usage:
+    python fake_mcp_server.py [--latency SEC] [--startup-delay SEC]
+
+Options:
+    --latency: Artificial latency in seconds added to every tool call
+               (defaults to the FAKE_MCP_LATENCY environment variable)
+    --startup-delay: Seconds to wait before serving, like `npx -y` resolving
+                     the package before the server starts
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+from mcp.server.fastmcp import FastMCP
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--latency", type=float, default=float(os.getenv("FAKE_MCP_LATENCY", "0")))
+parser.add_argument("--startup-delay", type=float, default=0.0)
+ARGS = parser.parse_args(sys.argv[1:])
+LATENCY = ARGS.latency
+
+mcp = FastMCP("fake-asana")
+
+WORKSPACES = [
+    {"gid": "1001", "name": "Yapodu"},
+    {"gid": "1002", "name": "Yapodu Labs"},
+]
+PROJECTS = {
+    "1001": [{"gid": "2001", "name": "Webサイトリニューアル"}, {"gid": "2002", "name": "社内ハンズオン"}],
+    "1002": [{"gid": "2003", "name": "LangChain検証"}],
+}
+TASKS = {
+    "3001": {"gid": "3001", "name": "会議資料の準備", "completed": False, "due_on": "2026-10-17", "projects": ["2001"]},
+    "3002": {"gid": "3002", "name": "デザインレビュー", "completed": True, "due_on": "2026-10-10", "projects": ["2001"]},
+    "3003": {"gid": "3003", "name": "ハンズオン手順書の作成", "completed": False, "due_on": "2026-10-20", "projects": ["2002"]},
+}
+
+
+async def _delay():
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+
+
+@mcp.tool()
+async def asana_list_workspaces() -> str:
+    """List all available workspaces in Asana"""
+    await _delay()
+    return json.dumps(WORKSPACES, ensure_ascii=False)
+
+
+@mcp.tool()
+async def asana_search_projects(workspace: str, name_pattern: str = ".*") -> str:
+    """Search for projects in Asana using name pattern matching"""
+    await _delay()
+    return json.dumps(PROJECTS.get(workspace, []), ensure_ascii=False)
+
+
+@mcp.tool()
+async def asana_search_tasks(workspace: str, text: str = "") -> str:
+    """Search tasks in a workspace with advanced filtering options"""
+    await _delay()
+    return json.dumps([task for task in TASKS.values() if text in task["name"]], ensure_ascii=False)
+
+
+@mcp.tool()
+async def asana_get_task(task_id: str) -> str:
+    """Get detailed information about a specific task"""
+    await _delay()
+    return json.dumps(TASKS.get(task_id, {}), ensure_ascii=False)
+
+
+@mcp.tool()
+async def asana_create_task(project_id: str, name: str) -> str:
+    """Create a new task in a project"""
+    await _delay()
+    gid = str(3000 + len(TASKS) + 1)
+    TASKS[gid] = {"gid": gid, "name": name, "completed": False, "due_on": None, "projects": [project_id]}
+    return json.dumps(TASKS[gid], ensure_ascii=False)
+
+
+@mcp.tool()
+async def asana_update_task(task_id: str, completed: bool = False) -> str:
+    """Update an existing task's details"""
+    await _delay()
+    TASKS[task_id]["completed"] = completed
+    return json.dumps(TASKS[task_id], ensure_ascii=False)
+
+
+@mcp.tool()
+async def fake_get_pid() -> str:
+    """Return the server process ID (test helper)"""
+    return str(os.getpid())
+
+
+@mcp.tool()
+async def fake_sleep(seconds: float) -> str:
+    """Sleep for the given number of seconds (test helper)"""
+    start = time.monotonic()
+    await asyncio.sleep(seconds)
+    return f"slept {time.monotonic() - start:.2f}s"
+
+
+if __name__ == "__main__":
+    if ARGS.startup_delay:
+        time.sleep(ARGS.startup_delay)
+    mcp.run(transport="stdio")
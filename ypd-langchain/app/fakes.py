@@ -0,0 +1,406 @@
+"""
+Deterministic fake backends for offline benchmarks and tests (no AWS / Asana access required)
+"""
+import asyncio
+import fnmatch
+import json
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.tools import BaseTool, StructuredTool
+from pydantic import PrivateAttr
+
+from prefetch import DIRECTORY_HEADER, DIRECTORY_TOOLS
+from tool_selection import schema_tokens
+
+# Tool names modelled on @roychri/mcp-server-asana
+FAKE_ASANA_TOOL_NAMES = [
+    "asana_list_workspaces", "asana_search_projects", "asana_search_tasks",
+    "asana_get_task", "asana_create_task", "asana_update_task",
+    "asana_get_stories_for_task", "asana_create_task_story", "asana_get_project",
+    "asana_get_project_task_counts", "asana_get_project_sections",
+    "asana_add_task_dependencies", "asana_add_task_dependents",
+    "asana_create_subtask", "asana_get_multiple_tasks_by_gid",
+    "asana_get_project_status", "asana_get_project_statuses",
+    "asana_create_project_status", "asana_delete_project_status",
+    "asana_set_parent_for_task", "asana_get_tasks_for_tag", "asana_get_tags_for_workspace",
+]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Scripted chat model that emits tool calls like Nova Pro does in the ReAct loop
+
+    When tools are bound, each entry of tool_script is called once (in order) after
+    the latest human message (a list entry emits several tool calls in one turn);
+    entries naming tools that are not bound are skipped, so one script can drive
+    both the Asana and the knowledge base agent;
+    once the script is exhausted the model returns a final answer wrapped in
+    <thinking> tags so the response post-processing is exercised.
+
+    capacity > 0 limits how many async calls are served at once, like a saturated
+    Bedrock endpoint: further calls wait for a free slot. Questions listed in
+    fail_on raise an error; for questions listed in invalid_on the model (with
+    tools bound) calls a tool that does not exist, like a small model picking a
+    wrong tool name. Every call's question is appended to call_log, which
+    is shared with the tool-bound copies used by the agents, and the estimated
+    input tokens to prompt_tokens. With reuse_tool_results, script entries whose
+    tool call (name and arguments) is already in the history are skipped, like a
+    model answering a follow-up from earlier tool results. Entries calling only
+    the discovery tools are skipped when a system message carries the prefetched
+    workspace / project directory, as the prompt asks.
+
+    Input tokens include the bound tool schemas. A system message ending in a
+    cache point is cached like Bedrock prompt caching does: the first call with
+    a given prefix (tools and system prompt) writes it, later calls report it as
+    cache_read and not as input tokens.
+    """
+
+    tool_script: List[Any] = []
+    latency: float = 0.0
+    tools_bound: bool = False
+    bound_tools: List[str] = []
+    capacity: int = 0
+    fail_on: List[str] = []
+    invalid_on: List[str] = []
+    call_log: List[str] = []
+    prompt_tokens: List[int] = []
+    reuse_tool_results: bool = False
+    tool_tokens: int = 0
+    cached_prefixes: List[str] = []
+    _slots: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def bind_tools(self, tools, **kwargs):
+        # Tool calls are scripted by name; the script only runs once tools are bound
+        names = [getattr(tool, "name", None) for tool in tools]
+        return self.model_copy(update={"tools_bound": True, "bound_tools": names, "tool_tokens": schema_tokens(tools)})
+
+    def _next_message(self, messages: List[BaseMessage]) -> AIMessage:
+        human_index = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage))
+        question = messages[human_index].content
+        self.call_log.append(question)
+        if question in self.fail_on:
+            raise ValueError(f"model failure for {question!r}")
+        prompt = self._prompt_usage(messages)
+        self.prompt_tokens.append(prompt["input_tokens"] + prompt["input_token_details"]["cache_read"])
+        steps = sum(
+            1 for m in messages[human_index + 1:]
+            if isinstance(m, AIMessage) and m.tool_calls
+        )
+        script = [
+            entry for entry in self.tool_script
+            if all(self._entry_name(call) in self.bound_tools for call in (entry if isinstance(entry, list) else [entry]))
+        ]
+        if any(isinstance(m, SystemMessage) and DIRECTORY_HEADER in self._text(m) for m in messages[1:human_index]):
+            script = [
+                entry for entry in script
+                if not all(self._entry_name(call) in DIRECTORY_TOOLS for call in (entry if isinstance(entry, list) else [entry]))
+            ]
+        if self.reuse_tool_results:
+            seen = {
+                (call["name"], json.dumps(call["args"], sort_keys=True))
+                for m in messages[:human_index] if isinstance(m, AIMessage) for call in m.tool_calls
+            }
+            script = [
+                entry for entry in script
+                if not (isinstance(entry, tuple) and (entry[0], json.dumps(entry[1], sort_keys=True)) in seen)
+            ]
+        if self.tools_bound and question in self.invalid_on:
+            return AIMessage(content="", tool_calls=[{"name": "asana_unknown_tool", "args": {}, "id": f"call_{steps}_0"}],
+                             usage_metadata=self._usage(prompt, ""))
+        if self.tools_bound and steps < len(script):
+            entry = script[steps]
+            # A list entry is one turn with several independent tool calls
+            calls = entry if isinstance(entry, list) else [entry]
+            tool_calls = []
+            for i, call in enumerate(calls):
+                name, args = call if isinstance(call, tuple) else (call, {"query": question})
+                tool_calls.append({"name": name, "args": args, "id": f"call_{steps}_{i}"})
+            return AIMessage(content="", tool_calls=tool_calls, usage_metadata=self._usage(prompt, ""))
+        content = f"<thinking>回答を作成します</thinking>{question} への回答です。"
+        return AIMessage(content=content, usage_metadata=self._usage(prompt, content))
+
+    @staticmethod
+    def _entry_name(call) -> str:
+        return call[0] if isinstance(call, tuple) else call
+
+    @staticmethod
+    def _text(message: BaseMessage) -> str:
+        if isinstance(message.content, str):
+            return message.content
+        return "".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+    def _prompt_usage(self, messages: List[BaseMessage]) -> dict:
+        """Rough input token counts (4 characters per token), reading or writing the prompt cache"""
+        text = [self._text(m) for m in messages]
+        input_tokens = sum(len(t) for t in text) // 4 + 1 + self.tool_tokens
+        cache_read = cache_write = 0
+        system = messages[0] if messages and isinstance(messages[0], SystemMessage) else None
+        if system is not None and isinstance(system.content, list) and "cachePoint" in system.content[-1]:
+            prefix = len(text[0]) // 4 + self.tool_tokens
+            key = f"{self.bound_tools}{text[0]}"
+            if key in self.cached_prefixes:
+                cache_read = prefix
+            else:
+                self.cached_prefixes.append(key)
+                cache_write = prefix
+            input_tokens -= cache_read
+        return {"input_tokens": input_tokens, "input_token_details": {"cache_read": cache_read, "cache_creation": cache_write}}
+
+    @staticmethod
+    def _usage(prompt: dict, content: str) -> dict:
+        """Usage metadata in the shape Bedrock reports it"""
+        output_tokens = len(content) // 4 + 1
+        total = prompt["input_tokens"] + prompt["input_token_details"]["cache_read"] + output_tokens
+        return {**prompt, "output_tokens": output_tokens, "total_tokens": total}
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages))])
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        if self.capacity:
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(self.capacity)
+            async with self._slots:
+                await asyncio.sleep(self.latency)
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages))])
+
+    async def _astream(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message = self._next_message(messages)
+        if message.tool_calls:
+            chunk = AIMessageChunk(content="", tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False), "id": call["id"], "index": i}
+                for i, call in enumerate(message.tool_calls)
+            ])
+            yield ChatGenerationChunk(message=chunk)
+            return
+        # Small chunks so that <thinking> tags are split across chunk boundaries
+        for i in range(0, len(message.content), 4):
+            text = message.content[i:i + 4]
+            if run_manager:
+                await run_manager.on_llm_new_token(text)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+
+def _fake_reference(resource_type: str, gid: str, name: str) -> dict:
+    return {"gid": gid, "name": name, "resource_type": resource_type}
+
+
+def _fake_asana_task(index: int) -> dict:
+    """A task in the shape the Asana API returns it with the server's default fields"""
+    notes = f"タスク {index} の詳細です。関係者と日程を調整し、資料を共有フォルダに保存してください。" * 6
+    project = _fake_reference("project", "2001", "Webサイトリニューアル")
+    return {
+        "gid": str(3000 + index),
+        "resource_type": "task",
+        "resource_subtype": "default_task",
+        "name": f"タスク {index}: 会議資料の準備",
+        "notes": notes,
+        "html_notes": f"<body>{notes}</body>",
+        "completed": index % 3 == 0,
+        "completed_at": None,
+        "due_on": f"2026-10-{10 + index % 20:02d}",
+        "due_at": None,
+        "start_on": None,
+        "assignee": {**_fake_reference("user", "4001", "山田 太郎"), "email": "yamada@example.com",
+                     "photo": {"image_60x60": "https://s3.amazonaws.com/profile_photos/4001.60x60.png"}},
+        "assignee_status": "upcoming",
+        "projects": [project],
+        "memberships": [{"project": project, "section": _fake_reference("section", "5001", "進行中")}],
+        "workspace": _fake_reference("workspace", "1001", "Yapodu"),
+        "followers": [_fake_reference("user", "4001", "山田 太郎"), _fake_reference("user", "4002", "佐藤 花子")],
+        "tags": [],
+        "custom_fields": [{
+            **_fake_reference("custom_field", "6001", "優先度"), "resource_subtype": "enum", "type": "enum",
+            "enum_options": [{**_fake_reference("enum_option", f"700{i}", label), "color": "red", "enabled": True}
+                             for i, label in enumerate(("高", "中", "低"))],
+            "enum_value": {**_fake_reference("enum_option", "7000", "高"), "color": "red", "enabled": True},
+            "display_value": "高",
+        }],
+        "likes": [],
+        "hearts": [],
+        "liked": False,
+        "hearted": False,
+        "num_likes": 0,
+        "num_hearts": 0,
+        "parent": None,
+        "permalink_url": f"https://app.asana.com/0/2001/{3000 + index}",
+        "created_at": "2026-10-01T09:00:00.000Z",
+        "modified_at": "2026-10-15T18:30:00.000Z",
+    }
+
+
+def fake_asana_payload(name: str, arguments: Dict[str, Any], tasks: int = 10) -> str:
+    """
+    JSON an Asana MCP tool returns, with the fields and nesting of the Asana API
+
+    Args:
+        name: Tool name
+        arguments: Tool arguments
+        tasks: Number of tasks in search results
+
+    Returns:
+        JSON string
+    """
+    if name == "asana_list_workspaces":
+        value = [{**_fake_reference("workspace", gid, workspace), "is_organization": True, "email_domains": ["example.com"]}
+                 for gid, workspace in (("1001", "Yapodu"), ("1002", "Yapodu Labs"))]
+    elif "project" in name:
+        value = [{**_fake_reference("project", str(2001 + i), project), "archived": False, "color": None,
+                  "owner": _fake_reference("user", "4001", "山田 太郎"), "notes": "", "html_notes": "<body></body>",
+                  "workspace": _fake_reference("workspace", arguments.get("workspace") or "1001", "Yapodu"),
+                  "permalink_url": f"https://app.asana.com/0/{2001 + i}/list"}
+                 for i, project in enumerate(("Webサイトリニューアル", "社内ハンズオン", "LangChain検証"))]
+    elif name in ("asana_get_task", "asana_create_task", "asana_update_task"):
+        value = {"data": _fake_asana_task(1)}
+    else:
+        value = {"data": [_fake_asana_task(i) for i in range(1, tasks + 1)]}
+    return json.dumps(value, ensure_ascii=False, indent=2)
+
+
+def make_fake_asana_tools(
+    latency: float = 0.0,
+    calls: Optional[List[str]] = None,
+    latencies: Optional[Dict[str, float]] = None,
+    payloads: bool = False
+) -> List[BaseTool]:
+    """
+    Create fake Asana tools with realistic names and argument schemas
+
+    Args:
+        latency: Artificial latency in seconds added to each call
+        calls: Optional list that records the name of every completed call
+        latencies: Optional per-tool latency overriding latency
+        payloads: Return full Asana API payloads (fake_asana_payload) instead of a short stub
+
+    Returns:
+        List of tools returning canned JSON strings
+    """
+    def build(name: str) -> BaseTool:
+        delay = (latencies or {}).get(name, latency)
+
+        async def call(**arguments) -> str:
+            if delay:
+                await asyncio.sleep(delay)
+            if calls is not None:
+                calls.append(name)
+            if payloads:
+                return fake_asana_payload(name, arguments)
+            return f'{{"tool": "{name}", "arguments": {arguments}, "data": []}}'
+
+        return StructuredTool(
+            name=name,
+            description=f"Fake {name} tool",
+            args_schema={
+                "type": "object",
+                "properties": {
+                    "workspace": {"type": "string", "description": "Workspace GID"},
+                    "text": {"type": "string", "description": "Search text"},
+                },
+            },
+            coroutine=call,
+        )
+
+    return [build(name) for name in FAKE_ASANA_TOOL_NAMES]
+
+
+class FakeRetriever(BaseRetriever):
+    """
+    Retriever stand-in for AmazonKnowledgeBasesRetriever with blocking latency
+
+    Scores start at top_score and drop by 0.1 per result. document_chars pads each
+    chunk to about that length, the way real chunks fill the context.
+    """
+
+    latency: float = 0.0
+    number_of_results: int = 5
+    top_score: float = 1.0
+    document_chars: int = 0
+    calls: int = 0
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        self.calls += 1
+        if self.latency:
+            # Blocking sleep, like the boto3 retrieve call
+            time.sleep(self.latency)
+        documents = []
+        for i in range(self.number_of_results):
+            content = f"{query} に関する文書 {i + 1}。"
+            if self.document_chars:
+                filler = f"文書 {i + 1} の規程の条文と運用の説明です。"
+                content += filler * max(0, (self.document_chars - len(content)) // len(filler))
+            documents.append(Document(
+                page_content=content,
+                metadata={"location": {"s3Location": {"uri": f"s3://fake-kb/doc-{i + 1}.md"}},
+                          "score": round(self.top_score - i * 0.1, 4)},
+            ))
+        return documents
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic embedder based on hashed character bigrams
+
+    Similar strings get similar vectors, which is enough to exercise semantic
+    lookups without calling Bedrock.
+    """
+
+    def __init__(self, dimension: int = 256):
+        self.dimension = dimension
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        padded = f" {text} "
+        for i in range(len(padded) - 1):
+            vector[zlib.crc32(padded[i:i + 2].encode("utf-8")) % self.dimension] += 1.0
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class FakeRedis:
+    """Local stand-in for the subset of redis.Redis used by RedisCacheBackend"""
+
+    def __init__(self):
+        self._data = {}
+
+    def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def set(self, key: str, value, ex: Optional[int] = None):
+        self._data[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def delete(self, *keys) -> int:
+        return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def scan_iter(self, match: str = "*"):
+        return iter([key for key in list(self._data) if fnmatch.fnmatchcase(key, match)])
@@ -0,0 +1,180 @@
+"""
+Hybrid route: questions that need both Asana and the knowledge base
+
+"このプロジェクトの手順書と進捗を教えて" scores for both routes, but the router
+answers only the best one and users re-ask for the other half. When several
+routes match clearly, their handlers run concurrently under one
+deadline and a single model call merges the answers.
+"""
+import os
+import re
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from langchain_core.messages import HumanMessage
+
+import metrics
+from budget import RequestBudget
+from response_cache import ERROR_MARKERS
+from router import Intent
+
+logger = logging.getLogger(__name__)
+
+HYBRID_ROUTE = "hybrid"
+BRANCH_LABELS = {"asana": "Asana", "knowledge_base": "社内文書"}
+
+SYNTHESIS_PROMPT = """以下は、ユーザーの質問について{sources}をそれぞれ調べた結果です。
+これらを統合して、質問に対する一つの回答を日本語で作成してください。
+調査結果にない情報は推測せず、取得できなかった情報があればその旨を記載してください。
+
+質問: {question}
+
+{results}"""
+
+
+class BranchResult(NamedTuple):
+    """Outcome of one route's handler in a hybrid answer"""
+    route: str
+    # "ok", "error" (failed or answered with an error message) or "cancelled"
+    status: str
+    response: Optional[str]
+    error: Optional[BaseException]
+    seconds: float
+
+
+def hybrid_enabled() -> bool:
+    return os.getenv("HYBRID_ROUTING_ENABLED", "true").lower() == "true"
+
+
+def hybrid_routes(intents: List[Intent], min_score: Optional[float] = None) -> List[str]:
+    """
+    Routes to answer together
+
+    Every route must reach min_score on its own, so a generic word shared by
+    both keyword lists ("プロジェクトの仕様書" is a document question) does not
+    make a question hybrid.
+
+    Args:
+        intents: Matching intents, best first (IntentRouter.matching_routes)
+        min_score: Score each route needs (HYBRID_MIN_SCORE)
+
+    Returns:
+        Two or more routes, or [] when the best route alone answers the question
+    """
+    min_score = min_score if min_score is not None else float(os.getenv("HYBRID_MIN_SCORE", "1.0"))
+    routes = [intent.route for intent in intents if intent.route in BRANCH_LABELS and intent.score >= min_score]
+    return routes if len(routes) > 1 else []
+
+
+def _is_error(response) -> bool:
+    return not response or any(marker in response for marker in ERROR_MARKERS)
+
+
+async def run_branches(
+    branches: Dict[str, Callable[[], Awaitable[str]]],
+    deadline: Optional[float] = None,
+    straggler_timeout: Optional[float] = None,
+    budget: Optional[RequestBudget] = None
+) -> List[BranchResult]:
+    """
+    Run the route handlers concurrently until they finish or are no longer needed
+
+    All branches share one deadline. Once a branch has answered, the others get
+    at most straggler_timeout more seconds, so a slow tool call cannot hold the
+    whole answer back. Branches still running then are cancelled, which cancels
+    their model and tool calls.
+
+    Args:
+        branches: Handler per route
+        deadline: Seconds for all branches (HYBRID_DEADLINE)
+        straggler_timeout: Seconds the others get after the first answer (HYBRID_STRAGGLER_TIMEOUT)
+        budget: The request's budget; the branches also end at its deadline
+
+    Returns:
+        One result per branch, in the order of branches
+    """
+    deadline = deadline if deadline is not None else float(os.getenv("HYBRID_DEADLINE", "60"))
+    if budget is not None:
+        deadline = min(deadline, max(budget.remaining(), 0))
+    straggler_timeout = straggler_timeout if straggler_timeout is not None else float(
+        os.getenv("HYBRID_STRAGGLER_TIMEOUT", "10"))
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    ends_at = start + deadline
+    tasks = {asyncio.create_task(func()): route for route, func in branches.items()}
+    pending = set(tasks)
+    results: Dict[str, BranchResult] = {}
+    try:
+        while pending and loop.time() < ends_at:
+            done, pending = await asyncio.wait(pending, timeout=ends_at - loop.time(),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            answered = any(result.status == "ok" for result in results.values())
+            for task in done:
+                route = tasks[task]
+                try:
+                    response = task.result()
+                    status, error = ("error" if _is_error(response) else "ok"), None
+                except Exception as e:
+                    response, status, error = None, "error", e
+                results[route] = BranchResult(route, status, response, error, loop.time() - start)
+            if not answered and any(result.status == "ok" for result in results.values()):
+                ends_at = min(ends_at, loop.time() + straggler_timeout)
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    for task in pending:
+        route = tasks[task]
+        logger.info(f"Cancelled {route} branch after {loop.time() - start:.2f}s")
+        results[route] = BranchResult(route, "cancelled", None, None, loop.time() - start)
+    for result in results.values():
+        metrics.HYBRID_BRANCHES.inc(route=result.route, status=result.status)
+    return [results[route] for route in branches]
+
+
+def synthesis_messages(question: str, results: List[BranchResult]) -> List[HumanMessage]:
+    """Prompt that merges the branch answers"""
+    sections = []
+    for result in results:
+        body = result.response if result.status == "ok" else "（時間内に情報を取得できませんでした）"
+        sections.append(f"## {BRANCH_LABELS[result.route]}の調査結果\n{body}")
+    sources = "と".join(BRANCH_LABELS[result.route] for result in results)
+    return [HumanMessage(content=SYNTHESIS_PROMPT.format(
+        sources=sources, question=question, results="\n\n".join(sections)))]
+
+
+async def answer_hybrid(
+    question: str,
+    branches: Dict[str, Callable[[], Awaitable[str]]],
+    chat_model,
+    deadline: Optional[float] = None,
+    straggler_timeout: Optional[float] = None,
+    budget: Optional[RequestBudget] = None
+) -> str:
+    """
+    Answer a question from several routes
+
+    With one usable branch its answer is returned as is (noting what is
+    missing); with several, one model call merges them.
+
+    Raises:
+        Exception: The first branch's exception when no branch answered and one
+            raised (e.g. admission's Overloaded)
+    """
+    results = await run_branches(branches, deadline, straggler_timeout, budget)
+    usable = [result for result in results if result.status == "ok"]
+    if not usable:
+        raised = next((result.error for result in results if result.error is not None), None)
+        if raised is not None:
+            raise raised
+        return next((result.response for result in results if result.response),
+                    "申し訳ございません。Asanaと社内文書のどちらからも情報を取得できませんでした。")
+    if len(usable) == 1:
+        missing = [BRANCH_LABELS[result.route] for result in results if result.status != "ok"]
+        note = f"\n\n（{'・'.join(missing)}からは情報を取得できませんでした）" if missing else ""
+        return usable[0].response + note
+    with metrics.stage("synthesis", route=HYBRID_ROUTE):
+        ai_msg = await chat_model.ainvoke(synthesis_messages(question, results))
+    return re.sub(r"<thinking>.*?</thinking>", "", ai_msg.content, flags=re.DOTALL).strip()
@@ -2,56 +2,315 @@
 AWS Bedrock Knowledge Base integration module
 """
 import os
+import json
+import asyncio
 import logging
-from typing import Dict, Any, Optional
-import boto3
-from langchain_aws import AmazonKnowledgeBasesRetriever
-from langchain_core.messages import HumanMessage, SystemMessage
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langgraph.prebuilt import create_react_agent
+from langchain_core.tools import StructuredTool
 import re
 
+import metrics
+from admission import bedrock_client_config
+from budget import RequestBudget, default_budget, run_agent
+from local_index import LocalIndex, load_or_build_index, merge_results
+from memory import history_trimmer
+from retrieval_cache import RetrievalCache
+from router import intent_router
+from tables import TableQuery, TableStore, is_table_question
+
 logger = logging.getLogger(__name__)
 
+KB_SYSTEM_PROMPT = """あなたは社内文書検索のアシスタントです。
+AWS Bedrock Knowledge Baseから関連する文書を検索し、その内容に基づいて日本語で正確に回答してください。
+
+重要なルール：
+1. 常に日本語で応答する
+2. Knowledge Baseから取得した情報に基づいて回答する
+3. 情報が見つからない場合は、その旨を明確に伝える
+4. 複数の関連文書が見つかった場合は、最も関連性の高い情報を優先する
+5. 回答には出典（文書名やセクション）を含める
+6. 推測や憶測は避け、文書に記載されている内容のみを伝える
+
+回答フォーマット：
+- 見つかった情報を簡潔にまとめる
+- 必要に応じて箇条書きを使用する
+- 出典を明記する（例：「〇〇マニュアルによると...」）
+"""
+
+# Added to the agent's system prompt when spreadsheet tables are loaded
+KB_TABLE_PROMPT = """
+表形式のデータ（query_table で参照できるテーブル）について：
+- 一覧・件数・絞り込み・集計の質問には search_knowledge_base ではなく query_table を使用する
+- query_table の結果は該当する行をすべて含むため、行を省略せずに回答する（truncated が true の場合はその旨を伝える）
+- 出典としてテーブルのファイル名とシート名を示す
+"""
+
 
 class KnowledgeBaseClient:
     """Client for AWS Bedrock Knowledge Base operations"""
     
-    def __init__(self):
+    def __init__(self, knowledge_base_id: Optional[str] = None):
         self.region = os.getenv("AWS_REGION", "us-west-2")
-        self.knowledge_base_id = os.getenv("BEDROCK_KNOWLEDGE_BASE_ID")
+        self.knowledge_base_id = knowledge_base_id or os.getenv("BEDROCK_KNOWLEDGE_BASE_ID")
         self.retriever = None
+        self.retrieval_config = {
+            "vectorSearchConfiguration": {
+                "numberOfResults": 5,  # Return top 5 most relevant documents
+                "overrideSearchType": "HYBRID",  # Use hybrid search (semantic + keyword)
+            }
+        }
+        
+        # Repeated questions are answered from the retrieval cache
+        self.cache = None
+        if os.getenv("KB_CACHE_ENABLED", "true").lower() == "true":
+            self.cache = RetrievalCache(
+                retrieval_config=self.retrieval_config,
+                namespace=self.knowledge_base_id or ""
+            )
+        
+        # Blocking boto3 retrieve calls run on a dedicated, bounded thread pool
+        self.max_workers = int(os.getenv("KB_RETRIEVAL_MAX_WORKERS", "8"))
+        self.max_concurrency = int(os.getenv("KB_RETRIEVAL_MAX_CONCURRENCY", str(self.max_workers)))
+        self.timeout = float(os.getenv("KB_RETRIEVAL_TIMEOUT", "10"))
+        self._executor = None
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        # "direct" answers from the retrieved documents with a single model call and
+        # uses the agent only when retrieval looks weak; "agent" always uses the agent
+        self.answer_mode = os.getenv("KB_ANSWER_MODE", "direct")
+        self.min_score = float(os.getenv("KB_RAG_MIN_SCORE", "0.4"))
+        self.max_context_tokens = int(os.getenv("KB_RAG_MAX_CONTEXT_TOKENS", "3000"))
+        self.max_document_tokens = int(os.getenv("KB_RAG_MAX_DOCUMENT_TOKENS", "1000"))
+        
+        # Local retrieval tier over the data-source files, consulted before Bedrock:
+        # "fallback" answers from it alone when its top score reaches local_min_score,
+        # "merge" always queries both and merges the results
+        self.local_source_dir = os.getenv("KB_LOCAL_SOURCE_DIR")
+        self.local_index_dir = os.getenv("KB_LOCAL_INDEX_DIR", ".kb_local_index")
+        self.local_mode = os.getenv("KB_LOCAL_MODE", "fallback")
+        self.local_min_score = float(os.getenv("KB_LOCAL_MIN_SCORE", "0.6"))
+        self.local_vector_weight = float(os.getenv("KB_LOCAL_VECTOR_WEIGHT", "0.5"))
+        self.local_index: Optional[LocalIndex] = None
+        self.local_embedder = None
+        self.local_counters = {"local": 0, "remote": 0, "merged": 0}
+        
+        # Spreadsheets in the data-source directory are also loaded as tables for
+        # list / count / filter questions (query_table tool)
+        self.tables_enabled = os.getenv("KB_TABLES_ENABLED", "true").lower() == "true"
+        self.tables: Optional[TableStore] = None
         
         if not self.knowledge_base_id:
             logger.warning("BEDROCK_KNOWLEDGE_BASE_ID not set. Knowledge Base integration disabled.")
         
-    def initialize(self):
-        """Initialize the knowledge base retriever"""
+    def initialize(self, retriever=None, local_index: Optional[LocalIndex] = None, tables: Optional[TableStore] = None):
+        """
+        Initialize the knowledge base retriever
+        
+        Args:
+            retriever: Optional retriever to use instead of AmazonKnowledgeBasesRetriever
+                       (used with the fake backends in benchmarks and tests)
+            local_index: Optional local index to use instead of the one built from KB_LOCAL_SOURCE_DIR
+            tables: Optional table store to use instead of the one loaded from KB_LOCAL_SOURCE_DIR
+        """
         if not self.knowledge_base_id:
             raise ValueError("BEDROCK_KNOWLEDGE_BASE_ID is required")
+        
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="kb-retrieve"
+        )
+        if local_index is not None:
+            self.local_index = local_index
+        else:
+            self.reload_local_index()
+        if tables is not None:
+            self.tables = tables
+        elif self.local_source_dir and self.tables_enabled:
+            self.tables = TableStore(self.local_source_dir)
+            self.tables.refresh(force=True)
+        if retriever is not None:
+            self.retriever = retriever
+            return
             
         try:
-            # Initialize the retriever
+            # Initialize the retriever (langchain_aws is imported here, not with the app)
+            from langchain_aws import AmazonKnowledgeBasesRetriever
             self.retriever = AmazonKnowledgeBasesRetriever(
                 knowledge_base_id=self.knowledge_base_id,
                 region_name=self.region,
-                retrieval_config={
-                    "vectorSearchConfiguration": {
-                        "numberOfResults": 5,  # Return top 5 most relevant documents
-                        "overrideSearchType": "HYBRID",  # Use hybrid search (semantic + keyword)
-                    }
-                }
+                retrieval_config=self.retrieval_config,
+                config=bedrock_client_config(self.max_workers)
             )
             logger.info(f"Knowledge Base retriever initialized for ID: {self.knowledge_base_id}")
         except Exception as e:
             logger.error(f"Failed to initialize Knowledge Base retriever: {e}")
             raise
     
+    def reload_local_index(self):
+        """
+        Load the local index from KB_LOCAL_INDEX_DIR, rebuilding it if the files in
+        KB_LOCAL_SOURCE_DIR changed; without KB_LOCAL_SOURCE_DIR the local tier is off
+        
+        Failures are logged and leave the previous index (or none) in place, so
+        retrieval keeps working through Bedrock.
+        """
+        if not self.local_source_dir:
+            return
+        try:
+            if os.getenv("KB_LOCAL_EMBEDDINGS", "false").lower() == "true" and self.local_embedder is None:
+                from response_cache import create_embedder
+                self.local_embedder = create_embedder(os.getenv("KB_LOCAL_EMBEDDING_MODEL"))
+            self.local_index = load_or_build_index(
+                self.local_source_dir,
+                self.local_index_dir,
+                embedder=self.local_embedder,
+                embedding_model=getattr(self.local_embedder, "model_id", "") if self.local_embedder else "",
+            )
+        except Exception as e:
+            logger.error(f"Failed to load the local knowledge base index: {e}")
+    
+    def is_table_question(self, query: str) -> bool:
+        """Whether the question should be answered from the tables (list / count / filter)"""
+        return bool(self.tables is not None and self.tables.tables and is_table_question(query))
+    
+    async def _search_local(self, query: str) -> List[Document]:
+        """Search the local index, embedding the query when the index has vectors"""
+        query_vector = None
+        if self.local_index.vectors is not None and self.local_embedder is not None:
+            query_vector = await self.local_embedder.aembed_query(query)
+        with metrics.stage("kb_local_search", route="knowledge_base"):
+            return self.local_index.search(
+                query,
+                k=self.retrieval_config["vectorSearchConfiguration"]["numberOfResults"],
+                query_vector=query_vector,
+                vector_weight=self.local_vector_weight
+            )
+    
     def get_retriever(self):
         """Get the configured retriever"""
         if not self.retriever:
             raise RuntimeError("Knowledge Base retriever not initialized. Call initialize() first.")
         return self.retriever
+    
+    async def aretrieve(self, query: str) -> List[Document]:
+        """
+        Retrieve documents without blocking the event loop
+        
+        With a local index, its results are returned directly when the top score
+        reaches local_min_score ("fallback" mode) or merged with the Bedrock
+        results ("merge" mode). Cached results are returned directly. On a miss
+        the blocking retriever call runs on the dedicated thread pool, at most
+        max_concurrency calls are in flight and each call is bounded by timeout.
+        
+        Args:
+            query: Search query
+            
+        Returns:
+            List of retrieved documents
+            
+        Raises:
+            asyncio.TimeoutError: If the retrieval does not finish within timeout
+        """
+        retriever = self.get_retriever()
+        local = []
+        if self.local_index is not None:
+            local = await self._search_local(query)
+            if self.local_mode != "merge" and retrieval_score(local) >= self.local_min_score:
+                self._count_local("local")
+                return local
+        
+        try:
+            documents = await self._retrieve_remote(retriever, query)
+        except asyncio.TimeoutError:
+            # Bedrock is too slow, but the local results may still answer the question
+            if local:
+                logger.warning(f"Knowledge base retrieval timed out after {self.timeout}s, using local results")
+                self._count_local("local")
+                return local
+            raise
+        if self.local_index is not None and self.local_mode == "merge":
+            self._count_local("merged")
+            return merge_results(local, documents, self.retrieval_config["vectorSearchConfiguration"]["numberOfResults"])
+        if self.local_index is not None:
+            self._count_local("remote")
+        return documents
+    
+    def _count_local(self, outcome: str):
+        self.local_counters[outcome] += 1
+        metrics.KB_LOCAL_RETRIEVALS.inc(outcome=outcome)
+    
+    async def warm(self, query: str) -> bool:
+        """
+        Retrieve a frequent query ahead of time so its results wait in the retrieval cache
+        
+        A cached entry is retrieved again (refreshed) rather than returned, so
+        warming before KB_CACHE_TTL keeps the entry from expiring. Queries the
+        local index answers on its own are skipped.
+        
+        Args:
+            query: Search query
+            
+        Returns:
+            True when the query was retrieved from Bedrock
+        """
+        retriever = self.get_retriever()
+        if self.local_index is not None and self.local_mode != "merge" and \
+                retrieval_score(await self._search_local(query)) >= self.local_min_score:
+            return False
+        await self._retrieve_remote(retriever, query, refresh=True)
+        return True
+    
+    async def _retrieve_remote(self, retriever, query: str, refresh: bool = False) -> List[Document]:
+        """Retrieve from Bedrock (or the retrieval cache, unless refresh is set)"""
+        if self.cache and not refresh:
+            documents = self.cache.get(query)
+            if documents is not None:
+                return documents
+        
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            # A timed-out call keeps its worker thread until boto3 returns, which is
+            # why the pool is bounded rather than shared with the default executor
+            with metrics.stage("kb_retrieve", route="knowledge_base"):
+                documents = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, retriever.invoke, query),
+                    timeout=self.timeout
+                )
+        
+        if self.cache:
+            self.cache.set(query, documents)
+        return documents
+    
+    def invalidate_cache(self):
+        """Invalidate cached retrieval results, e.g. after a data source sync"""
+        if self.cache:
+            self.cache.invalidate()
+    
+    def local_stats(self) -> Optional[dict]:
+        """Local index size and outcome counters for health reporting (None when the tier is off)"""
+        if self.local_index is None:
+            return None
+        return {
+            "documents": len(self.local_index),
+            "vectors": self.local_index.vectors is not None,
+            "mode": self.local_mode,
+            "min_score": self.local_min_score,
+            **self.local_counters,
+        }
+    
+    def table_stats(self) -> Optional[dict]:
+        """Loaded tables and reload counters for health reporting (None when tables are off)"""
+        return self.tables.stats() if self.tables is not None else None
+    
+    def close(self):
+        """Shut down the retrieval thread pool"""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
 
 
 def is_knowledge_base_query(query: str) -> bool:
@@ -64,86 +323,26 @@ def is_knowledge_base_query(query: str) -> bool:
     Returns:
         bool: True if the query is related to knowledge base
     """
-    # Keywords that indicate knowledge base queries
-    kb_keywords = [
-        # Document-related
-        "文書", "ドキュメント", "資料", "書類", "文献",
-        "マニュアル", "ガイド", "手順書", "説明書",
-        "規程", "規則", "ポリシー", "方針",
-        "仕様書", "設計書", "報告書", "レポート",
-        "レコード", "リスト", 
-        
-        # Company/internal related
-        "社内", "会社", "組織", "部署", "チーム",
-        "プロジェクト", "製品", "サービス",
-        "システム", "ツール", "アプリケーション",
-        
-        # Question patterns
-        "について教えて", "について説明", "とは何",
-        "どのような", "どうやって", "やり方",
-        "使い方", "方法", "手順",
-        
-        # Specific document requests
-        "最新の", "現在の", "今の",
-        "確認したい", "調べたい", "知りたい",
-        "探している", "検索", "参照"
-    ]
-    
-    # Convert query to lowercase for case-insensitive matching
-    query_lower = query.lower()
-    
-    # Check for keywords
-    for keyword in kb_keywords:
-        if keyword in query_lower:
-            logger.debug(f"Knowledge base keyword found: {keyword}")
-            return True
-    
-    # Additional patterns that might indicate KB queries
-    # Pattern: asking about specific procedures or policies
-    procedure_patterns = [
-        r".*の(手順|方法|やり方|使い方)",
-        r".*について(教えて|説明|知りたい)",
-        r".*マニュアル|.*ガイド|.*ドキュメント",
-        r".*規程|.*ポリシー|.*ルール"
-    ]
-    
-    for pattern in procedure_patterns:
-        if re.search(pattern, query_lower):
-            logger.debug(f"Knowledge base pattern matched: {pattern}")
-            return True
-    
-    return False
+    return intent_router.route(query) == "knowledge_base"
 
 
-def create_knowledge_base_agent(chat_model, retriever):
+def create_knowledge_base_agent(chat_model, kb_client: KnowledgeBaseClient, checkpointer=None):
     """
     Create an agent configured for Knowledge Base operations
     
     Args:
         chat_model: The LLM model to use
-        retriever: The knowledge base retriever
+        kb_client: Initialized KnowledgeBaseClient used for async retrieval
+        checkpointer: Optional LangGraph checkpointer for session memory
         
     Returns:
         Configured agent for knowledge base operations
     """
     
+    tables = kb_client.tables if kb_client.tables is not None and kb_client.tables.tables else None
+    
     # System message for the agent
-    system_message = SystemMessage(content="""あなたは社内文書検索のアシスタントです。
-AWS Bedrock Knowledge Baseから関連する文書を検索し、その内容に基づいて日本語で正確に回答してください。
-
-重要なルール：
-1. 常に日本語で応答する
-2. Knowledge Baseから取得した情報に基づいて回答する
-3. 情報が見つからない場合は、その旨を明確に伝える
-4. 複数の関連文書が見つかった場合は、最も関連性の高い情報を優先する
-5. 回答には出典（文書名やセクション）を含める
-6. 推測や憶測は避け、文書に記載されている内容のみを伝える
-
-回答フォーマット：
-- 見つかった情報を簡潔にまとめる
-- 必要に応じて箇条書きを使用する
-- 出典を明記する（例：「〇〇マニュアルによると...」）
-""")
+    system_message = SystemMessage(content=KB_SYSTEM_PROMPT + (KB_TABLE_PROMPT if tables else ""))
     
     # Create prompt template
     prompt = ChatPromptTemplate.from_messages([
@@ -151,58 +350,115 @@ AWS Bedrock Knowledge Baseから関連する文書を検索し、その内容に
         MessagesPlaceholder(variable_name="messages"),
     ])
     
-    # For knowledge base, we'll use the retriever as a tool
-    from langchain_core.tools import Tool
+    # Imported here: compaction builds on the helpers of this module
+    from compaction import CompactingToolNode, ToolOutputCompactor, compaction_enabled
+    compaction = compaction_enabled()
+    
+    # For knowledge base, we'll use the retriever as a native async tool. With
+    # compaction the model gets the truncated, deduplicated documents and the
+    # full documents stay on the tool message as its artifact
+    async def search_knowledge_base(query: str):
+        try:
+            documents = await kb_client.aretrieve(query)
+        except asyncio.TimeoutError:
+            logger.warning(f"Knowledge base retrieval timed out after {kb_client.timeout}s")
+            return ("文書検索がタイムアウトしました。", []) if compaction else "文書検索がタイムアウトしました。"
+        if not compaction:
+            return documents
+        context, _ = compact_documents(documents, kb_client.max_context_tokens, kb_client.max_document_tokens)
+        return context or "関連する文書が見つかりませんでした。", documents
     
-    retriever_tool = Tool(
+    retriever_tool = StructuredTool.from_function(
+        coroutine=search_knowledge_base,
         name="search_knowledge_base",
         description="社内文書やマニュアルを検索します。質問に関連する文書を探すときに使用します。",
-        func=lambda query: retriever.invoke(query)
+        response_format="content_and_artifact" if compaction else "content"
     )
     
-    # Create agent with the retriever tool
+    tools = [retriever_tool]
+    if tables:
+        async def query_table(**arguments):
+            try:
+                with metrics.stage("kb_table_query", route="knowledge_base"):
+                    # query() may re-read changed spreadsheets first
+                    result = await asyncio.to_thread(tables.query, TableQuery(**arguments))
+            except (KeyError, ValueError) as e:
+                return str(e.args[0] if e.args else e)
+            return json.dumps(result, ensure_ascii=False)
+        
+        tools.append(StructuredTool.from_function(
+            coroutine=query_table,
+            name="query_table",
+            description="表形式のデータを条件で絞り込み、該当する行・件数・集計値を正確に返します。"
+                        "一覧・件数・絞り込み・集計の質問に使用します。テーブル:\n" + tables.describe(),
+            args_schema=TableQuery
+        ))
+    
+    # Session agents keep earlier turns; trim them to a token budget before each model call
+    if checkpointer is not None:
+        prompt = history_trimmer() | prompt
+    
+    # Create agent with the retriever tool; documents already shown in the request
+    # are left out of later searches and all results share one token budget
+    from langgraph.prebuilt import create_react_agent
+    compactor = ToolOutputCompactor(
+        "knowledge_base",
+        max_output_tokens=kb_client.max_context_tokens,
+        max_document_tokens=kb_client.max_document_tokens
+    ) if compaction else None
     agent = create_react_agent(
         chat_model,
-        [retriever_tool],
-        messages_modifier=prompt
+        CompactingToolNode(tools, compactor=compactor),
+        messages_modifier=prompt,
+        checkpointer=checkpointer
     )
     
     return agent
 
 
-async def execute_knowledge_base_query(agent, query: str) -> str:
+async def execute_knowledge_base_query(agent, query: str, config: Optional[Dict[str, Any]] = None,
+                                      budget: Optional[RequestBudget] = None, chat_model=None) -> str:
     """
     Execute a knowledge base query using the configured agent
     
     Args:
         agent: The configured agent
         query: User's query
+        config: Optional runnable config (selects the session thread for session agents)
+        budget: Request deadline and step / tool-call limits (a default budget when omitted)
+        chat_model: Model that writes a partial answer when the budget runs out
         
     Returns:
         Response string in Japanese
     """
     try:
-        # Execute the query
-        result = await agent.ainvoke({
+        # Execute the query within the request's deadline and step budget
+        result = await run_agent(agent, {
             "messages": [HumanMessage(content=query)]
-        })
+        }, "knowledge_base", config, budget or default_budget(), chat_model)
         
         # Extract and process the response
         if result.get("messages"):
-            # Find the last AI message
-            for message in reversed(result["messages"]):
-                if hasattr(message, 'content') and message.content:
-                    # Skip tool call messages
-                    if hasattr(message, 'tool_calls') and message.tool_calls:
-                        continue
-                    
-                    content = message.content
-                    
-                    # Remove thinking tags if present
-                    content = re.sub(r'<thinking>.*?</thinking>', '', content, flags=re.DOTALL).strip()
-                    
-                    if content:
-                        return content
+            from compaction import record_request_savings
+            record_request_savings("knowledge_base", result["messages"])
+            with metrics.stage("postprocess", route="knowledge_base"):
+                # Find the last AI message
+                for message in reversed(result["messages"]):
+                    # Earlier turns of a session are not part of this answer
+                    if isinstance(message, HumanMessage):
+                        break
+                    if hasattr(message, 'content') and message.content:
+                        # Skip tool call messages
+                        if hasattr(message, 'tool_calls') and message.tool_calls:
+                            continue
+                        
+                        content = message.content
+                        
+                        # Remove thinking tags if present
+                        content = re.sub(r'<thinking>.*?</thinking>', '', content, flags=re.DOTALL).strip()
+                        
+                        if content:
+                            return content
             
             return "申し訳ございません。関連する文書が見つかりませんでした。"
         
@@ -210,4 +466,139 @@ async def execute_knowledge_base_query(agent, query: str) -> str:
         
     except Exception as e:
         logger.error(f"Error executing knowledge base query: {e}")
-        return f"文書検索中にエラーが発生しました: {str(e)}"
\ No newline at end of file
+        metrics.record_error("knowledge_base")
+        return f"文書検索中にエラーが発生しました: {str(e)}"
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: about 4 ASCII characters per token, one token per Japanese character"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to roughly max_tokens (see estimate_tokens)"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0.0
+    for i, c in enumerate(text):
+        used += 0.25 if ord(c) < 128 else 1.0
+        if used > max_tokens:
+            return text[:i].rstrip() + "…"
+    return text
+
+
+def document_source(document: Document) -> str:
+    """Document name for citations, from the S3 (or web) location in the retrieval metadata"""
+    location = document.metadata.get("location") or {}
+    uri = (
+        (location.get("s3Location") or {}).get("uri")
+        or (location.get("webLocation") or {}).get("url")
+        or document.metadata.get("source", "")
+    )
+    return uri.rstrip("/").rsplit("/", 1)[-1] or "不明な文書"
+
+
+def retrieval_score(documents: List[Document]) -> float:
+    """Highest relevance score among the retrieved documents (0 when there are none)"""
+    return max((float(doc.metadata.get("score") or 0.0) for doc in documents), default=0.0)
+
+
+def compact_documents(
+    documents: List[Document],
+    max_tokens: int = 3000,
+    max_document_tokens: int = 1000
+) -> Tuple[str, List[str]]:
+    """
+    Build the model context from retrieved documents
+    
+    Documents are taken in score order; empty, duplicate and contained chunks are
+    dropped, each chunk is truncated to max_document_tokens and the total is kept
+    within max_tokens. Every chunk is labelled with the number of its source.
+    
+    Args:
+        documents: Retrieved documents
+        max_tokens: Token budget for the whole context
+        max_document_tokens: Token budget per document
+        
+    Returns:
+        (context text, source names in label order)
+    """
+    ranked = sorted(documents, key=lambda doc: float(doc.metadata.get("score") or 0.0), reverse=True)
+    kept: List[str] = []
+    blocks: List[str] = []
+    sources: List[str] = []
+    budget = max_tokens
+    for document in ranked:
+        text = " ".join(document.page_content.split())
+        # Overlapping chunks of one document often repeat each other; compare without whitespace
+        key = "".join(text.split())
+        if not key or any(key in other for other in kept):
+            continue
+        kept.append(key)
+        text = truncate_to_tokens(text, min(max_document_tokens, budget))
+        source = document_source(document)
+        if source not in sources:
+            sources.append(source)
+        blocks.append(f"[{sources.index(source) + 1}] {source}\n{text}")
+        budget -= estimate_tokens(text)
+        if budget <= 0:
+            break
+    return "\n\n".join(blocks), sources
+
+
+async def prepare_direct_rag(kb_client: KnowledgeBaseClient, query: str) -> Optional[List[BaseMessage]]:
+    """
+    Retrieve documents for a query and build the messages for a single model call
+    
+    Args:
+        kb_client: Initialized KnowledgeBaseClient
+        query: User's query
+        
+    Returns:
+        Messages for the chat model, or None when retrieval confidence is low
+        and the agent should handle the question instead
+    """
+    documents = await kb_client.aretrieve(query)
+    score = retrieval_score(documents)
+    if score < kb_client.min_score:
+        logger.info(f"Low retrieval score ({score:.2f} < {kb_client.min_score:g}), falling back to the agent")
+        return None
+    
+    with metrics.stage("kb_compact", route="knowledge_base"):
+        context, sources = compact_documents(documents, kb_client.max_context_tokens, kb_client.max_document_tokens)
+    return [
+        SystemMessage(content=KB_SYSTEM_PROMPT),
+        HumanMessage(content=f"""以下はKnowledge Baseの検索結果です。この内容のみに基づいて質問に回答してください。
+出典は [番号] と文書名で示してください。
+
+{context}
+
+質問: {query}"""),
+    ]
+
+
+async def execute_direct_rag(chat_model, kb_client: KnowledgeBaseClient, query: str) -> Optional[str]:
+    """
+    Answer a knowledge base question with one retrieval and one model call (no ReAct loop)
+    
+    Args:
+        chat_model: The LLM model to use
+        kb_client: Initialized KnowledgeBaseClient
+        query: User's query
+        
+    Returns:
+        Response string in Japanese, or None when the agent should handle the question
+    """
+    try:
+        messages = await prepare_direct_rag(kb_client, query)
+    except asyncio.TimeoutError:
+        logger.warning(f"Knowledge base retrieval timed out after {kb_client.timeout}s")
+        return "文書検索がタイムアウトしました。"
+    if messages is None:
+        return None
+    
+    ai_msg = await chat_model.ainvoke(messages)
+    with metrics.stage("postprocess", route="knowledge_base"):
+        content = re.sub(r'<thinking>.*?</thinking>', '', ai_msg.content, flags=re.DOTALL).strip()
+    return content or "申し訳ございません。関連する文書が見つかりませんでした。"
@@ -0,0 +1,370 @@
+"""
+Local hybrid search index over the knowledge base data-source files
+
+A BM25 inverted index (with character-bigram tokenisation for Japanese) and,
+optionally, a matrix of document embeddings. The index is stored as .npy arrays
+plus a JSON metadata file and loaded memory-mapped, so startup only reads the
+parts a query touches. KnowledgeBaseClient consults it before Bedrock.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from data_sources import load_documents, source_files
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT = 1
+
+# Latin/digit words, hiragana runs, katakana runs (with the long vowel mark) and kanji runs
+TOKEN_PATTERN = re.compile(r"[0-9a-z\u00c0-\u024f]+|[\u3041-\u309f]+|[\u30a0-\u30ff]+|[\u3005\u3006\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+HIRAGANA_PATTERN = re.compile(r"[\u3041-\u309f]+")
+
+# A match needs at least this many rare query terms' worth of evidence to score 1
+MIN_EVIDENCE_TERMS = 2
+
+ARRAY_NAMES = ("indptr", "postings", "frequencies", "lengths", "idf")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into index terms
+
+    Text is NFKC-normalised (full-width letters and half-width kana become
+    their usual forms) and lower-cased. Latin words are kept whole; Japanese has
+    no spaces, so text is cut where the script changes (which mostly separates
+    particles from words) and each run is split into overlapping character
+    bigrams, which matches compounds without a morphological analyser.
+    Single-character particles are dropped.
+    """
+    tokens = []
+    for run in TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if len(run) == 1 and HIRAGANA_PATTERN.fullmatch(run):
+            # A lone hiragana between words is a particle (の, は, を)
+            continue
+        if run.isascii() or len(run) == 1 or run[0] < "\u3041":
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _content_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def _unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def source_fingerprint(source_dir: str) -> str:
+    """Hash of the data-source file names, sizes and modification times"""
+    digest = hashlib.sha256()
+    for path in source_files(source_dir):
+        stat = os.stat(path)
+        digest.update(f"{os.path.relpath(path, source_dir)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class LocalIndex:
+    """
+    BM25 index with an optional embedding matrix
+
+    Postings are stored in CSR form: the documents containing term t are
+    postings[indptr[t]:indptr[t + 1]], with their term frequencies in
+    frequencies. Scores are reported between 0 and 1 (see search()) so that a
+    single threshold can decide whether the local answer is good enough.
+    """
+
+    def __init__(
+        self,
+        documents: List[dict],
+        vocabulary: Dict[str, int],
+        arrays: Dict[str, np.ndarray],
+        vectors: Optional[np.ndarray] = None,
+        k1: float = 1.2,
+        b: float = 0.75,
+        fingerprint: str = "",
+        embedding_model: str = ""
+    ):
+        self.documents = documents
+        self.vocabulary = vocabulary
+        self.indptr = arrays["indptr"]
+        self.postings = arrays["postings"]
+        self.frequencies = arrays["frequencies"]
+        self.lengths = arrays["lengths"]
+        self.idf = arrays["idf"]
+        self.vectors = vectors
+        self.k1 = k1
+        self.b = b
+        self.fingerprint = fingerprint
+        self.embedding_model = embedding_model
+        self.average_length = float(np.mean(self.lengths)) if len(self.lengths) else 0.0
+        self.max_idf = float(np.max(self.idf)) if len(self.idf) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @classmethod
+    def build(
+        cls,
+        documents: List[Document],
+        embedder=None,
+        embedding_model: str = "",
+        cached_embeddings: Optional[Dict[str, np.ndarray]] = None,
+        fingerprint: str = ""
+    ) -> "LocalIndex":
+        """
+        Build an index from documents
+
+        Args:
+            documents: Documents to index
+            embedder: Optional LangChain embeddings; adds the vector matrix
+            embedding_model: Name stored with the vectors (a model change re-embeds everything)
+            cached_embeddings: Content key -> vector from a previous build; only
+                               documents not found here are sent to the embedder
+            fingerprint: Source fingerprint stored with the index
+
+        Returns:
+            The index
+        """
+        vocabulary: Dict[str, int] = {}
+        term_documents: List[List[Tuple[int, int]]] = []
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            counts: Dict[int, int] = {}
+            tokens = tokenize(document.page_content)
+            for token in tokens:
+                term = vocabulary.setdefault(token, len(vocabulary))
+                counts[term] = counts.get(term, 0) + 1
+            if len(term_documents) < len(vocabulary):
+                term_documents.extend([] for _ in range(len(vocabulary) - len(term_documents)))
+            for term, count in counts.items():
+                term_documents[term].append((doc_id, count))
+            lengths[doc_id] = len(tokens)
+
+        document_frequency = np.array([len(entries) for entries in term_documents], dtype=np.float32)
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(document_frequency, dtype=np.int64)
+        postings = np.array([doc_id for entries in term_documents for doc_id, _ in entries], dtype=np.int32)
+        frequencies = np.array([count for entries in term_documents for _, count in entries], dtype=np.float32)
+        total = len(documents)
+        # BM25+ style idf that stays positive for terms found in most documents
+        idf = np.log(1.0 + (total - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+
+        vectors = None
+        if embedder is not None and documents:
+            cached_embeddings = cached_embeddings or {}
+            keys = [_content_key(document.page_content) for document in documents]
+            missing = [i for i, key in enumerate(keys) if key not in cached_embeddings]
+            if missing:
+                embedded = embedder.embed_documents([documents[i].page_content for i in missing])
+                for i, vector in zip(missing, embedded):
+                    cached_embeddings[keys[i]] = np.asarray(vector, dtype=np.float32)
+            logger.info(f"Embedded {len(missing)} of {len(documents)} local documents ({len(documents) - len(missing)} cached)")
+            vectors = _unit_rows(np.stack([cached_embeddings[key] for key in keys]).astype(np.float32))
+
+        return cls(
+            documents=[{"text": document.page_content, "metadata": document.metadata} for document in documents],
+            vocabulary=vocabulary,
+            arrays={"indptr": indptr, "postings": postings, "frequencies": frequencies,
+                    "lengths": lengths, "idf": idf},
+            vectors=vectors,
+            fingerprint=fingerprint,
+            embedding_model=embedding_model if vectors is not None else "",
+        )
+
+    def save(self, index_dir: str):
+        """
+        Write the index to index_dir
+
+        Arrays are written first and metadata.json last, each through a
+        temporary file, so a reader never sees metadata for arrays that are not there yet.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in ARRAY_NAMES}
+        if self.vectors is not None:
+            arrays["vectors"] = self.vectors
+        # Per-process temporary names: several workers may rebuild the index at the same time
+        suffix = f".{os.getpid()}.tmp"
+        for name, array in arrays.items():
+            path = os.path.join(index_dir, f"{name}.npy")
+            with open(path + suffix, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(path + suffix, path)
+        metadata = {
+            "format": INDEX_FORMAT,
+            "fingerprint": self.fingerprint,
+            "k1": self.k1,
+            "b": self.b,
+            "embedding_model": self.embedding_model,
+            "vocabulary": self.vocabulary,
+            "documents": self.documents,
+        }
+        path = os.path.join(index_dir, "metadata.json")
+        with open(path + suffix, "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        os.replace(path + suffix, path)
+
+    @classmethod
+    def load(cls, index_dir: str) -> "LocalIndex":
+        """Load an index written by save(); the arrays are memory-mapped read-only"""
+        with open(os.path.join(index_dir, "metadata.json"), encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("format") != INDEX_FORMAT:
+            raise ValueError(f"Unsupported local index format: {metadata.get('format')}")
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r") for name in ARRAY_NAMES}
+        vectors_path = os.path.join(index_dir, "vectors.npy")
+        vectors = np.load(vectors_path, mmap_mode="r") if metadata["embedding_model"] and os.path.exists(vectors_path) else None
+        return cls(
+            documents=metadata["documents"],
+            vocabulary=metadata["vocabulary"],
+            arrays=arrays,
+            vectors=vectors,
+            k1=metadata["k1"],
+            b=metadata["b"],
+            fingerprint=metadata["fingerprint"],
+            embedding_model=metadata["embedding_model"],
+        )
+
+    def cached_embeddings(self) -> Dict[str, np.ndarray]:
+        """Content key -> vector of the indexed documents, for reuse by the next build"""
+        if self.vectors is None:
+            return {}
+        return {_content_key(document["text"]): np.array(self.vectors[i]) for i, document in enumerate(self.documents)}
+
+    def lexical_scores(self, query: str) -> np.ndarray:
+        """
+        BM25 score of every document, divided by the score of an ideal match
+
+        A document containing each (indexed) query term once at average length
+        scores the sum of the terms' idf; dividing by that sum gives the share of
+        the query matched. Query terms that occur in no document are ignored,
+        since they cannot tell documents apart, and so are hiragana terms
+        (inflections and question phrasing such as "について教えて") unless the
+        query has nothing else. So that one stray term does not make a perfect
+        match, the divisor is at least the idf of MIN_EVIDENCE_TERMS of the rarest terms.
+        """
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        tokens = tokenize(query)
+        tokens = [token for token in tokens if not HIRAGANA_PATTERN.fullmatch(token)] or tokens
+        terms = {self.vocabulary[token] for token in tokens if token in self.vocabulary}
+        if not terms:
+            return scores
+        length_norm = self.k1 * (1.0 - self.b + self.b * np.asarray(self.lengths) / max(self.average_length, 1.0))
+        ideal = 0.0
+        for term in terms:
+            start, end = int(self.indptr[term]), int(self.indptr[term + 1])
+            doc_ids = np.asarray(self.postings[start:end])
+            frequencies = np.asarray(self.frequencies[start:end])
+            idf = float(self.idf[term])
+            scores[doc_ids] += idf * frequencies * (self.k1 + 1.0) / (frequencies + length_norm[doc_ids])
+            ideal += idf
+        return np.minimum(scores / max(ideal, MIN_EVIDENCE_TERMS * self.max_idf), 1.0)
+
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        query_vector: Optional[List[float]] = None,
+        vector_weight: float = 0.5
+    ) -> List[Document]:
+        """
+        Return the k best matching documents
+
+        Args:
+            query: Search query
+            k: Number of results
+            query_vector: Query embedding; when given (and the index has vectors)
+                          the score blends BM25 with cosine similarity
+            vector_weight: Share of the cosine similarity in the blended score
+
+        Returns:
+            Documents with metadata "score" (0-1) and "retrieval": "local"
+        """
+        scores = self.lexical_scores(query)
+        if query_vector is not None and self.vectors is not None:
+            vector = np.asarray(query_vector, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm:
+                similarity = np.clip(np.asarray(self.vectors) @ (vector / norm), 0.0, 1.0)
+                scores = (1.0 - vector_weight) * scores + vector_weight * similarity
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            Document(
+                page_content=self.documents[i]["text"],
+                metadata={**self.documents[i]["metadata"], "score": round(float(scores[i]), 4), "retrieval": "local"},
+            )
+            for i in top if scores[i] > 0
+        ]
+
+
+def load_or_build_index(source_dir: str, index_dir: str, embedder=None, embedding_model: str = "") -> LocalIndex:
+    """
+    Load the stored index, rebuilding it when the data-source files changed
+
+    Args:
+        source_dir: Data-source directory
+        index_dir: Directory holding the stored index
+        embedder: Optional LangChain embeddings for the vector matrix
+        embedding_model: Embedding model name (a change re-embeds every document)
+
+    Returns:
+        The index
+    """
+    started = time.perf_counter()
+    fingerprint = source_fingerprint(source_dir)
+    previous = None
+    if os.path.exists(os.path.join(index_dir, "metadata.json")):
+        try:
+            previous = LocalIndex.load(index_dir)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable local index in {index_dir}: {e}")
+    wants_vectors = embedder is not None
+    if previous is not None and previous.fingerprint == fingerprint and \
+            (previous.embedding_model == embedding_model if wants_vectors else True):
+        logger.info(f"Loaded local index of {len(previous)} documents in {(time.perf_counter() - started) * 1000:.1f}ms")
+        return previous
+
+    cached = previous.cached_embeddings() if previous is not None and previous.embedding_model == embedding_model else {}
+    index = LocalIndex.build(
+        load_documents(source_dir),
+        embedder=embedder,
+        embedding_model=embedding_model,
+        cached_embeddings=cached,
+        fingerprint=fingerprint,
+    )
+    index.save(index_dir)
+    logger.info(f"Built local index of {len(index)} documents in {(time.perf_counter() - started) * 1000:.1f}ms")
+    return index
+
+
+def merge_results(local: List[Document], remote: List[Document], k: int) -> List[Document]:
+    """
+    Merge local and Bedrock results by score, dropping duplicate passages
+
+    Both score on a 0-1 scale, but they are not calibrated against each other;
+    ties go to the Bedrock result, which covers the full knowledge base.
+    """
+    merged: List[Document] = []
+    seen = set()
+    for document in sorted(remote + local, key=lambda doc: float(doc.metadata.get("score") or 0.0), reverse=True):
+        key = "".join(document.page_content.split())
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(document)
+    return merged[:k]
@@ -1,17 +1,34 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from langchain_aws import ChatBedrock
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
+from typing import List, Optional
 from langchain_core.messages import HumanMessage
-from langgraph.prebuilt import create_react_agent
 import os
+import json
 import asyncio
 import logging
 import re
-from contextlib import asynccontextmanager
+import time
+from contextlib import asynccontextmanager, nullcontext, suppress
 
-from asana_mcp import AsanaMCPClient, is_asana_related_query
-from agent_helper import create_asana_agent, execute_asana_query
-from knowledge_base import KnowledgeBaseClient, is_knowledge_base_query, create_knowledge_base_agent, execute_knowledge_base_query
+from asana_mcp import AsanaMCPClient
+from agent_helper import execute_asana_query
+from knowledge_base import KnowledgeBaseClient, execute_direct_rag, execute_knowledge_base_query, prepare_direct_rag
+from agent_registry import AgentRegistry
+from response_cache import SemanticResponseCache
+from streaming import format_sse, stream_events
+from router import DEFAULT_ROUTE, intent_router
+from hybrid import HYBRID_ROUTE, answer_hybrid, hybrid_enabled, hybrid_routes
+from admission import AdmissionController, Overloaded, is_throttling_error
+from budget import RequestBudget, default_budget
+from batch import run_batch
+from memory import SessionMemory
+from traces import create_trace_recorder
+from shared_state import close_store, get_store
+from prefetch import Prefetcher, prefetch_enabled
+from startup import StartupState, background_init_enabled, concurrent_init_enabled, preload_modules
+import metrics
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -20,94 +37,289 @@ logger = logging.getLogger(__name__)
 # Global variables to store clients
 asana_client = None
 kb_client = None
+agent_registry = None
+response_cache = None
+admission = None
+memory = None
+trace_recorder = None
+startup = None
+prefetcher = None
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Manage application lifecycle - initialize and cleanup resources"""
-    global asana_client, kb_client
-    
-    # Startup
+async def init_asana_client():
+    """Start the Asana MCP client (None when ASANA_ACCESS_TOKEN is not set or it fails)"""
+    if not os.getenv("ASANA_ACCESS_TOKEN"):
+        logger.warning("ASANA_ACCESS_TOKEN not found. Asana integration disabled.")
+        return None
     try:
-        # Initialize Asana MCP client if token is available
-        if os.getenv("ASANA_ACCESS_TOKEN"):
-            asana_client = AsanaMCPClient()
-            await asana_client.initialize()
-            logger.info("Asana MCP client initialized successfully")
-        else:
-            logger.warning("ASANA_ACCESS_TOKEN not found. Asana integration disabled.")
+        client = AsanaMCPClient()
+        await client.initialize()
+        logger.info("Asana MCP client initialized successfully")
+        return client
     except Exception as e:
         logger.error(f"Failed to initialize Asana MCP client: {e}")
-        asana_client = None
-    
-    # Initialize Knowledge Base client
+        return None
+
+
+def init_kb_client():
+    """Create the Knowledge Base client (blocking; runs on a worker thread during startup)"""
+    if not os.getenv("BEDROCK_KNOWLEDGE_BASE_ID"):
+        logger.warning("BEDROCK_KNOWLEDGE_BASE_ID not found. Knowledge Base integration disabled.")
+        return None
     try:
-        if os.getenv("BEDROCK_KNOWLEDGE_BASE_ID"):
-            kb_client = KnowledgeBaseClient()
-            kb_client.initialize()
-            logger.info("Knowledge Base client initialized successfully")
-        else:
-            logger.warning("BEDROCK_KNOWLEDGE_BASE_ID not found. Knowledge Base integration disabled.")
+        client = KnowledgeBaseClient()
+        client.initialize()
+        logger.info("Knowledge Base client initialized successfully")
+        return client
     except Exception as e:
         logger.error(f"Failed to initialize Knowledge Base client: {e}")
-        kb_client = None
+        return None
+
+
+async def init_memory():
+    """Conversation memory for requests that carry a session_id"""
+    if os.getenv("MEMORY_ENABLED", "true").lower() != "true":
+        return None
+    try:
+        session_memory = SessionMemory()
+        await session_memory.initialize()
+        return session_memory
+    except Exception as e:
+        logger.error(f"Failed to initialize conversation memory: {e}")
+        return None
+
+
+async def initialize_services():
+    """
+    Initialise the clients and build the agents, then mark the app ready
+
+    The Asana MCP server start, the Knowledge Base client and the memory
+    backend do not depend on each other and start concurrently (unless
+    STARTUP_CONCURRENT_INIT=false); the deferred heavy imports are preloaded
+    on a worker thread meanwhile.
+    """
+    global asana_client, kb_client, memory, response_cache, prefetcher
+    
+    steps = [
+        ("asana_mcp", init_asana_client),
+        ("knowledge_base", lambda: asyncio.to_thread(init_kb_client)),
+        ("memory", init_memory),
+        ("imports", preload_modules),
+    ]
+    if concurrent_init_enabled():
+        results = await asyncio.gather(*(startup.phase(name, func) for name, func in steps))
+    else:
+        results = [await startup.phase(name, func) for name, func in steps]
+    asana_client, kb_client, memory, _ = results
+    
+    # Workspaces / projects and frequent knowledge base queries are fetched in the
+    # background; the Asana agents read the latest snapshot on every model call
+    if prefetch_enabled() and (asana_client or kb_client):
+        prefetcher = Prefetcher(asana_client=asana_client, kb_client=kb_client)
+        agent_registry.asana_directory = prefetcher.directory_prompt
+        prefetcher.start()
+    
+    # Build the shared chat model and agents once
+    async def build_agents():
+        await asyncio.to_thread(agent_registry.initialize, checkpointer=memory.checkpointer if memory else None)
+        if asana_client:
+            await agent_registry.get_asana_agent(asana_client)
+        if kb_client:
+            await agent_registry.get_knowledge_base_agent(kb_client)
+    await startup.phase("agents", build_agents)
+    
+    # Opt-in answer cache in front of routing
+    if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true":
+        try:
+            response_cache = SemanticResponseCache()
+            logger.info("Response cache enabled")
+        except Exception as e:
+            logger.error(f"Failed to initialize response cache: {e}")
+            response_cache = None
+    
+    startup.mark_ready()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Manage application lifecycle - initialize and cleanup resources"""
+    global agent_registry, admission, trace_recorder, startup
+    
+    # Startup
+    startup = StartupState()
+    agent_registry = AgentRegistry()
+    
+    # Per-route concurrency limits with bounded wait queues
+    if os.getenv("ADMISSION_ENABLED", "true").lower() == "true":
+        admission = AdmissionController()
+    
+    # Opt-in request trace for offline replay (benchmark.py replay)
+    trace_recorder = create_trace_recorder()
+    
+    # In background mode uvicorn accepts connections (liveness) while the clients start
+    init_task = None
+    if background_init_enabled():
+        init_task = asyncio.create_task(initialize_services())
+    else:
+        await initialize_services()
     
     yield
     
     # Shutdown
+    if init_task and not init_task.done():
+        init_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await init_task
+    if prefetcher:
+        await prefetcher.close()
     if asana_client:
         await asana_client.close()
         logger.info("Asana MCP client closed")
+    if kb_client:
+        kb_client.close()
+        logger.info("Knowledge Base client closed")
+    if memory:
+        await memory.close()
+    close_store()
 
 app = FastAPI(lifespan=lifespan)
 
 class Query(BaseModel):
     prompt: str
+    # Follow-up questions with the same session_id continue the conversation (agent routes only)
+    session_id: Optional[str] = Field(default=None, min_length=1, max_length=128)
+
+
+class BatchQuery(BaseModel):
+    prompts: List[str] = Field(min_length=1)
+    # False streams each result as soon as it is ready
+    ordered: bool = True
+
 
+def overloaded_error(e: Overloaded) -> HTTPException:
+    """Fast 429/503 response with Retry-After for a request that was not admitted"""
+    metrics.REJECTIONS.inc(route=e.route, status=str(e.status_code))
+    logger.warning(f"Rejected request: {e}")
+    return HTTPException(
+        status_code=e.status_code,
+        detail="現在混み合っています。しばらくしてから再度お試しください。",
+        headers={"Retry-After": str(e.retry_after)}
+    )
 
-async def handle_asana_query(query: str, chat_model):
+
+async def wait_until_ready():
+    """Hold requests that arrive while background initialisation is still running"""
+    if startup is None or startup.ready:
+        return
+    if not await startup.wait_ready(float(os.getenv("STARTUP_WAIT_TIMEOUT", "30"))):
+        raise HTTPException(
+            status_code=503,
+            detail="起動処理中です。しばらくしてから再度お試しください。",
+            headers={"Retry-After": "5"}
+        )
+
+
+def conversation(route: str, session_id: Optional[str], agent):
+    """Context manager yielding the session's runnable config, or None without a session"""
+    if memory and session_id:
+        return memory.session(route, session_id, agent)
+    return nullcontext()
+
+
+async def handle_asana_query(query: str, session_id: Optional[str] = None, budget: Optional[RequestBudget] = None):
     """Handle Asana-related queries using MCP tools"""
     if not asana_client:
         return "Asana統合が設定されていません。ASANA_ACCESS_TOKENを設定してください。"
     
     try:
-        # Get Asana tools
-        tools = await asana_client.get_tools()
-        
-        # Create specialized Asana agent
-        agent = create_asana_agent(chat_model, tools)
+        # Reuse the compiled Asana agent (rebuilt only when the tool list changes)
+        agent = await agent_registry.get_asana_agent(asana_client, session=bool(memory and session_id), query=query)
         
         # Execute the query using helper function
-        response = await execute_asana_query(agent, query)
+        async with conversation("asana", session_id, agent) as config:
+            response = await execute_asana_query(agent, query, config, budget, agent_registry.get_chat_model("asana"))
         
         return response
             
     except Exception as e:
         logger.error(f"Error handling Asana query: {e}")
+        metrics.record_error("asana")
         return f"Asanaクエリの処理中にエラーが発生しました: {str(e)}"
 
 
-async def handle_knowledge_base_query(query: str, chat_model):
+async def handle_knowledge_base_query(query: str, session_id: Optional[str] = None,
+                                      budget: Optional[RequestBudget] = None):
     """Handle knowledge base related queries"""
     if not kb_client:
         return "Knowledge Base統合が設定されていません。BEDROCK_KNOWLEDGE_BASE_IDを設定してください。"
     
     try:
-        # Get retriever
-        retriever = kb_client.get_retriever()
+        # One retrieval and one model call; the agent handles sessions and weak retrievals
+        session = bool(memory and session_id)
+        if kb_client.is_table_question(query):
+            # List / count / filter questions: the agent queries the spreadsheet tables
+            metrics.KB_ANSWERS.inc(mode="table")
+        elif kb_client.answer_mode == "direct" and not session:
+            response = await execute_direct_rag(agent_registry.get_chat_model("knowledge_base"), kb_client, query)
+            if response is not None:
+                metrics.KB_ANSWERS.inc(mode="direct")
+                return response
+            metrics.KB_ANSWERS.inc(mode="agent_fallback")
+        else:
+            metrics.KB_ANSWERS.inc(mode="agent")
         
-        # Create specialized knowledge base agent
-        agent = create_knowledge_base_agent(chat_model, retriever)
+        # Reuse the compiled knowledge base agent
+        agent = await agent_registry.get_knowledge_base_agent(kb_client, session=session)
         
         # Execute the query
-        response = await execute_knowledge_base_query(agent, query)
+        async with conversation("knowledge_base", session_id, agent) as config:
+            response = await execute_knowledge_base_query(agent, query, config, budget,
+                                                          agent_registry.get_chat_model("knowledge_base"))
         
         return response
         
     except Exception as e:
         logger.error(f"Error handling knowledge base query: {e}")
+        metrics.record_error("knowledge_base")
         return f"文書検索中にエラーが発生しました: {str(e)}"
 
 
+async def handle_hybrid_query(query: str, session_id: Optional[str] = None, admit: bool = False,
+                              budget: Optional[RequestBudget] = None):
+    """
+    Handle questions that need both Asana and the knowledge base
+    
+    The route handlers run concurrently under one deadline and one model call
+    merges their answers. With admit, each branch takes a slot of its own route.
+    The branches end before the request's deadline, leaving time for the merge.
+    """
+    handlers = {"asana": handle_asana_query, "knowledge_base": handle_knowledge_base_query}
+    budget = budget or default_budget()
+    branch_budget = budget.shortened(budget.reserve) if budget else None
+    
+    def branch(route: str):
+        async def run():
+            ticket = await admission.admit(route) if admit and admission else None
+            try:
+                with metrics.stage("handler", route=route):
+                    return await handlers[route](query, session_id, branch_budget)
+            finally:
+                if ticket:
+                    ticket.release()
+        return run
+    
+    routes = hybrid_routes(intent_router.matching_routes(query)) or list(handlers)
+    return await answer_hybrid(query, {route: branch(route) for route in routes},
+                               agent_registry.get_chat_model(HYBRID_ROUTE), budget=branch_budget)
+
+
+def route_query(prompt: str) -> str:
+    """Route a prompt; "hybrid" when it asks about both Asana and the knowledge base"""
+    intents = intent_router.matching_routes(prompt)
+    if hybrid_enabled() and asana_client and kb_client and hybrid_routes(intents):
+        return HYBRID_ROUTE
+    return intents[0].route if intents else DEFAULT_ROUTE
+
+
 async def handle_general_query(query: str, chat_model):
     """Handle general queries using the base LLM"""
     ai_msg = await chat_model.ainvoke([HumanMessage(content=query)])
@@ -119,32 +331,300 @@ async def generate(query: Query):
     """
     Generate response based on query type:
     - Asana-related queries: Use Asana MCP tools
+    - Knowledge base queries: Answer from the retrieved documents
+    - Queries about both: Run both concurrently and merge the answers
     - General queries: Use Nova Pro directly
+    
+    The request has a deadline (REQUEST_DEADLINE) from the moment it arrives;
+    agents stopped by it or by their step budget answer from what they found so far.
     """
+    await wait_until_ready()
+    route = "unrouted"
+    status = 500
+    start = time.perf_counter()
+    budget = default_budget()
+    deadline = budget.guard() if budget else nullcontext()
+    # Answers within a session depend on the earlier turns, so they bypass the answer cache
+    use_cache = response_cache and not query.session_id
     try:
-        # Initialize chat model
-        chat = ChatBedrock(
-            model="us.amazon.nova-pro-v1:0",
-            region_name=os.getenv("AWS_REGION", "us-west-2"),
-            beta_use_converse_api=True
-        )
+        # Serve repeated and near-duplicate prompts from the answer cache
+        embedding = None
+        if use_cache:
+            try:
+                with metrics.stage("cache_lookup"):
+                    cached, embedding = await response_cache.lookup(query.prompt)
+                if cached:
+                    logger.info(f"Response cache hit ({cached['match']}, route={cached['route']})")
+                    metrics.REQUESTS.inc(endpoint="generate", route="cache")
+                    route, status = cached["route"], 200
+                    return {"response": cached["response"]}
+            except Exception as e:
+                logger.warning(f"Response cache lookup failed: {e}")
         
-        # Determine query type and route accordingly
-        if is_asana_related_query(query.prompt):
-            logger.info(f"Detected Asana-related query: {query.prompt}")
-            response = await handle_asana_query(query.prompt, chat)
-        elif is_knowledge_base_query(query.prompt):
-            logger.info(f"Detected knowledge base query: {query.prompt}")
-            response = await handle_knowledge_base_query(query.prompt, chat)
-        else:
-            logger.info(f"Handling general query: {query.prompt}")
-            response = await handle_general_query(query.prompt, chat)
+        # Shared chat model built once in lifespan
+        chat = agent_registry.get_chat_model("general")
+        
+        # Determine query type (single pass over the prompt) and route accordingly
+        with metrics.stage("route"):
+            route = route_query(query.prompt)
+        # Only the prompt length is logged; prompts may contain personal information
+        logger.info(f"Routing {route} query ({len(query.prompt)} chars)")
+        metrics.REQUESTS.inc(endpoint="generate", route=route)
+        with metrics.stage("queue", route=route):
+            ticket = await admission.admit(route) if admission else None
+        try:
+            async with deadline:
+                with metrics.stage("handler", route=route):
+                    if route == "asana":
+                        response = await handle_asana_query(query.prompt, query.session_id, budget)
+                    elif route == "knowledge_base":
+                        response = await handle_knowledge_base_query(query.prompt, query.session_id, budget)
+                    elif route == HYBRID_ROUTE:
+                        response = await handle_hybrid_query(query.prompt, query.session_id, admit=True, budget=budget)
+                    else:
+                        response = await handle_general_query(query.prompt, chat)
+        finally:
+            if ticket:
+                ticket.release()
+        
+        if use_cache:
+            try:
+                await response_cache.store(query.prompt, route, response, embedding)
+            except Exception as e:
+                logger.warning(f"Response cache store failed: {e}")
         
+        status = 200
         return {"response": response}
         
+    except Overloaded as e:
+        status = e.status_code
+        raise overloaded_error(e)
     except Exception as e:
+        if isinstance(e, TimeoutError) and budget and deadline.expired():
+            # Agents answer from their partial results by the deadline; this is a
+            # route without an agent (general, direct knowledge base answers)
+            status = 504
+            logger.warning(f"{route} request exceeded its {budget.deadline:g}s deadline")
+            metrics.REQUEST_DEADLINES.inc(route=route)
+            raise HTTPException(status_code=504, detail="時間内に応答を生成できませんでした。質問を絞って再度お試しください。")
         logger.error(f"Error generating response: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        metrics.record_error(route)
+        if is_throttling_error(e):
+            # Bedrock still throttles after the client's adaptive retries
+            status = 503
+            raise HTTPException(
+                status_code=503,
+                detail="現在混み合っています。しばらくしてから再度お試しください。",
+                headers={"Retry-After": "5"}
+            )
+        raise HTTPException(status_code=500, detail="応答の生成中にエラーが発生しました。")
+    finally:
+        if trace_recorder:
+            trace_recorder.record("generate", query.prompt, route, status, time.perf_counter() - start, query.session_id)
+
+
+async def select_stream_target(prompt: str, session: bool = False):
+    """
+    Route a prompt for streaming
+    
+    Args:
+        prompt: User's query
+        session: Use the session-aware agents
+    
+    Returns:
+        (route, runnable, inputs, fallback) where runnable is None if the route is not configured
+        and fallback is then the message to send
+    """
+    route = intent_router.route(prompt)
+    if route == "asana":
+        if not asana_client:
+            return "asana", None, None, "Asana統合が設定されていません。ASANA_ACCESS_TOKENを設定してください。"
+        agent = await agent_registry.get_asana_agent(asana_client, session=session, query=prompt)
+        inputs = {"messages": [HumanMessage(content=prompt)]}
+        return "asana", agent, inputs, "申し訳ございません。Asanaからの情報を取得できませんでした。"
+    if route == "knowledge_base":
+        if not kb_client:
+            return "knowledge_base", None, None, "Knowledge Base統合が設定されていません。BEDROCK_KNOWLEDGE_BASE_IDを設定してください。"
+        fallback = "申し訳ございません。関連する文書が見つかりませんでした。"
+        if kb_client.is_table_question(prompt):
+            metrics.KB_ANSWERS.inc(mode="table")
+        elif kb_client.answer_mode == "direct" and not session:
+            try:
+                messages = await prepare_direct_rag(kb_client, prompt)
+            except asyncio.TimeoutError:
+                return "knowledge_base", None, None, "文書検索がタイムアウトしました。"
+            if messages is not None:
+                metrics.KB_ANSWERS.inc(mode="direct")
+                return "knowledge_base", agent_registry.get_chat_model("knowledge_base"), messages, fallback
+            metrics.KB_ANSWERS.inc(mode="agent_fallback")
+        else:
+            metrics.KB_ANSWERS.inc(mode="agent")
+        agent = await agent_registry.get_knowledge_base_agent(kb_client, session=session)
+        inputs = {"messages": [HumanMessage(content=prompt)]}
+        return "knowledge_base", agent, inputs, fallback
+    return "general", agent_registry.get_chat_model("general"), [HumanMessage(content=prompt)], ""
+
+
+@app.post("/generate/stream")
+async def generate_stream(query: Query, request: Request):
+    """
+    Streaming variant of /generate (Server-Sent Events)
+    
+    Emits a route event, tool_start / tool_end events for each tool call, token
+    events with the model output (thinking blocks removed) and a final done event.
+    Work stops when the client disconnects. Agents stop within the request budget
+    and send their partial answer as the done event; other routes send an error
+    event at the deadline.
+    """
+    await wait_until_ready()
+    start = time.perf_counter()
+    cached, embedding = None, None
+    use_cache = response_cache and not query.session_id
+    if use_cache:
+        try:
+            cached, embedding = await response_cache.lookup(query.prompt)
+        except Exception as e:
+            logger.warning(f"Response cache lookup failed: {e}")
+    
+    if cached:
+        route, runnable, inputs, fallback = cached["route"], None, None, cached["response"]
+    else:
+        route, runnable, inputs, fallback = await select_stream_target(query.prompt, session=bool(memory and query.session_id))
+    logger.info(f"Streaming {route} query")
+    metrics.REQUESTS.inc(endpoint="stream", route=route)
+    
+    # Admit before the response starts so that overload is still reported as 429/503
+    ticket = None
+    if runnable is not None and admission:
+        try:
+            ticket = await admission.admit(route)
+        except Overloaded as e:
+            if trace_recorder:
+                trace_recorder.record("stream", query.prompt, route, e.status_code, time.perf_counter() - start, query.session_id)
+            raise overloaded_error(e)
+    
+    def release():
+        if ticket:
+            ticket.release()
+    
+    async def event_source():
+        yield format_sse({"event": "route", "data": {"route": route, "cached": bool(cached)}})
+        if runnable is None:
+            yield format_sse({"event": "done", "data": {"response": fallback}})
+            if trace_recorder:
+                trace_recorder.record("stream", query.prompt, route, 200, time.perf_counter() - start, query.session_id)
+            return
+        
+        session = conversation(route, query.session_id, runnable) if route != "general" else nullcontext()
+        budget = default_budget()
+        # Recorded in the trace like /generate's status code; 499 when the client went away
+        status = 500
+        try:
+            async with session as config:
+                events = stream_events(runnable, inputs, fallback, config, budget, route,
+                                       agent_registry.get_chat_model(route))
+                try:
+                    async for event in events:
+                        if await request.is_disconnected():
+                            logger.info("Client disconnected, cancelling streaming query")
+                            status = 499
+                            break
+                        if event["event"] == "done":
+                            status = 200
+                            if use_cache:
+                                await response_cache.store(query.prompt, route, event["data"]["response"], embedding)
+                        yield format_sse(event)
+                finally:
+                    # Closing the generator cancels in-flight model and tool calls
+                    await events.aclose()
+        except asyncio.CancelledError:
+            # The server cancels the stream when it notices the disconnect first
+            status = 499
+            raise
+        except Exception as e:
+            if isinstance(e, TimeoutError) and budget and budget.remaining() <= 0:
+                # The budget's guard cancelled a route without an agent
+                status = 504
+                logger.warning(f"{route} stream exceeded its {budget.deadline:g}s deadline")
+                metrics.REQUEST_DEADLINES.inc(route=route)
+                yield format_sse({"event": "error", "data": {"detail": "時間内に応答を生成できませんでした。質問を絞って再度お試しください。"}})
+                return
+            logger.error(f"Error streaming response: {e}")
+            metrics.record_error(route)
+            status = 503 if is_throttling_error(e) else 500
+            yield format_sse({"event": "error", "data": {"detail": str(e)}})
+        finally:
+            release()
+            if trace_recorder:
+                trace_recorder.record("stream", query.prompt, route, status, time.perf_counter() - start, query.session_id)
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Also release if the stream never starts (release is idempotent)
+        background=BackgroundTask(release)
+    )
+
+
+@app.post("/generate/batch")
+async def generate_batch(batch: BatchQuery):
+    """
+    Answer many prompts in one call (NDJSON, one line per prompt)
+    
+    Prompts are routed in one pass and identical prompts are answered once.
+    Every item takes a slot of its route's admission limit, like an
+    interactive request. Each line carries the prompt index and either a response or an error, so a
+    failed prompt does not fail the batch.
+    """
+    await wait_until_ready()
+    max_prompts = int(os.getenv("BATCH_MAX_PROMPTS", "500"))
+    if len(batch.prompts) > max_prompts:
+        raise HTTPException(status_code=413, detail=f"一度に送信できるプロンプトは{max_prompts}件までです。")
+    
+    # Each item gets its own deadline and step budget, starting when it is admitted
+    handlers = {
+        "asana": lambda prompt: handle_asana_query(prompt, budget=default_budget()),
+        "knowledge_base": lambda prompt: handle_knowledge_base_query(prompt, budget=default_budget()),
+        # Hybrid branches take the slots of their own routes
+        HYBRID_ROUTE: lambda prompt: handle_hybrid_query(prompt, admit=True, budget=default_budget()),
+    }
+    results = run_batch(batch.prompts, agent_registry.get_chat_model("general"), handlers, ordered=batch.ordered,
+                        router=route_query, admit=admission.admit if admission else None)
+    
+    async def lines():
+        try:
+            async for item in results:
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+        finally:
+            await results.aclose()
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/knowledge-base/cache/invalidate")
+async def invalidate_knowledge_base_cache():
+    """Invalidate cached retrieval results and refresh the local index after a Knowledge Base data source sync"""
+    await wait_until_ready()
+    if not kb_client:
+        raise HTTPException(status_code=404, detail="Knowledge Base integration is disabled")
+    kb_client.invalidate_cache()
+    # The local index and the tables are rebuilt only if the data-source files changed
+    await asyncio.get_running_loop().run_in_executor(None, kb_client.reload_local_index)
+    if kb_client.tables is not None:
+        await asyncio.to_thread(kb_client.tables.refresh, force=True)
+    return {
+        "status": "invalidated",
+        "retrieval_cache": kb_client.cache.stats() if kb_client.cache else None,
+        "local_index": kb_client.local_stats(),
+        "tables": kb_client.table_stats()
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Per-stage latency histograms, token counts and error counters in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/")
@@ -158,19 +638,45 @@ async def root():
     return status
 
 
+@app.get("/health/live")
+async def liveness():
+    """Liveness probe: the process serves HTTP (initialisation may still be running)"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    """Readiness probe: 503 until the clients and agents are initialised"""
+    if startup is not None and not startup.ready:
+        return JSONResponse(status_code=503, content={"status": "starting", "startup": startup.stats()})
+    return {"status": "ready", "startup": startup.stats() if startup else None}
+
+
 @app.get("/health")
 async def health():
     """Detailed health check"""
     return {
-        "status": "healthy",
+        "status": "healthy" if startup is None or startup.ready else "starting",
+        "startup": startup.stats() if startup else None,
+        # Each uvicorn worker answers for itself; shared_state is common to the host's workers
+        "worker": {"pid": os.getpid()},
+        "shared_state": get_store().stats() if get_store() else None,
         "services": {
             "asana_mcp": {
                 "enabled": bool(asana_client),
-                "connected": bool(asana_client and asana_client.tools)
+                **(asana_client.status() if asana_client else {"connected": False})
             },
             "knowledge_base": {
                 "enabled": bool(kb_client),
-                "connected": bool(kb_client and kb_client.retriever)
-            }
+                "connected": bool(kb_client and kb_client.retriever),
+                "retrieval_cache": kb_client.cache.stats() if kb_client and kb_client.cache else None,
+                "local_index": kb_client.local_stats() if kb_client else None,
+                "tables": kb_client.table_stats() if kb_client else None
+            },
+            "agents": agent_registry.stats() if agent_registry else None,
+            "response_cache": response_cache.stats() if response_cache else None,
+            "admission": admission.stats() if admission else None,
+            "memory": memory.stats() if memory else None,
+            "prefetch": prefetcher.stats() if prefetcher else None
         }
     }
\ No newline at end of file
@@ -0,0 +1,299 @@
+"""
+Supervised pool of long-lived MCP server processes with least-busy dispatch
+"""
+import os
+import random
+import importlib
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from langchain_core.tools import BaseTool, StructuredTool, ToolException
+
+logger = logging.getLogger(__name__)
+
+
+def _unwrap(error: BaseException) -> BaseException:
+    """First leaf of the task group exception groups raised by the stdio transport"""
+    while isinstance(error, BaseExceptionGroup) and error.exceptions:
+        error = error.exceptions[0]
+    return error
+
+
+def _describe(error: BaseException) -> str:
+    """Describe an error, unwrapping the task group exception groups raised by the stdio transport"""
+    error = _unwrap(error)
+    return f"{type(error).__name__}: {error}"
+
+
+def is_transport_failure(error: BaseException) -> bool:
+    """
+    Whether an error means the session to the server is broken (closed stream, dead process)
+
+    Errors the server answered with (McpError) and timeouts of a single call
+    leave the session usable; a hung server is caught by the health probe.
+    """
+    import anyio
+    from mcp.shared.exceptions import McpError
+    from mcp.types import CONNECTION_CLOSED
+    error = _unwrap(error)
+    if isinstance(error, McpError):
+        return error.error.code == CONNECTION_CLOSED
+    return isinstance(error, (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream, ConnectionError))
+
+
+class MCPServerProcess:
+    """
+    One MCP server subprocess with a long-lived session
+
+    The stdio transport must be entered and exited from the same task, so the
+    session lives inside _supervise(), which also restarts the process with
+    exponential backoff when it dies or fails a health probe.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        connection: Dict[str, Any],
+        call_timeout: float,
+        probe_interval: float,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0
+    ):
+        self.name = name
+        self.connection = connection
+        self.call_timeout = call_timeout
+        self.probe_interval = probe_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = None
+        self.state = "stopped"
+        self.in_flight = 0
+        self.calls = 0
+        self.restarts = 0
+        self.last_error: Optional[str] = None
+        self._ready = asyncio.Event()
+        self._restart = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.state == "ready"
+
+    def start(self):
+        self._task = asyncio.create_task(self._supervise(), name=f"mcp-{self.name}")
+
+    async def wait_ready(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _supervise(self):
+        # The MCP SDK is imported on first start, not with the app (see startup.py)
+        from langchain_mcp_adapters.sessions import create_session
+        failures = 0
+        while not self._stop.is_set():
+            self.state = "starting"
+            try:
+                async with create_session(self.connection) as session:
+                    await asyncio.wait_for(session.initialize(), timeout=self.call_timeout)
+                    self.session = session
+                    self.state = "ready"
+                    self._ready.set()
+                    failures = 0
+                    logger.info(f"MCP server {self.name} ready")
+                    await self._serve_until_restart()
+            except Exception as e:
+                self.last_error = _describe(e)
+                logger.warning(f"MCP server {self.name} failed: {self.last_error}")
+            finally:
+                self.session = None
+                self._ready.clear()
+
+            if self._stop.is_set():
+                break
+            # Restart with exponential backoff and jitter
+            self.state = "restarting"
+            self.restarts += 1
+            delay = min(self.backoff_max, self.backoff_base * (2 ** failures)) * random.uniform(0.5, 1.0)
+            failures += 1
+            logger.info(f"Restarting MCP server {self.name} in {delay:.2f}s")
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        self.state = "stopped"
+
+    async def _serve_until_restart(self):
+        """Probe the server periodically until a restart or stop is requested"""
+        self._restart.clear()
+        while not self._stop.is_set():
+            waiters = [asyncio.create_task(self._stop.wait()), asyncio.create_task(self._restart.wait())]
+            done, pending = await asyncio.wait(waiters, timeout=self.probe_interval, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in pending:
+                waiter.cancel()
+            if self._restart.is_set():
+                raise ConnectionError(self.last_error or "restart requested")
+            if done:
+                return
+            try:
+                await asyncio.wait_for(self.session.send_ping(), timeout=self.call_timeout)
+            except Exception as e:
+                raise ConnectionError(f"health probe failed: {_describe(e)}") from e
+
+    def request_restart(self, reason: str):
+        """Mark the process unhealthy and let the supervisor restart it"""
+        if self.state == "ready":
+            self.state = "unhealthy"
+            self.last_error = reason
+            self._restart.set()
+
+    async def call_tool(self, name: str, arguments: Dict[str, Any]):
+        """
+        Call a tool on this process
+
+        Only a broken transport restarts the process (see is_transport_failure);
+        server errors and call timeouts are raised as ToolException.
+        """
+        self.in_flight += 1
+        self.calls += 1
+        try:
+            return await asyncio.wait_for(self.session.call_tool(name, arguments), timeout=self.call_timeout)
+        except asyncio.TimeoutError:
+            raise ToolException(f"MCP tool {name} timed out after {self.call_timeout}s")
+        except Exception as e:
+            if is_transport_failure(e):
+                self.request_restart(f"tool call {name} failed: {_describe(e)}")
+                raise
+            raise ToolException(f"MCP tool {name} failed: {_describe(e)}") from e
+        finally:
+            self.in_flight -= 1
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            await self._task
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+        }
+
+
+def _convert_result(result) -> str:
+    """Convert an MCP CallToolResult to tool output, raising ToolException on tool errors"""
+    from mcp.types import TextContent
+    texts = [content.text for content in result.content if isinstance(content, TextContent)]
+    output = "\n".join(texts)
+    if result.isError:
+        raise ToolException(output)
+    return output
+
+
+class MCPServerPool:
+    """Pool of pre-warmed MCP server processes sharing one tool list"""
+
+    def __init__(self, connection: Dict[str, Any], size: Optional[int] = None, name: str = "mcp"):
+        self.connection = connection
+        self.size = size or int(os.getenv("ASANA_MCP_POOL_SIZE", "2"))
+        self.call_timeout = float(os.getenv("ASANA_MCP_CALL_TIMEOUT", "30"))
+        self.start_timeout = float(os.getenv("ASANA_MCP_START_TIMEOUT", "60"))
+        self.drain_timeout = float(os.getenv("ASANA_MCP_DRAIN_TIMEOUT", "30"))
+        probe_interval = float(os.getenv("ASANA_MCP_PROBE_INTERVAL", "15"))
+        self.members = [
+            MCPServerProcess(f"{name}-{i}", connection, self.call_timeout, probe_interval)
+            for i in range(self.size)
+        ]
+        self.draining = False
+        self._changed = asyncio.Condition()
+
+    async def start(self):
+        """Start every process and wait until all are ready (at least one is required)"""
+        # The MCP SDK is imported lazily; import it off the event loop before the first start
+        await asyncio.to_thread(importlib.import_module, "langchain_mcp_adapters.sessions")
+        for member in self.members:
+            member.start()
+        ready = await asyncio.gather(*(member.wait_ready(self.start_timeout) for member in self.members))
+        if not any(ready):
+            errors = [member.last_error for member in self.members if member.last_error]
+            await self.close()
+            raise RuntimeError(f"No MCP server became ready: {errors}")
+        logger.info(f"MCP server pool started ({sum(ready)}/{self.size} ready)")
+
+    async def _acquire(self) -> MCPServerProcess:
+        """Pick the healthy process with the fewest in-flight calls"""
+        if self.draining:
+            raise ToolException("MCP server pool is shutting down")
+        healthy = [member for member in self.members if member.healthy]
+        if not healthy:
+            waiters = [asyncio.create_task(member.wait_ready(self.call_timeout)) for member in self.members]
+            done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in pending:
+                waiter.cancel()
+            healthy = [member for member in self.members if member.healthy]
+            if not healthy:
+                raise ToolException("No healthy MCP server available")
+        return min(healthy, key=lambda member: member.in_flight)
+
+    async def call_tool(self, name: str, arguments: Dict[str, Any]) -> str:
+        """Dispatch a tool call to the least busy process"""
+        member = await self._acquire()
+        try:
+            return _convert_result(await member.call_tool(name, arguments))
+        finally:
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def get_tools(self) -> List[BaseTool]:
+        """List the tools of the first ready process as LangChain tools that dispatch through the pool"""
+        member = await self._acquire()
+        listed = await asyncio.wait_for(member.session.list_tools(), timeout=self.call_timeout)
+
+        def build(tool) -> BaseTool:
+            async def call_tool(**arguments):
+                return await self.call_tool(tool.name, arguments)
+
+            return StructuredTool(
+                name=tool.name,
+                description=tool.description or "",
+                args_schema=tool.inputSchema,
+                coroutine=call_tool,
+                metadata=tool.annotations.model_dump() if tool.annotations else None,
+            )
+
+        return [build(tool) for tool in listed.tools]
+
+    @property
+    def in_flight(self) -> int:
+        return sum(member.in_flight for member in self.members)
+
+    async def close(self):
+        """Stop accepting calls, wait for in-flight calls to finish, then stop every process"""
+        self.draining = True
+        try:
+            async with self._changed:
+                await asyncio.wait_for(
+                    self._changed.wait_for(lambda: self.in_flight == 0),
+                    timeout=self.drain_timeout
+                )
+        except asyncio.TimeoutError:
+            logger.warning(f"MCP pool drain timed out with {self.in_flight} calls in flight")
+        await asyncio.gather(*(member.stop() for member in self.members))
+
+    def status(self) -> dict:
+        """Report real connection state of every process"""
+        return {
+            "connected": any(member.healthy for member in self.members),
+            "ready": sum(1 for member in self.members if member.healthy),
+            "size": self.size,
+            "draining": self.draining,
+            "servers": {member.name: member.status() for member in self.members},
+        }
@@ -0,0 +1,218 @@
+"""
+Conversation memory for the agents: a LangGraph checkpointer keyed by session,
+token-budgeted history trimming and LRU eviction of idle sessions
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage, RemoveMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableLambda
+from langgraph.checkpoint.memory import MemorySaver
+
+logger = logging.getLogger(__name__)
+
+
+def split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """Split a message history into turns, each starting at a human message"""
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def retention_order(turns: List[List[BaseMessage]]) -> List[int]:
+    """
+    Indices of turns, most worth keeping first
+
+    Turns with tool results come first (they are what follow-up questions reuse
+    instead of calling the tools again), then the other turns; newest first within each group.
+    """
+    newest_first = range(len(turns) - 1, -1, -1)
+    return sorted(newest_first, key=lambda i: not any(isinstance(m, ToolMessage) for m in turns[i]))
+
+
+def trim_history(
+    messages: List[BaseMessage],
+    max_tokens: int,
+    token_counter: Callable[[List[BaseMessage]], int] = count_tokens_approximately
+) -> List[BaseMessage]:
+    """
+    Keep the current turn and as many earlier turns as fit in max_tokens
+
+    Whole turns are kept or dropped so that every tool call stays paired with its
+    tool result, which Bedrock requires. Earlier turns are picked in
+    retention_order and keep their original order. The current turn is always
+    kept, even when it exceeds the budget on its own.
+
+    Args:
+        messages: Conversation history (without the system prompt)
+        max_tokens: Token budget for the earlier turns
+        token_counter: Function estimating the tokens of a list of messages
+
+    Returns:
+        The messages sent to the model
+    """
+    turns = split_turns(messages)
+    if len(turns) <= 1:
+        return messages
+    earlier = turns[:-1]
+    kept = set()
+    budget = max_tokens
+    for index in retention_order(earlier):
+        tokens = token_counter(earlier[index])
+        if tokens <= budget:
+            budget -= tokens
+            kept.add(index)
+    return [message for index in sorted(kept) for message in earlier[index]] + turns[-1]
+
+
+def history_trimmer(max_tokens: Optional[int] = None):
+    """
+    Runnable that trims the agent's message history before the prompt template
+
+    Args:
+        max_tokens: Token budget for earlier turns (env MEMORY_MAX_HISTORY_TOKENS)
+    """
+    max_tokens = max_tokens or int(os.getenv("MEMORY_MAX_HISTORY_TOKENS", "4000"))
+    return RunnableLambda(lambda messages: trim_history(messages, max_tokens), name="trim_history")
+
+
+class SessionMemory:
+    """
+    Checkpointer shared by the session-aware agents, with a bounded number of sessions
+
+    Each (route, session_id) pair is a LangGraph thread. Sessions are tracked in
+    LRU order; when there are more than max_sessions, or a session has been idle
+    longer than idle_ttl, its checkpoints are deleted. Turns of one session run
+    one at a time. After each turn the stored history is cut to max_turns turns
+    (see retention_order) and superseded checkpoints are dropped, so that a
+    session holds a single copy of its history.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[str] = None,
+        max_sessions: Optional[int] = None,
+        idle_ttl: Optional[float] = None,
+        max_turns: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.backend = backend or os.getenv("MEMORY_BACKEND", "memory")
+        self.max_sessions = max_sessions or int(os.getenv("MEMORY_MAX_SESSIONS", "1000"))
+        self.idle_ttl = idle_ttl or float(os.getenv("MEMORY_SESSION_TTL", "1800"))
+        self.max_turns = max_turns or int(os.getenv("MEMORY_MAX_TURNS", "20"))
+        self.clock = clock
+        self.checkpointer = None
+        self._stack = AsyncExitStack()
+        # thread_id -> last used, least recently used first
+        self._sessions: "OrderedDict[str, float]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.counters = {"turns": 0, "evicted_idle": 0, "evicted_lru": 0, "dropped_turns": 0}
+
+    async def initialize(self):
+        """Create the checkpointer selected by MEMORY_BACKEND ("memory" or "sqlite")"""
+        if self.backend == "sqlite":
+            try:
+                from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+                path = os.getenv("MEMORY_SQLITE_PATH", "sessions.sqlite")
+                self.checkpointer = await self._stack.enter_async_context(AsyncSqliteSaver.from_conn_string(path))
+                logger.info(f"Conversation memory stored in SQLite: {path}")
+                return
+            except ImportError:
+                logger.error("MEMORY_BACKEND=sqlite requires the langgraph-checkpoint-sqlite package. "
+                             "Falling back to in-memory sessions.")
+                self.backend = "memory"
+        self.checkpointer = MemorySaver()
+
+    async def close(self):
+        await self._stack.aclose()
+
+    @asynccontextmanager
+    async def session(self, route: str, session_id: str, agent) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Run one turn of a session
+
+        Args:
+            route: Agent route ("asana", "knowledge_base"); each route keeps its own thread
+            session_id: Client-supplied session ID
+            agent: Session-aware agent (compiled with this checkpointer)
+
+        Yields:
+            Runnable config selecting the session's thread
+        """
+        thread_id = f"{route}:{session_id}"
+        lock = self._locks.setdefault(thread_id, asyncio.Lock())
+        async with lock:
+            self._sessions[thread_id] = self.clock()
+            self._sessions.move_to_end(thread_id)
+            await self._evict()
+            config = {"configurable": {"thread_id": thread_id}}
+            try:
+                yield config
+            finally:
+                self.counters["turns"] += 1
+                self._sessions[thread_id] = self.clock()
+                try:
+                    await self._compact(agent, config)
+                except Exception as e:
+                    logger.warning(f"Failed to compact session history: {e}")
+
+    async def _evict(self):
+        """Delete sessions that are idle too long or beyond max_sessions (sessions in use are kept)"""
+        now = self.clock()
+        for thread_id, last_used in list(self._sessions.items()):
+            idle = now - last_used > self.idle_ttl
+            over = len(self._sessions) > self.max_sessions
+            if not (idle or over):
+                break
+            if self._locks[thread_id].locked():
+                continue
+            del self._sessions[thread_id]
+            del self._locks[thread_id]
+            await self.checkpointer.adelete_thread(thread_id)
+            self.counters["evicted_idle" if idle else "evicted_lru"] += 1
+
+    async def _compact(self, agent, config: Dict[str, Any]):
+        """Drop turns beyond max_turns from the stored state (in retention_order), then superseded checkpoints"""
+        state = await agent.aget_state(config)
+        turns = split_turns(state.values.get("messages", []))
+        if len(turns) > self.max_turns:
+            # The latest turn is always kept
+            dropped = retention_order(turns[:-1])[self.max_turns - 1:]
+            old = [message for index in dropped for message in turns[index]]
+            await agent.aupdate_state(config, {"messages": [RemoveMessage(id=message.id) for message in old]})
+            self.counters["dropped_turns"] += len(dropped)
+        await self._squash_checkpoints(agent, config)
+
+    async def _squash_checkpoints(self, agent, config: Dict[str, Any]):
+        """
+        Replace the checkpoints of a thread with a single one holding its current messages
+
+        Every graph step stores a new checkpoint (in memory, with its own copy of
+        the message list); old checkpoints are only needed for time travel, which
+        is not used. Only public checkpointer and graph APIs are used, so this
+        works for every backend. Runs under the session lock.
+        """
+        state = await agent.aget_state(config)
+        messages = state.values.get("messages", [])
+        await self.checkpointer.adelete_thread(config["configurable"]["thread_id"])
+        if messages:
+            # As the agent node's output, so the thread ends like a finished run
+            await agent.aupdate_state(config, {"messages": messages}, as_node="agent")
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "idle_ttl": self.idle_ttl,
+            **self.counters,
+        }
@@ -0,0 +1,384 @@
+"""
+Request-level latency instrumentation exposed as Prometheus text on /metrics
+
+Histograms and counters are kept in process (no client library required) and
+rendered in the Prometheus text exposition format. Model and tool calls are
+measured by a LangChain callback handler; request stages by the stage() context
+manager. OpenTelemetry spans are emitted as well when OTEL_TRACING_ENABLED=true
+and opentelemetry-api is installed.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Runs whose end callback never arrives (cancelled calls) are forgotten after this many newer runs
+MAX_OPEN_RUNS = 4096
+
+# Model runs with this tag are not measured, e.g. the tiered model whose tier models are
+UNMEASURED_TAG = "ypd_unmeasured"
+
+# Run metadata key: estimated tool-schema tokens a model call does not send (see tool_selection)
+TOOL_TOKENS_SAVED_KEY = "ypd_tool_tokens_saved"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels.get(name, "")) for name in self.labelnames), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(tuple(str(labels.get(name, "")) for name in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Named collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics: "OrderedDict[str, Any]" = OrderedDict()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _create_tracer():
+    """Create an OpenTelemetry tracer when enabled and installed (exporters are configured by the SDK)"""
+    if os.getenv("OTEL_TRACING_ENABLED", "false").lower() != "true":
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        logger.warning("OTEL_TRACING_ENABLED is set but opentelemetry-api is not installed. Tracing disabled.")
+        return None
+    return trace.get_tracer("ypd-langchain")
+
+
+ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+registry = MetricsRegistry()
+tracer = _create_tracer()
+
+STAGE_SECONDS = registry.histogram(
+    "ypd_stage_duration_seconds", "Duration of request stages", ["stage", "route"]
+)
+MODEL_SECONDS = registry.histogram(
+    "ypd_model_call_duration_seconds", "Duration of chat model calls", ["model"]
+)
+MODEL_TOKENS = registry.counter(
+    "ypd_model_tokens_total", "Tokens reported in Bedrock usage metadata (input, output, cache_read)", ["model", "type"]
+)
+PROMPT_TOKENS_SAVED = registry.counter(
+    "ypd_prompt_tokens_saved_total", "Estimated Asana tool-schema input tokens not sent thanks to per-query tool selection"
+)
+MODEL_ERRORS = registry.counter(
+    "ypd_model_errors_total", "Failed chat model calls", ["model"]
+)
+TOOL_SECONDS = registry.histogram(
+    "ypd_tool_call_duration_seconds", "Duration of agent tool calls (MCP and knowledge base)", ["tool"]
+)
+TOOL_ERRORS = registry.counter(
+    "ypd_tool_errors_total", "Failed agent tool calls", ["tool"]
+)
+REQUESTS = registry.counter(
+    "ypd_requests_total", "Handled /generate requests", ["endpoint", "route"]
+)
+REQUEST_ERRORS = registry.counter(
+    "ypd_request_errors_total", "Requests answered with an error, per route", ["route"]
+)
+REJECTIONS = registry.counter(
+    "ypd_requests_rejected_total", "Requests rejected by admission control", ["route", "status"]
+)
+KB_ANSWERS = registry.counter(
+    "ypd_kb_answers_total", "Knowledge base answers by mode (direct, agent_fallback, agent, table)", ["mode"]
+)
+MODEL_TIER_CALLS = registry.counter(
+    "ypd_model_tier_calls_total", "Chat model calls per tier and purpose (answer, tool, synthesis)", ["tier", "purpose"]
+)
+MODEL_ESCALATIONS = registry.counter(
+    "ypd_model_escalations_total", "Calls escalated to a larger model tier, by the tier that failed and why", ["tier", "reason"]
+)
+MODEL_COST = registry.counter(
+    "ypd_model_cost_usd_total", "Estimated on-demand model cost in USD per tier", ["tier"]
+)
+KB_LOCAL_RETRIEVALS = registry.counter(
+    "ypd_kb_local_retrievals_total",
+    "Knowledge base retrievals with the local index by outcome (local, remote, merged)", ["outcome"]
+)
+HYBRID_BRANCHES = registry.counter(
+    "ypd_hybrid_branches_total",
+    "Branches of hybrid (Asana + knowledge base) answers by route and outcome (ok, error, cancelled)", ["route", "status"]
+)
+PREFETCH_RESULTS = registry.counter(
+    "ypd_prefetch_total",
+    "Background prefetch results: Asana directory refreshes and knowledge base warm-up retrievals, by outcome",
+    ["kind", "status"]
+)
+TOOL_OUTPUT_TOKENS_SAVED = registry.counter(
+    "ypd_tool_output_tokens_saved_total", "Estimated tokens tool-output compaction kept out of the agent context", ["route"]
+)
+TOOL_OUTPUT_BYTES_SAVED = registry.counter(
+    "ypd_tool_output_bytes_saved_total", "Bytes tool-output compaction kept out of the agent context", ["route"]
+)
+TOOL_OUTPUT_REQUEST_TOKENS_SAVED = registry.histogram(
+    "ypd_tool_output_request_tokens_saved", "Estimated tokens tool-output compaction saved per agent request", ["route"],
+    buckets=(0, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+)
+TOOL_OUTPUT_REQUEST_BYTES_SAVED = registry.histogram(
+    "ypd_tool_output_request_bytes_saved", "Bytes tool-output compaction saved per agent request", ["route"],
+    buckets=(0, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+)
+AGENT_RUNS = registry.counter(
+    "ypd_agent_runs_total",
+    "Agent runs by route and outcome (completed, or stopped by deadline, steps or tool_calls)", ["route", "outcome"]
+)
+AGENT_STEPS = registry.histogram(
+    "ypd_agent_steps", "Model steps per agent run", ["route"], buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24)
+)
+AGENT_TOOL_CALLS = registry.histogram(
+    "ypd_agent_tool_calls", "Tool results per agent run", ["route"], buckets=(0, 1, 2, 4, 8, 12, 16, 24, 32)
+)
+REQUEST_DEADLINES = registry.counter(
+    "ypd_request_deadline_exceeded_total", "Requests that did not finish within their deadline", ["route"]
+)
+
+
+@contextmanager
+def stage(name: str, route: str = "") -> Iterator[None]:
+    """
+    Time a request stage into ypd_stage_duration_seconds (and an OpenTelemetry span when enabled)
+
+    Args:
+        name: Stage name, e.g. "route", "handler", "postprocess"
+        route: Route label ("asana", "knowledge_base", "general") or empty
+    """
+    if not ENABLED:
+        yield
+        return
+    span = tracer.start_as_current_span(f"ypd.{name}", attributes={"ypd.route": route}) if tracer else None
+    if span:
+        span.__enter__()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name, route=route)
+        if span:
+            span.__exit__(None, None, None)
+
+
+def record_error(route: str):
+    """Count a request answered with an error message"""
+    if ENABLED:
+        REQUEST_ERRORS.inc(route=route)
+
+
+def _usage(response) -> Tuple[int, int]:
+    """Extract (input, output) token counts from an LLMResult"""
+    input_tokens = output_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+    if not (input_tokens or output_tokens):
+        # Non-converse Bedrock responses report usage in llm_output
+        usage = (response.llm_output or {}).get("usage") or {}
+        input_tokens = usage.get("prompt_tokens", usage.get("input_tokens", 0))
+        output_tokens = usage.get("completion_tokens", usage.get("output_tokens", 0))
+    return input_tokens, output_tokens
+
+
+def _cache_read_tokens(response) -> int:
+    """Input tokens served from the Bedrock prompt cache"""
+    total = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            total += (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+    return total
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records chat model and tool call durations, token usage and errors"""
+
+    # Run inline on the event loop: the handler only does dictionary updates
+    run_inline = True
+    # Graph nodes and chains are not measured; skipping them keeps per-request overhead low
+    ignore_chain = True
+    ignore_retriever = True
+    ignore_custom_event = True
+
+    def __init__(self):
+        self._runs: "OrderedDict[UUID, Tuple[str, str, float, Any]]" = OrderedDict()
+
+    def _start(self, run_id: UUID, kind: str, name: str):
+        span = tracer.start_span(f"ypd.{kind}", attributes={f"ypd.{kind}": name}) if tracer else None
+        self._runs[run_id] = (kind, name, time.perf_counter(), span)
+        if len(self._runs) > MAX_OPEN_RUNS:
+            self._runs.popitem(last=False)
+
+    def _finish(self, run_id: UUID, error: Optional[BaseException] = None) -> Optional[Tuple[str, str, float]]:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return None
+        kind, name, start, span = run
+        if span:
+            if error is not None:
+                span.record_exception(error)
+            span.end()
+        return kind, name, time.perf_counter() - start
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata=None, tags=None, **kwargs):
+        saved = (metadata or {}).get(TOOL_TOKENS_SAVED_KEY)
+        if saved:
+            PROMPT_TOKENS_SAVED.inc(saved)
+        if tags and UNMEASURED_TAG in tags:
+            return
+        model = (metadata or {}).get("ls_model_name") or (serialized or {}).get("name") or "unknown"
+        self._start(run_id, "model", model)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        run = self._finish(run_id)
+        if run is None:
+            return
+        _, model, elapsed = run
+        MODEL_SECONDS.observe(elapsed, model=model)
+        input_tokens, output_tokens = _usage(response)
+        if input_tokens:
+            MODEL_TOKENS.inc(input_tokens, model=model, type="input")
+        if output_tokens:
+            MODEL_TOKENS.inc(output_tokens, model=model, type="output")
+        cache_read = _cache_read_tokens(response)
+        if cache_read:
+            MODEL_TOKENS.inc(cache_read, model=model, type="cache_read")
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        run = self._finish(run_id, error)
+        if run is not None:
+            MODEL_ERRORS.inc(model=run[1])
+
+    def on_tool_start(self, serialized, input_str, *, run_id: UUID, **kwargs):
+        self._start(run_id, "tool", (serialized or {}).get("name") or kwargs.get("name") or "unknown")
+
+    def on_tool_end(self, output, *, run_id: UUID, **kwargs):
+        run = self._finish(run_id)
+        if run is not None:
+            TOOL_SECONDS.observe(run[2], tool=run[1])
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        run = self._finish(run_id, error)
+        if run is not None:
+            TOOL_SECONDS.observe(run[2], tool=run[1])
+            TOOL_ERRORS.inc(tool=run[1])
+
+
+callback_handler = MetricsCallbackHandler()
+
+
+def callbacks() -> List[BaseCallbackHandler]:
+    """Callback handlers to attach to models and agents (empty when metrics are disabled)"""
+    return [callback_handler] if ENABLED else []
+
+
+def render() -> str:
+    """Prometheus text for /metrics"""
+    return registry.render()
@@ -0,0 +1,273 @@
+"""
+Model tiering: answer simple prompts and agent tool-selection steps with Nova Micro / Lite
+and keep Nova Pro for complex questions and final answers
+"""
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cheapest first; escalation moves one tier up
+TIER_ORDER = ("micro", "lite", "pro")
+
+DEFAULT_TIER_MODELS = {
+    "micro": "us.amazon.nova-micro-v1:0",
+    "lite": "us.amazon.nova-lite-v1:0",
+    "pro": "us.amazon.nova-pro-v1:0",
+}
+
+# On-demand USD per 1,000 (input, output) tokens, used for cost reporting only
+MODEL_PRICES = {
+    "micro": (0.000035, 0.00014),
+    "lite": (0.00006, 0.00024),
+    "pro": (0.0008, 0.0032),
+}
+# Prompt-cache reads are billed at a quarter of the input price
+CACHE_READ_PRICE_RATIO = 0.25
+
+# Requests that need reasoning, comparison or longer writing
+COMPLEX_PATTERN = re.compile(
+    r"なぜ|理由|比較|分析|設計|要約|まとめ|手順|方法|違い|メリット|デメリット|考察|提案|計画|評価|"
+    r"コード|実装|翻訳|explain|why|compare|analy[sz]e|design|summari[sz]e|implement|code|translate",
+    re.IGNORECASE
+)
+
+
+def complexity_score(text: str) -> float:
+    """
+    Rough 0-1 estimate of how hard a prompt is to answer
+
+    Longer prompts, reasoning / writing keywords, several questions in one
+    prompt and code all add to the score.
+    """
+    score = min(len(text) / 400, 1.0) * 0.4
+    score += min(len(COMPLEX_PATTERN.findall(text)) * 0.15, 0.45)
+    if len(re.findall(r"[?？]", text)) > 1 or len(re.findall(r"^\s*(?:[-*・]|\d+[.)．])", text, re.MULTILINE)) > 1:
+        score += 0.1
+    if "```" in text:
+        score += 0.2
+    return min(score, 1.0)
+
+
+def _text(message: BaseMessage) -> str:
+    content = message.content
+    if isinstance(content, list):
+        return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return str(content)
+
+
+class TierPolicy:
+    """
+    Which tier answers which call
+
+    Calls without tools (general questions, direct knowledge base answers) use
+    the tier configured for their route, or for general questions the tier
+    matching the prompt's complexity_score. In the agents, tool-selection steps
+    use tool_tier and the final answer synthesis_tier.
+    """
+
+    def __init__(
+        self,
+        low: Optional[float] = None,
+        high: Optional[float] = None,
+        tool_tier: Optional[str] = None,
+        synthesis_tier: Optional[str] = None,
+        route_tiers: Optional[Dict[str, str]] = None
+    ):
+        self.low = low if low is not None else float(os.getenv("MODEL_TIER_COMPLEXITY_LOW", "0.3"))
+        self.high = high if high is not None else float(os.getenv("MODEL_TIER_COMPLEXITY_HIGH", "0.6"))
+        self.tool_tier = tool_tier or os.getenv("MODEL_TIER_TOOL_STEP", "lite")
+        self.synthesis_tier = synthesis_tier or os.getenv("MODEL_TIER_SYNTHESIS", "pro")
+        # Knowledge base answers are written from retrieved documents and hybrid answers
+        # merge several routes' answers; both need Pro
+        self.route_tiers = {
+            "knowledge_base": os.getenv("MODEL_TIER_ROUTE_KNOWLEDGE_BASE", "pro"),
+            "hybrid": os.getenv("MODEL_TIER_ROUTE_HYBRID", "pro"),
+        }
+        self.route_tiers.update(route_tiers or {})
+
+    def answer_tier(self, route: Optional[str], text: str) -> str:
+        """Tier for a call without tools"""
+        if route in self.route_tiers:
+            return self.route_tiers[route]
+        score = complexity_score(text)
+        if score < self.low:
+            return "micro"
+        return "lite" if score < self.high else "pro"
+
+    @staticmethod
+    def escalate(tier: str) -> Optional[str]:
+        """Next tier up, or None for the top tier"""
+        index = TIER_ORDER.index(tier)
+        return TIER_ORDER[index + 1] if index + 1 < len(TIER_ORDER) else None
+
+
+class TieredChatModel(BaseChatModel):
+    """
+    Chat model that forwards each call to one of several tier models
+
+    With tools bound (agent steps) the tool tier is asked first: its tool calls
+    are used as they are, but when it answers instead, the synthesis tier writes
+    the final answer. Output that fails validation (unknown tool, malformed
+    tool call, empty answer) or an error escalates to the next tier.
+
+    Only the tier models' calls are measured (the router's own run is tagged
+    metrics.UNMEASURED_TAG); calls, escalations and cost are counted per tier.
+    """
+
+    tiers: Dict[str, Any]
+    policy: Any
+    tool_names: List[str] = []
+    tags: Optional[List[str]] = [metrics.UNMEASURED_TAG]
+
+    @property
+    def _llm_type(self) -> str:
+        return "tiered-chat-model"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={
+            "tiers": {name: model.bind_tools(tools, **kwargs) for name, model in self.tiers.items()},
+            "tool_names": [getattr(tool, "name", None) for tool in tools],
+        })
+
+    def _first_tier(self, messages: List[BaseMessage], run_manager) -> Tuple[str, str]:
+        """(tier, purpose) for the first attempt of a call"""
+        if self.tool_names:
+            return self.policy.tool_tier, "tool"
+        route = (getattr(run_manager, "metadata", None) or {}).get("route")
+        question = next((_text(m) for m in reversed(messages) if isinstance(m, HumanMessage)), "")
+        return self.policy.answer_tier(route, question), "answer"
+
+    def _problem(self, message: AIMessage) -> Optional[str]:
+        """Why an output cannot be used, or None"""
+        if getattr(message, "invalid_tool_calls", None):
+            return "invalid_tool_call"
+        if any(call["name"] not in self.tool_names or not isinstance(call.get("args"), dict)
+               for call in message.tool_calls):
+            return "unknown_tool"
+        if not message.tool_calls and not re.sub(r"<thinking>.*?</thinking>", "", _text(message), flags=re.DOTALL).strip():
+            return "empty"
+        return None
+
+    def _record(self, tier: str, purpose: str, message: Optional[AIMessage]):
+        usage = getattr(message, "usage_metadata", None) or {}
+        price_in, price_out = MODEL_PRICES.get(tier, (0.0, 0.0))
+        cache_read = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+        cost = (usage.get("input_tokens", 0) + cache_read * CACHE_READ_PRICE_RATIO) / 1000 * price_in + \
+            usage.get("output_tokens", 0) / 1000 * price_out
+        metrics.MODEL_TIER_CALLS.inc(tier=tier, purpose=purpose)
+        if cost:
+            metrics.MODEL_COST.inc(cost, tier=tier)
+
+    def _next_step(self, tier: str, purpose: str, message: Optional[AIMessage], error: Optional[Exception]):
+        """
+        Decide what to do with one attempt
+
+        Returns:
+            (tier, purpose) of the next attempt, or None when message is the answer
+        """
+        problem = "error" if error is not None else self._problem(message)
+        if problem is None:
+            if purpose == "tool" and not message.tool_calls and \
+                    TIER_ORDER.index(tier) < TIER_ORDER.index(self.policy.synthesis_tier):
+                return self.policy.synthesis_tier, "synthesis"
+            return None
+        higher = self.policy.escalate(tier)
+        if higher is None:
+            if error is not None:
+                raise error
+            return None
+        logger.info(f"Escalating from {tier} to {higher}: {problem}")
+        metrics.MODEL_ESCALATIONS.inc(tier=tier, reason=problem)
+        return higher, purpose
+
+    def _call_config(self) -> Dict[str, Any]:
+        # Tier models report to the metrics handler only, so a discarded answer
+        # of a small model is never streamed to the client
+        return {"callbacks": metrics.callbacks()}
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tier, purpose = self._first_tier(messages, run_manager)
+        while True:
+            message, error = None, None
+            try:
+                message = self.tiers[tier].invoke(messages, config=self._call_config(), stop=stop)
+                self._record(tier, purpose, message)
+            except Exception as e:
+                error = e
+            step = self._next_step(tier, purpose, message, error)
+            if step is None:
+                return ChatResult(generations=[ChatGeneration(message=message)])
+            tier, purpose = step
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tier, purpose = self._first_tier(messages, run_manager)
+        while True:
+            message, error = None, None
+            try:
+                message = await self.tiers[tier].ainvoke(messages, config=self._call_config(), stop=stop)
+                self._record(tier, purpose, message)
+            except Exception as e:
+                error = e
+            step = self._next_step(tier, purpose, message, error)
+            if step is None:
+                return ChatResult(generations=[ChatGeneration(message=message)])
+            tier, purpose = step
+
+    async def _astream(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        """
+        Stream the answer of the tier that writes it
+
+        Tool-selection attempts are not streamed (their text may be discarded);
+        once the answering tier is known its output is streamed chunk by chunk.
+        """
+        tier, purpose = self._first_tier(messages, run_manager)
+        while purpose == "tool":
+            message, error = None, None
+            try:
+                message = await self.tiers[tier].ainvoke(messages, config=self._call_config(), stop=stop)
+                self._record(tier, purpose, message)
+            except Exception as e:
+                error = e
+            step = self._next_step(tier, purpose, message, error)
+            if step is None:
+                chunk = AIMessageChunk(
+                    content=message.content,
+                    tool_call_chunks=[
+                        {"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False),
+                         "id": call["id"], "index": i}
+                        for i, call in enumerate(message.tool_calls)
+                    ],
+                    usage_metadata=message.usage_metadata,
+                )
+                yield ChatGenerationChunk(message=chunk)
+                return
+            tier, purpose = step
+
+        usage = None
+        async for chunk in self.tiers[tier].astream(messages, config=self._call_config(), stop=stop):
+            usage = chunk.usage_metadata or usage
+            yield ChatGenerationChunk(message=chunk)
+        self._record(tier, purpose, AIMessage(content="", usage_metadata=usage) if usage else None)
+
+
+def tiering_enabled() -> bool:
+    return os.getenv("MODEL_TIERING_ENABLED", "false").lower() == "true"
+
+
+def tier_model_ids(default_pro: str) -> Dict[str, str]:
+    """Model ID per tier (env MODEL_TIER_MICRO / MODEL_TIER_LITE; Pro is BEDROCK_MODEL_ID)"""
+    return {
+        "micro": os.getenv("MODEL_TIER_MICRO", DEFAULT_TIER_MODELS["micro"]),
+        "lite": os.getenv("MODEL_TIER_LITE", DEFAULT_TIER_MODELS["lite"]),
+        "pro": default_pro,
+    }
@@ -0,0 +1,224 @@
+"""
+Background prefetch of Asana workspace / project metadata and knowledge base warm-up
+
+Almost every Asana question starts with asana_list_workspaces and
+asana_search_projects. A refresher started with the app fetches both
+periodically through the MCP client (which also fills the tool result cache)
+and keeps a snapshot; while the snapshot is fresh the Asana agent gets it as
+an extra system message and can use the IDs without the discovery round-trips.
+
+The refresher also retrieves a configured list of frequent knowledge base
+queries, and re-retrieves them before the retrieval cache expires, so those
+questions never wait for Bedrock.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Discovery tools the snapshot replaces
+DIRECTORY_TOOLS = ("asana_list_workspaces", "asana_search_projects")
+
+DIRECTORY_HEADER = "取得済みのAsanaワークスペースとプロジェクト一覧"
+DIRECTORY_PROMPT = """{header}：
+{entries}
+
+上記のワークスペース・プロジェクトのIDは、asana_list_workspaces や asana_search_projects を呼び出さずにそのまま使用してください。
+一覧にないプロジェクトが必要な場合や、作成・変更された直後の場合のみ検索してください。"""
+
+
+def prefetch_enabled() -> bool:
+    return os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+
+
+def _parse_list(result: Any) -> List[dict]:
+    """Objects in an MCP tool result: a JSON list, or the "data" list of an Asana API response"""
+    if not isinstance(result, str):
+        result = "".join(part if isinstance(part, str) else part.get("text", "") for part in result)
+    value = json.loads(result)
+    if isinstance(value, dict):
+        value = value.get("data", [])
+    return [item for item in value if isinstance(item, dict) and item.get("gid")]
+
+
+class AsanaDirectory(NamedTuple):
+    """Snapshot of the workspaces and their projects"""
+    workspaces: List[dict]
+    # Workspace gid -> projects ({"gid", "name"})
+    projects: Dict[str, List[dict]]
+    fetched_at: float
+
+    def project_count(self) -> int:
+        return sum(len(projects) for projects in self.projects.values())
+
+    def prompt(self, max_projects: int) -> str:
+        """System message text listing at most max_projects projects"""
+        lines, listed = [], 0
+        for workspace in self.workspaces:
+            lines.append(f"- ワークスペース {workspace['name']} (gid: {workspace['gid']})")
+            projects = self.projects.get(workspace["gid"], [])
+            shown = projects[:max(max_projects - listed, 0)]
+            listed += len(shown)
+            lines.extend(f"  - プロジェクト {project.get('name', '')} (gid: {project['gid']})" for project in shown)
+            if len(shown) < len(projects):
+                lines.append(f"  - ほか {len(projects) - len(shown)} 件（asana_search_projects で検索してください）")
+        return DIRECTORY_PROMPT.format(header=DIRECTORY_HEADER, entries="\n".join(lines))
+
+
+class Prefetcher:
+    """
+    Periodic refresher of the Asana directory snapshot and the knowledge base warm-up queries
+
+    Each refresh runs in its own background task; a failed refresh keeps the
+    previous snapshot and is retried sooner. The snapshot is offered to the
+    agent only while it is younger than max_staleness.
+    """
+
+    def __init__(
+        self,
+        asana_client=None,
+        kb_client=None,
+        asana_interval: Optional[float] = None,
+        max_staleness: Optional[float] = None,
+        max_projects: Optional[int] = None,
+        kb_queries: Optional[List[str]] = None,
+        kb_interval: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Args:
+            asana_client: Initialized AsanaMCPClient (None disables the Asana refresh)
+            kb_client: Initialized KnowledgeBaseClient (None disables the warm-up)
+            asana_interval: Seconds between Asana refreshes
+            max_staleness: Age in seconds after which the snapshot is no longer used
+            max_projects: Projects listed in the agent prompt at most
+            kb_queries: Queries retrieved ahead of time
+            kb_interval: Seconds between warm-ups; below KB_CACHE_TTL keeps the entries from expiring
+            clock: Time source (tests)
+        """
+        self.asana_client = asana_client
+        self.kb_client = kb_client
+        self.asana_interval = asana_interval or float(os.getenv("PREFETCH_ASANA_INTERVAL", "300"))
+        self.max_staleness = max_staleness or float(os.getenv("PREFETCH_ASANA_MAX_STALENESS", "900"))
+        self.max_projects = max_projects or int(os.getenv("PREFETCH_ASANA_MAX_PROJECTS", "100"))
+        if kb_queries is None:
+            kb_queries = [query.strip() for query in os.getenv("KB_WARMUP_QUERIES", "").split("|")]
+        self.kb_queries = [query for query in kb_queries if query]
+        self.kb_interval = kb_interval or float(os.getenv("KB_WARMUP_INTERVAL", "240"))
+        self.clock = clock
+        self.directory: Optional[AsanaDirectory] = None
+        self._prompt: Optional[str] = None
+        self._tasks: List[asyncio.Task] = []
+        self.counters = {"asana_refreshes": 0, "asana_errors": 0, "kb_warmed": 0, "kb_errors": 0}
+
+    async def refresh_asana(self) -> AsanaDirectory:
+        """
+        Fetch the workspaces and their projects and replace the snapshot
+
+        Raises:
+            Exception: When a tool call fails or returns unexpected output
+        """
+        tools = {tool.name: tool for tool in await self.asana_client.get_tools()}
+        with metrics.stage("prefetch_asana", route="asana"):
+            workspaces = _parse_list(await tools["asana_list_workspaces"].ainvoke({}))
+            results = await asyncio.gather(*(
+                tools["asana_search_projects"].ainvoke({"workspace": workspace["gid"], "name_pattern": ".*"})
+                for workspace in workspaces
+            ))
+        self.directory = AsanaDirectory(
+            workspaces=[{"gid": w["gid"], "name": w.get("name", "")} for w in workspaces],
+            projects={
+                workspace["gid"]: [{"gid": p["gid"], "name": p.get("name", "")} for p in _parse_list(result)]
+                for workspace, result in zip(workspaces, results)
+            },
+            fetched_at=self.clock(),
+        )
+        self._prompt = self.directory.prompt(self.max_projects)
+        self.counters["asana_refreshes"] += 1
+        logger.info(f"Prefetched {len(workspaces)} Asana workspaces and {self.directory.project_count()} projects")
+        return self.directory
+
+    async def warm_knowledge_base(self) -> int:
+        """
+        Retrieve the warm-up queries (refreshing their cache entries)
+
+        Returns:
+            Number of queries retrieved from Bedrock
+        """
+        warmed = 0
+        for query in self.kb_queries:
+            try:
+                warmed += await self.kb_client.warm(query)
+            except Exception as e:
+                self.counters["kb_errors"] += 1
+                metrics.PREFETCH_RESULTS.inc(kind="knowledge_base", status="error")
+                logger.warning(f"Knowledge base warm-up query failed: {e}")
+        self.counters["kb_warmed"] += warmed
+        metrics.PREFETCH_RESULTS.inc(warmed, kind="knowledge_base", status="ok")
+        return warmed
+
+    def directory_prompt(self) -> Optional[str]:
+        """Snapshot text for the Asana agent, or None when there is none or it is too old"""
+        directory = self.directory
+        if directory is None or self.clock() - directory.fetched_at > self.max_staleness:
+            return None
+        return self._prompt
+
+    async def _asana_loop(self):
+        while True:
+            try:
+                await self.refresh_asana()
+                metrics.PREFETCH_RESULTS.inc(kind="asana", status="ok")
+                delay = self.asana_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.counters["asana_errors"] += 1
+                metrics.PREFETCH_RESULTS.inc(kind="asana", status="error")
+                logger.warning(f"Asana metadata prefetch failed: {e}")
+                delay = min(self.asana_interval, 30)
+            await asyncio.sleep(delay)
+
+    async def _kb_loop(self):
+        while True:
+            await self.warm_knowledge_base()
+            await asyncio.sleep(self.kb_interval)
+
+    def start(self):
+        """Start the background refreshes (call from the running event loop)"""
+        if self.asana_client is not None:
+            self._tasks.append(asyncio.create_task(self._asana_loop()))
+        if self.kb_client is not None and self.kb_queries:
+            if self.kb_client.cache is None:
+                logger.warning("KB_WARMUP_QUERIES is set but the retrieval cache is disabled; skipping the warm-up")
+            else:
+                self._tasks.append(asyncio.create_task(self._kb_loop()))
+
+    async def close(self):
+        """Stop the background refreshes"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self) -> dict:
+        """Snapshot age and counters for health reporting"""
+        directory = self.directory
+        return {
+            "asana": {
+                "workspaces": len(directory.workspaces) if directory else 0,
+                "projects": directory.project_count() if directory else 0,
+                "age_seconds": round(self.clock() - directory.fetched_at, 1) if directory else None,
+                "fresh": self.directory_prompt() is not None,
+                "interval": self.asana_interval,
+                "max_staleness": self.max_staleness,
+            },
+            "knowledge_base": {"queries": len(self.kb_queries), "interval": self.kb_interval},
+            **self.counters,
+        }
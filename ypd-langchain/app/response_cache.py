@@ -0,0 +1,284 @@
+"""
+Semantic response cache for full /generate answers (exact hash match, then embedding similarity)
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from retrieval_cache import normalize_query
+from shared_state import get_store
+
+logger = logging.getLogger(__name__)
+
+# Prompts that change Asana state must always reach the agent. English verbs are
+# matched as whole words, like the router's ASCII keywords ("address" is not "add")
+MUTATION_PATTERN = re.compile(
+    r"作成|追加|更新|変更|削除|完了にして|登録|コメントして|\b(?:create|add|update|delete|modify|remove)\b",
+    re.IGNORECASE
+)
+
+# Fallback / error answers returned by the handlers are never cached
+ERROR_MARKERS = ("エラーが発生しました", "申し訳ございません", "統合が設定されていません")
+# Nor are the partial answers of agents stopped by their budget (see budget.PARTIAL_NOTE)
+PARTIAL_MARKER = "調査を途中で打ち切りました"
+
+DEFAULT_ROUTE_TTLS = {
+    "asana": 60,
+    "knowledge_base": 3600,
+    "general": 3600,
+}
+
+
+class VectorIndex:
+    """In-process cosine-similarity index over unit vectors stored in a NumPy matrix"""
+
+    def __init__(self, dimension: Optional[int] = None, capacity: int = 64):
+        self.dimension = dimension
+        self._capacity = capacity
+        self._matrix = None
+        self._keys: List[Optional[str]] = []
+        self._slots: Dict[str, int] = {}
+        self._free: List[int] = []
+
+    def _ensure_capacity(self, dimension: int):
+        if self._matrix is None:
+            self.dimension = dimension
+            self._matrix = np.zeros((self._capacity, dimension), dtype=np.float32)
+        elif len(self._keys) >= self._matrix.shape[0] and not self._free:
+            grown = np.zeros((self._matrix.shape[0] * 2, self.dimension), dtype=np.float32)
+            grown[:self._matrix.shape[0]] = self._matrix
+            self._matrix = grown
+
+    def add(self, key: str, vector: np.ndarray):
+        """Add or replace the vector stored under key"""
+        self.remove(key)
+        self._ensure_capacity(vector.shape[0])
+        slot = self._free.pop() if self._free else len(self._keys)
+        if slot == len(self._keys):
+            self._keys.append(key)
+        else:
+            self._keys[slot] = key
+        self._matrix[slot] = vector
+        self._slots[key] = slot
+
+    def remove(self, key: str):
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._keys[slot] = None
+            self._matrix[slot] = 0.0
+            self._free.append(slot)
+
+    def search(self, vector: np.ndarray) -> Tuple[Optional[str], float]:
+        """Return the most similar key and its cosine similarity"""
+        if not self._slots:
+            return None, 0.0
+        scores = self._matrix[:len(self._keys)] @ vector
+        slot = int(np.argmax(scores))
+        return self._keys[slot], float(scores[slot])
+
+    def clear(self):
+        self._matrix = None
+        self._keys = []
+        self._slots = {}
+        self._free = []
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+def _unit_vector(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def create_embedder(model_id: Optional[str] = None):
+    """Create the Bedrock embedding model used for similarity lookups"""
+    from langchain_aws import BedrockEmbeddings
+    return BedrockEmbeddings(
+        model_id=model_id or os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "amazon.titan-embed-text-v2:0"),
+        region_name=os.getenv("AWS_REGION", "us-west-2")
+    )
+
+
+class SemanticResponseCache:
+    """
+    Answer cache consulted before routing in /generate
+
+    Lookups try an exact hash of the normalized prompt first and only embed the
+    prompt when that misses. Entries expire according to the TTL of the route
+    that produced them, so Asana answers go stale quickly while document answers live longer.
+
+    With a shared store (several workers on one host) every answer is also
+    written there with its embedding, and each lookup first mirrors the answers
+    the other workers stored since the previous lookup into the local index.
+    """
+
+    SHARED_NAMESPACE = "responses"
+
+    def __init__(
+        self,
+        embedder=None,
+        similarity_threshold: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        route_ttls: Optional[Dict[str, float]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        shared=None
+    ):
+        self.embedder = embedder if embedder is not None else create_embedder()
+        self.similarity_threshold = similarity_threshold or float(os.getenv("RESPONSE_CACHE_SIMILARITY_THRESHOLD", "0.92"))
+        self.max_entries = max_entries or int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+        self.route_ttls = dict(DEFAULT_ROUTE_TTLS)
+        for route in self.route_ttls:
+            env_value = os.getenv(f"RESPONSE_CACHE_TTL_{route.upper()}")
+            if env_value is not None:
+                self.route_ttls[route] = float(env_value)
+        self.route_ttls.update(route_ttls or {})
+        self.clock = clock
+
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._index = VectorIndex()
+        self.counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0}
+        self.shared = shared if shared is not None else get_store()
+        self._shared_seen = 0
+        self._shared_generation = None
+
+    @staticmethod
+    def _key(prompt: str) -> str:
+        return hashlib.sha256(normalize_query(prompt).encode("utf-8")).hexdigest()
+
+    def _get_live(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= self.clock():
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _evict(self, key: str):
+        self._entries.pop(key, None)
+        self._index.remove(key)
+        self.counters["evictions"] += 1
+
+    def _put(self, key: str, response: str, route: str, ttl: float, embedding: np.ndarray):
+        self._entries[key] = {"response": response, "route": route, "expires_at": self.clock() + ttl}
+        self._entries.move_to_end(key)
+        self._index.add(key, embedding)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._evict(oldest)
+
+    def _sync_shared(self):
+        """Mirror the answers stored in the shared store since the last sync"""
+        if self.shared is None:
+            return
+        try:
+            generation = self.shared.generation(self.SHARED_NAMESPACE)
+            if generation != self._shared_generation:
+                # Some worker invalidated answers; rebuild the mirror from what is left
+                self._entries.clear()
+                self._index.clear()
+                self._shared_seen = 0
+                self._shared_generation = generation
+            for entry_id, key, route, value, ttl in self.shared.changes(self.SHARED_NAMESPACE, self._shared_seen):
+                self._shared_seen = entry_id
+                self._put(key, value["response"], route, ttl, np.asarray(value["embedding"], dtype=np.float32))
+        except Exception as e:
+            logger.warning(f"Shared response cache sync failed: {e}")
+
+    async def lookup(self, prompt: str) -> Tuple[Optional[dict], Optional[np.ndarray]]:
+        """
+        Look up a cached answer for the prompt
+
+        Prompts asking for a change (MUTATION_PATTERN) are never answered from the
+        cache, not even by a similar read-only question, so that the change is made.
+
+        Args:
+            prompt: User prompt
+
+        Returns:
+            (hit, embedding) where hit is a dict with response/route/match/similarity or None,
+            and embedding is the prompt vector to pass back to store() on a miss
+        """
+        if MUTATION_PATTERN.search(prompt):
+            self.counters["bypassed"] += 1
+            return None, None
+        self._sync_shared()
+        entry = self._get_live(self._key(prompt))
+        if entry is not None:
+            self.counters["exact_hits"] += 1
+            return {"response": entry["response"], "route": entry["route"], "match": "exact", "similarity": 1.0}, None
+
+        embedding = _unit_vector(await self.embedder.aembed_query(normalize_query(prompt)))
+        key, similarity = self._index.search(embedding)
+        if key is not None and similarity >= self.similarity_threshold:
+            entry = self._get_live(key)
+            if entry is not None:
+                self.counters["semantic_hits"] += 1
+                return {"response": entry["response"], "route": entry["route"], "match": "semantic", "similarity": similarity}, embedding
+
+        self.counters["misses"] += 1
+        return None, embedding
+
+    def is_cacheable(self, prompt: str, route: str, response: str) -> bool:
+        """Only successful, read-only answers on routes with a positive TTL are cached"""
+        if self.route_ttls.get(route, 0) <= 0:
+            return False
+        if MUTATION_PATTERN.search(prompt):
+            # Never looked up (see lookup)
+            return False
+        return bool(response) and not any(marker in response for marker in (*ERROR_MARKERS, PARTIAL_MARKER))
+
+    async def store(self, prompt: str, route: str, response: str, embedding: Optional[np.ndarray] = None):
+        """
+        Store an answer under the prompt's exact hash and embedding
+
+        Args:
+            prompt: User prompt
+            route: Route that produced the answer (selects the TTL)
+            response: Answer text
+            embedding: Prompt vector returned by lookup(), computed if omitted
+        """
+        if not self.is_cacheable(prompt, route, response):
+            return
+        if embedding is None:
+            embedding = _unit_vector(await self.embedder.aembed_query(normalize_query(prompt)))
+
+        key = self._key(prompt)
+        ttl = self.route_ttls[route]
+        self._put(key, response, route, ttl, embedding)
+        self.counters["stores"] += 1
+        if self.shared is not None:
+            try:
+                self.shared.set(self.SHARED_NAMESPACE, key, {"response": response, "embedding": embedding.tolist()},
+                                ttl, tag=route, max_entries=self.max_entries)
+            except Exception as e:
+                logger.warning(f"Shared response cache store failed: {e}")
+
+    def invalidate(self, route: Optional[str] = None):
+        """Drop cached answers, optionally only those of one route (in every worker when shared)"""
+        if self.shared is not None:
+            try:
+                self.shared.clear(self.SHARED_NAMESPACE, tag=route)
+            except Exception as e:
+                logger.warning(f"Shared response cache invalidation failed: {e}")
+        if route is None:
+            self._entries.clear()
+            self._index.clear()
+            return
+        for key in [k for k, entry in self._entries.items() if entry["route"] == route]:
+            self._entries.pop(key)
+            self._index.remove(key)
+
+    def stats(self) -> dict:
+        """Return cache counters for health reporting"""
+        return {"entries": len(self._entries), "route_ttls": self.route_ttls, "shared": self.shared is not None,
+                **self.counters}
@@ -0,0 +1,243 @@
+"""
+Retrieval result cache for the Bedrock Knowledge Base retriever (LRU + TTL eviction)
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.documents import Document
+
+from shared_state import get_store, shared_state_path
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize query text so trivially different phrasings share a cache entry
+
+    Applies NFKC (full-width / half-width folding), case folding and whitespace collapsing.
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+def make_cache_key(query: str, retrieval_config: Optional[Dict[str, Any]] = None, namespace: str = "") -> str:
+    """
+    Build a cache key from the normalized query and the retrieval configuration
+
+    Args:
+        query: Raw query text
+        retrieval_config: Retriever configuration (number of results, search type, ...)
+        namespace: Knowledge base ID, so several knowledge bases can share a backend
+
+    Returns:
+        Hex digest used as the backend key
+    """
+    payload = json.dumps(
+        {"kb": namespace, "query": normalize_query(query), "config": retrieval_config or {}},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class InMemoryCacheBackend:
+    """In-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[List[Document]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, documents = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return list(documents)
+
+    def set(self, key: str, documents: List[Document]):
+        self._entries[key] = (self.clock() + self.ttl, list(documents))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    """
+    Shared cache backend on a Redis-compatible client
+
+    TTL is delegated to Redis (SET ... EX) and LRU eviction to the server's
+    maxmemory-policy, so several API processes share one cache.
+    """
+
+    def __init__(self, client, ttl: float = 300, prefix: str = "kb-retrieval:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[List[Document]]:
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+        return [Document(page_content=item["page_content"], metadata=item["metadata"]) for item in json.loads(raw)]
+
+    def set(self, key: str, documents: List[Document]):
+        raw = json.dumps(
+            [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+            ensure_ascii=False,
+            default=str
+        )
+        self.client.set(self.prefix + key, raw, ex=max(1, int(self.ttl)))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + "*"))
+
+
+class SQLiteCacheBackend:
+    """
+    Cache backend on the host's shared SQLite store (shared_state.SharedStore)
+
+    Shares cached retrievals between the worker processes of one host without
+    running Redis; TTL and LRU eviction are handled by the store.
+    """
+
+    def __init__(self, store, max_entries: int = 256, ttl: float = 300, namespace: str = "kb-retrieval"):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.namespace = namespace
+        self._evictions_at_start = store.evictions
+
+    @property
+    def evictions(self) -> int:
+        return self.store.evictions - self._evictions_at_start
+
+    def get(self, key: str) -> Optional[List[Document]]:
+        entry = self.store.get(self.namespace, key)
+        if entry is None:
+            return None
+        return [Document(page_content=item["page_content"], metadata=item["metadata"]) for item in entry[0]]
+
+    def set(self, key: str, documents: List[Document]):
+        # Round-trip through JSON so metadata values such as datetimes become strings, as with Redis
+        items = json.loads(json.dumps(
+            [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+            ensure_ascii=False,
+            default=str
+        ))
+        self.store.set(self.namespace, key, items, self.ttl, max_entries=self.max_entries)
+
+    def clear(self):
+        self.store.clear(self.namespace)
+
+    def __len__(self) -> int:
+        return self.store.count(self.namespace)
+
+
+def create_cache_backend():
+    """
+    Create the cache backend selected by KB_CACHE_BACKEND ("memory", "sqlite" or "redis")
+
+    Defaults to "sqlite" when shared state is configured for several workers.
+    Falls back to the in-process backend when Redis or the shared store is not available.
+    """
+    backend = os.getenv("KB_CACHE_BACKEND", "sqlite" if shared_state_path() else "memory")
+    max_entries = int(os.getenv("KB_CACHE_MAX_ENTRIES", "256"))
+    ttl = float(os.getenv("KB_CACHE_TTL", "300"))
+
+    if backend == "sqlite":
+        store = get_store()
+        if store is not None:
+            return SQLiteCacheBackend(store, max_entries=max_entries, ttl=ttl)
+        logger.error("KB_CACHE_BACKEND=sqlite requires SHARED_STATE_PATH. Falling back to in-memory cache.")
+
+    if backend == "redis":
+        try:
+            import redis
+            client = redis.Redis.from_url(os.getenv("KB_CACHE_REDIS_URL", "redis://localhost:6379/0"))
+            return RedisCacheBackend(client, ttl=ttl)
+        except ImportError:
+            logger.error("KB_CACHE_BACKEND=redis requires the redis package. Falling back to in-memory cache.")
+
+    return InMemoryCacheBackend(max_entries=max_entries, ttl=ttl)
+
+
+class RetrievalCache:
+    """Caching layer in front of the knowledge base retriever"""
+
+    def __init__(self, backend=None, retrieval_config: Optional[Dict[str, Any]] = None, namespace: str = ""):
+        self.backend = backend if backend is not None else create_cache_backend()
+        self.retrieval_config = retrieval_config or {}
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _key(self, query: str) -> str:
+        return make_cache_key(query, self.retrieval_config, self.namespace)
+
+    def get(self, query: str) -> Optional[List[Document]]:
+        """Return cached documents for the query, or None on a miss"""
+        try:
+            documents = self.backend.get(self._key(query))
+        except Exception as e:
+            logger.warning(f"Retrieval cache lookup failed: {e}")
+            documents = None
+
+        if documents is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return documents
+
+    def set(self, query: str, documents: List[Document]):
+        """Store retrieved documents for the query"""
+        try:
+            self.backend.set(self._key(query), documents)
+        except Exception as e:
+            logger.warning(f"Retrieval cache store failed: {e}")
+
+    def invalidate(self):
+        """Drop every cached result (call after a knowledge base data source sync)"""
+        self.backend.clear()
+        self.invalidations += 1
+        logger.info("Retrieval cache invalidated")
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters"""
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,157 @@
+"""
+Single-pass intent router for /generate (Asana / knowledge base / general)
+"""
+import os
+import re
+import math
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Keyword weights per route. Strong signals (1.0) route on their own; generic
+# words (0.3) such as "作成" or "new" only count together with other evidence.
+INTENT_KEYWORDS: Dict[str, Dict[str, float]] = {
+    "asana": {
+        "アサナ": 1.5, "asana": 1.5,
+        "タスク": 1.0, "task": 1.0, "tasks": 1.0, "サブタスク": 1.0, "subtask": 1.0,
+        "担当者": 1.0, "担当": 0.8, "assignee": 1.0, "assigned": 0.8,
+        "期限": 0.8, "締切": 0.8, "締め切り": 0.8, "deadline": 0.8, "due": 0.3,
+        "ワークスペース": 1.0, "workspace": 1.0,
+        "プロジェクト一覧": 1.0, "プロジェクト": 0.8, "project": 0.8, "projects": 0.8,
+        "セクション": 0.5, "マイルストーン": 0.8,
+        "進捗": 0.5, "progress": 0.3, "status": 0.3, "ステータス": 0.5,
+        "コメント": 0.4, "comment": 0.3,
+        "完了": 0.3, "complete": 0.3, "done": 0.3,
+        "作成": 0.3, "create": 0.3, "new": 0.3, "新しい": 0.2,
+        "更新": 0.3, "update": 0.3, "modify": 0.3,
+    },
+    "knowledge_base": {
+        # Document-related
+        "文書": 1.0, "ドキュメント": 1.0, "資料": 0.8, "書類": 1.0, "文献": 1.0,
+        "マニュアル": 1.0, "ガイド": 0.8, "手順書": 1.0, "説明書": 1.0,
+        "規程": 1.0, "規則": 1.0, "就業規則": 1.2, "ポリシー": 1.0, "方針": 0.8, "ルール": 0.6,
+        "仕様書": 1.0, "設計書": 1.0, "報告書": 1.0, "レポート": 0.6,
+        "レコード": 1.0, "リスト": 0.3,
+        # Company/internal related
+        "社内": 1.0, "会社": 0.6, "組織": 0.5, "部署": 0.5, "チーム": 0.3,
+        "プロジェクト": 0.3, "製品": 0.5, "サービス": 0.3,
+        "システム": 0.3, "ツール": 0.3, "アプリケーション": 0.3,
+        # Question patterns
+        "について教えて": 0.6, "について説明": 0.6, "について知りたい": 0.6, "とは何": 0.6,
+        "どのような": 0.3, "どうやって": 0.3, "やり方": 0.6,
+        "使い方": 0.6, "方法": 0.3, "手順": 0.6,
+        # Specific document requests
+        "最新の": 0.3, "現在の": 0.2, "今の": 0.2,
+        "確認したい": 0.3, "調べたい": 0.3, "知りたい": 0.3,
+        "探している": 0.3, "検索": 0.3, "参照": 0.3,
+    },
+}
+
+DEFAULT_ROUTE = "general"
+
+
+class Intent(NamedTuple):
+    """Scored route for a query"""
+    route: str
+    score: float
+    confidence: float
+    matches: Tuple[str, ...]
+
+
+def _trie_pattern(keywords: List[str]) -> str:
+    """
+    Build a regex whose alternation is factored as a trie
+
+    "手順" and "手順書" become "手順(?:書)?", so at each position the regex engine
+    follows a single branch instead of trying every keyword, and the greedy
+    optional groups return the longest keyword.
+    """
+    trie: dict = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build(node: dict) -> str:
+        terminal = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if terminal:
+            return f"(?:{body})?" if len(branches) > 1 else (f"(?:{body})?" if len(body) > 1 else f"{body}?")
+        return body
+
+    return build(trie)
+
+
+# ASCII keywords are matched as whole words: every ASCII word in the query is
+# captured and looked up, so "new" never matches inside "news"
+ASCII_WORD = r"[a-z0-9]+"
+
+
+class IntentRouter:
+    """
+    Scores every route in one pass over the query
+
+    All keywords of all routes are compiled into a single trie-shaped regex, so a
+    query is lowercased and scanned once (in C, via findall) regardless of the
+    number of intents.
+    """
+
+    def __init__(self, intents: Dict[str, Dict[str, float]] = INTENT_KEYWORDS, min_score: Optional[float] = None):
+        self.intents = intents
+        self.min_score = min_score if min_score is not None else float(os.getenv("ROUTER_MIN_SCORE", "0.6"))
+        self._weights: Dict[str, List[Tuple[str, float]]] = {}
+        for route, keywords in intents.items():
+            for keyword, weight in keywords.items():
+                self._weights.setdefault(keyword.lower(), []).append((route, weight))
+        non_ascii = [keyword for keyword in self._weights if not keyword.isascii()]
+        # The leading lookahead lets the regex engine skip positions that cannot start a keyword
+        first_chars = re.escape("".join(sorted({keyword[0] for keyword in non_ascii})))
+        self._pattern = re.compile(f"(?=[a-z0-9{first_chars}])(?:{ASCII_WORD}|{_trie_pattern(non_ascii)})")
+
+    def rank(self, query: str) -> List[Intent]:
+        """
+        Score all routes for a query
+
+        Args:
+            query: User's input query
+
+        Returns:
+            Intents sorted by score (highest first); each keyword counts once
+        """
+        scores = {route: 0.0 for route in self.intents}
+        matches: Dict[str, List[str]] = {route: [] for route in self.intents}
+        for keyword in dict.fromkeys(self._pattern.findall(query.lower())):
+            for route, weight in self._weights.get(keyword, ()):
+                scores[route] += weight
+                matches[route].append(keyword)
+
+        ranked = [
+            Intent(route, round(score, 3), round(1 - math.exp(-score), 3), tuple(matches[route]))
+            for route, score in scores.items()
+        ]
+        return sorted(ranked, key=lambda intent: intent.score, reverse=True)
+
+    def matching_routes(self, query: str) -> List[Intent]:
+        """Return every route whose score reaches min_score, best first"""
+        return [intent for intent in self.rank(query) if intent.score >= self.min_score]
+
+    def route(self, query: str) -> str:
+        """
+        Pick the route for a query
+
+        Returns:
+            The best scoring route, or "general" if no route reaches min_score
+        """
+        matching = self.matching_routes(query)
+        if not matching:
+            return DEFAULT_ROUTE
+        logger.debug(f"Routed to {matching[0].route} (score={matching[0].score}, matches={matching[0].matches})")
+        return matching[0].route
+
+
+intent_router = IntentRouter()
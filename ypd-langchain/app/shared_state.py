@@ -0,0 +1,423 @@
+"""
+State shared by the worker processes of one host, in a SQLite database (WAL mode)
+
+With several uvicorn workers (WEB_CONCURRENCY) every worker has its own MCP
+server pool, Knowledge Base client, agents and in-process caches. When
+SHARED_STATE_PATH is set (or more than one worker is configured) the retrieval
+cache, the Asana tool result cache, the response cache and the admission
+limits also keep their state in this database, so an answer cached by one
+worker is a hit in the others and the per-route limits hold for the host.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "/tmp/ypd-shared-state.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    tag TEXT NOT NULL DEFAULT '',
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    UNIQUE (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries (namespace, last_used);
+CREATE TABLE IF NOT EXISTS generations (
+    namespace TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slots (
+    name TEXT NOT NULL,
+    worker INTEGER NOT NULL,
+    active INTEGER NOT NULL,
+    PRIMARY KEY (name, worker)
+);
+"""
+
+
+def shared_state_path() -> Optional[str]:
+    """SHARED_STATE_PATH, or the default path when WEB_CONCURRENCY starts several workers"""
+    path = os.getenv("SHARED_STATE_PATH")
+    if path:
+        return path
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        return DEFAULT_PATH
+    return None
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedStore:
+    """
+    Namespaced key-value entries with TTL and LRU eviction, plus counted slots
+
+    Values are stored as JSON. Entries get increasing ids when written, so a
+    process can follow what the others stored (changes()); clear() bumps the
+    namespace's generation so processes mirroring a namespace know to drop
+    their copies. Slots are counted per worker process, and slots of workers
+    that died are released when a store is opened.
+
+    Each thread uses its own connection; every statement is short, so the
+    calls are made directly from the event loop with a short busy timeout.
+    A statement that cannot get the write lock within it is skipped instead of
+    blocking the loop (counted as busy): a lookup is a miss, a store or LRU
+    touch is dropped, and try_acquire() reports the slot as not taken.
+    Invalidations (clear(), delete_tags()) and slot releases are never
+    dropped; they are retried off the event loop. Hits refresh an entry's LRU
+    time at most every touch_interval seconds.
+    """
+
+    # Seconds that opening a connection, creating the schema and the writes
+    # retried off the event loop wait for the write lock
+    LOCK_WAIT_TIMEOUT = 60.0
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        worker: Optional[int] = None,
+        busy_timeout: Optional[float] = None,
+        touch_interval: Optional[float] = None
+    ):
+        """
+        Args:
+            path: SQLite database file
+            max_entries: Default entry limit per namespace (SHARED_STATE_MAX_ENTRIES)
+            worker: Worker id of the slots (defaults to the process id)
+            busy_timeout: Seconds a statement waits for another worker's write lock (SHARED_STATE_BUSY_TIMEOUT)
+            touch_interval: Minimum seconds between LRU updates of an entry on hits (SHARED_STATE_TOUCH_INTERVAL)
+        """
+        self.path = path
+        self.max_entries = max_entries or int(os.getenv("SHARED_STATE_MAX_ENTRIES", "10000"))
+        self.worker = worker if worker is not None else os.getpid()
+        self.busy_timeout = busy_timeout if busy_timeout is not None else float(os.getenv("SHARED_STATE_BUSY_TIMEOUT", "0.05"))
+        self.touch_interval = (touch_interval if touch_interval is not None
+                               else float(os.getenv("SHARED_STATE_TOUCH_INTERVAL", "30")))
+        self.evictions = 0
+        self.busy = 0
+        self._retries: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Workers starting together wait for each other here
+        connection = self._connection()
+        self._set_busy_timeout(connection, self.LOCK_WAIT_TIMEOUT)
+        connection.executescript(SCHEMA)
+        self.reap()
+        self._set_busy_timeout(connection, self.busy_timeout)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.LOCK_WAIT_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._set_busy_timeout(connection, self.busy_timeout)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @staticmethod
+    def _set_busy_timeout(connection: sqlite3.Connection, seconds: float):
+        connection.execute(f"PRAGMA busy_timeout = {int(seconds * 1000)}")
+
+    # Cache entries
+
+    def get(self, namespace: str, key: str) -> Optional[Tuple[Any, float]]:
+        """
+        Look up an entry
+
+        Returns:
+            (value, seconds until it expires), or None when missing, expired or the database is busy
+        """
+        connection = self._connection()
+        now = time.time()
+        row = None
+        try:
+            row = connection.execute(
+                "SELECT value, expires_at, last_used FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                connection.execute("DELETE FROM entries WHERE namespace = ? AND key = ? AND expires_at <= ?",
+                                   (namespace, key, now))
+                self.evictions += 1
+                return None
+            if now - row[2] >= self.touch_interval:
+                connection.execute("UPDATE entries SET last_used = ? WHERE namespace = ? AND key = ?",
+                                   (now, namespace, key))
+        except sqlite3.OperationalError as e:
+            if row is None or row[1] <= now:
+                return self._busy(e)
+            # The value was read; only the LRU touch was skipped
+            self._busy(e)
+        return json.loads(row[0]), row[1] - now
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float, tag: str = "", max_entries: Optional[int] = None):
+        """
+        Store a JSON-serialisable value for ttl seconds
+
+        The least recently used entries of the namespace are evicted beyond max_entries.
+        The store is dropped when the database is busy.
+
+        Raises:
+            TypeError: If the value is not JSON-serialisable
+        """
+        raw = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        connection = self._connection()
+        limit = max_entries or self.max_entries
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, tag, value, expires_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, tag, raw, now + ttl, now)
+            )
+            excess = connection.execute("SELECT COUNT(*) FROM entries WHERE namespace = ?", (namespace,)).fetchone()[0] - limit
+            if excess > 0:
+                connection.execute(
+                    "DELETE FROM entries WHERE id IN "
+                    "(SELECT id FROM entries WHERE namespace = ? ORDER BY last_used LIMIT ?)",
+                    (namespace, excess)
+                )
+                self.evictions += excess
+        except sqlite3.OperationalError as e:
+            # A cache store (or its eviction, done by the next store) may be dropped
+            self._busy(e)
+
+    def tags(self, namespace: str) -> List[str]:
+        return [row[0] for row in self._connection().execute(
+            "SELECT DISTINCT tag FROM entries WHERE namespace = ?", (namespace,))]
+
+    def clear(self, namespace: str, tag: Optional[str] = None):
+        """Delete a namespace's entries (optionally one tag's) and bump its generation"""
+        self._write_or_retry(f"clear shared {namespace} entries", self._clear, namespace, tag)
+
+    def _clear(self, connection: sqlite3.Connection, namespace: str, tag: Optional[str]):
+        if tag is None:
+            connection.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+        else:
+            connection.execute("DELETE FROM entries WHERE namespace = ? AND tag = ?", (namespace, tag))
+        self._bump(connection, namespace)
+
+    @staticmethod
+    def _bump(connection: sqlite3.Connection, namespace: str):
+        connection.execute(
+            "INSERT INTO generations (namespace, generation) VALUES (?, 1) "
+            "ON CONFLICT (namespace) DO UPDATE SET generation = generation + 1",
+            (namespace,)
+        )
+
+    def delete_tags(self, namespace: str, tags: Iterable[str]) -> int:
+        """
+        Delete the entries stored with any of the tags and bump the namespace's generation
+
+        Returns:
+            Number of entries deleted (0 when the deletion was left to the retry)
+        """
+        deleted = self._write_or_retry(f"invalidate shared {namespace} entries", self._delete_tags, namespace, list(tags))
+        return deleted or 0
+
+    def _delete_tags(self, connection: sqlite3.Connection, namespace: str, tags: List[str]) -> int:
+        placeholders = ", ".join("?" for _ in tags)
+        deleted = connection.execute(
+            f"DELETE FROM entries WHERE namespace = ? AND tag IN ({placeholders})", (namespace, *tags)
+        ).rowcount if tags else 0
+        self._bump(connection, namespace)
+        return deleted
+
+    def generation(self, namespace: str) -> int:
+        row = self._connection().execute(
+            "SELECT generation FROM generations WHERE namespace = ?", (namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def changes(self, namespace: str, since: int) -> List[Tuple[int, str, str, Any, float]]:
+        """
+        Live entries written after the entry id since
+
+        Returns:
+            [(id, key, tag, value, seconds until it expires)] in write order
+        """
+        now = time.time()
+        rows = self._connection().execute(
+            "SELECT id, key, tag, value, expires_at FROM entries "
+            "WHERE namespace = ? AND id > ? AND expires_at > ? ORDER BY id",
+            (namespace, since, now)
+        ).fetchall()
+        return [(row[0], row[1], row[2], json.loads(row[3]), row[4] - now) for row in rows]
+
+    def count(self, namespace: str) -> int:
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM entries WHERE namespace = ? AND expires_at > ?", (namespace, time.time())
+        ).fetchone()[0]
+
+    # Slots
+
+    def try_acquire(self, name: str, limit: int) -> bool:
+        """Take one of limit slots shared by every worker; False when all are taken or the database is busy"""
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            # The caller polls again
+            self._busy(e)
+            return False
+        try:
+            active = connection.execute("SELECT COALESCE(SUM(active), 0) FROM slots WHERE name = ?", (name,)).fetchone()[0]
+            acquired = active < limit
+            if acquired:
+                connection.execute(
+                    "INSERT INTO slots (name, worker, active) VALUES (?, ?, 1) "
+                    "ON CONFLICT (name, worker) DO UPDATE SET active = active + 1",
+                    (name, self.worker)
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def release(self, name: str):
+        """Give a slot back (retried off the event loop while the database is busy)"""
+        self._write_or_retry(f"release shared slot {name}", self._release, name)
+
+    def _release(self, connection: sqlite3.Connection, name: str):
+        connection.execute("UPDATE slots SET active = MAX(active - 1, 0) WHERE name = ? AND worker = ?",
+                           (name, self.worker))
+
+    # Writes that must not be dropped
+
+    @staticmethod
+    def _transaction(connection: sqlite3.Connection, statements: Callable[..., Any], *args) -> Any:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements(connection, *args)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return result
+
+    def _write_or_retry(self, description: str, statements: Callable[..., Any], *args) -> Any:
+        """
+        Run statements(connection, *args) in a write transaction
+
+        When another worker holds the write lock, the transaction is retried on a
+        worker thread with LOCK_WAIT_TIMEOUT instead of blocking the event loop.
+
+        Returns:
+            The statements' result, or None when the write was left to the retry
+        """
+        try:
+            return self._transaction(self._connection(), statements, *args)
+        except sqlite3.OperationalError as e:
+            self._busy(e)
+        with self._lock:
+            if self._retries is None:
+                self._retries = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state-retry")
+        self._retries.submit(self._write_patiently, description, statements, *args)
+        return None
+
+    def _write_patiently(self, description: str, statements: Callable[..., Any], *args):
+        connection = sqlite3.connect(self.path, timeout=self.LOCK_WAIT_TIMEOUT, isolation_level=None)
+        try:
+            self._transaction(connection, statements, *args)
+        except sqlite3.Error as e:
+            logger.error(f"Could not {description}: {e}")
+        finally:
+            connection.close()
+
+    def _busy(self, error: sqlite3.OperationalError) -> None:
+        """Count a statement skipped because another worker held the write lock (other errors are raised)"""
+        if "locked" not in str(error) and "busy" not in str(error):
+            raise error
+        self.busy += 1
+
+    def active(self, name: str) -> int:
+        return self._connection().execute(
+            "SELECT COALESCE(SUM(active), 0) FROM slots WHERE name = ?", (name,)).fetchone()[0]
+
+    def reap(self):
+        """Release the slots of worker processes that no longer exist (and this worker's earlier ones)"""
+        connection = self._connection()
+        workers = [row[0] for row in connection.execute("SELECT DISTINCT worker FROM slots")]
+        dead = [worker for worker in workers if worker == self.worker or not _alive(worker)]
+        for worker in dead:
+            connection.execute("DELETE FROM slots WHERE worker = ?", (worker,))
+        if dead:
+            logger.info(f"Released shared slots of {len(dead)} exited workers")
+
+    def stats(self) -> dict:
+        connection = self._connection()
+        entries = dict(connection.execute(
+            "SELECT namespace, COUNT(*) FROM entries WHERE expires_at > ? GROUP BY namespace", (time.time(),)))
+        slots = dict(connection.execute("SELECT name, SUM(active) FROM slots GROUP BY name"))
+        return {"path": self.path, "worker": self.worker, "entries": entries, "slots": slots,
+                "evictions": self.evictions, "busy": self.busy}
+
+    def close(self):
+        if self._retries is not None:
+            self._retries.shutdown(wait=True)
+            self._retries = None
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> Optional[SharedStore]:
+    """
+    The process's shared store, opened on first use (None when shared state is not configured)
+
+    Opened lazily so each worker process opens its own connections after it started.
+    """
+    global _store
+    path = shared_state_path()
+    if path is None:
+        return None
+    with _store_lock:
+        if _store is None or _store.path != path:
+            try:
+                _store = SharedStore(path)
+                logger.info(f"Shared state in {path} (worker {_store.worker})")
+            except sqlite3.Error as e:
+                logger.error(f"Could not open shared state {path}: {e}. Falling back to per-process state.")
+                return None
+        return _store
+
+
+def close_store():
+    """Close the process's shared store connections (application shutdown)"""
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
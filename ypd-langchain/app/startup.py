@@ -0,0 +1,101 @@
+"""
+Startup tracking for the FastAPI lifespan: phase timings, readiness and module preloading
+
+Liveness only says the process serves HTTP; readiness says the clients and
+agents are initialised. With STARTUP_BACKGROUND_INIT the app accepts
+connections right away and initialises in the background, so /health/live
+answers within the import time while /health/ready waits for the clients.
+"""
+import os
+import time
+import asyncio
+import importlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Imported lazily by the clients and the chat model; preloaded on a worker thread
+# while the MCP server processes start, instead of on the event loop at first use
+PRELOAD_MODULES = ("botocore.config", "langchain_aws", "langchain_mcp_adapters.sessions")
+
+
+def background_init_enabled() -> bool:
+    return os.getenv("STARTUP_BACKGROUND_INIT", "false").lower() == "true"
+
+
+def concurrent_init_enabled() -> bool:
+    return os.getenv("STARTUP_CONCURRENT_INIT", "true").lower() == "true"
+
+
+class StartupState:
+    """Phase timings and the readiness flag of one application start"""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.started_at = clock()
+        self.ready_at: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self._ready = asyncio.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    async def phase(self, name: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run one initialisation step and record its duration
+
+        Errors are logged and recorded; the step then returns None so the
+        other integrations still start.
+        """
+        start = self.clock()
+        try:
+            return await func()
+        except Exception as e:
+            logger.error(f"Startup phase {name} failed: {e}")
+            self.errors[name] = str(e)
+            return None
+        finally:
+            self.phases[name] = self.clock() - start
+
+    def mark_ready(self):
+        self.ready_at = self.clock()
+        self._ready.set()
+        logger.info(f"Application ready in {self.ready_at - self.started_at:.2f}s "
+                    f"({', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.phases.items())})")
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """Wait until initialisation finished; False on timeout"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "seconds_to_ready": round(self.ready_at - self.started_at, 3) if self.ready_at is not None else None,
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "errors": dict(self.errors),
+        }
+
+
+async def preload_modules(modules: Tuple[str, ...] = PRELOAD_MODULES) -> Dict[str, float]:
+    """
+    Import the deferred heavy modules on a worker thread
+
+    Returns:
+        Seconds per module (0 for modules already imported or not installed)
+    """
+    timings = {}
+    for name in modules:
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(importlib.import_module, name)
+        except ImportError as e:
+            logger.warning(f"Could not preload {name}: {e}")
+        timings[name] = time.perf_counter() - start
+    return timings
@@ -0,0 +1,235 @@
+"""
+Server-Sent Events streaming of agent progress and model tokens
+"""
+import re
+import json
+import asyncio
+import logging
+from contextlib import aclosing, nullcontext, suppress
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage
+from langgraph.errors import GraphRecursionError
+
+from budget import RequestBudget, conclude_run
+
+logger = logging.getLogger(__name__)
+
+THINKING_OPEN = "<thinking>"
+THINKING_CLOSE = "</thinking>"
+
+
+def _partial_suffix(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that is a proper prefix of tag"""
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+class ThinkingStripper:
+    """
+    Incrementally remove <thinking>...</thinking> blocks from a token stream
+
+    Tags may be split across chunks, so text that could be the start of a tag is
+    held back until the next chunk arrives. Leading whitespace is dropped, matching
+    the .strip() applied to non-streamed answers.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._inside = False
+        self._started = False
+
+    def feed(self, text: str) -> str:
+        """Add a chunk and return the text that is safe to emit"""
+        self._buffer += text
+        output = []
+        while self._buffer:
+            if self._inside:
+                end = self._buffer.find(THINKING_CLOSE)
+                if end == -1:
+                    keep = _partial_suffix(self._buffer, THINKING_CLOSE)
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                self._buffer = self._buffer[end + len(THINKING_CLOSE):]
+                self._inside = False
+            else:
+                start = self._buffer.find(THINKING_OPEN)
+                if start == -1:
+                    keep = _partial_suffix(self._buffer, THINKING_OPEN)
+                    output.append(self._buffer[:len(self._buffer) - keep])
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                output.append(self._buffer[:start])
+                self._buffer = self._buffer[start + len(THINKING_OPEN):]
+                self._inside = True
+        return self._emit("".join(output))
+
+    def flush(self) -> str:
+        """Return any held-back text once the stream has ended"""
+        # An unterminated thinking block is dropped rather than leaked
+        text = "" if self._inside else self._buffer
+        self._buffer = ""
+        return self._emit(text)
+
+    def _emit(self, text: str) -> str:
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+
+def strip_thinking(text: str) -> str:
+    """Remove complete <thinking> blocks from a finished answer"""
+    return re.sub(r'<thinking>.*?</thinking>', '', text, flags=re.DOTALL).strip()
+
+
+def _message_text(message: Any) -> str:
+    """Extract text from a message or chunk whose content is a string or a list of blocks"""
+    content = getattr(message, "content", message)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            block if isinstance(block, str) else block.get("text", "")
+            for block in content
+            if isinstance(block, str) or block.get("type") == "text"
+        )
+    return ""
+
+
+def _agent_deadline(budget: Optional[RequestBudget]):
+    """Timeout stopping an agent run with the partial-answer reserve left before the deadline"""
+    return asyncio.timeout(max(budget.remaining() - budget.reserve, 0)) if budget is not None else nullcontext()
+
+
+async def _stop(task: asyncio.Task):
+    """
+    Cancel the agent task once and wait until its run has unwound
+
+    A client disconnect cancels the consumer repeatedly (anyio cancel scopes) while
+    it waits here. Awaiting the task directly would forward each of those cancellations
+    into the run's own cleanup and leave LangGraph's channels open for asyncio to close,
+    so the task is only watched with asyncio.wait().
+    """
+    task.cancel()
+    while not task.done():
+        with suppress(asyncio.CancelledError):
+            await asyncio.wait({task})
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Agent run failed while being cancelled: {task.exception()}")
+
+
+async def stream_events(
+    runnable,
+    inputs: Any,
+    fallback: str,
+    config: Optional[Dict[str, Any]] = None,
+    budget: Optional[RequestBudget] = None,
+    route: str = "agent",
+    chat_model=None
+) -> AsyncIterator[dict]:
+    """
+    Run an agent (or a plain chat model) and yield progress events as they happen
+
+    Events:
+        tool_start / tool_end: a tool call began / finished
+        token: a piece of model output with <thinking> blocks removed
+        done: the final answer (fallback if the model produced none)
+
+    The agent runs in its own task feeding a queue; closing this generator cancels
+    that task, which cancels any in-flight model or tool call, and waits until the
+    run has unwound.
+
+    With a budget the run is cancelled by budget.guard() shortly after the
+    deadline (raising TimeoutError). An agent is stopped earlier, like
+    budget.run_agent stops it: before a step that exceeds the step / tool-call
+    limits, or when the time before the deadline is down to the reserve. The
+    done event then carries the partial answer.
+
+    Args:
+        runnable: Compiled agent or chat model
+        inputs: Input passed to astream_events
+        fallback: Answer used when no final message is produced
+        config: Optional runnable config
+        budget: Request budget; None runs unbounded
+        route: Route label of the agent metrics
+        chat_model: Model (without tools) that writes the partial answer of a stopped run
+    """
+    strippers: Dict[str, ThinkingStripper] = {}
+    final_text = ""
+    queue: asyncio.Queue = asyncio.Queue()
+    end_of_stream = object()
+    # Step and tool-call limits apply to agents, whose input is their state
+    agent_budget = budget if isinstance(inputs, dict) else None
+    messages: List[BaseMessage] = list(inputs.get("messages", [])) if agent_budget else []
+    stop_reason: Optional[str] = None
+    run_config = {**(config or {}), "recursion_limit": budget.recursion_limit} if agent_budget else config
+
+    async def pump():
+        nonlocal stop_reason
+        try:
+            # aclosing() closes the event stream inside this task, so the run unwinds here
+            async with budget.guard() if budget else nullcontext():
+                try:
+                    async with _agent_deadline(agent_budget):
+                        async with aclosing(runnable.astream_events(inputs, version="v2", config=run_config)) as events:
+                            async for event in events:
+                                queue.put_nowait(event)
+                                if agent_budget and event["event"] == "on_chain_stream" and not event.get("parent_ids"):
+                                    # The graph's update after each step, checked before the next step starts
+                                    for update in event["data"]["chunk"].values():
+                                        messages.extend((update or {}).get("messages", []))
+                                    stop_reason = agent_budget.exceeded(messages)
+                                    if stop_reason:
+                                        break
+                except TimeoutError:
+                    if not agent_budget:
+                        raise
+                    stop_reason = "deadline"
+                except GraphRecursionError:
+                    if not agent_budget:
+                        raise
+                    stop_reason = "steps"
+        finally:
+            queue.put_nowait(end_of_stream)
+
+    task = asyncio.create_task(pump())
+    try:
+        while (event := await queue.get()) is not end_of_stream:
+            kind = event["event"]
+            if kind == "on_chat_model_stream":
+                stripper = strippers.setdefault(event["run_id"], ThinkingStripper())
+                text = stripper.feed(_message_text(event["data"]["chunk"]))
+                if text:
+                    yield {"event": "token", "data": {"text": text}}
+            elif kind == "on_chat_model_end":
+                stripper = strippers.pop(event["run_id"], None)
+                text = stripper.flush() if stripper else ""
+                if text:
+                    yield {"event": "token", "data": {"text": text}}
+                output = event["data"].get("output")
+                if output is not None and not getattr(output, "tool_calls", None):
+                    final_text = strip_thinking(_message_text(output)) or final_text
+            elif kind == "on_tool_start":
+                yield {"event": "tool_start", "data": {"name": event["name"], "input": event["data"].get("input")}}
+            elif kind == "on_tool_end":
+                yield {"event": "tool_end", "data": {"name": event["name"]}}
+        # Re-raise any error from the agent run
+        await task
+    finally:
+        if not task.done():
+            await _stop(task)
+
+    if agent_budget:
+        _, answer = await conclude_run(runnable, messages, route, stop_reason, config, agent_budget, chat_model)
+        if answer is not None:
+            final_text = answer.content
+    yield {"event": "done", "data": {"response": final_text or fallback}}
+
+
+def format_sse(event: dict) -> str:
+    """Serialize an event as a Server-Sent Events frame"""
+    data = json.dumps(event.get("data", {}), ensure_ascii=False, default=str)
+    return f"event: {event['event']}\ndata: {data}\n\n"
@@ -0,0 +1,288 @@
+"""
+Columnar in-memory tables over the spreadsheet data sources (.xlsx / .csv)
+
+List, count and filter questions ("〇〇のレコードのリスト", "何枚ある?") need every
+matching row, which top-k vector retrieval cannot give. The knowledge base
+agent answers them with the query_table tool over these tables instead.
+"""
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+from data_sources import TABLE_EXTENSIONS, read_table, source_files
+
+logger = logging.getLogger(__name__)
+
+# Questions that need whole-table answers rather than the top retrieved chunks
+TABLE_QUESTION_PATTERN = re.compile(
+    r"一覧|リスト|全部|すべて|全て|何枚|何件|何曲|何人|いくつ|件数|枚数|合計|平均|最大|最小|"
+    r"ランキング|順に|多い順|少ない順|\blist\b|\bcount\b|how many|\ball\b",
+    re.IGNORECASE
+)
+
+FILTER_OPS = ("eq", "ne", "contains", "startswith", "gt", "ge", "lt", "le")
+AGGREGATES = ("rows", "count", "distinct", "sum", "avg", "min", "max")
+
+
+def fold(value: str) -> str:
+    """Normalise a value for matching: NFKC, case folding and collapsed whitespace"""
+    return " ".join(unicodedata.normalize("NFKC", value).casefold().split())
+
+
+def _number(value: str) -> float:
+    try:
+        return float(value.replace(",", ""))
+    except ValueError:
+        return float("nan")
+
+
+class TableFilter(BaseModel):
+    """One condition of a query_table call"""
+
+    column: str = Field(description="列名")
+    op: str = Field(default="eq", description="eq, ne, contains, startswith, gt, ge, lt, le のいずれか")
+    value: str = Field(description="比較する値（大文字・小文字、全角・半角は区別しない）")
+
+
+class TableQuery(BaseModel):
+    """Arguments of the query_table tool"""
+
+    table: str = Field(description="テーブル名")
+    filters: List[TableFilter] = Field(default_factory=list, description="すべてを満たす行に絞り込む条件")
+    aggregate: str = Field(
+        default="rows",
+        description="rows（行を返す）, count（件数）, distinct（column の値ごとの件数）, sum, avg, min, max（column の数値集計）"
+    )
+    column: str = Field(default="", description="distinct / sum / avg / min / max の対象列")
+    columns: List[str] = Field(default_factory=list, description="rows で返す列（省略時はすべて）")
+    limit: int = Field(default=50, description="rows / distinct で返す最大件数")
+
+
+class Table:
+    """
+    One sheet as NumPy column arrays
+
+    Each column is kept as display strings, as folded strings for matching and
+    as floats (NaN where the cell is not a number). Equality lookups use a
+    per-column hash index from folded value to row numbers, built on first use.
+    """
+
+    def __init__(self, name: str, source: str, header: List[str], rows: List[List[str]]):
+        self.name = name
+        self.source = source
+        self.columns: List[str] = []
+        for i, column in enumerate(header):
+            column = column or f"列{i + 1}"
+            while column in self.columns:
+                column += "_"
+            self.columns.append(column)
+        width = len(self.columns)
+        padded = [row[:width] + [""] * (width - len(row)) for row in rows]
+        self.row_count = len(padded)
+        self.values: Dict[str, np.ndarray] = {}
+        self.folded: Dict[str, np.ndarray] = {}
+        self.numbers: Dict[str, np.ndarray] = {}
+        for i, column in enumerate(self.columns):
+            cells = [row[i] for row in padded]
+            self.values[column] = np.array(cells, dtype=object)
+            self.folded[column] = np.array([fold(cell) for cell in cells], dtype=str)
+            self.numbers[column] = np.array([_number(cell) for cell in cells], dtype=np.float64)
+        self._indexes: Dict[str, Dict[str, np.ndarray]] = {}
+
+    def column(self, name: str) -> str:
+        """Resolve a column name given by the model (case and width insensitive)"""
+        if name in self.values:
+            return name
+        for column in self.columns:
+            if fold(column) == fold(name):
+                return column
+        raise KeyError(f"列 {name!r} はありません。列: {', '.join(self.columns)}")
+
+    def index(self, column: str) -> Dict[str, np.ndarray]:
+        """Folded value -> row numbers of column"""
+        if column not in self._indexes:
+            positions: Dict[str, List[int]] = {}
+            for row, value in enumerate(self.folded[column]):
+                positions.setdefault(str(value), []).append(row)
+            self._indexes[column] = {value: np.array(rows, dtype=np.int64) for value, rows in positions.items()}
+        return self._indexes[column]
+
+    def mask(self, condition: TableFilter) -> np.ndarray:
+        """Boolean row mask for one filter"""
+        column = self.column(condition.column)
+        op = condition.op if condition.op in FILTER_OPS else "eq"
+        value = fold(str(condition.value))
+        if op in ("eq", "ne"):
+            mask = np.zeros(self.row_count, dtype=bool)
+            mask[self.index(column).get(value, np.array([], dtype=np.int64))] = True
+            return mask if op == "eq" else ~mask
+        if op == "contains":
+            return np.char.find(self.folded[column], value) >= 0
+        if op == "startswith":
+            return np.char.startswith(self.folded[column], value)
+        number = _number(value)
+        if np.isnan(number):
+            raise ValueError(f"{op} には数値を指定してください: {condition.value!r}")
+        numbers = self.numbers[column]
+        with np.errstate(invalid="ignore"):
+            return {"gt": numbers > number, "ge": numbers >= number, "lt": numbers < number, "le": numbers <= number}[op]
+
+    def query(self, request: TableQuery) -> Dict[str, Any]:
+        """Filter the rows and aggregate them as requested"""
+        mask = np.ones(self.row_count, dtype=bool)
+        for condition in request.filters:
+            mask &= self.mask(condition)
+        rows = np.flatnonzero(mask)
+        result: Dict[str, Any] = {"table": self.name, "source": self.source, "matched": int(len(rows))}
+        aggregate = request.aggregate if request.aggregate in AGGREGATES else "rows"
+        limit = max(1, request.limit)
+        if aggregate == "count":
+            return result
+        if aggregate == "rows":
+            columns = [self.column(name) for name in request.columns] or self.columns
+            result["rows"] = [{column: self.values[column][row] for column in columns} for row in rows[:limit]]
+            result["truncated"] = bool(len(rows) > limit)
+            return result
+        column = self.column(request.column)
+        if aggregate == "distinct":
+            values, counts = np.unique(self.values[column][rows].astype(str), return_counts=True)
+            order = np.argsort(-counts, kind="stable")
+            result["values"] = [{"value": str(values[i]), "count": int(counts[i])} for i in order[:limit]]
+            result["truncated"] = bool(len(values) > limit)
+            return result
+        numbers = self.numbers[column][rows]
+        numbers = numbers[~np.isnan(numbers)]
+        result["column"] = column
+        result["numeric_rows"] = int(len(numbers))
+        if len(numbers):
+            value = {"sum": np.sum, "avg": np.mean, "min": np.min, "max": np.max}[aggregate](numbers)
+            result[aggregate] = round(float(value), 6)
+        return result
+
+
+class TableStore:
+    """
+    Tables of every .xlsx / .csv file under a data-source directory
+
+    Files are checked for changes (size and modification time) at most every
+    reload_interval seconds; only changed files are read again, and tables of
+    deleted files are dropped. refresh() reads files, so the app calls it on a
+    worker thread; it swaps in the new tables at once for readers on other threads.
+    """
+
+    def __init__(self, source_dir: str, reload_interval: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.source_dir = source_dir
+        self.reload_interval = reload_interval if reload_interval is not None else float(
+            os.getenv("KB_TABLE_RELOAD_INTERVAL", "5"))
+        self.clock = clock
+        self.tables: Dict[str, Table] = {}
+        # source path -> ((size, mtime), table names)
+        self._files: Dict[str, Tuple[Tuple[int, int], List[str]]] = {}
+        self._checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.version = 0
+        self.counters = {"reloaded_files": 0, "queries": 0}
+
+    def due(self) -> bool:
+        """Whether the next refresh() checks the files (reload_interval has passed)"""
+        return self._checked_at is None or self.clock() - self._checked_at >= self.reload_interval
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Reload changed files
+
+        Returns:
+            True if any table was added, replaced or removed
+        """
+        with self._lock:
+            if not force and not self.due():
+                return False
+            self._checked_at = self.clock()
+            changed = False
+            current = {}
+            for path in source_files(self.source_dir):
+                if path.lower().endswith(TABLE_EXTENSIONS):
+                    stat = os.stat(path)
+                    current[path] = (stat.st_size, stat.st_mtime_ns)
+            tables = dict(self.tables)
+            for path in [path for path in self._files if path not in current]:
+                for name in self._files.pop(path)[1]:
+                    tables.pop(name, None)
+                changed = True
+            for path, signature in current.items():
+                known = self._files.get(path)
+                if known is not None and known[0] == signature:
+                    continue
+                for name in known[1] if known else []:
+                    tables.pop(name, None)
+                self._files[path] = (signature, self._load(path, tables))
+                self.counters["reloaded_files"] += 1
+                changed = True
+            if changed:
+                self.tables = tables
+                self.version += 1
+                logger.info(f"Loaded {len(self.tables)} tables from {self.source_dir}")
+            return changed
+
+    def _load(self, path: str, tables: Dict[str, Table]) -> List[str]:
+        source = os.path.relpath(path, self.source_dir).replace(os.sep, "/")
+        names = []
+        try:
+            sheets = read_table(path)
+        except Exception as e:
+            logger.warning(f"Skipping unreadable table file {path}: {e}")
+            return names
+        for sheet, rows in sheets.items():
+            if len(rows) < 2:
+                continue
+            name = sheet if sheet not in tables else f"{os.path.splitext(source)[0]}/{sheet}"
+            tables[name] = Table(name, source, rows[0], rows[1:])
+            names.append(name)
+        return names
+
+    def get(self, name: str) -> Table:
+        """Find a table by name (case and width insensitive)"""
+        if name in self.tables:
+            return self.tables[name]
+        for table_name, table in self.tables.items():
+            if fold(table_name) == fold(name):
+                return table
+        raise KeyError(f"テーブル {name!r} はありません。テーブル: {', '.join(self.tables)}")
+
+    def query(self, request: TableQuery) -> Dict[str, Any]:
+        """Run a query against the current tables (reloading changed files first)"""
+        self.refresh()
+        self.counters["queries"] += 1
+        return self.get(request.table).query(request)
+
+    def describe(self, samples: int = 3) -> str:
+        """Table names, columns and sample values for the query_table tool description"""
+        self.refresh()
+        lines = []
+        for table in self.tables.values():
+            columns = []
+            for column in table.columns:
+                values = [str(v) for v in dict.fromkeys(table.values[column][:samples * 2]) if v][:samples]
+                columns.append(f"{column}（例: {', '.join(values)}）" if values else column)
+            lines.append(f"- {table.name}（{table.source}、{table.row_count}行）: {' / '.join(columns)}")
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        return {
+            "tables": {name: table.row_count for name, table in self.tables.items()},
+            "version": self.version,
+            **self.counters,
+        }
+
+
+def is_table_question(query: str) -> bool:
+    """Whether a question asks for a list, count or aggregate rather than a passage"""
+    return bool(TABLE_QUESTION_PATTERN.search(query))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Simple test script for the Asana MCP integration, run against the local fake MCP server
+"""
+import asyncio
+import os
+import signal
+import sys
+import time
+
+# Fast health probes so that crashes are detected within the test
+os.environ.setdefault("ASANA_MCP_PROBE_INTERVAL", "0.5")
+
+import anyio
+from langchain_core.tools import StructuredTool, ToolException
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, INVALID_PARAMS, ErrorData
+
+from asana_mcp import AsanaMCPClient
+from mcp_pool import is_transport_failure
+from tool_cache import ToolResultCache
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_mcp_server.py")
+
+
+def fake_asana_client(pool_size: int = 3) -> AsanaMCPClient:
+    """AsanaMCPClient that starts fake_mcp_server.py instead of npx"""
+    return AsanaMCPClient(access_token="fake-token", command=sys.executable, args=[FAKE_SERVER], pool_size=pool_size)
+
+
+def report(name: str, passed: bool):
+    print(f"{'✅' if passed else '❌'} {name}")
+
+
+async def wait_until(predicate, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def test_mcp_pool():
+    """Test pre-warmed pool dispatch, restart after a crash and graceful drain"""
+    print("=== Asana MCP Server Pool Test ===")
+    client = fake_asana_client()
+    start = time.perf_counter()
+    tools = await client.initialize()
+    print(f"Pool of {client.pool.size} servers ready in {time.perf_counter() - start:.2f}s")
+    report("tools are listed from the pool", "asana_list_workspaces" in [tool.name for tool in tools])
+    report("/health reports every server as ready", client.status()["ready"] == 3)
+
+    # Concurrent calls spread over the least busy servers
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client.pool.call_tool("fake_sleep", {"seconds": 0.3}) for _ in range(9)))
+    elapsed = time.perf_counter() - start
+    report(f"9 concurrent calls complete in {elapsed:.2f}s", len(results) == 9 and elapsed < 9 * 0.3 / 2)
+    report("calls are dispatched to every server", all(member.calls > 0 for member in client.pool.members))
+
+    # Kill one server; it must be detected and restarted
+    victim = client.pool.members[0]
+    pid = int((await victim.call_tool("fake_get_pid", {})).content[0].text)
+    os.kill(pid, signal.SIGKILL)
+    detected = await wait_until(lambda: victim.restarts > 0)
+    report("crashed server is detected", detected)
+    recovered = await wait_until(lambda: victim.healthy)
+    report(f"crashed server is restarted ({victim.status()})", recovered)
+    workspaces = await client.pool.call_tool("asana_list_workspaces", {})
+    report("pool keeps serving after the restart", "Yapodu" in workspaces)
+
+    # A slow call or a server error fails the call, not the process
+    member = client.pool.members[1]
+    restarts, member.call_timeout = member.restarts, 0.2
+    try:
+        await member.call_tool("fake_sleep", {"seconds": 1.0})
+        timed_out = False
+    except ToolException:
+        timed_out = True
+    member.call_timeout = client.pool.call_timeout
+    # Let the abandoned call finish on the server before the pool is closed
+    await asyncio.sleep(1.0)
+    report("a timed-out call raises ToolException without restarting the server",
+           timed_out and member.healthy and member.restarts == restarts)
+    server_error = McpError(ErrorData(code=INVALID_PARAMS, message="Invalid params"))
+    closed = McpError(ErrorData(code=CONNECTION_CLOSED, message="Connection closed"))
+    report("only transport failures restart a server", not is_transport_failure(server_error)
+           and is_transport_failure(closed) and is_transport_failure(anyio.ClosedResourceError()))
+
+    # Graceful drain: in-flight calls finish, new calls are rejected
+    in_flight = asyncio.create_task(client.pool.call_tool("fake_sleep", {"seconds": 0.5}))
+    await asyncio.sleep(0.1)
+    await client.close()
+    report("in-flight call completes during drain", in_flight.done() and not in_flight.exception())
+    try:
+        await client.pool.call_tool("asana_list_workspaces", {})
+        report("calls are rejected after close", False)
+    except Exception:
+        report("calls are rejected after close", True)
+    report("/health reports the pool as disconnected", not client.status()["connected"])
+
+
+async def test_tool_cache():
+    """Test caching, request coalescing and invalidation of read-only tool calls"""
+    print("\n=== Asana MCP Tool Cache Test ===")
+    client = AsanaMCPClient(
+        access_token="fake-token", command=sys.executable, args=[FAKE_SERVER, "--latency", "0.2"], pool_size=2
+    )
+    tools = {tool.name: tool for tool in await client.initialize()}
+    cache = client.tool_cache
+    upstream_calls = lambda: sum(member.calls for member in client.pool.members)
+    report("read tools are classified as read-only",
+           tools["asana_search_tasks"].metadata["cache_classification"] == "read_only")
+    report("write tools are classified as mutating",
+           tools["asana_create_task"].metadata["cache_classification"] == "mutating")
+
+    # A repeated read is served from the cache
+    await tools["asana_list_workspaces"].ainvoke({})
+    before = upstream_calls()
+    start = time.perf_counter()
+    await tools["asana_list_workspaces"].ainvoke({})
+    report(f"repeated read is a cache hit ({(time.perf_counter() - start) * 1000:.1f}ms)",
+           upstream_calls() == before and cache.counters["hits"] == 1)
+
+    # Identical concurrent reads share one upstream call
+    before = upstream_calls()
+    results = await asyncio.gather(*(
+        tools["asana_search_tasks"].ainvoke({"workspace": "1001", "text": "資料"}) for _ in range(5)
+    ))
+    report("5 identical concurrent reads make 1 upstream call",
+           upstream_calls() - before == 1 and cache.counters["coalesced"] == 4 and len(set(results)) == 1)
+
+    # A write is never cached and invalidates reads of the same entity
+    await tools["asana_create_task"].ainvoke({"project_id": "2001", "name": "追加の資料作成"})
+    await tools["asana_create_task"].ainvoke({"project_id": "2001", "name": "追加の資料作成"})
+    report("writes always reach the server", cache.counters["mutations"] == 2)
+    after = await tools["asana_search_tasks"].ainvoke({"workspace": "1001", "text": "資料"})
+    report("write invalidates cached task searches", "追加の資料作成" in after)
+    report("write keeps unrelated reads cached",
+           any(key[0] == "asana_list_workspaces" for key in cache._entries))
+    print(f"Cache stats: {client.status()['tool_cache']}")
+    await client.close()
+
+    # TTL expiry with an injected clock
+    now = [0.0]
+    calls = []
+
+    async def read(**arguments):
+        calls.append(arguments)
+        return "result"
+
+    ttl_cache = ToolResultCache(default_ttl=10, clock=lambda: now[0])
+    tool = ttl_cache.wrap([StructuredTool.from_function(coroutine=read, name="asana_get_task", description="get")])[0]
+    await tool.ainvoke({})
+    now[0] = 9
+    await tool.ainvoke({})
+    now[0] = 11
+    await tool.ainvoke({})
+    report("entries expire after their TTL", len(calls) == 2)
+
+
+async def main():
+    """Run all tests"""
+    await test_mcp_pool()
+    await test_tool_cache()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,6 +5,8 @@ Simple test script for Knowledge Base functionality
 import asyncio
 import os
 from knowledge_base import is_knowledge_base_query, KnowledgeBaseClient
+from retrieval_cache import InMemoryCacheBackend, RedisCacheBackend, RetrievalCache
+from fakes import FakeRedis, FakeRetriever
 from langchain_aws import ChatBedrock
 
 async def test_kb_detection():
@@ -57,10 +59,55 @@ async def test_kb_client():
         print(f"❌ Error: {e}")
 
 
+async def test_retrieval_cache():
+    """Test retrieval cache eviction and invalidation (no AWS access required)"""
+    print("\n=== Retrieval Cache Test ===")
+    
+    now = [0.0]
+    backend = InMemoryCacheBackend(max_entries=2, ttl=10, clock=lambda: now[0])
+    cache = RetrievalCache(backend=backend, retrieval_config={"numberOfResults": 5})
+    documents = FakeRetriever().invoke("レコード")
+    
+    cache.set("Vinyl レコード", documents)
+    checks = [("normalized query hits", cache.get("  ｖｉｎｙｌ   レコード ") is not None)]
+    cache.set("マニュアル", documents)
+    cache.set("規程", documents)
+    checks.append(("LRU evicts oldest entry", cache.get("Vinyl レコード") is None))
+    now[0] = 11.0
+    checks.append(("TTL expires entries", cache.get("規程") is None))
+    
+    other_config = RetrievalCache(backend=backend, retrieval_config={"numberOfResults": 10})
+    cache.set("マニュアル", documents)
+    checks.append(("retrieval_config is part of the key", other_config.get("マニュアル") is None))
+    
+    shared = RetrievalCache(backend=RedisCacheBackend(FakeRedis()))
+    shared.set("レコード", documents)
+    restored = shared.get("レコード") or []
+    checks.append(("shared backend round-trips documents", [d.page_content for d in restored] == [d.page_content for d in documents]))
+    shared.invalidate()
+    checks.append(("invalidate clears the shared backend", shared.get("レコード") is None))
+    
+    kb_client = KnowledgeBaseClient(knowledge_base_id="FAKEKB")
+    retriever = FakeRetriever()
+    kb_client.initialize(retriever=retriever)
+    await kb_client.aretrieve("社内マニュアル")
+    await kb_client.aretrieve("社内マニュアル ")
+    checks.append(("client serves repeated queries from cache", retriever.calls == 1))
+    kb_client.invalidate_cache()
+    await kb_client.aretrieve("社内マニュアル")
+    checks.append(("client retrieves again after invalidation", retriever.calls == 2))
+    kb_client.close()
+    
+    for name, passed in checks:
+        print(f"{'✅' if passed else '❌'} {name}")
+    print(f"Stats: {cache.stats()}")
+
+
 async def main():
     """Run all tests"""
     await test_kb_detection()
     await test_kb_client()
+    await test_retrieval_cache()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,235 @@
+"""
+Result cache and request coalescing for read-only Asana MCP tool calls
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.tools import BaseTool, StructuredTool
+
+from shared_state import get_store
+
+logger = logging.getLogger(__name__)
+
+READ_ONLY_PATTERN = re.compile(r"^asana_(list|get|search)_")
+MUTATING_PATTERN = re.compile(r"create|update|delete|add|remove|set_")
+
+# Entity words shared by reads and writes; a write invalidates reads that mention the same entity
+ENTITY_WORDS = ("task", "project", "workspace", "tag", "story", "stories", "status", "section", "dependen")
+
+# Workspaces and projects change rarely and are fetched on almost every question
+DEFAULT_TTLS = {
+    "asana_list_workspaces": 300,
+    "asana_search_projects": 120,
+}
+
+
+def classify_tool(tool: BaseTool) -> str:
+    """
+    Classify a tool as "read_only" or "mutating"
+
+    MCP readOnlyHint annotations win when present; otherwise the tool name decides.
+    Unknown tools are treated as mutating so they are never cached.
+    """
+    hints = tool.metadata or {}
+    if hints.get("readOnlyHint") is True:
+        return "read_only"
+    if hints.get("readOnlyHint") is False or hints.get("destructiveHint") is True:
+        return "mutating"
+    if READ_ONLY_PATTERN.match(tool.name) and not MUTATING_PATTERN.search(tool.name):
+        return "read_only"
+    return "mutating"
+
+
+def _entities(tool_name: str) -> set:
+    return {word for word in ENTITY_WORDS if word in tool_name}
+
+
+class ToolResultCache:
+    """
+    Wraps MCP tools so read-only results are cached and identical concurrent calls share one request
+
+    Mutating tools always reach the server and drop cached reads of the entities they touch
+    (for example asana_create_task invalidates asana_search_tasks and asana_get_task).
+
+    With a shared store (several workers on one host), results are also stored
+    there: a local miss is looked up in the store before calling the tool, and
+    invalidations remove the other workers' stored reads too. A write in any
+    worker bumps the store's generation, which makes every worker drop its
+    local entries and read them from the store again. Coalescing stays per process.
+    """
+
+    SHARED_NAMESPACE = "asana-tools"
+
+    def __init__(self, default_ttl: Optional[float] = None, ttls: Optional[Dict[str, float]] = None,
+                 max_entries: int = 1024, clock: Callable[[], float] = time.monotonic, shared=None):
+        self.default_ttl = default_ttl if default_ttl is not None else float(os.getenv("ASANA_TOOL_CACHE_TTL", "30"))
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self._in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.shared = shared if shared is not None else get_store()
+        self._shared_generation = None
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "coalesced": 0, "mutations": 0,
+                         "invalidated": 0, "errors": 0}
+
+    @staticmethod
+    def _key(tool_name: str, arguments: Dict[str, Any]) -> Tuple[str, str]:
+        return tool_name, json.dumps(arguments, sort_keys=True, ensure_ascii=False, default=str)
+
+    async def call_read_only(self, tool: BaseTool, arguments: Dict[str, Any]):
+        """Return a cached result, join an identical in-flight call, or call the tool"""
+        key = self._key(tool.name, arguments)
+        self._check_generation()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, result = entry
+            if expires_at > self.clock():
+                self.counters["hits"] += 1
+                return result
+            del self._entries[key]
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.counters["coalesced"] += 1
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+                # The call we joined was cancelled by its own caller; make our own
+                return await self.call_read_only(tool, arguments)
+
+        shared = self._shared_get(key)
+        if shared is not None:
+            result, ttl = shared
+            self.counters["shared_hits"] += 1
+            self._store_local(key, result, ttl)
+            return result
+
+        self.counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await tool.ainvoke(arguments)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.counters["errors"] += 1
+            future.set_exception(e)
+            # Avoid "exception was never retrieved" when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+        future.set_result(result)
+        ttl = self.ttls.get(tool.name, self.default_ttl)
+        self._store_local(key, result, ttl)
+        self._shared_set(key, result, ttl)
+        return result
+
+    def _store_local(self, key: Tuple[str, str], result: Any, ttl: float):
+        if len(self._entries) >= self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (self.clock() + ttl, result)
+
+    def _check_generation(self):
+        """Drop local entries when a worker invalidated reads since the last call"""
+        if self.shared is None:
+            return
+        try:
+            generation = self.shared.generation(self.SHARED_NAMESPACE)
+        except Exception as e:
+            logger.warning(f"Shared tool cache generation check failed: {e}")
+            return
+        if generation != self._shared_generation:
+            if self._shared_generation is not None:
+                self._entries.clear()
+            self._shared_generation = generation
+
+    def _shared_get(self, key: Tuple[str, str]) -> Optional[Tuple[Any, float]]:
+        if self.shared is None:
+            return None
+        try:
+            return self.shared.get(self.SHARED_NAMESPACE, "\n".join(key))
+        except Exception as e:
+            logger.warning(f"Shared tool cache lookup failed: {e}")
+            return None
+
+    def _shared_set(self, key: Tuple[str, str], result: Any, ttl: float):
+        # Only text results (what the MCP server returned) are shared; other types would not round-trip
+        if self.shared is None or not isinstance(result, str):
+            return
+        try:
+            self.shared.set(self.SHARED_NAMESPACE, "\n".join(key), result, ttl, tag=key[0], max_entries=self.max_entries)
+        except Exception as e:
+            logger.warning(f"Shared tool cache store failed: {e}")
+
+    async def call_mutating(self, tool: BaseTool, arguments: Dict[str, Any]):
+        """Call a mutating tool and invalidate cached reads of the same entities"""
+        self.counters["mutations"] += 1
+        try:
+            return await tool.ainvoke(arguments)
+        finally:
+            self.invalidate_related(tool.name)
+
+    def invalidate_related(self, tool_name: str):
+        entities = _entities(tool_name)
+        stale = [key for key in self._entries if entities & _entities(key[0])]
+        for key in stale:
+            del self._entries[key]
+        self.counters["invalidated"] += len(stale)
+        if self.shared is not None:
+            try:
+                tags = [tag for tag in self.shared.tags(self.SHARED_NAMESPACE) if entities & _entities(tag)]
+                self.counters["invalidated"] += self.shared.delete_tags(self.SHARED_NAMESPACE, tags)
+                # Our own entries were invalidated above already
+                self._shared_generation = self.shared.generation(self.SHARED_NAMESPACE)
+            except Exception as e:
+                logger.warning(f"Shared tool cache invalidation failed: {e}")
+
+    def clear(self):
+        self._entries.clear()
+        if self.shared is not None:
+            self.shared.clear(self.SHARED_NAMESPACE)
+
+    def wrap(self, tools: List[BaseTool]) -> List[BaseTool]:
+        """
+        Wrap tools with caching (read-only) or invalidation (mutating)
+
+        Args:
+            tools: Tools returned by the MCP client
+
+        Returns:
+            Tools with the same names, descriptions and schemas
+        """
+        def build(tool: BaseTool) -> BaseTool:
+            kind = classify_tool(tool)
+            handler = self.call_read_only if kind == "read_only" else self.call_mutating
+
+            async def call(**arguments):
+                return await handler(tool, arguments)
+
+            return StructuredTool(
+                name=tool.name,
+                description=tool.description,
+                args_schema=tool.args_schema,
+                coroutine=call,
+                metadata={**(tool.metadata or {}), "cache_classification": kind},
+            )
+
+        wrapped = [build(tool) for tool in tools]
+        read_only = [tool.name for tool in wrapped if tool.metadata["cache_classification"] == "read_only"]
+        logger.info(f"Caching {len(read_only)} read-only Asana tools: {read_only}")
+        return wrapped
+
+    def stats(self) -> dict:
+        """Return cache counters for health reporting"""
+        return {"entries": len(self._entries), "in_flight": len(self._in_flight), **self.counters}
@@ -0,0 +1,82 @@
+"""
+Per-query Asana tool subsets
+
+The Asana MCP server exposes dozens of tools, and every model step of the agent
+sends all of their JSON schemas. Most questions need a handful of them, so the
+tools are grouped by what they do and only the groups the question asks about
+are bound (plus the workspace / project discovery tools every query needs).
+"""
+import os
+import re
+import json
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from knowledge_base import estimate_tokens
+
+# Group -> (question keywords, tool name pattern). Discovery tools (and task
+# search, which the system prompt lists) are always bound.
+TOOL_GROUPS = {
+    "discovery": (None, re.compile(r"list_workspaces|search_projects|get_project$|search_tasks")),
+    "task_read": (
+        re.compile(r"タスク|task|締切|締め切り|期限|期日|担当|今日|今週|来週|遅れ|未完了|残って|検索|探して|due", re.IGNORECASE),
+        re.compile(r"search_tasks|get_task|get_multiple_tasks|get_tasks_for|get_stories"),
+    ),
+    "task_write": (
+        re.compile(r"作成|追加|登録|更新|変更|完了に|完了して|割り当て|アサイン|コメント|依存|サブタスク|"
+                   r"create|add|update|assign|comment|close", re.IGNORECASE),
+        re.compile(r"search_tasks|get_task$|create_task|update_task|create_subtask|add_task_|set_parent|add_followers"),
+    ),
+    "project": (
+        re.compile(r"プロジェクト|project|進捗|ステータス|status|セクション|section|マイルストーン|件数", re.IGNORECASE),
+        re.compile(r"project"),
+    ),
+    "tags": (
+        re.compile(r"タグ|ラベル|tag", re.IGNORECASE),
+        re.compile(r"tag"),
+    ),
+}
+
+
+class ToolSelection(NamedTuple):
+    """Tools bound for one query"""
+    tools: List[Any]
+    # Matched groups, or None when every tool is bound
+    groups: Optional[Tuple[str, ...]]
+
+
+def tool_selection_enabled() -> bool:
+    return os.getenv("ASANA_TOOL_SELECTION_ENABLED", "true").lower() == "true"
+
+
+def schema_tokens(tools: List[Any]) -> int:
+    """Estimated tokens of the tools' names, descriptions and argument schemas as sent to the model"""
+    total = 0
+    for tool in tools:
+        try:
+            schema = convert_to_openai_tool(tool)
+        except Exception:
+            schema = {"name": getattr(tool, "name", ""), "description": getattr(tool, "description", "")}
+        total += estimate_tokens(json.dumps(schema, ensure_ascii=False))
+    return total
+
+
+def select_tools(tools: List[Any], query: str) -> ToolSelection:
+    """
+    Choose the tools to bind for a query
+
+    Args:
+        tools: Every Asana tool, in the order the server lists them
+        query: User's question
+
+    Returns:
+        ToolSelection; all tools when no group beyond discovery matches
+    """
+    groups = tuple(name for name, (keywords, _) in TOOL_GROUPS.items() if keywords is None or keywords.search(query))
+    if groups == ("discovery",):
+        return ToolSelection(tools, None)
+    patterns = [TOOL_GROUPS[name][1] for name in groups]
+    # Keep the server's order so the same groups always produce the same prompt prefix
+    selected = [tool for tool in tools if any(pattern.search(tool.name) for pattern in patterns)]
+    return ToolSelection(selected, groups)
@@ -0,0 +1,77 @@
+"""
+Traffic trace recording for offline replay (benchmark.py replay)
+
+When TRACE_RECORD_PATH is set, every /generate and /generate/stream request is
+appended to that file as one JSON line. Prompts may contain personal
+information, so only the route and prompt length are recorded unless
+TRACE_RECORD_PROMPTS=true; replay then substitutes a prompt of the same route.
+"""
+import os
+import json
+import time
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TraceRecorder:
+    """Appends one JSON line per request, with its offset from the first recorded request"""
+
+    def __init__(self, path: str, record_prompts: bool = False):
+        self.path = path
+        self.record_prompts = record_prompts
+        self._start: Optional[float] = None
+        self.records = 0
+
+    def record(self, endpoint: str, prompt: str, route: str, status: int, latency: float,
+               session_id: Optional[str] = None):
+        """
+        Record one request
+
+        Args:
+            endpoint: "generate" or "stream"
+            prompt: User's query (stored only when record_prompts is set)
+            route: Route the request took
+            status: HTTP status code
+            latency: Seconds from receiving the request to the response (or end of stream)
+            session_id: Session ID, if any
+        """
+        now = time.time()
+        if self._start is None:
+            self._start = now - latency
+        entry = {
+            "offset": round(now - latency - self._start, 4),
+            "endpoint": endpoint,
+            "route": route,
+            "prompt_chars": len(prompt),
+            "status": status,
+            "latency": round(latency, 4),
+        }
+        if self.record_prompts:
+            entry["prompt"] = prompt
+        if session_id:
+            entry["session_id"] = session_id
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.records += 1
+        except OSError as e:
+            logger.warning(f"Failed to record trace entry: {e}")
+
+
+def create_trace_recorder() -> Optional[TraceRecorder]:
+    """Create a recorder when TRACE_RECORD_PATH is set"""
+    path = os.getenv("TRACE_RECORD_PATH")
+    if not path:
+        return None
+    record_prompts = os.getenv("TRACE_RECORD_PROMPTS", "false").lower() == "true"
+    logger.info(f"Recording request traces to {path} (prompts {'included' if record_prompts else 'omitted'})")
+    return TraceRecorder(path, record_prompts=record_prompts)
+
+
+def load_trace(path: str) -> List[dict]:
+    """Load a recorded trace ordered by offset"""
+    with open(path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda entry: entry.get("offset", 0))